@@ -1,3 +1,20 @@
-from .design_agent import design_agent, DesignAgent
+"""
+Agent 模块（导出名在首次访问时才导入对应子模块，见 services/__init__.py）
+"""
+from typing import TYPE_CHECKING
 
-__all__ = ["design_agent", "DesignAgent"]
+from utils.lazy_service import lazy_exports
+
+# 导出名 → 所在子模块
+lazy_exports(__name__, {
+    "design_agent": "design_agent",
+    "DesignAgent": "design_agent",
+    "job_manager": "job_manager",
+    "JobManager": "job_manager",
+    "JobQueueFullError": "job_manager",
+})
+
+
+if TYPE_CHECKING:
+    from .design_agent import design_agent, DesignAgent
+    from .job_manager import job_manager, JobManager, JobQueueFullError
@@ -0,0 +1,336 @@
+"""
+对话上下文预算管理
+控制每轮对话发送给模型的 token 数，长会话的延迟不随轮数增长
+
+设计理念：
+- 本地估算 token（中日韩字符按 1 token/字，其余按 4 字符/token），不额外请求接口
+- 最近 N 轮对话原样保留，超出预算时继续从最早的一轮开始舍弃（至少保留本轮）
+- 更早的对话滚动合并为一份摘要，缓存在会话中（随会话持久化），按覆盖的消息数和内容摘要校验
+- 摘要在后台异步刷新（每个会话同时只有一个刷新任务），本轮请求直接使用已有摘要，
+  尚未被摘要覆盖的少量消息以截断文本补入
+- 分析上下文块按分析结果缓存，每轮只注入一次；客户端回传的注入块会被剔除，避免重复
+
+核心方法：
+- build(): 构建本轮发送给模型的消息列表
+- new_messages(): 提取本轮新增的消息（写入会话历史）
+- metrics(): 运行指标
+"""
+import asyncio
+import hashlib
+import json
+import re
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from config import get_settings
+from models import ChatMessage, ImageAnalysis
+
+settings = get_settings()
+
+CONTEXT_MARKER = "[当前设计上下文]"
+SUMMARY_MARKER = "[对话摘要]"
+
+# 单条消息的固定开销（角色、分隔符）
+_MESSAGE_OVERHEAD = 4
+# 未被摘要覆盖的消息，每条最多保留的字符数
+_GAP_MESSAGE_CHARS = 200
+# 送入摘要的单条消息最多字符数
+_SUMMARY_MESSAGE_CHARS = 1000
+# 上下文块缓存条数
+_CONTEXT_CACHE_SIZE = 128
+
+_CJK = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+
+SUMMARY_SYSTEM_PROMPT = """你是配饰设计对话的记录员。请把对话整理为简洁的中文摘要，供设计师在后续对话中参考。
+
+要求：
+- 保留用户确定的需求和偏好（品类、元素、材料、颜色、风格、预算、尺寸）
+- 保留已经给出的设计方案要点和用户的反馈（采纳/否定的内容）
+- 保留尚未解决的问题
+- 不要寒暄，不要逐句复述，不超过 300 字"""
+
+
+def estimate_tokens(text: str) -> int:
+    """本地估算文本的 token 数"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_message_tokens(messages: List[ChatMessage]) -> int:
+    """估算消息列表的 token 数"""
+    return sum(estimate_tokens(m.content) + _MESSAGE_OVERHEAD for m in messages)
+
+
+def _digest(messages: List[ChatMessage]) -> str:
+    hasher = hashlib.sha256()
+    for message in messages:
+        hasher.update(message.role.encode("utf-8"))
+        hasher.update(b"\0")
+        hasher.update(message.content.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def _is_injected(message: ChatMessage) -> bool:
+    """是否为服务端注入的上下文块（客户端可能把它回传）"""
+    return message.role == "assistant" and message.content.startswith((CONTEXT_MARKER, SUMMARY_MARKER))
+
+
+def _split_turns(messages: List[ChatMessage]) -> List[List[ChatMessage]]:
+    """按轮切分：每轮从一条用户消息开始"""
+    turns: List[List[ChatMessage]] = []
+    for message in messages:
+        if not turns or (message.role == "user" and turns[-1][-1].role != "user"):
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def _transcript(messages: List[ChatMessage], limit: int) -> str:
+    roles = {"user": "用户", "assistant": "设计师"}
+    return "\n".join(f"{roles.get(m.role, m.role)}: {_clip(m.content, limit)}" for m in messages)
+
+
+class ChatHistoryManager:
+    """对话上下文预算管理器"""
+
+    def __init__(
+        self,
+        llm: Any,
+        sessions: Any,
+        token_budget: Optional[int] = None,
+        keep_turns: Optional[int] = None,
+        summary_max_tokens: Optional[int] = None,
+    ):
+        """
+        Args:
+            llm: 对话服务（需提供 chat(messages, system_prompt, max_tokens)）
+            sessions: 会话存储（摘要更新后调用 save() 持久化）
+            token_budget: 对话上下文（不含 System Prompt）的 token 预算
+            keep_turns: 原样保留的最近轮数
+            summary_max_tokens: 摘要的最大输出 token 数
+        """
+        self.llm = llm
+        self.sessions = sessions
+        self.token_budget = token_budget or settings.CHAT_HISTORY_TOKEN_BUDGET
+        self.keep_turns = keep_turns or settings.CHAT_KEEP_TURNS
+        self.summary_max_tokens = summary_max_tokens or settings.CHAT_SUMMARY_MAX_TOKENS
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._context_blocks: "OrderedDict[str, str]" = OrderedDict()
+        self._stats = {
+            "requests": 0, "compacted": 0, "dropped_messages": 0,
+            "summary_refreshes": 0, "summary_failures": 0,
+            "input_tokens": 0, "max_input_tokens": 0,
+        }
+
+    # ==================== 对话整理 ====================
+
+    @staticmethod
+    def conversation(session: Dict[str, Any], messages: List[ChatMessage]) -> List[ChatMessage]:
+        """
+        还原完整对话
+
+        客户端重发整段对话时直接使用；只发送本轮消息时拼接会话中的历史。
+        """
+        messages = [m for m in messages if not _is_injected(m)]
+        if session["history"] and not any(m.role == "assistant" for m in messages):
+            return [*session["history"], *messages]
+        return messages
+
+    @staticmethod
+    def new_messages(messages: List[ChatMessage]) -> List[ChatMessage]:
+        """本轮新增的消息（最后一条助手消息之后的部分）"""
+        messages = [m for m in messages if not _is_injected(m)]
+        for index in range(len(messages) - 1, -1, -1):
+            if messages[index].role == "assistant":
+                return messages[index + 1:]
+        return messages
+
+    def context_block(self, analysis: ImageAnalysis, selected_style: Optional[str] = None) -> str:
+        """分析上下文块（按分析结果缓存）"""
+        key = hashlib.sha256(
+            json.dumps([analysis.model_dump(), selected_style], ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        if key in self._context_blocks:
+            self._context_blocks.move_to_end(key)
+            return self._context_blocks[key]
+
+        primary_elements = ', '.join([e.type for e in analysis.elements.primary])
+        secondary_elements = ', '.join([f"{e.type}×{e.count}" if e.count else e.type for e in analysis.elements.secondary])
+        hardware = ', '.join([e.type for e in analysis.elements.hardware])
+        style_tags = ', '.join(analysis.style.tags) if analysis.style.tags else ""
+        mood = analysis.style.mood if analysis.style else ""
+
+        block = f"""{CONTEXT_MARKER}
+- 主体元素: {primary_elements or '无'}
+- 辅助元素: {secondary_elements or '无'}
+- 五金配件: {hardware or '无'}
+- 风格标签: {style_tags or '未识别'}
+- 整体氛围: {mood or '未知'}
+- 尺寸: 约{analysis.physicalSpecs.lengthCm}cm / {analysis.physicalSpecs.weightG}g"""
+        if selected_style:
+            block += f"\n- 用户选择风格: {selected_style}"
+
+        self._context_blocks[key] = block
+        if len(self._context_blocks) > _CONTEXT_CACHE_SIZE:
+            self._context_blocks.popitem(last=False)
+        return block
+
+    def build(
+        self,
+        session: Dict[str, Any],
+        messages: List[ChatMessage],
+        analysis: Optional[ImageAnalysis] = None,
+        selected_style: Optional[str] = None,
+    ) -> List[ChatMessage]:
+        """
+        构建本轮发送给模型的消息列表
+
+        Args:
+            session: 会话
+            messages: 客户端发送的消息
+            analysis: 当前设计的分析结果
+            selected_style: 用户选择的风格
+
+        Returns:
+            [上下文块（分析 + 摘要）] + 最近若干轮对话
+        """
+        conversation = self.conversation(session, messages)
+        context = self.context_block(analysis, selected_style) if analysis else ""
+
+        # 最近 N 轮原样保留，超出预算时从最早的一轮开始舍弃
+        turns = _split_turns(conversation)[-self.keep_turns:]
+        budget = self.token_budget - estimate_tokens(context)
+        while len(turns) > 1 and estimate_message_tokens([m for t in turns for m in t]) > budget:
+            turns.pop(0)
+        recent = [m for turn in turns for m in turn]
+        older = conversation[:len(conversation) - len(recent)]
+
+        # 更早的对话：已有摘要 + 尚未覆盖部分的截断文本
+        summary = self._valid_summary(session, conversation)
+        covered = min(summary["covered"], len(older)) if summary else 0
+        if covered < len(older):
+            self._schedule_refresh(session, older, summary)
+
+        sections = [context] if context else []
+        if older:
+            lines = [SUMMARY_MARKER]
+            if summary:
+                lines.append(summary["text"])
+            gap = older[covered:]
+            remaining = budget - estimate_message_tokens(recent) - estimate_tokens("\n".join(sections + lines))
+            gap_lines: List[str] = []
+            for message in reversed(gap):
+                line = _transcript([message], _GAP_MESSAGE_CHARS)
+                cost = estimate_tokens(line) + 1
+                if cost > remaining:
+                    break
+                gap_lines.insert(0, line)
+                remaining -= cost
+            if gap_lines:
+                lines.append("（近期对话）\n" + "\n".join(gap_lines))
+            self._stats["compacted"] += 1
+            self._stats["dropped_messages"] += len(gap) - len(gap_lines)
+            if len(lines) > 1:
+                sections.append("\n".join(lines))
+
+        result = [ChatMessage(role="assistant", content="\n\n".join(sections))] if sections else []
+        result.extend(recent)
+
+        tokens = estimate_message_tokens(result)
+        self._stats["requests"] += 1
+        self._stats["input_tokens"] += tokens
+        self._stats["max_input_tokens"] = max(self._stats["max_input_tokens"], tokens)
+        return result
+
+    # ==================== 摘要 ====================
+
+    @staticmethod
+    def _valid_summary(session: Dict[str, Any], conversation: List[ChatMessage]) -> Optional[Dict[str, Any]]:
+        """会话中的摘要（客户端对话与摘要覆盖的内容不一致时视为无效）"""
+        summary = session.get("summary")
+        if not summary or summary["covered"] > len(conversation):
+            return None
+        if _digest(conversation[:summary["covered"]]) != summary["digest"]:
+            return None
+        return summary
+
+    def _schedule_refresh(self, session: Dict[str, Any], older: List[ChatMessage], summary: Optional[Dict[str, Any]]):
+        """在后台刷新摘要（每个会话同时只有一个刷新任务）"""
+        session_id = session["id"]
+        task = self._tasks.get(session_id)
+        if task is not None and not task.done():
+            return
+        task = asyncio.create_task(self._refresh(session, list(older), summary), name=f"chat-summary-{session_id}")
+        self._tasks[session_id] = task
+        task.add_done_callback(lambda t: self._tasks.pop(session_id, None) if self._tasks.get(session_id) is t else None)
+
+    async def _refresh(self, session: Dict[str, Any], older: List[ChatMessage], summary: Optional[Dict[str, Any]]):
+        """把尚未覆盖的消息合并进摘要（单次输入不超过预算，剩余部分留给下一次刷新）"""
+        start = summary["covered"] if summary else 0
+        batch: List[ChatMessage] = []
+        used = 0
+        for message in older[start:]:
+            cost = estimate_tokens(_clip(message.content, _SUMMARY_MESSAGE_CHARS)) + _MESSAGE_OVERHEAD
+            if batch and used + cost > self.token_budget:
+                break
+            batch.append(message)
+            used += cost
+        covered = start + len(batch)
+
+        prompt = ""
+        if summary:
+            prompt += f"已有摘要：\n{summary['text']}\n\n"
+        prompt += f"新增对话：\n{_transcript(batch, _SUMMARY_MESSAGE_CHARS)}\n\n请输出合并后的完整摘要。"
+
+        try:
+            text = await self.llm.chat(
+                messages=[ChatMessage(role="user", content=prompt)],
+                system_prompt=SUMMARY_SYSTEM_PROMPT,
+                max_tokens=self.summary_max_tokens,
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._stats["summary_failures"] += 1
+            print(f"[Chat History] 会话 {session['id']} 摘要刷新失败: {e}")
+            return
+
+        # 期间已有其他刷新（或其他 worker）写入了覆盖更多的摘要
+        current = session.get("summary")
+        if current is not summary and self._valid_summary(session, older) and current["covered"] >= covered:
+            return
+        session["summary"] = {
+            "text": text.strip(),
+            "covered": covered,
+            "digest": _digest(older[:covered]),
+        }
+        self._stats["summary_refreshes"] += 1
+        self.sessions.save(session)
+        print(f"[Chat History] 会话 {session['id']} 摘要已更新，覆盖 {covered} 条消息")
+
+    async def stop(self):
+        """取消进行中的摘要任务"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        """运行指标"""
+        requests = self._stats["requests"]
+        return {
+            **self._stats,
+            "avg_input_tokens": round(self._stats["input_tokens"] / requests, 1) if requests else 0,
+            "refreshing": len(self._tasks),
+            "token_budget": self.token_budget,
+            "keep_turns": self.keep_turns,
+        }
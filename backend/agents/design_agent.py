@@ -12,25 +12,38 @@
 - generate_design(): 生成设计（自然语言模式）
 - chat(): 对话交互
 """
-import json
+import asyncio
 import uuid
-from pathlib import Path
-from typing import Optional, Dict, Any, List
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Union
 from config import get_settings
-from services import claude_service, seedream_service, preset_service
+from services import claude_service, seedream_service, preset_service, event_bus, generated_store, asset_registry
+from services.asset_registry import Asset
+from services.rate_limiter import UpstreamBusyError
+from utils.image_payload import ImagePayload
+from utils.lazy_service import LazyService
+from agents.pipeline import StagePipeline, StageListener
+from agents.session_store import SessionStore
+from agents.few_shot import FewShotRetriever
+from agents.chat_history import ChatHistoryManager
 from models import (
     AnalysisResult,
     ImageAnalysis,
+    SimilarItem,
     GenerationResult,
     DesignResponse,
     AspectRatio,
     ImageSize,
+    VariantStrategy,
+    DesignVariant,
     ChatMessage,
     ChatContext,
 )
 
 settings = get_settings()
 
+FEW_SHOT_FILE = "few_shot_examples.json"
+
 # 专业化 System Prompt 模板
 DESIGN_AGENT_SYSTEM_PROMPT = """你是专业的配饰设计师，专注于挂饰、钥匙扣、包挂等品类。
 
@@ -106,118 +119,117 @@ class DesignAgent:
         self.image_generator = seedream_service
         print("[Design Agent] 使用即梦4绘图模型")
 
-        self.sessions: Dict[str, Dict[str, Any]] = {}
-        self.few_shot_examples = self._load_few_shot_examples()
-        self.system_prompt = self._build_system_prompt()
-
-    def _load_few_shot_examples(self) -> List[Dict[str, Any]]:
-        """加载 few-shot 示例库"""
-        examples_path = Path(__file__).parent.parent / "data" / "few_shot_examples.json"
-        try:
-            with open(examples_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return data.get("examples", [])
-        except FileNotFoundError:
-            print(f"[Design Agent] Warning: few_shot_examples.json not found at {examples_path}")
-            return []
-        except json.JSONDecodeError as e:
-            print(f"[Design Agent] Error parsing few_shot_examples.json: {e}")
-            return []
-
-    def _format_few_shot_examples(self) -> str:
-        """格式化 few-shot 示例为 System Prompt 内容"""
-        if not self.few_shot_examples:
-            return "（暂无示例）"
-
-        formatted = []
-        for i, example in enumerate(self.few_shot_examples, 1):
-            analysis = example.get("analysis", {})
-            primary = ", ".join(analysis.get("primary", []))
-            secondary = ", ".join(analysis.get("secondary", []))
-            hardware = ", ".join(analysis.get("hardware", []))
-            structure = analysis.get("structure", "")
-            style_tags = ", ".join(analysis.get("style_tags", []))
-
-            example_text = f"""【案例{i}】{example.get("name", "")}
-分析结果：
-- 主体元素：{primary}
-- 辅助元素：{secondary}
-- 五金配件：{hardware}
-- 结构类型：{structure}
-- 风格标签：{style_tags}
-
-生成 Prompt：
-{example.get("ideal_prompt", "")}
-"""
-            formatted.append(example_text)
-
-        return "\n".join(formatted)
-
-    def _build_system_prompt(self) -> str:
-        """构建完整的 System Prompt"""
-        examples_text = self._format_few_shot_examples()
-        return DESIGN_AGENT_SYSTEM_PROMPT.format(few_shot_examples=examples_text)
-
-    def _select_few_shot_examples(
+        # 会话存储（空闲过期 + LRU 内存预算）
+        self.sessions = SessionStore()
+        # 对话上下文预算（最近若干轮 + 历史摘要）
+        self.history = ChatHistoryManager(self.claude, self.sessions)
+        # 后台任务（持有引用，避免被垃圾回收）
+        self._background_tasks: set = set()
+        # few-shot 示例按相关度检索，System Prompt 按示例组合缓存
+        # 示例由资源注册表加载，文件修改后在后台重建检索器并整体替换
+        self.few_shot = FewShotRetriever(asset_registry.get(FEW_SHOT_FILE).data.get("examples", []))
+        self._system_prompts: Dict[tuple, str] = {}
+        asset_registry.subscribe(FEW_SHOT_FILE, self._reload_few_shot)
+
+    @property
+    def few_shot_examples(self) -> List[Dict[str, Any]]:
+        return self.few_shot.examples
+
+    async def _reload_few_shot(self, asset: Asset):
+        """few_shot_examples.json 变化后重建检索器（先生成示例向量，再替换）"""
+        retriever = FewShotRetriever(asset.data.get("examples", []))
+        await retriever.warm_up()
+        # 同步替换检索器和 System Prompt 缓存，中间没有 await，请求不会看到新旧混合的状态
+        self.few_shot = retriever
+        self._system_prompts = {}
+        print(f"[Design Agent] few-shot 示例已更新 (v{asset.version}): {len(retriever.examples)} examples")
+
+    def _build_system_prompt(self, examples: List[Dict[str, Any]]) -> str:
+        """构建 System Prompt（按选中的示例组合缓存）"""
+        key = tuple(example.get("id", "") for example in examples)
+        if key not in self._system_prompts:
+            examples_text = self.few_shot.format_examples(examples)
+            self._system_prompts[key] = DESIGN_AGENT_SYSTEM_PROMPT.format(few_shot_examples=examples_text)
+        return self._system_prompts[key]
+
+    async def _select_few_shot_examples(
         self,
+        analysis: Optional[ImageAnalysis] = None,
         style_key: Optional[str] = None,
-        product_type: Optional[str] = None,
-        max_examples: int = 3
+        max_examples: Optional[int] = None,
     ) -> List[Dict[str, Any]]:
         """
         动态选择相关的 few-shot 示例
 
         Args:
-            style_key: 风格标识
-            product_type: 产品类型
+            analysis: 当前设计的分析结果（按描述向量检索）
+            style_key: 风格标识（向量不可用时按风格匹配）
             max_examples: 最大示例数
 
         Returns:
             筛选后的示例列表
         """
-        if not self.few_shot_examples:
-            return []
-
-        selected = []
-
-        # 1. 优先选择匹配风格的示例
-        if style_key:
-            for example in self.few_shot_examples:
-                if example.get("style") == style_key:
-                    selected.append(example)
-                    if len(selected) >= max_examples:
-                        break
-
-        # 2. 如果不够，补充其他示例
-        if len(selected) < max_examples:
-            for example in self.few_shot_examples:
-                if example not in selected:
-                    selected.append(example)
-                    if len(selected) >= max_examples:
-                        break
-
+        selected = await self.few_shot.select(
+            analysis=analysis,
+            k=max_examples or settings.FEW_SHOT_TOP_K,
+            style_key=style_key,
+        )
         print(f"[Design Agent] Selected {len(selected)} few-shot examples for style={style_key}")
         return selected
 
     def _get_session(self, session_id: Optional[str] = None) -> Dict[str, Any]:
         """获取或创建会话"""
-        if not session_id:
-            session_id = str(uuid.uuid4())
-
-        if session_id not in self.sessions:
-            self.sessions[session_id] = {
-                "id": session_id,
-                "history": [],
-                "current_image": None,
-                "analysis": None,
-                "generated_versions": [],
-            }
+        return self.sessions.get_or_create(session_id)
+
+    async def _find_similar_items(
+        self,
+        payload: ImagePayload,
+        analysis: ImageAnalysis,
+    ) -> Optional[List[SimilarItem]]:
+        """
+        查找图库中的相似产品（用于市场参考和设计灵感）
+
+        Args:
+            payload: 参考图载体
+            analysis: 参考图分析结果
 
-        return self.sessions[session_id]
+        Returns:
+            相似产品列表，检索失败时返回 None
+        """
+        try:
+            from services.embedding_service import embedding_service
+            from services.gallery_service import gallery_service
+            from services.search_utils import generate_multimodal_search_description
+
+            # 使用标准化的详细描述生成查询向量
+            text_desc = generate_multimodal_search_description(analysis)
+            print(f"[Design Agent] Query description: {text_desc}")
+            query_embedding = await embedding_service.generate_embedding(
+                image_base64=payload,
+                text=text_desc
+            )
+
+            if query_embedding is None:
+                return None
+
+            # 使用较低阈值（文本嵌入相似度通常偏低）
+            similar = await gallery_service.find_similar(query_embedding, top_k=3, threshold=0.15)
+            print(f"[Design Agent] Found {len(similar)} similar products")
+            return [
+                SimilarItem(
+                    id=item["id"],
+                    imageUrl=item["imageUrl"],
+                    similarity=item["similarity"]
+                )
+                for item in similar
+            ]
+        except Exception as e:
+            print(f"[Design Agent] Failed to find similar items: {e}")
+            return None
 
     async def analyze_reference(
         self,
-        image_base64: str,
+        image_base64: Union[str, ImagePayload],
         session_id: Optional[str] = None,
         include_similar: bool = True,
     ) -> ImageAnalysis:
@@ -225,7 +237,7 @@ class DesignAgent:
         分析参考图
 
         Args:
-            image_base64: 图像base64数据
+            image_base64: 图像base64数据或图像载体
             session_id: 会话ID
             include_similar: 是否查找相似产品
 
@@ -233,173 +245,244 @@ class DesignAgent:
             分析结果（包含相似产品）
         """
         session = self._get_session(session_id)
+        payload = ImagePayload.coerce(image_base64)
 
         # 调用Claude Vision分析（使用专业化分析Prompt）
         analysis = await self.claude.analyze_image(
-            image_base64=image_base64,
+            image_base64=payload,
             prompt=ANALYSIS_PROMPT,
         )
 
         # 查找相似产品（用于市场参考和设计灵感）
         if include_similar:
-            try:
-                from services.embedding_service import embedding_service
-                from services.gallery_service import gallery_service
-                from services.search_utils import generate_multimodal_search_description
-                from models import SimilarItem
-
-                # 使用标准化的详细描述生成查询向量
-                text_desc = generate_multimodal_search_description(analysis)
-                print(f"[Design Agent] Query description: {text_desc}")
-                query_embedding = await embedding_service.generate_embedding(
-                    image_base64=image_base64,
-                    text=text_desc
-                )
-
-                if query_embedding is not None:
-                    # 使用较低阈值（文本嵌入相似度通常偏低）
-                    similar = await gallery_service.find_similar(query_embedding, top_k=3, threshold=0.15)
-
-                    # 添加相似产品到结果
-                    analysis.similarItems = [
-                        SimilarItem(
-                            id=item["id"],
-                            imageUrl=item["imageUrl"],
-                            similarity=item["similarity"]
-                        )
-                        for item in similar
-                    ]
-                    print(f"[Design Agent] Found {len(similar)} similar products")
-            except Exception as e:
-                print(f"[Design Agent] Failed to find similar items: {e}")
+            similar_items = await self._find_similar_items(payload, analysis)
+            if similar_items is not None:
+                analysis.similarItems = similar_items
 
-        # 保存到会话
-        session["current_image"] = image_base64
+        # 保存到会话（保存载体本身，不额外生成 base64 副本）
+        session["current_image"] = payload
         session["analysis"] = analysis
+        self.sessions.save(session)
 
         return analysis
 
     async def generate_design(
         self,
         instruction: str,
-        reference_image: Optional[str] = None,
+        reference_image: Optional[Union[str, ImagePayload]] = None,
         session_id: Optional[str] = None,
         image_size: ImageSize = ImageSize.SIZE_2K,
         include_similar: bool = False,
+        defer_analysis: Optional[bool] = None,
+        on_stage: Optional[StageListener] = None,
+        variants: int = 1,
+        variant_strategy: VariantStrategy = VariantStrategy.BATCH,
     ) -> DesignResponse:
         """
         根据指令生成设计 - 自然语言模式
 
-        核心流程：
-        1. 分析参考图（可选）
-        2. 用自然语言增强用户意图
-        3. 图生图 + 自然语言描述
+        核心流程（依赖图，互不依赖的阶段并行执行）：
+
+            normalize ──────────────────────┐
+            analyze ──┬── similar           ├── generate ── post_analyze
+                      └── enhance ──────────┘
+
+        1. analyze: 分析参考图（可选），与 normalize（参考图编码为 data URI）并行
+        2. enhance: 用自然语言增强用户意图，与 similar（相似产品检索）并行
+        3. generate: 图生图 + 自然语言描述
+        4. post_analyze: 下载并分析生成的图片；延迟模式下改为后台任务，
+           结果写回版本记录，可通过 /session/{id}/versions 轮询或 SSE 获取
+
+        多方案模式（variants > 1）：generate 一次产出多张图片，post_analyze 并行下载、
+        分析每张图片并按与指令的相似度排名，每个方案都作为独立版本记录到会话中
 
         Args:
             instruction: 用户设计指令
-            reference_image: 参考图base64
+            reference_image: 参考图base64、URL或图像载体
             session_id: 会话ID
             image_size: 图像尺寸
             include_similar: 是否查找相似产品
+            defer_analysis: 是否后台分析生成图片（None 时使用 DEFER_GENERATED_ANALYSIS）
+            on_stage: 阶段状态回调（任务队列用于上报进度）
+            variants: 生成方案数量
+            variant_strategy: 多方案生成策略（单次请求 n 张 / 按 seed 并行请求）
 
         Returns:
-            设计响应
+            设计响应（timings 字段记录各阶段耗时）
         """
         session = self._get_session(session_id)
-        analysis = None
+        pipeline = StagePipeline(concurrent=settings.PIPELINE_CONCURRENT, listener=on_stage)
+        if defer_analysis is None:
+            defer_analysis = settings.DEFER_GENERATED_ANALYSIS
 
         try:
-            # 步骤1: 如果有参考图，先分析（仅 base64 格式可分析）
-            # URL 格式的参考图直接用于生成，跳过分析
-            is_url = reference_image and reference_image.startswith("http")
-            if reference_image and not is_url:
-                analysis = await self.analyze_reference(
-                    reference_image,
-                    session["id"],
-                    include_similar=include_similar
-                )
-                print(f"[Design Agent] 分析参考图完成")
+            # URL 格式的参考图直接用于生成，跳过分析（本地存储的生成图由生成服务读取本地副本）
+            is_url = isinstance(reference_image, str) and (
+                reference_image.startswith("http") or generated_store.is_local(reference_image)
+            )
+            # base64 参考图只解析一次，分析和生成共用同一个载体
+            reference_payload = (
+                ImagePayload.coerce(reference_image)
+                if reference_image and not is_url else None
+            )
+
+            if reference_payload:
+                # 分析与编码两个阶段并发读取同一载体：先在线程中把原始字节读入内存，
+                # 之后各阶段都从内存副本读取，不再并发 seek 共享的临时文件
+                await asyncio.to_thread(lambda: reference_payload.data)
+
+                async def normalize_stage(results):
+                    # 在线程中完成 base64 / data URI 编码，不阻塞分析请求
+                    await asyncio.to_thread(lambda: reference_payload.data_uri)
+                    return reference_payload
+
+                async def analyze_stage(results):
+                    analysis = await self.claude.analyze_image(
+                        image_base64=reference_payload,
+                        prompt=ANALYSIS_PROMPT,
+                    )
+                    session["current_image"] = reference_payload
+                    session["analysis"] = analysis
+                    print(f"[Design Agent] 分析参考图完成")
+                    return analysis
+
+                pipeline.add("normalize", normalize_stage)
+                pipeline.add("analyze", analyze_stage)
+
+                if include_similar:
+                    async def similar_stage(results):
+                        similar_items = await self._find_similar_items(reference_payload, results["analyze"])
+                        if similar_items is not None:
+                            results["analyze"].similarItems = similar_items
+                        return similar_items
+
+                    pipeline.add("similar", similar_stage, deps=["analyze"], optional=True)
             elif is_url:
                 print(f"[Design Agent] 参考图为 URL，跳过分析步骤")
-            elif session.get("analysis"):
-                analysis = session["analysis"]
 
-            # 步骤2: 自然语言模式生成Prompt
-            design_prompt = await self.claude.enhance_prompt(
-                user_instruction=instruction,
-                reference_analysis=analysis,
-            )
-            print(f"[Design Agent] Natural language prompt: {design_prompt}")
-
-            # 步骤3: 调用图像生成服务
-            # 注意：只使用明确传入的参考图，不自动使用 session 中的图片
-            # 这样可以正确区分「图生图」和「纯文生图」场景
-            reference_images = None
-            if reference_image:
-                reference_images = [reference_image]
-                # 打印参考图信息（不打印完整内容）
-                if is_url:
+            async def enhance_stage(results):
+                analysis = results.get("analyze")
+                if analysis is None and not reference_payload and not is_url:
+                    analysis = session.get("analysis")
+                design_prompt = await self.claude.enhance_prompt(
+                    user_instruction=instruction,
+                    reference_analysis=analysis,
+                )
+                print(f"[Design Agent] Natural language prompt: {design_prompt}")
+                return design_prompt
+
+            async def generate_stage(results):
+                # 注意：只使用明确传入的参考图，不自动使用 session 中的图片
+                # 这样可以正确区分「图生图」和「纯文生图」场景
+                reference_images = None
+                if reference_payload:
+                    reference_images = [reference_payload]
+                    print(f"[Design Agent] 图生图模式，使用图像数据 ({reference_payload.size} bytes)")
+                elif is_url:
+                    reference_images = [reference_image]
                     print(f"[Design Agent] 图生图模式，使用 URL: {reference_image[:80]}...")
                 else:
-                    print(f"[Design Agent] 图生图模式，使用 base64 ({len(reference_image)} chars)")
-            else:
-                print(f"[Design Agent] 纯文生图模式，不使用参考图")
+                    print(f"[Design Agent] 纯文生图模式，不使用参考图")
+
+                size_map = {
+                    ImageSize.SIZE_1K: "1K",
+                    ImageSize.SIZE_2K: "2K",
+                    ImageSize.SIZE_4K: "4K",
+                }
+                if variants > 1:
+                    image_urls = await self.image_generator.generate_batch(
+                        prompt=results["enhance"],
+                        reference_images=reference_images,
+                        size=size_map.get(image_size, "2K"),
+                        n=variants,
+                        strategy=VariantStrategy(variant_strategy).value,
+                    )
+                    return GenerationResult(
+                        image_url=image_urls[0],
+                        prompt_used=results["enhance"],
+                        metadata={"all_urls": image_urls, "variants": len(image_urls)},
+                    )
+                return await self.image_generator.generate(
+                    prompt=results["enhance"],
+                    reference_images=reference_images,
+                    size=size_map.get(image_size, "2K"),
+                )
 
-            size_map = {
-                ImageSize.SIZE_1K: "1K",
-                ImageSize.SIZE_2K: "2K",
-                ImageSize.SIZE_4K: "4K",
-            }
-            generation_result = await self.image_generator.generate(
-                prompt=design_prompt,
-                reference_images=reference_images,
-                size=size_map.get(image_size, "2K"),
-            )
+            async def post_analyze_stage(results):
+                if variants > 1:
+                    return await self._score_variants(
+                        results["generate"].metadata["all_urls"],
+                        f"{instruction}\n{results['enhance']}",
+                    )
+                image_url = results["generate"].image_url
+                if not image_url:
+                    return None
+                return await self._analyze_generated_image(image_url)
+
+            pipeline.add("enhance", enhance_stage, deps=["analyze"])
+            pipeline.add("generate", generate_stage, deps=["enhance", "normalize"])
+            if not defer_analysis:
+                # 分析失败不影响返回结果
+                pipeline.add("post_analyze", post_analyze_stage, deps=["generate"], optional=True)
+
+            results = await pipeline.run()
+            design_prompt = results["enhance"]
+            generation_result = results["generate"]
+            reference_analysis = results.get("analyze")
+
+            if variants > 1:
+                return self._record_variants(
+                    session, instruction, design_prompt, generation_result,
+                    reference_analysis, pipeline, defer_analysis,
+                )
 
-            # 步骤4: 保存版本历史
-            session["generated_versions"].append({
+            # 保存版本历史
+            version = {
+                "version_id": str(uuid.uuid4()),
                 "instruction": instruction,
                 "prompt": design_prompt,
                 "image_url": generation_result.image_url,
-            })
-
-            # 步骤5: 分析生成的图片（后端分析避免前端 CORS 问题）
-            generated_analysis = None
-            if generation_result.image_url:
-                try:
-                    import httpx
-                    import base64
-                    print(f"[Design Agent] 正在分析生成的图片...")
-
-                    # 从 URL 获取图片
-                    async with httpx.AsyncClient(timeout=30.0) as client:
-                        img_response = await client.get(generation_result.image_url)
-                        img_response.raise_for_status()
-                        img_base64 = base64.b64encode(img_response.content).decode("utf-8")
-
-                    # 分析图片
-                    generated_analysis = await self.claude.analyze_image(
-                        image_base64=img_base64,
-                        prompt=ANALYSIS_PROMPT,
-                    )
-                    print(f"[Design Agent] 生成图片分析完成")
-                except Exception as e:
-                    print(f"[Design Agent] 生成图片分析失败: {e}")
-                    # 分析失败不影响返回结果
-
-            # 步骤6: 估算成本
-            cost_estimate = self._estimate_cost(generated_analysis or analysis)
+                "thumbnails": generated_store.thumbnails(generation_result.image_url),
+                "created_at": datetime.now().isoformat(),
+                "analysis_status": "pending",
+                "analysis": None,
+                "cost_estimate": None,
+            }
+            session["generated_versions"].append(version)
+            self.sessions.save(session)
+            print(f"[Design Agent] 阶段耗时(ms): {pipeline.durations()}")
+
+            if defer_analysis:
+                if generation_result.image_url:
+                    # 两阶段响应：先返回图片 URL，分析和成本估算在后台完成
+                    self._spawn(self._complete_version_analysis(session, version, reference_analysis))
+                else:
+                    self._finish_version(session, version, None, reference_analysis, "skipped")
+                generated_analysis = None
+            else:
+                generated_analysis = results.get("post_analyze")
+                status = "completed" if generated_analysis else (
+                    "failed" if "post_analyze" in pipeline.errors else "skipped"
+                )
+                self._finish_version(session, version, generated_analysis, reference_analysis, status)
 
             return DesignResponse(
                 success=True,
                 image_url=generation_result.image_url,
+                thumbnails=version["thumbnails"] or None,
                 analysis=generated_analysis,  # 返回生成图片的分析
                 prompt_used=design_prompt,
                 message="设计生成成功",
-                cost_estimate=cost_estimate,
+                cost_estimate=version["cost_estimate"],
                 session_id=session["id"],
+                timings=pipeline.durations(),
+                version_id=version["version_id"],
+                analysis_status=version["analysis_status"],
             )
 
+        except UpstreamBusyError:
+            # 上游繁忙交给接口层返回 503 + Retry-After，客户端据此重试
+            raise
         except Exception as e:
             import traceback
             print(f"[Design Agent Error] {str(e)}")
@@ -407,8 +490,225 @@ class DesignAgent:
             return DesignResponse(
                 success=False,
                 message=f"生成失败: {str(e)}",
+                timings=pipeline.durations() or None,
             )
 
+    async def _analyze_generated_image(self, image_url: str) -> ImageAnalysis:
+        """下载并分析生成的图片（后端分析避免前端 CORS 问题）"""
+        print(f"[Design Agent] 正在分析生成的图片...")
+
+        # 读取本地存储的副本（远程 URL 只会下载一次）
+        generated_payload = await generated_store.open(image_url)
+
+        # 分析图片
+        generated_analysis = await self.claude.analyze_image(
+            image_base64=generated_payload,
+            prompt=ANALYSIS_PROMPT,
+        )
+        print(f"[Design Agent] 生成图片分析完成")
+        return generated_analysis
+
+    def _finish_version(
+        self,
+        session: Dict[str, Any],
+        version: Dict[str, Any],
+        generated_analysis: Optional[ImageAnalysis],
+        fallback_analysis: Optional[ImageAnalysis],
+        status: str,
+    ):
+        """写回版本的分析结果与成本估算，并推送会话事件"""
+        version["analysis"] = generated_analysis.model_dump() if generated_analysis else None
+        version["cost_estimate"] = self._estimate_cost(generated_analysis or fallback_analysis)
+        version["analysis_status"] = status
+        self.sessions.save(session)
+        event_bus.publish(f"session:{session['id']}", {
+            "event": "version_updated",
+            "session_id": session["id"],
+            "version": version,
+        })
+
+    async def _complete_version_analysis(
+        self,
+        session: Dict[str, Any],
+        version: Dict[str, Any],
+        fallback_analysis: Optional[ImageAnalysis],
+    ):
+        """后台任务：分析生成的图片并估算成本"""
+        try:
+            generated_analysis = await self._analyze_generated_image(version["image_url"])
+            self._finish_version(session, version, generated_analysis, fallback_analysis, "completed")
+        except Exception as e:
+            print(f"[Design Agent] 生成图片分析失败: {e}")
+            # 分析失败时仍基于参考图给出成本估算
+            self._finish_version(session, version, None, fallback_analysis, "failed")
+
+    async def _score_variants(
+        self,
+        image_urls: List[str],
+        query_text: str,
+    ) -> List[Dict[str, Any]]:
+        """
+        并行下载、分析各方案图片，并计算与指令的相似度
+
+        所有上游请求经过共享限流器，单个方案失败不影响其他方案
+
+        Args:
+            image_urls: 方案图片 URL
+            query_text: 用于排名的查询文本（用户指令 + 增强后的设计描述）
+
+        Returns:
+            与 image_urls 顺序一致的结果列表：{"analysis", "score"}
+        """
+        from services.embedding_service import embedding_service
+        from services.search_utils import generate_multimodal_search_description
+
+        async def embed(text: str):
+            try:
+                return await embedding_service.generate_embedding(image_base64=None, text=text)
+            except Exception as e:
+                print(f"[Design Agent] 方案排名向量生成失败: {e}")
+                return None
+
+        async def process(image_url: str):
+            try:
+                analysis = await self._analyze_generated_image(image_url)
+            except Exception as e:
+                print(f"[Design Agent] 方案图片分析失败: {e}")
+                return None, None
+            return analysis, await embed(generate_multimodal_search_description(analysis))
+
+        query_embedding, *processed = await asyncio.gather(
+            embed(query_text),
+            *[process(url) for url in image_urls],
+        )
+
+        scored = []
+        for analysis, embedding in processed:
+            score = None
+            if query_embedding is not None and embedding is not None:
+                score = round(embedding_service.compute_similarity(query_embedding, embedding), 4)
+            scored.append({"analysis": analysis, "score": score})
+        return scored
+
+    def _record_variants(
+        self,
+        session: Dict[str, Any],
+        instruction: str,
+        design_prompt: str,
+        generation_result: GenerationResult,
+        reference_analysis: Optional[ImageAnalysis],
+        pipeline: StagePipeline,
+        defer_analysis: bool,
+    ) -> DesignResponse:
+        """把每个方案记录为独立版本，并返回（已排名的）多方案响应"""
+        group_id = str(uuid.uuid4())
+        created_at = datetime.now().isoformat()
+        versions = []
+        for index, image_url in enumerate(generation_result.metadata["all_urls"]):
+            versions.append({
+                "version_id": str(uuid.uuid4()),
+                "instruction": instruction,
+                "prompt": design_prompt,
+                "image_url": image_url,
+                "thumbnails": generated_store.thumbnails(image_url),
+                "created_at": created_at,
+                "variant_group": group_id,
+                "variant_index": index,
+                "rank": None,
+                "score": None,
+                "analysis_status": "pending",
+                "analysis": None,
+                "cost_estimate": None,
+            })
+        session["generated_versions"].extend(versions)
+        self.sessions.save(session)
+        print(f"[Design Agent] 生成 {len(versions)} 个方案，阶段耗时(ms): {pipeline.durations()}")
+
+        if defer_analysis:
+            # 排名依赖分析结果，放到后台完成后通过 version_updated 事件推送
+            self._spawn(self._complete_variants(session, versions, design_prompt, instruction, reference_analysis))
+        else:
+            scored = pipeline.results.get("post_analyze") or [{"analysis": None, "score": None}] * len(versions)
+            self._finish_variants(session, versions, scored, reference_analysis)
+            versions = sorted(versions, key=lambda v: v["rank"])
+
+        variants = [
+            DesignVariant(
+                version_id=v["version_id"],
+                image_url=v["image_url"],
+                thumbnails=v["thumbnails"] or None,
+                rank=v["rank"],
+                score=v["score"],
+                analysis=v["analysis"],
+                cost_estimate=v["cost_estimate"],
+                analysis_status=v["analysis_status"],
+            )
+            for v in versions
+        ]
+        best = versions[0]
+        return DesignResponse(
+            success=True,
+            image_url=best["image_url"],
+            thumbnails=best["thumbnails"] or None,
+            analysis=variants[0].analysis,
+            prompt_used=design_prompt,
+            message=f"设计生成成功，共 {len(versions)} 个方案",
+            cost_estimate=best["cost_estimate"],
+            session_id=session["id"],
+            timings=pipeline.durations(),
+            version_id=best["version_id"],
+            analysis_status=best["analysis_status"],
+            variants=variants,
+        )
+
+    def _finish_variants(
+        self,
+        session: Dict[str, Any],
+        versions: List[Dict[str, Any]],
+        scored: List[Dict[str, Any]],
+        fallback_analysis: Optional[ImageAnalysis],
+    ):
+        """按相似度排名并写回各方案版本（无分数的方案排在最后，保持生成顺序）"""
+        order = sorted(
+            range(len(versions)),
+            key=lambda i: (scored[i]["score"] is None, -(scored[i]["score"] or 0.0), i),
+        )
+        for rank, index in enumerate(order, 1):
+            version = versions[index]
+            version["rank"] = rank
+            version["score"] = scored[index]["score"]
+            analysis = scored[index]["analysis"]
+            self._finish_version(
+                session, version, analysis, fallback_analysis,
+                "completed" if analysis else "failed",
+            )
+
+    async def _complete_variants(
+        self,
+        session: Dict[str, Any],
+        versions: List[Dict[str, Any]],
+        design_prompt: str,
+        instruction: str,
+        fallback_analysis: Optional[ImageAnalysis],
+    ):
+        """后台任务：分析并排名各方案"""
+        try:
+            scored = await self._score_variants(
+                [v["image_url"] for v in versions],
+                f"{instruction}\n{design_prompt}",
+            )
+        except Exception as e:
+            print(f"[Design Agent] 方案分析失败: {e}")
+            scored = [{"analysis": None, "score": None}] * len(versions)
+        self._finish_variants(session, versions, scored, fallback_analysis)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        """启动后台任务并持有引用"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
     async def chat(
         self,
         messages: list[ChatMessage],
@@ -428,8 +728,17 @@ class DesignAgent:
         """
         session = self._get_session(session_id)
 
-        # 使用专业化 System Prompt（包含 few-shot 示例）
-        chat_system_prompt = self.system_prompt + """
+        # 优先使用传入的 context，其次使用 session 中的分析结果
+        analysis = None
+        if context and context.analysis:
+            analysis = context.analysis
+        elif session.get("analysis"):
+            analysis = session.get("analysis")
+
+        # 使用专业化 System Prompt（按当前设计检索相关的 few-shot 示例）
+        selected_style = context.selected_style if context else None
+        examples = await self._select_few_shot_examples(analysis, style_key=selected_style)
+        chat_system_prompt = self._build_system_prompt(examples) + """
 
 ## 对话指南
 
@@ -462,52 +771,18 @@ class DesignAgent:
 
 请用专业但友好的语气回复。"""
 
-        # 添加上下文
-        context_messages = []
-
-        # 优先使用传入的 context，其次使用 session 中的分析结果
-        analysis = None
-        if context and context.analysis:
-            analysis = context.analysis
-        elif session.get("analysis"):
-            analysis = session.get("analysis")
-
-        # 如果有分析结果，添加到上下文
-        if analysis:
-            # 生成详细的分析描述
-            primary_elements = ', '.join([e.type for e in analysis.elements.primary])
-            secondary_elements = ', '.join([f"{e.type}×{e.count}" if e.count else e.type for e in analysis.elements.secondary])
-            hardware = ', '.join([e.type for e in analysis.elements.hardware])
-            style_tags = ', '.join(analysis.style.tags) if analysis.style.tags else ""
-            mood = analysis.style.mood if analysis.style else ""
-
-            context_desc = f"""[当前设计上下文]
-- 主体元素: {primary_elements or '无'}
-- 辅助元素: {secondary_elements or '无'}
-- 五金配件: {hardware or '无'}
-- 风格标签: {style_tags or '未识别'}
-- 整体氛围: {mood or '未知'}
-- 尺寸: 约{analysis.physicalSpecs.lengthCm}cm / {analysis.physicalSpecs.weightG}g"""
-
-            if context and context.selected_style:
-                context_desc += f"\n- 用户选择风格: {context.selected_style}"
-
-            context_messages.append(ChatMessage(
-                role="assistant",
-                content=context_desc,
-            ))
-
-        # 添加用户消息
-        context_messages.extend(messages)
+        # 上下文块（分析 + 历史摘要）+ 最近若干轮对话，控制在 token 预算内
+        context_messages = self.history.build(session, messages, analysis, selected_style)
 
         response = await self.claude.chat(
             messages=context_messages,
             system_prompt=chat_system_prompt,
         )
 
-        # 保存对话历史
-        session["history"].extend(messages)
-        session["history"].append(ChatMessage(role="assistant", content=response))
+        # 保存对话历史（客户端会重发整段对话，只追加本轮新增的消息）
+        self.sessions.append_history(
+            session, [*self.history.new_messages(messages), ChatMessage(role="assistant", content=response)]
+        )
 
         return response
 
@@ -559,10 +834,11 @@ class DesignAgent:
 
     def get_session_versions(self, session_id: str) -> list:
         """获取会话的版本历史"""
-        if session_id in self.sessions:
-            return self.sessions[session_id].get("generated_versions", [])
+        session = self.sessions.get(session_id)
+        if session is not None:
+            return session.get("generated_versions", [])
         return []
 
 
-# 单例实例
-design_agent = DesignAgent()
+# 单例实例（首次使用时构造：加载 few-shot 示例、创建会话存储）
+design_agent: DesignAgent = LazyService(DesignAgent)
@@ -0,0 +1,210 @@
+"""
+Few-shot 示例检索
+按当前设计的分析描述，从示例库中选出最相关的 top-k 个示例注入 System Prompt
+
+设计理念：
+- 启动时（后台）为每个示例计算嵌入向量，向量按示例文本哈希缓存到磁盘，
+  示例未变化时重启无需重新请求嵌入接口
+- 查询描述与示例向量做余弦相似度（向量已归一化，一次矩阵乘法），取 top-k
+- 查询向量按描述文本缓存（同一会话多轮对话共用同一份分析结果）
+- 格式化后的示例片段按选中的示例组合缓存
+- 向量未就绪或嵌入失败时退化为按风格匹配 + 顺序补齐
+
+核心方法：
+- warm_up(): 预计算示例向量
+- select(): 选择相关示例
+- format_examples(): 格式化示例（带缓存）
+"""
+import asyncio
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from models import ImageAnalysis
+
+# 查询向量缓存条数
+_QUERY_CACHE_SIZE = 256
+
+
+def _example_text(example: Dict[str, Any]) -> str:
+    """示例的检索文本：英文 ideal_prompt 与查询描述语言一致，附加风格标签"""
+    analysis = example.get("analysis", {})
+    tags = ", ".join(analysis.get("style_tags", []))
+    return f"{example.get('ideal_prompt', '')}\nStyle: {example.get('style', '')} {tags}".strip()
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class FewShotRetriever:
+    """基于嵌入向量的 few-shot 示例检索器"""
+
+    def __init__(self, examples: List[Dict[str, Any]], cache_path: Optional[Path] = None):
+        """
+        Args:
+            examples: 示例列表（few_shot_examples.json 的 examples）
+            cache_path: 示例向量的磁盘缓存路径
+        """
+        self.examples = examples
+        self.cache_path = Path(
+            cache_path or Path(__file__).parent.parent / "data" / "few_shot_embeddings.npz"
+        )
+        self._matrix: Optional[np.ndarray] = None  # (示例数, 维度)，行已归一化
+        self._query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._fragments: Dict[Tuple[str, ...], str] = {}
+        self._warm_up_task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._matrix is not None
+
+    # ==================== 向量预计算 ====================
+
+    def _load_cache(self) -> Dict[str, np.ndarray]:
+        try:
+            with np.load(self.cache_path) as data:
+                return {key: data[key] for key in data.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return {}
+
+    async def warm_up(self):
+        """为所有示例计算嵌入向量（已缓存的直接复用）"""
+        from services.embedding_service import embedding_service
+
+        if not self.examples:
+            return
+        texts = [_example_text(example) for example in self.examples]
+        hashes = [_text_hash(text) for text in texts]
+        cached = self._load_cache()
+
+        missing = [i for i, h in enumerate(hashes) if h not in cached]
+        if missing:
+            print(f"[Few-shot] 计算 {len(missing)} 个示例向量（缓存命中 {len(hashes) - len(missing)} 个）")
+            embeddings = await asyncio.gather(
+                *[embedding_service.generate_embedding(image_base64=None, text=texts[i]) for i in missing],
+                return_exceptions=True,
+            )
+            for i, embedding in zip(missing, embeddings):
+                if isinstance(embedding, np.ndarray):
+                    cached[hashes[i]] = embedding
+                else:
+                    print(f"[Few-shot] 示例 {self.examples[i].get('id')} 向量生成失败: {embedding}")
+
+        if not all(h in cached for h in hashes):
+            print("[Few-shot] 部分示例缺少向量，暂时使用风格匹配")
+            return
+
+        if missing:
+            # 只保留当前示例的向量，删除过期条目
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            np.savez(self.cache_path, **{h: cached[h] for h in hashes})
+
+        matrix = np.stack([cached[h] for h in hashes]).astype(np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self._matrix = matrix / np.where(norms > 0, norms, 1.0)
+        print(f"[Few-shot] 示例向量就绪: {self._matrix.shape}")
+
+    def start_warm_up(self) -> asyncio.Task:
+        """在后台预计算示例向量（不阻塞应用启动）"""
+        if self._warm_up_task is None:
+            self._warm_up_task = asyncio.create_task(self.warm_up(), name="few-shot-warm-up")
+        return self._warm_up_task
+
+    # ==================== 检索 ====================
+
+    async def _query_embedding(self, text: str) -> Optional[np.ndarray]:
+        from services.embedding_service import embedding_service
+
+        key = _text_hash(text)
+        if key in self._query_cache:
+            self._query_cache.move_to_end(key)
+            return self._query_cache[key]
+        embedding = await embedding_service.generate_embedding(image_base64=None, text=text)
+        if embedding is not None:
+            self._query_cache[key] = embedding
+            if len(self._query_cache) > _QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return embedding
+
+    def _fallback(self, style_key: Optional[str], k: int) -> List[Dict[str, Any]]:
+        """按风格匹配优先、其余按顺序补齐"""
+        matched = [e for e in self.examples if style_key and e.get("style") == style_key]
+        others = [e for e in self.examples if not (style_key and e.get("style") == style_key)]
+        return (matched + others)[:k]
+
+    async def select(
+        self,
+        analysis: Optional[ImageAnalysis] = None,
+        k: int = 3,
+        style_key: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        选择与当前设计最相关的示例
+
+        Args:
+            analysis: 当前设计的分析结果（没有时按风格匹配）
+            k: 选择数量
+            style_key: 风格标识（退化模式使用）
+
+        Returns:
+            示例列表（按相关度降序）
+        """
+        if not self.examples:
+            return []
+        if analysis is None or self._matrix is None:
+            return self._fallback(style_key, k)
+
+        from services.search_utils import generate_multimodal_search_description
+
+        try:
+            query = await self._query_embedding(generate_multimodal_search_description(analysis))
+        except Exception as e:
+            print(f"[Few-shot] 查询向量生成失败，使用风格匹配: {e}")
+            query = None
+        if query is None:
+            return self._fallback(style_key, k)
+
+        scores = self._matrix @ (query / (np.linalg.norm(query) or 1.0))
+        top = np.argsort(-scores)[:k]
+        selected = [self.examples[i] for i in top]
+        print(f"[Few-shot] 选中示例: {[(self.examples[i].get('id'), round(float(scores[i]), 3)) for i in top]}")
+        return selected
+
+    # ==================== 格式化 ====================
+
+    def format_examples(self, examples: List[Dict[str, Any]]) -> str:
+        """格式化示例为 System Prompt 片段（按示例组合缓存）"""
+        if not examples:
+            return "（暂无示例）"
+
+        key = tuple(example.get("id", example.get("name", "")) for example in examples)
+        if key not in self._fragments:
+            self._fragments[key] = "\n".join(
+                self._format_example(i, example) for i, example in enumerate(examples, 1)
+            )
+        return self._fragments[key]
+
+    @staticmethod
+    def _format_example(index: int, example: Dict[str, Any]) -> str:
+        analysis = example.get("analysis", {})
+        primary = ", ".join(analysis.get("primary", []))
+        secondary = ", ".join(analysis.get("secondary", []))
+        hardware = ", ".join(analysis.get("hardware", []))
+        structure = analysis.get("structure", "")
+        style_tags = ", ".join(analysis.get("style_tags", []))
+
+        return f"""【案例{index}】{example.get("name", "")}
+分析结果：
+- 主体元素：{primary}
+- 辅助元素：{secondary}
+- 五金配件：{hardware}
+- 结构类型：{structure}
+- 风格标签：{style_tags}
+
+生成 Prompt：
+{example.get("ideal_prompt", "")}
+"""
@@ -0,0 +1,443 @@
+"""
+设计生成任务队列
+把耗时的 generate_design 从 HTTP 请求中剥离，改为异步任务
+
+设计理念：
+- POST 只负责入队并返回任务ID，有界的 worker 池在后台执行生成流程
+- 队列按会话轮询调度（每个会话一个子队列），单个会话批量提交不会饿死其他会话
+- 任务及各阶段进度持久化到本地 SQLite，重启后未完成的任务自动重新入队；
+  base64 参考图存入内容寻址存储（blob_store），任务记录只保存哈希，任务结束后释放引用
+- 多个 worker 进程共享同一个 SQLite 文件：执行前以条件更新认领任务，同一任务只会被执行一次；
+  执行中定期刷新 updated_at（心跳），进程异常退出遗留的 running 任务在超过 JOB_STALE_SECONDS
+  未更新后由其他进程接管；各进程定期扫描数据库，其他进程提交的排队任务也会被调度
+- 状态变更都是条件更新：取消只把 queued / running 的任务置为 cancelled，认领和最终结果写入
+  不会覆盖已取消的任务；执行进程在心跳时发现任务已被取消（可能由其他进程发起）即停止执行
+- 阶段进度通过事件总线推送（频道 job:<id>），供 SSE 订阅
+
+核心方法：
+- submit(): 提交任务
+- get(): 查询任务状态
+- cancel(): 取消排队中或执行中的任务
+- start() / stop(): 启动与停止 worker 池（由应用生命周期调用）
+"""
+import asyncio
+import json
+import sqlite3
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional
+
+from config import get_settings
+from models import GenerateRequest
+from services import blob_store, event_bus, generated_store
+from utils.image_payload import ImagePayload
+
+settings = get_settings()
+
+# 任务终态
+TERMINAL_STATUSES = {"succeeded", "failed", "cancelled"}
+
+
+class JobQueueFullError(Exception):
+    """排队任务数已达上限"""
+
+
+class JobManager:
+    """设计生成任务管理器"""
+
+    def __init__(self, db_path: Optional[Path] = None, workers: Optional[int] = None):
+        """
+        Args:
+            db_path: SQLite 文件路径
+            workers: worker 数量（最大并行生成任务数）
+        """
+        self.db_path = Path(
+            db_path or settings.JOBS_DB_PATH
+            or Path(__file__).parent.parent / "data" / "jobs.db"
+        )
+        self.worker_count = workers or settings.JOB_WORKERS
+        self.max_pending = settings.JOB_MAX_PENDING
+
+        self._conn: Optional[sqlite3.Connection] = None
+        # 按会话分组的待执行队列：session_id -> deque[job_id]
+        self._queues: "OrderedDict[str, Deque[str]]" = OrderedDict()
+        self._pending = 0
+        self._wakeup: Optional[asyncio.Condition] = None
+        self._workers: List[asyncio.Task] = []
+        self._scanner: Optional[asyncio.Task] = None
+        self._running: Dict[str, asyncio.Task] = {}
+        self._cancel_requested: set = set()
+
+    # ==================== 持久化 ====================
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.db_path), timeout=10.0)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    session_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    request TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    stages TEXT NOT NULL DEFAULT '{}',
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+            self._conn.commit()
+        return self._conn
+
+    def _update(self, job_id: str, **fields):
+        fields["updated_at"] = datetime.now().isoformat()
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        self._db().execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+        self._db().commit()
+
+    def _transition(self, job_id: str, from_statuses, **fields) -> bool:
+        """条件更新：只有当前状态属于 from_statuses 时才写入，返回是否写入成功"""
+        fields["updated_at"] = datetime.now().isoformat()
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        placeholders = ", ".join("?" for _ in from_statuses)
+        cursor = self._db().execute(
+            f"UPDATE jobs SET {columns} WHERE id = ? AND status IN ({placeholders})",
+            (*fields.values(), job_id, *from_statuses),
+        )
+        self._db().commit()
+        return cursor.rowcount == 1
+
+    def _status(self, job_id: str) -> Optional[str]:
+        row = self._db().execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row["status"] if row else None
+
+    def _claim(self, job_id: str) -> bool:
+        """认领排队中的任务（多进程下只有一个进程能认领成功）"""
+        cursor = self._db().execute(
+            "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+            (datetime.now().isoformat(), job_id),
+        )
+        self._db().commit()
+        return cursor.rowcount == 1
+
+    @staticmethod
+    def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "job_id": row["id"],
+            "session_id": row["session_id"],
+            "status": row["status"],
+            "stages": json.loads(row["stages"] or "{}"),
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    # ==================== 调度 ====================
+
+    def _condition(self) -> asyncio.Condition:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Condition()
+        return self._wakeup
+
+    async def _enqueue(self, job_id: str, session_id: str):
+        cond = self._condition()
+        async with cond:
+            self._queues.setdefault(session_id, deque()).append(job_id)
+            self._pending += 1
+            cond.notify()
+
+    async def _next_job(self) -> str:
+        """按会话轮询取出下一个任务"""
+        cond = self._condition()
+        async with cond:
+            while self._pending == 0:
+                await cond.wait()
+            session_id, queue = next(iter(self._queues.items()))
+            job_id = queue.popleft()
+            self._pending -= 1
+            # 当前会话移到队尾，下一次优先调度其他会话
+            del self._queues[session_id]
+            if queue:
+                self._queues[session_id] = queue
+            return job_id
+
+    async def _remove_queued(self, job_id: str) -> bool:
+        cond = self._condition()
+        async with cond:
+            for session_id, queue in list(self._queues.items()):
+                if job_id in queue:
+                    queue.remove(job_id)
+                    self._pending -= 1
+                    if not queue:
+                        del self._queues[session_id]
+                    return True
+        return False
+
+    def _publish(self, job_id: str, event: Dict[str, Any]):
+        event_bus.publish(f"job:{job_id}", {"job_id": job_id, **event})
+
+    # ==================== 执行 ====================
+
+    async def _worker(self, index: int):
+        while True:
+            job_id = await self._next_job()
+            row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or not self._claim(job_id):
+                continue
+            task = asyncio.create_task(self._execute(row))
+            self._running[job_id] = task
+            heartbeat = asyncio.create_task(self._heartbeat(job_id, task))
+            try:
+                await task
+            except asyncio.CancelledError:
+                if job_id not in self._cancel_requested:
+                    # worker 自身被停止（应用关闭）：由 stop() 把任务放回队列
+                    task.cancel()
+                    raise
+            except Exception as e:
+                print(f"[Job Manager] 任务 {job_id} 执行异常: {e}")
+                if self._transition(job_id, ("running",), status="failed", error=str(e)):
+                    blob_store.release(json.loads(row["request"]).get("reference_image_sha256"))
+                    self._publish(job_id, {"event": "status", "status": "failed", "error": str(e)})
+            finally:
+                heartbeat.cancel()
+                self._running.pop(job_id, None)
+                self._cancel_requested.discard(job_id)
+
+    async def _heartbeat(self, job_id: str, task: asyncio.Task):
+        """执行期间定期刷新 updated_at；任务已不是 running（被取消或被接管）时停止本地执行"""
+        while not task.done():
+            await asyncio.sleep(settings.JOB_HEARTBEAT_INTERVAL)
+            try:
+                alive = self._transition(job_id, ("running",))
+            except Exception as e:
+                print(f"[Job Manager] 任务 {job_id} 心跳失败: {e}")
+                continue
+            if not alive and not task.done():
+                self._cancel_requested.add(job_id)
+                task.cancel()
+                return
+
+    async def _execute(self, row: sqlite3.Row):
+        # 延迟导入，避免与 design_agent 循环依赖
+        from agents.design_agent import design_agent
+
+        job_id = row["id"]
+        request_data = json.loads(row["request"])
+        image_sha256 = request_data.pop("reference_image_sha256", None)
+        request = GenerateRequest(**request_data)
+        reference_image = request.reference_image
+        if image_sha256:
+            reference_image = blob_store.open(image_sha256)
+            if reference_image is None:
+                raise FileNotFoundError(f"参考图内容不存在: {image_sha256}")
+        stages: Dict[str, str] = {}
+
+        def on_stage(name: str, status: str):
+            stages[name] = status
+            self._update(job_id, stages=json.dumps(stages))
+            self._publish(job_id, {"event": "stage", "stage": name, "status": status})
+
+        self._publish(job_id, {"event": "status", "status": "running"})
+        print(f"[Job Manager] 开始执行任务 {job_id} (session={row['session_id']})")
+
+        try:
+            result = await design_agent.generate_design(
+                instruction=request.instruction,
+                reference_image=reference_image,
+                session_id=row["session_id"],
+                image_size=request.image_size,
+                defer_analysis=request.defer_analysis,
+                variants=request.variants,
+                variant_strategy=request.variant_strategy,
+                on_stage=on_stage,
+            )
+        except asyncio.CancelledError:
+            if job_id in self._cancel_requested:
+                # cancel() 已把状态置为 cancelled；执行中的任务由执行进程释放参考图引用
+                if self._status(job_id) == "cancelled":
+                    blob_store.release(image_sha256)
+                    self._publish(job_id, {"event": "status", "status": "cancelled"})
+                    print(f"[Job Manager] 任务 {job_id} 已取消")
+                else:
+                    print(f"[Job Manager] 任务 {job_id} 已被其他进程接管，停止执行")
+            raise
+
+        status = "succeeded" if result.success else "failed"
+        if not self._transition(
+            job_id,
+            ("running",),
+            status=status,
+            result=result.model_dump_json(),
+            error=None if result.success else result.message,
+        ):
+            # 执行期间任务被取消（或被接管），不覆盖当前状态
+            if self._status(job_id) == "cancelled":
+                blob_store.release(image_sha256)
+                self._publish(job_id, {"event": "status", "status": "cancelled"})
+            print(f"[Job Manager] 任务 {job_id} 执行期间状态已变为 {self._status(job_id)}，丢弃结果")
+            return
+        blob_store.release(image_sha256)
+        self._publish(job_id, {"event": "status", "status": status, "result": result.model_dump()})
+        print(f"[Job Manager] 任务 {job_id} 完成: {status}")
+
+    # ==================== 公共接口 ====================
+
+    async def _scan(self) -> int:
+        """
+        扫描数据库：把本进程尚未调度的排队任务和过期的 running 任务加入队列
+
+        Returns:
+            新加入队列的任务数
+        """
+        stale_before = (datetime.now() - timedelta(seconds=settings.JOB_STALE_SECONDS)).isoformat()
+        rows = self._db().execute(
+            "SELECT id, session_id, status FROM jobs "
+            "WHERE status = 'queued' OR (status = 'running' AND updated_at < ?) ORDER BY created_at",
+            (stale_before,),
+        ).fetchall()
+        known = set(self._running) | {job_id for queue in self._queues.values() for job_id in queue}
+        count = 0
+        for row in rows:
+            if row["id"] in known:
+                continue
+            if row["status"] == "running":
+                # 条件更新：心跳在此期间刷新过的任务不会被接管
+                cursor = self._db().execute(
+                    "UPDATE jobs SET status = 'queued' WHERE id = ? AND status = 'running' AND updated_at < ?",
+                    (row["id"], stale_before),
+                )
+                self._db().commit()
+                if cursor.rowcount != 1:
+                    continue
+            await self._enqueue(row["id"], row["session_id"])
+            count += 1
+        return count
+
+    async def _scan_loop(self):
+        while True:
+            await asyncio.sleep(settings.JOB_SCAN_INTERVAL)
+            try:
+                count = await self._scan()
+                if count:
+                    print(f"[Job Manager] 扫描到 {count} 个待执行任务")
+            except Exception as e:
+                print(f"[Job Manager] 扫描任务失败: {e}")
+
+    async def start(self):
+        """启动 worker 池，并恢复重启前未完成的任务"""
+        if self._workers:
+            return
+        count = await self._scan()
+        if count:
+            print(f"[Job Manager] 恢复 {count} 个未完成任务")
+
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"job-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+        self._scanner = asyncio.create_task(self._scan_loop(), name="job-scanner")
+        print(f"[Job Manager] 启动 {self.worker_count} 个 worker")
+
+    async def stop(self):
+        """停止 worker 池（执行中的任务放回队列，下次启动时由任一进程重新执行）"""
+        interrupted = list(self._running)
+        tasks = self._workers + ([self._scanner] if self._scanner else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._scanner = None
+        for job_id in interrupted:
+            self._transition(job_id, ("running",), status="queued")
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def submit(self, request: GenerateRequest) -> Dict[str, Any]:
+        """
+        提交生成任务
+
+        Args:
+            request: 设计生成请求
+
+        Returns:
+            任务信息（含 job_id 和 session_id）
+        """
+        if self._pending >= self.max_pending:
+            raise JobQueueFullError(f"排队任务过多（{self.max_pending}），请稍后重试")
+
+        job_id = str(uuid.uuid4())
+        session_id = request.session_id or str(uuid.uuid4())
+        now = datetime.now().isoformat()
+        request_data = request.model_dump(mode="json")
+        reference = request.reference_image
+        if reference and not (reference.startswith("http") or generated_store.is_local(reference)):
+            # base64 参考图不写进任务记录，改存哈希（URL 和本地生成图路径原样保留）
+            request_data["reference_image"] = None
+            request_data["reference_image_sha256"] = blob_store.acquire(ImagePayload.from_base64(reference))
+        self._db().execute(
+            "INSERT INTO jobs (id, session_id, status, request, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, session_id, "queued", json.dumps(request_data, ensure_ascii=False), now, now),
+        )
+        self._db().commit()
+        await self._enqueue(job_id, session_id)
+        print(f"[Job Manager] 任务入队 {job_id} (session={session_id}, 排队={self._pending})")
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """查询任务"""
+        row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    async def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        取消任务
+
+        Returns:
+            取消后的任务信息，任务不存在时返回 None
+        """
+        job = self.get(job_id)
+        if job is None or job["status"] in TERMINAL_STATUSES:
+            return job
+
+        if not self._transition(job_id, (job["status"],), status="cancelled"):
+            # 读取之后状态已变化（被认领或已结束），按最新状态重新处理
+            return await self.cancel(job_id)
+
+        if job["status"] == "queued":
+            # 没有进程认领过（认领要求 queued），由这里释放参考图引用
+            await self._remove_queued(job_id)
+            request_data = json.loads(self._db().execute(
+                "SELECT request FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()["request"])
+            blob_store.release(request_data.get("reference_image_sha256"))
+            self._publish(job_id, {"event": "status", "status": "cancelled"})
+        elif job_id in self._running:
+            self._cancel_requested.add(job_id)
+            self._running[job_id].cancel()
+            await asyncio.gather(self._running.get(job_id, asyncio.sleep(0)), return_exceptions=True)
+        # 在其他进程中执行的任务：执行进程在下次心跳时发现已取消并停止
+        return self.get(job_id)
+
+    def metrics(self) -> Dict[str, Any]:
+        """队列指标"""
+        return {
+            "workers": len(self._workers),
+            "running": len(self._running),
+            "queued": self._pending,
+            "queued_sessions": len(self._queues),
+        }
+
+
+# 单例实例
+job_manager = JobManager()
@@ -0,0 +1,146 @@
+"""
+阶段流水线
+把 generate_design 的各个步骤建模为一个小型依赖图（DAG）
+
+设计理念：
+- 每个阶段声明自己依赖的阶段，依赖满足后立即启动，互不依赖的阶段并行执行
+- 记录每个阶段的开始时间与耗时，便于在响应中返回并做性能对比
+- 可选阶段失败只记录错误，不影响主流程；必需阶段失败则取消其余阶段并抛出
+- sequential 模式按声明顺序逐个执行，用于基准对比和问题排查
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# 阶段函数：接收已完成阶段的结果字典，返回本阶段结果
+StageFunc = Callable[[Dict[str, Any]], Awaitable[Any]]
+# 阶段事件回调：(阶段名, 状态) 状态为 started / completed / failed
+StageListener = Callable[[str, str], None]
+
+
+@dataclass
+class Stage:
+    """流水线阶段"""
+    name: str
+    func: StageFunc
+    deps: List[str] = field(default_factory=list)
+    optional: bool = False
+
+
+class StagePipeline:
+    """基于依赖关系调度的异步阶段流水线"""
+
+    def __init__(
+        self,
+        concurrent: bool = True,
+        listener: Optional[StageListener] = None,
+    ):
+        """
+        Args:
+            concurrent: 是否并行执行互不依赖的阶段
+            listener: 阶段状态变化回调（用于进度上报）
+        """
+        self.concurrent = concurrent
+        self.listener = listener
+        self.stages: Dict[str, Stage] = {}
+        self.results: Dict[str, Any] = {}
+        self.errors: Dict[str, str] = {}
+        self.timings: Dict[str, Dict[str, float]] = {}
+        self._origin = 0.0
+
+    def add(
+        self,
+        name: str,
+        func: StageFunc,
+        deps: Optional[List[str]] = None,
+        optional: bool = False,
+    ) -> "StagePipeline":
+        """
+        注册阶段
+
+        Args:
+            name: 阶段名
+            func: 阶段协程函数
+            deps: 依赖的阶段名（未注册的依赖会被忽略，便于按条件组装）
+            optional: 失败时是否允许继续
+        """
+        self.stages[name] = Stage(name=name, func=func, deps=list(deps or []), optional=optional)
+        return self
+
+    def _notify(self, name: str, status: str):
+        if self.listener:
+            try:
+                self.listener(name, status)
+            except Exception as e:
+                print(f"[Pipeline] Listener error: {e}")
+
+    async def _execute(self, stage: Stage):
+        start = time.perf_counter()
+        self._notify(stage.name, "started")
+        try:
+            self.results[stage.name] = await stage.func(self.results)
+            self._notify(stage.name, "completed")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._notify(stage.name, "failed")
+            if not stage.optional:
+                raise
+            print(f"[Pipeline] 可选阶段 {stage.name} 失败: {e}")
+            self.errors[stage.name] = str(e)
+            self.results[stage.name] = None
+        finally:
+            end = time.perf_counter()
+            self.timings[stage.name] = {
+                "start_ms": round((start - self._origin) * 1000, 1),
+                "duration_ms": round((end - start) * 1000, 1),
+            }
+
+    async def run(self) -> Dict[str, Any]:
+        """
+        执行流水线
+
+        Returns:
+            各阶段结果字典
+        """
+        self._origin = time.perf_counter()
+
+        if not self.concurrent:
+            try:
+                for stage in self.stages.values():
+                    await self._execute(stage)
+            finally:
+                self.timings["total"] = {"start_ms": 0.0, "duration_ms": self._elapsed_ms()}
+            return self.results
+
+        tasks: Dict[str, asyncio.Task] = {}
+
+        async def run_stage(stage: Stage):
+            deps = [tasks[d] for d in stage.deps if d in tasks]
+            if deps:
+                await asyncio.gather(*deps)
+            await self._execute(stage)
+
+        # 按声明顺序创建任务，依赖必须先于依赖方声明
+        for stage in self.stages.values():
+            tasks[stage.name] = asyncio.create_task(run_stage(stage), name=f"stage:{stage.name}")
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        finally:
+            self.timings["total"] = {"start_ms": 0.0, "duration_ms": self._elapsed_ms()}
+
+        return self.results
+
+    def _elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self._origin) * 1000, 1)
+
+    def durations(self) -> Dict[str, float]:
+        """各阶段耗时（毫秒），用于响应返回"""
+        return {name: t["duration_ms"] for name, t in self.timings.items()}
@@ -0,0 +1,326 @@
+"""
+会话持久化后端
+让多个 uvicorn worker 共享会话（版本历史、对话历史、参考图引用）
+
+设计理念：
+- 会话记录（分析结果、参考图哈希、版本列表）与对话历史分开存储：
+  参考图本体在内容寻址存储（blob_store）中，对话历史只追加不重写
+- 记录带版本号，写入时校验期望版本（乐观并发控制），版本不一致抛出 SessionConflictError，
+  由上层重新加载并合并后重试
+- 提供 SQLite（默认）与本地文件两种实现，接口一致，可通过 SESSION_BACKEND 切换
+- 实现需可在线程中调用：会话存储把对话历史的批量写入放到线程中执行，不阻塞事件循环
+
+核心方法：
+- load(): 加载会话记录与对话历史
+- revision(): 只读取修订号（记录版本 + 历史条数，用于判断本地缓存是否过期）
+- save(): 按期望版本写入会话记录
+- append_history(): 批量追加对话历史
+- purge(): 删除长期未更新的会话
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows 下不做跨进程文件锁
+    fcntl = None
+
+from config import get_settings
+
+settings = get_settings()
+
+# 修订号：(记录版本, 对话历史条数)
+Revision = Tuple[int, int]
+
+_SAFE_ID = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+
+
+class SessionConflictError(Exception):
+    """会话已被其他 worker 修改（版本号不一致）"""
+
+
+@dataclass
+class StoredSession:
+    """后端中的会话数据"""
+    record: Dict[str, Any]
+    version: int
+    history: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def revision(self) -> Revision:
+        return (self.version, len(self.history))
+
+
+class SessionBackend:
+    """会话持久化后端接口"""
+
+    def load(self, session_id: str) -> Optional[StoredSession]:
+        raise NotImplementedError
+
+    def revision(self, session_id: str) -> Optional[Revision]:
+        raise NotImplementedError
+
+    def save(
+        self,
+        session_id: str,
+        record: Dict[str, Any],
+        expected_version: int,
+    ) -> int:
+        """
+        写入会话记录
+
+        Args:
+            session_id: 会话ID
+            record: 会话记录（可 JSON 序列化）
+            expected_version: 期望的当前版本（0 表示新建）
+
+        Returns:
+            写入后的版本号
+
+        Raises:
+            SessionConflictError: 版本不一致
+        """
+        raise NotImplementedError
+
+    def append_history(self, batches: Dict[str, List[Dict[str, Any]]]):
+        """批量追加对话历史：session_id -> 消息列表"""
+        raise NotImplementedError
+
+    def purge(self, older_than_seconds: float) -> List[Dict[str, Any]]:
+        """删除超过指定时间未更新的会话，返回被删除会话的记录（用于释放图片引用）"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """SQLite 会话后端（WAL 模式，多进程共享同一个文件；连接由锁保护，可在线程中使用）"""
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.db_path), timeout=10.0, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # WAL 模式下 NORMAL 只在检查点同步磁盘，每次写入不再等待 fsync
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    history_count INTEGER NOT NULL DEFAULT 0,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS session_history (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    message TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_history_session ON session_history(session_id, seq);
+                """
+            )
+            self._conn.commit()
+        return self._conn
+
+    def load(self, session_id: str) -> Optional[StoredSession]:
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT version, data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            history = [
+                json.loads(r["message"])
+                for r in db.execute(
+                    "SELECT message FROM session_history WHERE session_id = ? ORDER BY seq", (session_id,)
+                )
+            ]
+        return StoredSession(record=json.loads(row["data"]), version=row["version"], history=history)
+
+    def revision(self, session_id: str) -> Optional[Revision]:
+        with self._lock:
+            row = self._db().execute(
+                "SELECT version, history_count FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        return (row["version"], row["history_count"]) if row else None
+
+    def save(self, session_id, record, expected_version) -> int:
+        data = json.dumps(record, ensure_ascii=False, default=str)
+        now = time.time()
+        with self._lock, self._db() as db:
+            if expected_version == 0:
+                try:
+                    db.execute(
+                        "INSERT INTO sessions (id, version, data, updated_at) VALUES (?, 1, ?, ?)",
+                        (session_id, data, now),
+                    )
+                except sqlite3.IntegrityError:
+                    raise SessionConflictError(session_id)
+                return 1
+
+            cursor = db.execute(
+                "UPDATE sessions SET version = version + 1, data = ?, updated_at = ? WHERE id = ? AND version = ?",
+                (data, now, session_id, expected_version),
+            )
+            if cursor.rowcount == 0:
+                raise SessionConflictError(session_id)
+        return expected_version + 1
+
+    def append_history(self, batches):
+        now = time.time()
+        with self._lock, self._db() as db:
+            for session_id, messages in batches.items():
+                db.executemany(
+                    "INSERT INTO session_history (session_id, message) VALUES (?, ?)",
+                    [(session_id, json.dumps(m, ensure_ascii=False)) for m in messages],
+                )
+                db.execute(
+                    "UPDATE sessions SET history_count = history_count + ?, updated_at = ? WHERE id = ?",
+                    (len(messages), now, session_id),
+                )
+
+    def purge(self, older_than_seconds):
+        cutoff = time.time() - older_than_seconds
+        with self._lock, self._db() as db:
+            rows = db.execute("SELECT id, data FROM sessions WHERE updated_at < ?", (cutoff,)).fetchall()
+            for row in rows:
+                db.execute("DELETE FROM session_history WHERE session_id = ?", (row["id"],))
+                db.execute("DELETE FROM sessions WHERE id = ?", (row["id"],))
+        return [json.loads(row["data"]) for row in rows]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class FileSessionBackend(SessionBackend):
+    """
+    本地文件会话后端
+
+    每个会话一个目录：session.json（版本号 + 历史条数 + 记录）、history.jsonl（对话历史）。
+    写入时持有目录内的文件锁，先写临时文件再原子替换。
+    """
+
+    def __init__(self, base_dir: Path):
+        self.base_dir = Path(base_dir)
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+
+    def _dir(self, session_id: str) -> Path:
+        # 会话ID来自客户端，不安全的字符改用哈希作为目录名
+        name = session_id if _SAFE_ID.match(session_id) else hashlib.sha256(session_id.encode()).hexdigest()
+        return self.base_dir / name
+
+    def _lock(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        handle = open(directory / ".lock", "a")
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    @staticmethod
+    def _read_json(path: Path) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write_atomic(path: Path, content: str):
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def _write_meta(self, directory: Path, meta: Dict[str, Any]):
+        self._write_atomic(directory / "session.json", json.dumps(meta, ensure_ascii=False, default=str))
+
+    def load(self, session_id):
+        directory = self._dir(session_id)
+        meta = self._read_json(directory / "session.json")
+        if meta is None:
+            return None
+        history = []
+        try:
+            with open(directory / "history.jsonl", "r", encoding="utf-8") as f:
+                history = [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            pass
+        return StoredSession(record=meta["data"], version=meta["version"], history=history)
+
+    def revision(self, session_id):
+        meta = self._read_json(self._dir(session_id) / "session.json")
+        return (meta["version"], meta.get("history_count", 0)) if meta else None
+
+    def save(self, session_id, record, expected_version) -> int:
+        directory = self._dir(session_id)
+        with self._lock(directory):
+            meta = self._read_json(directory / "session.json") or {"version": 0, "history_count": 0}
+            if meta["version"] != expected_version:
+                raise SessionConflictError(session_id)
+            meta.update(version=expected_version + 1, data=record)
+            self._write_meta(directory, meta)
+        return expected_version + 1
+
+    def append_history(self, batches):
+        for session_id, messages in batches.items():
+            directory = self._dir(session_id)
+            lines = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages)
+            with self._lock(directory):
+                with open(directory / "history.jsonl", "a", encoding="utf-8") as f:
+                    f.write(lines)
+                meta = self._read_json(directory / "session.json")
+                if meta is not None:
+                    meta["history_count"] = meta.get("history_count", 0) + len(messages)
+                    self._write_meta(directory, meta)
+
+    def purge(self, older_than_seconds):
+        cutoff = time.time() - older_than_seconds
+        removed = []
+        for directory in self.base_dir.iterdir():
+            meta_path = directory / "session.json"
+            if meta_path.exists() and meta_path.stat().st_mtime < cutoff:
+                meta = self._read_json(meta_path)
+                shutil.rmtree(directory, ignore_errors=True)
+                if meta is not None:
+                    removed.append(meta["data"])
+        return removed
+
+
+def create_session_backend(kind: Optional[str] = None) -> Optional[SessionBackend]:
+    """
+    按配置创建会话后端
+
+    Args:
+        kind: sqlite / file / memory（memory 表示不持久化，仅单进程可用）
+
+    Returns:
+        会话后端，memory 模式返回 None
+    """
+    kind = (kind or settings.SESSION_BACKEND).lower()
+    data_dir = Path(__file__).parent.parent / "data"
+    if kind == "memory":
+        return None
+    if kind == "sqlite":
+        return SQLiteSessionBackend(Path(settings.SESSION_DB_PATH or data_dir / "sessions.db"))
+    if kind == "file":
+        return FileSessionBackend(Path(settings.SESSION_FILE_DIR or data_dir / "sessions"))
+    raise ValueError(f"未知的会话后端: {kind}")
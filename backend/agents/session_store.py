@@ -0,0 +1,522 @@
+"""
+会话存储
+替代 DesignAgent 中无上限的 sessions 字典
+
+设计理念：
+- 会话按最近访问排序（LRU），空闲超过 TTL 的会话由后台清理任务移除
+- 按会话估算占用字节（参考图、分析结果、对话历史、版本记录），
+  总量超出预算时从最久未访问的会话开始淘汰
+- 会话内容被修改后调用 save() 重新估算大小，读取只更新访问时间
+- 配置了持久化后端（SESSION_BACKEND=sqlite/file）时，内存只是缓存：
+  - 按需加载：本进程没有的会话在首次访问时从后端加载，被淘汰的会话下次访问时重新加载
+  - 访问时比对后端修订号（同一会话每 SESSION_REVISION_CHECK_INTERVAL 秒最多查询一次），
+    其他 worker 修改过的会话会重新加载
+  - save() 带期望版本写入，冲突时以上次加载的记录为基准做三方合并后重试
+  - 参考图存入内容寻址存储（blob_store），会话记录只保存 sha256 并持有一次引用
+  - 对话历史走 append_history()，在内存中缓冲后由后台任务在线程中批量写入（write-behind），不阻塞事件循环
+
+核心方法：
+- get_or_create(): 获取或创建会话
+- get(): 获取已有会话（不存在返回 None）
+- save(): 会话修改后持久化、重新计算大小并执行淘汰
+- append_history(): 追加对话历史
+- start() / stop(): 启动与停止后台清理与刷写任务
+- metrics(): 活跃会话数与占用字节
+"""
+import asyncio
+import copy
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional
+
+from pydantic import BaseModel
+
+from config import get_settings
+from models import ChatMessage, ImageAnalysis
+from services import blob_store
+from utils.image_payload import ImagePayload
+from agents.session_backend import (
+    Revision,
+    SessionBackend,
+    SessionConflictError,
+    StoredSession,
+    create_session_backend,
+)
+
+settings = get_settings()
+
+# 构造参数默认值：按 SESSION_BACKEND 创建后端
+_DEFAULT_BACKEND = object()
+
+# 保存冲突时的最大重试次数
+_MAX_SAVE_ATTEMPTS = 5
+
+
+def _estimate_value_size(value: Any) -> int:
+    """估算单个字段的字节数"""
+    if value is None:
+        return 0
+    if isinstance(value, ImagePayload):
+        # 原始字节 + 已生成的 base64 视图 + 压缩副本
+        size = value.size
+        if "base64" in value.__dict__:
+            size += len(value.__dict__["base64"])
+        size += sum(c.size for c in value._compressed.values() if c is not value)
+        return size
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, BaseModel):
+        return len(value.model_dump_json())
+    if isinstance(value, list):
+        return sum(_estimate_value_size(item) for item in value)
+    return len(json.dumps(value, ensure_ascii=False, default=str))
+
+
+def estimate_session_size(session: Dict[str, Any]) -> int:
+    """
+    估算会话占用的字节数
+
+    Args:
+        session: 会话字典
+
+    Returns:
+        估算字节数（近似值，用于预算控制）
+    """
+    return sum(_estimate_value_size(value) for value in session.values())
+
+
+def _to_record(session: Dict[str, Any]) -> Dict[str, Any]:
+    """会话 → 可持久化的记录（不含参考图本体与对话历史）"""
+    analysis = session.get("analysis")
+    image = session.get("current_image")
+    record = {
+        "analysis": analysis.model_dump() if isinstance(analysis, BaseModel) else analysis,
+        "image_sha256": image.sha256 if isinstance(image, ImagePayload) else None,
+        "generated_versions": session.get("generated_versions", []),
+        "summary": session.get("summary"),
+    }
+    # 经过一次 JSON 往返，得到与后端一致且与会话对象不共享引用的副本
+    return json.loads(json.dumps(record, ensure_ascii=False, default=str))
+
+
+class SessionStore:
+    """带空闲过期、LRU 淘汰、内存预算和可选持久化后端的会话存储"""
+
+    def __init__(
+        self,
+        ttl_seconds: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        sweep_interval: Optional[float] = None,
+        backend: Any = _DEFAULT_BACKEND,
+    ):
+        """
+        Args:
+            ttl_seconds: 空闲过期时间（秒）
+            max_bytes: 所有会话的总字节预算
+            sweep_interval: 后台清理间隔（秒）
+            backend: 持久化后端（None 表示仅内存），默认按 SESSION_BACKEND 创建
+        """
+        self.ttl_seconds = ttl_seconds or settings.SESSION_TTL_SECONDS
+        self.max_bytes = max_bytes or settings.SESSION_MAX_BYTES
+        self.sweep_interval = sweep_interval or settings.SESSION_SWEEP_INTERVAL
+        self.flush_interval = settings.SESSION_FLUSH_INTERVAL
+        self.backend: Optional[SessionBackend] = (
+            create_session_backend() if backend is _DEFAULT_BACKEND else backend
+        )
+
+        # session_id -> 会话字典（按访问时间从旧到新排列）
+        self._sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._last_access: Dict[str, float] = {}
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        # 持久化状态：已知的后端修订号、上次比对修订号的时间，以及上次加载/写入的记录（三方合并的基准）
+        self._revisions: Dict[str, Revision] = {}
+        self._checked: Dict[str, float] = {}
+        self._base: Dict[str, Dict[str, Any]] = {}
+        # 尚未写入后端的对话历史（刷写在线程中执行，交换与回填缓冲时加锁）
+        self._pending_history: Dict[str, List[Dict[str, Any]]] = {}
+        self._history_lock = threading.Lock()
+        self._flush_requested: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._last_purge = time.monotonic()
+        self._stats = {
+            "created": 0, "expired": 0, "evicted": 0,
+            "loaded": 0, "reloaded": 0, "conflicts": 0, "history_flushed": 0,
+        }
+
+    # ==================== 访问 ====================
+
+    def _touch(self, session_id: str):
+        self._sessions.move_to_end(session_id)
+        self._last_access[session_id] = time.monotonic()
+
+    def _cache(self, session: Dict[str, Any]):
+        session_id = session["id"]
+        self._sessions[session_id] = session
+        self._sizes.setdefault(session_id, 0)
+        self._touch(session_id)
+        self._account(session)
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """获取已有会话（刷新访问时间，必要时从后端加载或重新加载）"""
+        session = self._sessions.get(session_id)
+        if self.backend is None:
+            if session is not None:
+                self._touch(session_id)
+            return session
+
+        checked = self._checked.get(session_id, 0.0)
+        if session is not None and time.monotonic() - checked < settings.SESSION_REVISION_CHECK_INTERVAL:
+            # 刚比对过修订号：直接使用缓存，不再查询后端
+            self._touch(session_id)
+            return session
+
+        revision = self.backend.revision(session_id)
+        self._checked[session_id] = time.monotonic()
+        if session is None:
+            if revision is None:
+                return None
+            stored = self.backend.load(session_id)
+            if stored is None:
+                return None
+            session = self._new_session(session_id)
+            self._base[session_id] = _to_record(session)
+            self._merge(session, stored)
+            self._cache(session)
+            self._stats["loaded"] += 1
+            return session
+
+        if revision is not None and revision != self._revisions.get(session_id):
+            # 其他 worker 修改过：以后端为准刷新（本进程的写入都已落盘，只有历史可能在缓冲中）
+            stored = self.backend.load(session_id)
+            if stored is not None:
+                self._merge(session, stored)
+                self._account(session)
+                self._stats["reloaded"] += 1
+        self._touch(session_id)
+        return session
+
+    @staticmethod
+    def _new_session(session_id: str) -> Dict[str, Any]:
+        return {
+            "id": session_id,
+            "history": [],
+            "current_image": None,
+            "analysis": None,
+            "generated_versions": [],
+            "summary": None,
+        }
+
+    def get_or_create(self, session_id: Optional[str] = None) -> Dict[str, Any]:
+        """获取或创建会话"""
+        if not session_id:
+            session_id = str(uuid.uuid4())
+
+        session = self.get(session_id)
+        if session is None:
+            session = self._new_session(session_id)
+            self._stats["created"] += 1
+            self._cache(session)
+            if self.backend is not None:
+                self._persist(session)
+        return session
+
+    def save(self, session: Dict[str, Any]):
+        """
+        会话内容修改后调用：写入后端、重新估算大小，超出预算时淘汰最久未访问的会话
+
+        Args:
+            session: 已修改的会话
+        """
+        session_id = session["id"]
+        cached = self._sessions.get(session_id)
+        if self.backend is None:
+            if cached is not session:
+                # 会话已被淘汰（如长时间生成期间），不再回写
+                return
+        else:
+            self._persist(session)
+            if cached is not None and cached is not session:
+                # 淘汰后被重新加载为新对象：把合并后的内容同步到缓存中的对象
+                for key in ("current_image", "analysis", "generated_versions"):
+                    cached[key] = session[key]
+                session = cached
+
+        if self._sessions.get(session_id) is not session:
+            self._cache(session)
+        else:
+            self._touch(session_id)
+            self._account(session)
+        self._enforce_budget(keep=session_id)
+
+    def append_history(self, session: Dict[str, Any], messages: List[ChatMessage]):
+        """
+        追加对话历史（持久化模式下先缓冲，由后台任务批量写入）
+
+        Args:
+            session: 会话
+            messages: 新增消息
+        """
+        session["history"].extend(messages)
+        if self.backend is not None:
+            with self._history_lock:
+                pending = self._pending_history.setdefault(session["id"], [])
+                pending.extend(m.model_dump() for m in messages)
+            if sum(len(p) for p in self._pending_history.values()) >= settings.SESSION_FLUSH_BATCH:
+                if self._flush_requested is not None:
+                    # 唤醒后台刷写任务，不在事件循环中同步写入
+                    self._flush_requested.set()
+                else:
+                    self.flush()
+        if self._sessions.get(session["id"]) is session:
+            self._touch(session["id"])
+            self._account(session)
+            self._enforce_budget(keep=session["id"])
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._sessions))
+
+    # ==================== 持久化 ====================
+
+    def _persist(self, session: Dict[str, Any]):
+        """按期望版本写入后端，冲突时合并后重试"""
+        session_id = session["id"]
+        # 参考图变化：先存入 blob 并持有引用，写入成功后释放被替换图片的引用
+        acquired = None
+        payload = session.get("current_image")
+        base_sha256 = (self._base.get(session_id) or {}).get("image_sha256")
+        if isinstance(payload, ImagePayload) and payload.sha256 != base_sha256:
+            acquired = blob_store.acquire(payload)
+
+        for _ in range(_MAX_SAVE_ATTEMPTS):
+            record = _to_record(session)
+            replaced = (self._base.get(session_id) or {}).get("image_sha256")
+            expected = self._revisions.get(session_id, (0, 0))
+            try:
+                version = self.backend.save(session_id, record, expected[0])
+            except SessionConflictError:
+                self._stats["conflicts"] += 1
+                stored = self.backend.load(session_id)
+                if stored is None:
+                    # 已被清理：按新会话重新创建
+                    self._revisions.pop(session_id, None)
+                    self._base.pop(session_id, None)
+                else:
+                    self._merge(session, stored)
+                continue
+            self._revisions[session_id] = (version, expected[1])
+            self._checked[session_id] = time.monotonic()
+            self._base[session_id] = record
+            if replaced != record["image_sha256"]:
+                blob_store.release(replaced)
+            elif acquired:
+                # 其他 worker 已写入同一张图，撤销本次多加的引用
+                blob_store.release(acquired)
+            return
+        blob_store.release(acquired)
+        print(f"[Session Store] 会话 {session_id} 写入冲突次数过多，放弃本次保存")
+
+    def _merge(self, session: Dict[str, Any], stored: StoredSession):
+        """
+        以上次加载/写入的记录为基准，把后端的新内容合并进会话（三方合并）
+
+        - analysis / 参考图：本进程未修改时采用后端的值，否则保留本进程的修改
+        - 版本列表：按 version_id 取并集，本进程修改过的版本以本进程为准
+        - 对话摘要：取覆盖消息更多的一份
+        - 对话历史：后端历史 + 本进程尚未写入的缓冲
+        """
+        session_id = session["id"]
+        base = self._base.get(session_id)
+        ours = _to_record(session)
+        theirs = stored.record
+
+        if base is not None and ours["analysis"] == base.get("analysis"):
+            analysis = theirs.get("analysis")
+            session["analysis"] = ImageAnalysis(**analysis) if analysis else None
+
+        if base is not None and ours["image_sha256"] == base.get("image_sha256"):
+            if theirs.get("image_sha256") != ours["image_sha256"]:
+                image_sha256 = theirs.get("image_sha256")
+                session["current_image"] = blob_store.open(image_sha256) if image_sha256 else None
+
+        base_versions = {v["version_id"]: v for v in (base or {}).get("generated_versions", [])}
+        our_versions = {v["version_id"]: v for v in session["generated_versions"]}
+        merged: Dict[str, Dict[str, Any]] = {}
+        for version in theirs.get("generated_versions", []):
+            mine = our_versions.get(version["version_id"])
+            # 写入会话的是副本：theirs 会成为下次合并的基准，会话中的原地修改不能改到基准
+            version = copy.deepcopy(version)
+            if mine is not None and mine != base_versions.get(version["version_id"]):
+                merged[version["version_id"]] = mine
+            elif mine is not None:
+                # 保持对象引用不变（后台分析任务持有该字典并会原地更新）
+                mine.clear()
+                mine.update(version)
+                merged[version["version_id"]] = mine
+            else:
+                merged[version["version_id"]] = version
+        for version_id, version in our_versions.items():
+            if version_id not in merged and version_id not in base_versions:
+                merged[version_id] = version
+        session["generated_versions"][:] = sorted(merged.values(), key=lambda v: v.get("created_at", ""))
+
+        # 对话摘要：取覆盖消息更多的一份
+        their_summary = theirs.get("summary")
+        our_summary = session.get("summary")
+        if their_summary and (not our_summary or their_summary["covered"] > our_summary["covered"]):
+            session["summary"] = copy.deepcopy(their_summary)
+
+        pending = self._pending_history.get(session_id, [])
+        session["history"][:] = [ChatMessage(**m) for m in stored.history + pending]
+
+        self._revisions[session_id] = stored.revision
+        self._base[session_id] = theirs
+
+    def flush(self):
+        """把缓冲的对话历史批量写入后端（后台任务在线程中调用）"""
+        if self.backend is None or not self._pending_history:
+            return
+        with self._history_lock:
+            batches, self._pending_history = self._pending_history, {}
+        try:
+            self.backend.append_history(batches)
+        except Exception as e:
+            print(f"[Session Store] 对话历史写入失败，稍后重试: {e}")
+            with self._history_lock:
+                for session_id, messages in batches.items():
+                    self._pending_history[session_id] = messages + self._pending_history.get(session_id, [])
+            return
+        for session_id, messages in batches.items():
+            self._stats["history_flushed"] += len(messages)
+            known = self._revisions.get(session_id)
+            if known is None:
+                continue
+            # 只有本进程写入时才推进已知修订号；其他 worker 同时写过则保持过期，下次访问重新加载
+            expected = (known[0], known[1] + len(messages))
+            try:
+                current = self.backend.revision(session_id)
+            except Exception as e:
+                # 历史已写入，只是无法确认修订号：保持过期，下次访问时重新加载
+                print(f"[Session Store] 读取会话修订号失败: {e}")
+                continue
+            # 等待期间本进程又写入过（修订号已变）时不覆盖
+            if current == expected and self._revisions.get(session_id) == known:
+                self._revisions[session_id] = expected
+
+    # ==================== 淘汰 ====================
+
+    def _account(self, session: Dict[str, Any]):
+        session_id = session["id"]
+        size = estimate_session_size(session)
+        self._bytes += size - self._sizes.get(session_id, 0)
+        self._sizes[session_id] = size
+
+    def _remove(self, session_id: str, reason: str):
+        session = self._sessions.pop(session_id, None)
+        self._last_access.pop(session_id, None)
+        self._bytes -= self._sizes.pop(session_id, 0)
+        self._revisions.pop(session_id, None)
+        self._checked.pop(session_id, None)
+        self._base.pop(session_id, None)
+        self._stats[reason] += 1
+        image = session.get("current_image") if session else None
+        if isinstance(image, ImagePayload) and self.backend is None:
+            image.close()
+
+    def _enforce_budget(self, keep: Optional[str] = None):
+        while self._bytes > self.max_bytes and len(self._sessions) > 1:
+            oldest = next(iter(self._sessions))
+            if oldest == keep:
+                break
+            print(f"[Session Store] 超出内存预算，淘汰会话 {oldest} ({self._sizes.get(oldest, 0)} bytes)")
+            self._remove(oldest, "evicted")
+
+    def sweep(self) -> int:
+        """
+        移除空闲超时的会话（持久化模式下只是移出内存，超过保留期的才从后端删除）
+
+        Returns:
+            移除的会话数
+        """
+        deadline = time.monotonic() - self.ttl_seconds
+        expired = []
+        # 按访问时间有序，遇到第一个未过期的即可停止
+        for session_id in self._sessions:
+            if self._last_access[session_id] > deadline:
+                break
+            expired.append(session_id)
+        for session_id in expired:
+            self._remove(session_id, "expired")
+        if expired:
+            print(f"[Session Store] 清理 {len(expired)} 个过期会话，剩余 {len(self._sessions)} 个")
+
+        if self.backend is not None and time.monotonic() - self._last_purge > self.ttl_seconds:
+            self._last_purge = time.monotonic()
+            purged = self.backend.purge(settings.SESSION_RETENTION_SECONDS)
+            for record in purged:
+                blob_store.release(record.get("image_sha256"))
+            if purged:
+                print(f"[Session Store] 从后端删除 {len(purged)} 个超过保留期的会话")
+            blob_store.gc()
+        return len(expired)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[Session Store] 清理失败: {e}")
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                print(f"[Session Store] 刷写对话历史失败: {e}")
+
+    def start(self):
+        """启动后台清理与对话历史刷写任务"""
+        if self._tasks:
+            return
+        self._tasks.append(asyncio.create_task(self._sweep_loop(), name="session-sweeper"))
+        if self.backend is not None:
+            self._flush_requested = asyncio.Event()
+            self._tasks.append(asyncio.create_task(self._flush_loop(), name="session-flusher"))
+
+    async def stop(self):
+        """停止后台任务，并写入缓冲中的对话历史"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._flush_requested = None
+        await asyncio.to_thread(self.flush)
+        if self.backend is not None:
+            self.backend.close()
+
+    def metrics(self) -> Dict[str, Any]:
+        """会话存储指标"""
+        return {
+            "backend": type(self.backend).__name__ if self.backend else "memory",
+            "active_sessions": len(self._sessions),
+            "bytes_held": self._bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "pending_history": sum(len(p) for p in self._pending_history.values()),
+            **self._stats,
+        }
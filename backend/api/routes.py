@@ -1,9 +1,13 @@
 """
 API 路由定义
 """
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
-import base64
+from fastapi import APIRouter, UploadFile, File, HTTPException, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+import asyncio
+import math
+import uuid
+import zipfile
+from pathlib import Path
 from typing import Optional
 
 from models import (
@@ -20,11 +24,64 @@ from models import (
     PresetListResponse,
     DesignPreset,
 )
-from agents import design_agent
-from services import claude_service, seedream_service, gallery_service, preset_service
+from agents import design_agent, job_manager, JobQueueFullError
+from agents.job_manager import TERMINAL_STATUSES
+from services import (
+    claude_service, seedream_service, gallery_service, preset_service, event_bus, blob_store, generated_store,
+    image_derivatives, asset_registry, gallery_ingest,
+)
+from services.event_bus import sse_format
+from services.gallery_service import DuplicateReferenceError, DUPLICATE_POLICIES
+from config import get_settings
+from services.rate_limiter import UpstreamBusyError, limiter_metrics
+from utils.image_payload import ImagePayload, PayloadTooLargeError
+from utils.http_cache import cached_response, cache_headers, is_not_modified
+
+settings = get_settings()
 
 router = APIRouter(prefix="/api/v1", tags=["Design API"])
 
+# 预设只在 presets.json 变化时变化：允许浏览器短时间内直接使用缓存，过期后用 ETag 重新验证
+PRESET_CACHE_CONTROL = f"public, max-age={settings.PRESET_CACHE_MAX_AGE}"
+
+# 批量上传时处理的图片扩展名
+BULK_IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+async def _read_upload(upload: UploadFile) -> ImagePayload:
+    """
+    流式读取上传文件
+
+    分块写入溢出式临时文件并增量计算哈希，超过 MAX_UPLOAD_BYTES 返回 413
+    """
+    try:
+        return await ImagePayload.from_stream(
+            upload.read,
+            max_bytes=settings.MAX_UPLOAD_BYTES,
+            spool_bytes=settings.UPLOAD_SPOOL_BYTES,
+        )
+    except PayloadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+
+def _duplicate_reference(e: DuplicateReferenceError) -> HTTPException:
+    """入库图片与已有参考图重复时返回 409，并给出已有参考图"""
+    return HTTPException(status_code=409, detail={
+        "message": str(e),
+        "duplicate_of": e.item["id"],
+        "distance": e.distance,
+    })
+
+
+def _upstream_busy(e: UpstreamBusyError) -> HTTPException:
+    """上游繁忙时返回 503 并附带 Retry-After，让客户端稍后重试"""
+    retry_after = max(1, math.ceil(e.retry_after or 1))
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(retry_after)},
+    )
+
 
 # ==================== 设计生成 ====================
 
@@ -33,7 +90,8 @@ async def generate_design(request: GenerateRequest):
     """
     主设计生成接口
 
-    根据用户指令和可选的参考图生成挂饰设计（自然语言模式）
+    根据用户指令和可选的参考图生成挂饰设计（自然语言模式）；
+    variants > 1 时一次生成多个方案，按与指令的相关度排名后在 variants 字段返回
     """
     try:
         result = await design_agent.generate_design(
@@ -41,8 +99,13 @@ async def generate_design(request: GenerateRequest):
             reference_image=request.reference_image,
             session_id=request.session_id,
             image_size=request.image_size,
+            defer_analysis=request.defer_analysis,
+            variants=request.variants,
+            variant_strategy=request.variant_strategy,
         )
         return result
+    except UpstreamBusyError as e:
+        raise _upstream_busy(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -57,62 +120,127 @@ async def generate_design_with_upload(
     带文件上传的设计生成接口
     """
     try:
-        image_base64 = None
+        payload = None
         if reference_image:
-            content = await reference_image.read()
-            image_base64 = base64.b64encode(content).decode("utf-8")
+            payload = await _read_upload(reference_image)
 
         result = await design_agent.generate_design(
             instruction=instruction,
-            reference_image=image_base64,
+            reference_image=payload,
             session_id=session_id,
         )
         return result
+    except HTTPException:
+        raise
+    except UpstreamBusyError as e:
+        raise _upstream_busy(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/generate/jobs", status_code=202)
+async def submit_generate_job(request: GenerateRequest):
+    """
+    提交异步设计生成任务
+
+    立即返回任务ID，生成在后台 worker 池中执行；
+    通过 GET /generate/jobs/{job_id} 查询或 /generate/jobs/{job_id}/events 订阅进度
+    """
+    try:
+        return await job_manager.submit(request)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "10"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/generate/jobs/{job_id}")
+async def get_generate_job(job_id: str):
+    """
+    查询生成任务
+
+    返回状态（queued/running/succeeded/failed/cancelled）、各阶段进度和结果
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+
+@router.delete("/generate/jobs/{job_id}")
+async def cancel_generate_job(job_id: str):
+    """
+    取消生成任务（排队中直接移出队列，执行中中断流水线）
+    """
+    job = await job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+
+@router.get("/generate/jobs/{job_id}/events")
+async def generate_job_events(job_id: str):
+    """
+    生成任务进度事件流（SSE）
+
+    先推送一次当前快照（snapshot），之后推送 stage / status 事件，任务结束后关闭连接
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+    async def stream():
+        yield sse_format({"event": "snapshot", **job})
+        if job["status"] in TERMINAL_STATUSES:
+            return
+        async for event in event_bus.subscribe(f"job:{job_id}", heartbeat=5.0):
+            if event is None:
+                # 心跳时回查一次，避免订阅建立前任务已结束而错过终态事件
+                latest = job_manager.get(job_id)
+                if latest is None or latest["status"] in TERMINAL_STATUSES:
+                    yield sse_format({"event": "snapshot", **(latest or job)})
+                    return
+            yield sse_format(event)
+            if event and event.get("event") == "status" and event.get("status") in TERMINAL_STATUSES:
+                return
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # ==================== 预设管理 ====================
 
 @router.get("/presets", response_model=PresetListResponse)
-async def list_presets():
+async def list_presets(request: Request):
     """
     获取所有可用预设
 
-    返回产品类型和风格预设列表
+    返回产品类型和风格预设列表（响应体预先序列化，支持 ETag / Last-Modified 条件请求）
     """
-    try:
-        return preset_service.list_presets()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return cached_response(request, preset_service.responses["presets"], PRESET_CACHE_CONTROL)
 
 
 @router.get("/presets/product-types")
-async def list_product_types():
+async def list_product_types(request: Request):
     """
     获取所有产品类型预设
     """
-    try:
-        types = preset_service.list_product_types()
-        return {"success": True, "product_types": types}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return cached_response(request, preset_service.responses["product_types"], PRESET_CACHE_CONTROL)
 
 
 @router.get("/presets/styles")
-async def list_styles():
+async def list_styles(request: Request):
     """
     获取所有风格预设
     """
-    try:
-        styles = preset_service.list_styles()
-        return {"success": True, "styles": styles}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return cached_response(request, preset_service.responses["styles"], PRESET_CACHE_CONTROL)
 
 
 @router.get("/presets/{product_type}/{style}", response_model=DesignPreset)
-async def get_preset(product_type: str, style: str):
+async def get_preset(product_type: str, style: str, request: Request):
     """
     获取指定的组合预设
 
@@ -120,11 +248,7 @@ async def get_preset(product_type: str, style: str):
         product_type: 产品类型ID (keychain, bag_charm, etc.)
         style: 风格ID (ocean_kawaii, vintage_bohemian, etc.)
     """
-    try:
-        preset = preset_service.get_preset(product_type, style)
-        return preset
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return cached_response(request, preset_service.cached_preset(product_type, style), PRESET_CACHE_CONTROL)
 
 
 # ==================== 图像分析 ====================
@@ -147,6 +271,8 @@ async def analyze_image(
             include_similar=include_similar,
         )
         return result
+    except UpstreamBusyError as e:
+        raise _upstream_busy(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -160,15 +286,18 @@ async def analyze_image_upload(
     上传文件分析图像（统一使用 design_agent 的分析系统）
     """
     try:
-        content = await image.read()
-        image_base64 = base64.b64encode(content).decode("utf-8")
+        payload = await _read_upload(image)
 
         # 统一调用 design_agent 的分析方法
         result = await design_agent.analyze_reference(
-            image_base64=image_base64,
+            image_base64=payload,
             include_similar=include_similar,
         )
         return result
+    except HTTPException:
+        raise
+    except UpstreamBusyError as e:
+        raise _upstream_busy(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -193,6 +322,8 @@ async def generate_image(
             size=size,
         )
         return result
+    except UpstreamBusyError as e:
+        raise _upstream_busy(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -217,6 +348,8 @@ async def chat(request: ChatRequest):
             message=response,
             session_id=session_id,
         )
+    except UpstreamBusyError as e:
+        raise _upstream_busy(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -227,11 +360,44 @@ async def chat(request: ChatRequest):
 async def get_session_versions(session_id: str):
     """
     获取会话的版本历史
+
+    每个版本带 analysis_status，后台分析完成后 analysis / cost_estimate 会被填充
     """
     versions = design_agent.get_session_versions(session_id)
     return {"session_id": session_id, "versions": versions}
 
 
+@router.get("/session/{session_id}/events")
+async def session_events(session_id: str):
+    """
+    会话事件流（SSE）
+
+    生成图片的后台分析完成后推送 version_updated 事件。
+    事件总线只在进程内分发：分析在其他 worker 中完成时，心跳时回查会话（从持久化后端重新加载），
+    对分析状态有变化的版本补发 version_updated
+    """
+    def statuses() -> dict:
+        return {v["version_id"]: v.get("analysis_status") for v in design_agent.get_session_versions(session_id)}
+
+    async def stream():
+        seen = statuses()
+        async for event in event_bus.subscribe(f"session:{session_id}", heartbeat=5.0):
+            if event is None:
+                for version in design_agent.get_session_versions(session_id):
+                    if seen.get(version["version_id"]) != version.get("analysis_status"):
+                        seen[version["version_id"]] = version.get("analysis_status")
+                        yield sse_format({"event": "version_updated", "session_id": session_id, "version": version})
+            elif event.get("event") == "version_updated":
+                seen[event["version"]["version_id"]] = event["version"].get("analysis_status")
+            yield sse_format(event)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # ==================== 健康检查 ====================
 
 @router.get("/health")
@@ -242,37 +408,194 @@ async def health_check():
     return {"status": "healthy", "service": "AI Design Platform"}
 
 
+@router.get("/metrics/upstream")
+async def upstream_metrics():
+    """
+    上游限流指标
+
+    返回每个上游模型的并发数、队列深度、等待时间和限流次数，以及生成任务队列状态
+    """
+    return {"limiters": limiter_metrics(), "jobs": job_manager.metrics(), "gallery_ingest": gallery_ingest.metrics()}
+
+
+@router.get("/metrics/sessions")
+async def session_metrics():
+    """
+    会话存储指标
+
+    返回活跃会话数、估算占用字节、预算、过期/淘汰次数、对话上下文预算统计，以及内容寻址图片存储、生成图片本地存储、衍生图缓存和数据资源热重载的统计
+    """
+    return {
+        **design_agent.sessions.metrics(),
+        "chat": design_agent.history.metrics(),
+        "blobs": blob_store.metrics(),
+        "generated": generated_store.metrics(),
+        "derivatives": image_derivatives.metrics(),
+        "assets": asset_registry.metrics(),
+    }
+
+
 # ==================== 图库管理 ====================
 
+def _validate_duplicate_policy(duplicate_policy: Optional[str]):
+    if duplicate_policy is not None and duplicate_policy not in DUPLICATE_POLICIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"duplicate_policy 只能是 {', '.join(DUPLICATE_POLICIES)}",
+        )
+
+
+async def _ingest_image(
+    payload: ImagePayload,
+    sales_tier: str,
+    duplicate_policy: Optional[str],
+    filename: Optional[str] = None,
+    batch_id: Optional[str] = None,
+) -> dict:
+    """
+    入库一张图片：先查重（只计算哈希），重复图片按策略立即处理，其余提交到后台入库队列
+
+    Raises:
+        DuplicateReferenceError: 重复且策略为 reject
+    """
+    duplicate = await gallery_service.find_duplicate(payload)
+    if duplicate:
+        existing, distance = duplicate
+        item = await gallery_service.handle_duplicate(payload, existing, distance, sales_tier, duplicate_policy)
+        return {
+            "status": "indexed",
+            "reference": item,
+            "duplicate": {
+                "policy": duplicate_policy or settings.GALLERY_DUPLICATE_POLICY,
+                "duplicate_of": existing["id"],
+                "distance": distance,
+            },
+        }
+
+    ingest = gallery_ingest.submit(payload, sales_tier, filename=filename, batch_id=batch_id)
+    return {"status": ingest["status"], "ingest": ingest}
+
+
 @router.post("/gallery/references")
 async def upload_reference(
     image: UploadFile = File(...),
-    sales_tier: str = "B"
+    sales_tier: str = "B",
+    duplicate_policy: Optional[str] = None,
 ):
     """
     上传参考图到图库
 
-    自动生成图像分析和嵌入向量
+    图片保存后立即返回 status: pending，分析、向量生成和写入图库由后台入库队列完成，
+    通过 GET /gallery/ingest/{ingest_id} 查询进度（pending → analyzed → embedded → indexed）。
+
+    入库前先查重（内容哈希 → 感知哈希），重复图片按 duplicate_policy（默认 GALLERY_DUPLICATE_POLICY）立即处理：
+    - reject: 返回 409
+    - alias: 返回已有的参考图
+    - copy: 复用已有的分析结果和向量，以 sales_tier 另存一条
     """
+    _validate_duplicate_policy(duplicate_policy)
     try:
-        # 读取图像
-        content = await image.read()
-        image_base64 = base64.b64encode(content).decode("utf-8")
+        # 流式读取图像（查重与入库共用同一个载体）
+        payload = await _read_upload(image)
+        try:
+            result = await _ingest_image(payload, sales_tier, duplicate_policy, filename=image.filename)
+        finally:
+            payload.close()
+        return {"success": True, **result}
+    except HTTPException:
+        raise
+    except DuplicateReferenceError as e:
+        raise _duplicate_reference(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # 分析图片
-        analysis = await claude_service.analyze_image(image_base64)
 
-        # 添加到图库（包含向量嵌入）
-        item = await gallery_service.add_reference(
-            image_base64, analysis, sales_tier
-        )
+@router.post("/gallery/references/bulk")
+async def upload_references_bulk(
+    archive: UploadFile = File(...),
+    sales_tier: str = "B",
+    duplicate_policy: Optional[str] = None,
+):
+    """
+    批量上传参考图（zip 压缩包）
 
-        return {
-            "success": True,
-            "reference": item
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    压缩包中的每张图片（jpg / png / webp）与单张上传一样查重后进入后台入库队列，
+    通过 GET /gallery/ingest/batches/{batch_id} 查询整批进度。
+    单张图片重复（reject 策略）或无法读取不影响其他图片，在响应中分别列出
+    """
+    _validate_duplicate_policy(duplicate_policy)
+    batch_id = str(uuid.uuid4())
+    results = []
+    rejected = []
+    errors = []
+
+    try:
+        # 上传文件已由 starlette 落盘（大文件），zip 目录在线程中解析
+        archive_file = await asyncio.to_thread(zipfile.ZipFile, archive.file)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="不是有效的 zip 文件")
+
+    with archive_file:
+        entries = [
+            info for info in archive_file.infolist()
+            if not info.is_dir()
+            and not info.filename.startswith("__MACOSX/")
+            and Path(info.filename).suffix.lower() in BULK_IMAGE_SUFFIXES
+        ]
+        if len(entries) > settings.GALLERY_BULK_MAX_FILES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"压缩包中的图片过多，最多 {settings.GALLERY_BULK_MAX_FILES} 张",
+            )
+
+        for info in entries:
+            name = info.filename
+            if info.file_size > settings.MAX_UPLOAD_BYTES:
+                errors.append({"filename": name, "error": str(PayloadTooLargeError(settings.MAX_UPLOAD_BYTES))})
+                continue
+            try:
+                data = await asyncio.to_thread(archive_file.read, info)
+                result = await _ingest_image(
+                    ImagePayload(data=data), sales_tier, duplicate_policy,
+                    filename=Path(name).name, batch_id=batch_id,
+                )
+                results.append({"filename": name, **result})
+            except DuplicateReferenceError as e:
+                rejected.append({"filename": name, "duplicate_of": e.item["id"], "distance": e.distance})
+            except Exception as e:
+                errors.append({"filename": name, "error": str(e)})
+
+    return {
+        "success": True,
+        "batch_id": batch_id,
+        "queued": sum(1 for result in results if "ingest" in result),
+        "items": results,
+        "rejected": rejected,
+        "errors": errors,
+    }
+
+
+@router.get("/gallery/ingest/{ingest_id}")
+async def get_ingest_status(ingest_id: str):
+    """
+    查询单张图片的入库进度
+
+    status: pending → analyzed → embedded → indexed，失败时为 failed（error 为原因）；
+    indexed 时 reference 为写入图库的参考图
+    """
+    item = gallery_ingest.get(ingest_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="入库记录不存在")
+    return item
+
+
+@router.get("/gallery/ingest/batches/{batch_id}")
+async def get_ingest_batch(batch_id: str):
+    """查询批量上传的入库进度（各状态计数与每张图片的状态）"""
+    batch = gallery_ingest.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="批次不存在")
+    return batch
 
 
 @router.get("/gallery/references")
@@ -313,6 +636,46 @@ async def get_reference(ref_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/gallery/images/{image_id}")
+async def get_gallery_image(
+    image_id: str,
+    request: Request,
+    w: Optional[int] = Query(None, ge=1, le=4096, description="目标宽度（向上取整到档位）"),
+    fmt: Optional[str] = Query(None, pattern="^(webp|jpeg|jpg|png)$", description="输出格式"),
+):
+    """
+    获取图库图片（支持按需缩略图）
+
+    不带参数时返回原图；指定 w / fmt 时返回缓存的衍生图（如 ?w=320&fmt=webp）。
+    响应带 ETag / Last-Modified（条件请求命中时返回 304），支持 Range 分段请求
+    """
+    path = gallery_service.image_path(image_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    if w is None and fmt is None:
+        stat = path.stat()
+        target, media_type = path, None
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        # 原图可能被同名文件替换，每次使用前重新验证
+        cache_control = "no-cache"
+    else:
+        try:
+            derivative = await image_derivatives.get(path, width=w, fmt=fmt)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"缩略图生成失败: {e}")
+        stat = path.stat()
+        target, media_type, etag = derivative.path, derivative.media_type, derivative.etag
+        cache_control = "public, max-age=86400"
+
+    headers = cache_headers(etag, stat.st_mtime, cache_control)
+    headers["Accept-Ranges"] = "bytes"
+    if is_not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    # FileResponse 处理 Range / If-Range，返回 206 分段内容
+    return FileResponse(target, media_type=media_type, headers=headers)
+
+
 @router.delete("/gallery/references/{ref_id}")
 async def delete_reference(ref_id: str):
     """
@@ -368,5 +731,7 @@ async def find_similar_images(request: SimilarSearchRequest):
             "success": True,
             "similar": similar_items
         }
+    except UpstreamBusyError as e:
+        raise _upstream_busy(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
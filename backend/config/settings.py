@@ -21,6 +21,81 @@ class Settings(BaseSettings):
     # 图像生成模型选择 (nano_banana / seedream)
     IMAGE_GENERATION_MODEL: str = "seedream"
 
+    # 上游限流配置（Claude / 嵌入 / Seedream 共享同一网关 Key）
+    UPSTREAM_MAX_IN_FLIGHT: int = 4  # 每个模型的最大并发请求数
+    UPSTREAM_MODEL_MAX_IN_FLIGHT: dict = {}  # 按模型名覆盖最大并发数
+    UPSTREAM_RATE_PER_SEC: float = 0.0  # 每个模型的请求速率上限，0 表示不限速
+    UPSTREAM_BURST: int = 4  # 令牌桶容量
+    UPSTREAM_QUEUE_TIMEOUT: float = 60.0  # 排队等待超时（秒）
+    UPSTREAM_MAX_RETRIES: int = 3  # 遇到 429/5xx 的最大重试次数
+    UPSTREAM_BACKOFF_BASE: float = 0.5  # 指数退避基数（秒）
+    UPSTREAM_BACKOFF_MAX: float = 20.0  # 单次退避上限（秒）
+
+    # 设计生成流水线：并行执行互不依赖的阶段（False 时按顺序执行，便于排查和对比）
+    PIPELINE_CONCURRENT: bool = True
+    # 生成图片的分析与成本估算放到后台执行，先返回图片 URL（False 时保持阻塞式行为）
+    DEFER_GENERATED_ANALYSIS: bool = True
+
+    # 生成图片本地存储
+    GENERATED_THUMBNAIL_SIZES: list = [256, 512, 1024]  # WebP 缩略图宽度
+    GENERATED_MAX_BYTES: int = 50 * 1024 * 1024  # 单张生成图片的最大下载大小
+
+    # 图片衍生图（按需缩略图）
+    GALLERY_DERIVATIVE_WIDTHS: list = [160, 320, 480, 640, 960, 1280, 1920]  # 允许的宽度档位
+    DERIVATIVE_CACHE_MAX_BYTES: int = 256 * 1024 * 1024  # 衍生图磁盘缓存上限
+    DERIVATIVE_WORKERS: int = 2  # 缩放进程池大小
+    DERIVATIVE_QUALITY: int = 80  # WebP / JPEG 编码质量
+
+    # HTTP 缓存
+    PRESET_CACHE_MAX_AGE: int = 300  # 预设接口的浏览器缓存时间（秒）
+
+    # 图库查重
+    GALLERY_DUPLICATE_DISTANCE: int = 6  # pHash 汉明距离不超过该值视为重复图片，负数表示入库时不查重
+    GALLERY_DUPLICATE_POLICY: str = "reject"  # 重复图片的处理策略：reject 拒绝 / alias 返回已有项 / copy 复用分析和向量另存一条
+
+    # 图库后台入库
+    GALLERY_INGEST_WORKERS: int = 4  # 并行处理的入库图片数（分析 / 向量请求仍受模型限流器约束）
+    GALLERY_INGEST_DB_PATH: str = ""  # 入库队列 SQLite 路径，为空时使用 data/gallery/ingest.db
+    GALLERY_BULK_MAX_FILES: int = 1000  # 单个 zip 批量上传的最大图片数
+
+    # 上传配置
+    MAX_UPLOAD_BYTES: int = 25 * 1024 * 1024  # 单个上传文件的最大字节数
+    UPLOAD_SPOOL_BYTES: int = 1024 * 1024  # 超过该大小的上传转存到磁盘临时文件
+
+    # 生成任务队列配置（认领过期、心跳与扫描间隔同样用于图库入库队列）
+    JOB_WORKERS: int = 2  # 并行执行的生成任务数
+    JOB_MAX_PENDING: int = 100  # 最大排队任务数，超出时拒绝提交
+    JOBS_DB_PATH: str = ""  # 任务持久化 SQLite 路径，为空时使用 data/jobs.db
+    JOB_STALE_SECONDS: float = 600.0  # running 任务超过该时间未更新视为所属进程已退出，可被接管
+    JOB_HEARTBEAT_INTERVAL: float = 30.0  # 执行中任务刷新 updated_at 的间隔（秒），需远小于 JOB_STALE_SECONDS
+    JOB_SCAN_INTERVAL: float = 30.0  # 扫描共享数据库中排队任务与过期 running 任务的间隔（秒）
+
+    # 会话存储配置
+    SESSION_TTL_SECONDS: float = 2 * 60 * 60  # 会话空闲过期时间（秒）
+    SESSION_MAX_BYTES: int = 512 * 1024 * 1024  # 所有会话的总内存预算（估算字节）
+    SESSION_SWEEP_INTERVAL: float = 60.0  # 过期会话清理间隔（秒）
+    SESSION_BACKEND: str = "sqlite"  # 会话持久化后端：sqlite / file / memory（memory 仅支持单 worker）
+    SESSION_DB_PATH: str = ""  # SQLite 后端路径，为空时使用 data/sessions.db
+    SESSION_FILE_DIR: str = ""  # 文件后端目录，为空时使用 data/sessions
+    SESSION_FLUSH_INTERVAL: float = 0.5  # 对话历史批量写入间隔（秒）
+    SESSION_FLUSH_BATCH: int = 50  # 缓冲的对话历史条数达到该值时立即写入
+    SESSION_REVISION_CHECK_INTERVAL: float = 1.0  # 同一会话两次比对后端修订号的最小间隔（秒）
+    SESSION_RETENTION_SECONDS: float = 7 * 24 * 60 * 60  # 持久化会话的保留时间（秒）
+
+    # 数据资源热重载（presets.json / few_shot_examples.json）
+    ASSET_RELOAD_INTERVAL: float = 2.0  # 检查文件变化的间隔（秒），0 表示关闭热重载
+
+    # 向量嵌入
+    EMBEDDING_BATCH_SIZE: int = 64  # 批量生成向量时每次请求的文本数
+
+    # Few-shot 示例检索
+    FEW_SHOT_TOP_K: int = 3  # 每次对话注入的最相关示例数
+
+    # 对话上下文预算
+    CHAT_HISTORY_TOKEN_BUDGET: int = 6000  # 每轮发送的对话上下文 token 预算（不含 System Prompt）
+    CHAT_KEEP_TURNS: int = 6  # 原样保留的最近对话轮数
+    CHAT_SUMMARY_MAX_TOKENS: int = 600  # 历史摘要的最大输出 token 数
+
     # 应用配置
     APP_NAME: str = "AI挂饰设计平台"
     DEBUG: bool = True
@@ -14,6 +14,12 @@ from contextlib import asynccontextmanager
 
 from config import get_settings
 from api import router
+from agents import design_agent, job_manager
+from services import (
+    generated_store, image_derivatives, asset_registry, gallery_ingest, gallery_service, preset_service,
+)
+from utils.http_cache import ImmutableStaticFiles
+from utils.lazy_service import warm_up
 
 settings = get_settings()
 
@@ -24,8 +30,22 @@ async def lifespan(app: FastAPI):
     # 启动时
     print(f"🚀 {settings.APP_NAME} 启动中...")
     print(f"📡 API Base: {settings.OPENAI_API_BASE}")
+    # 服务单例延迟构造，启动时预热，避免第一个请求承担加载成本
+    timings = warm_up(gallery_service, preset_service, design_agent)
+    print("🔥 服务预热: " + ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in timings.items()))
+    design_agent.sessions.start()
+    design_agent.few_shot.start_warm_up()
+    asset_registry.start()
+    await job_manager.start()
+    await gallery_ingest.start()
     yield
     # 关闭时
+    await asset_registry.stop()
+    await job_manager.stop()
+    await gallery_ingest.stop()
+    await design_agent.history.stop()
+    await design_agent.sessions.stop()
+    image_derivatives.shutdown()
     print(f"👋 {settings.APP_NAME} 已关闭")
 
 
@@ -54,6 +74,11 @@ gallery_images_path = Path(__file__).parent / "data" / "gallery" / "images"
 gallery_images_path.mkdir(parents=True, exist_ok=True)
 app.mount("/gallery/images", StaticFiles(directory=str(gallery_images_path)), name="gallery_images")
 
+# 挂载静态文件服务（本地存储的生成图片及缩略图）
+generated_store.ensure_dirs()
+# 文件名即内容哈希，内容不会变化，允许浏览器永久缓存
+app.mount(generated_store.URL_PREFIX, ImmutableStaticFiles(directory=str(generated_store.base_dir)), name="generated_images")
+
 
 # 根路径
 @app.get("/")
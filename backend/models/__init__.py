@@ -1,6 +1,7 @@
 from .schemas import (
     AspectRatio,
     ImageSize,
+    VariantStrategy,
     StyleHint,
     ChatMessage,
     ChatContext,
@@ -18,6 +19,7 @@ from .schemas import (
     SimilarItem,
     GenerationResult,
     ChatResponse,
+    DesignVariant,
     DesignResponse,
     ErrorResponse,
     # 产品类型和结构类型枚举
@@ -28,12 +30,14 @@ from .schemas import (
     ProductTypePreset,
     StylePreset,
     DesignPreset,
+    PresetDetection,
     PresetListResponse,
 )
 
 __all__ = [
     "AspectRatio",
     "ImageSize",
+    "VariantStrategy",
     "StyleHint",
     "ChatMessage",
     "ChatContext",
@@ -51,6 +55,7 @@ __all__ = [
     "SimilarItem",
     "GenerationResult",
     "ChatResponse",
+    "DesignVariant",
     "DesignResponse",
     "ErrorResponse",
     "ProductType",
@@ -59,5 +64,6 @@ __all__ = [
     "ProductTypePreset",
     "StylePreset",
     "DesignPreset",
+    "PresetDetection",
     "PresetListResponse",
 ]
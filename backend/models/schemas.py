@@ -2,7 +2,7 @@
 Pydantic数据模型
 """
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Dict
 from enum import Enum
 
 
@@ -27,6 +27,12 @@ class ImageSize(str, Enum):
     SIZE_4K = "4K"
 
 
+class VariantStrategy(str, Enum):
+    """多方案生成策略"""
+    BATCH = "batch"  # 单次请求 n 张，不足部分再按不同 seed 补齐
+    SEEDS = "seeds"  # 按不同 seed 并行发起多次请求
+
+
 class StyleHint(str, Enum):
     """风格提示 - 用于引导生成结果的风格方向"""
     OCEAN_KAWAII = "ocean_kawaii"         # 海洋风少女系
@@ -55,6 +61,9 @@ class GenerateRequest(BaseModel):
     aspect_ratio: AspectRatio = Field(AspectRatio.RATIO_1_1, description="生成图像宽高比")
     image_size: ImageSize = Field(ImageSize.SIZE_2K, description="生成图像尺寸")
     style_hint: Optional[StyleHint] = Field(None, description="风格提示，用于引导生成方向")
+    defer_analysis: Optional[bool] = Field(None, description="是否后台分析生成图片（默认使用服务端配置）")
+    variants: int = Field(1, ge=1, le=8, description="生成方案数量，大于 1 时启用多方案模式")
+    variant_strategy: VariantStrategy = Field(VariantStrategy.BATCH, description="多方案生成策略")
 
 
 class ChatContext(BaseModel):
@@ -159,15 +168,32 @@ class ChatResponse(BaseModel):
     session_id: str = Field(..., description="会话ID")
 
 
+class DesignVariant(BaseModel):
+    """多方案模式下的单个方案"""
+    version_id: str = Field(..., description="版本ID")
+    image_url: str = Field(..., description="生成图像URL")
+    thumbnails: Optional[Dict[str, str]] = Field(None, description="WebP 缩略图URL（宽度 → URL）")
+    rank: Optional[int] = Field(None, description="排名（1 为与指令最相关）")
+    score: Optional[float] = Field(None, description="与指令的相似度")
+    analysis: Optional[ImageAnalysis] = Field(None, description="图像分析结果")
+    cost_estimate: Optional[dict] = Field(None, description="成本估算")
+    analysis_status: Optional[str] = Field(None, description="分析状态")
+
+
 class DesignResponse(BaseModel):
     """设计生成响应"""
     success: bool = Field(..., description="是否成功")
     image_url: Optional[str] = Field(None, description="生成图像URL")
+    thumbnails: Optional[Dict[str, str]] = Field(None, description="WebP 缩略图URL（宽度 → URL）")
     analysis: Optional[ImageAnalysis] = Field(None, description="图像分析结果")
     prompt_used: Optional[str] = Field(None, description="使用的提示词")
     message: str = Field("", description="处理消息")
     cost_estimate: Optional[dict] = Field(None, description="成本估算")
     session_id: Optional[str] = Field(None, description="会话ID")
+    timings: Optional[Dict[str, float]] = Field(None, description="各阶段耗时（毫秒）")
+    version_id: Optional[str] = Field(None, description="版本ID")
+    analysis_status: Optional[str] = Field(None, description="生成图片分析状态: pending/completed/failed/skipped")
+    variants: Optional[List[DesignVariant]] = Field(None, description="多方案模式下的全部方案（按排名排序）")
 
 
 class ErrorResponse(BaseModel):
@@ -247,6 +273,16 @@ class DesignPreset(BaseModel):
         return self.style.id
 
 
+class PresetDetection(BaseModel):
+    """预设检测结果"""
+    product_type: str = Field(..., description="产品类型ID")
+    product_type_confidence: float = Field(0.0, description="产品类型置信度（0 表示未命中，使用默认值）")
+    style: str = Field(..., description="风格ID")
+    style_confidence: float = Field(0.0, description="风格置信度（0 表示未命中，使用默认值）")
+    product_type_scores: Dict[str, float] = Field(default_factory=dict, description="各产品类型的加权得分")
+    style_scores: Dict[str, float] = Field(default_factory=dict, description="各风格的加权得分")
+
+
 class PresetListResponse(BaseModel):
     """预设列表响应"""
     product_types: List[ProductTypePreset] = Field(default_factory=list)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+设计生成流水线基准测试
+启动本地桩网关（模拟 Claude / 嵌入 / Seedream 的延迟），
+对比顺序执行、依赖图并行执行、以及后台分析生成图片（两阶段响应）的端到端耗时
+
+用法:
+  python benchmark_generate_pipeline.py              # 默认每种模式 3 轮
+  python benchmark_generate_pipeline.py --rounds 5
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import socket
+import statistics
+import sys
+from pathlib import Path
+
+# 桩网关监听地址（必须在导入 config 之前设置）
+STUB_PORT = int(os.environ.get("STUB_GATEWAY_PORT", "0")) or None
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+STUB_PORT = STUB_PORT or _free_port()
+os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{STUB_PORT}/v1"
+os.environ["OPENAI_API_KEY"] = "stub"
+
+# 添加 backend 目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+from PIL import Image
+
+# 模拟的上游延迟（秒）
+LATENCY = {
+    "vision": 1.2,
+    "enhance": 0.8,
+    "embedding": 0.4,
+    "seedream": 2.0,
+}
+
+STUB_ANALYSIS = {
+    "elements": {
+        "primary": [{"type": "贝壳", "color": "白色"}],
+        "secondary": [{"type": "玻璃珠", "count": 5}],
+        "hardware": [{"type": "龙虾扣", "material": "银色"}],
+    },
+    "style": {"tags": ["海洋风", "清新"], "mood": "夏日"},
+    "physicalSpecs": {"lengthCm": 12, "weightG": 8},
+    "suggestions": [],
+}
+
+
+def _sample_png() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (512, 512), (120, 180, 220)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+SAMPLE_PNG = _sample_png()
+
+stub_app = FastAPI()
+
+
+@stub_app.post("/v1/messages")
+async def stub_messages(request: Request):
+    payload = await request.json()
+    content = payload["messages"][-1]["content"]
+    is_vision = isinstance(content, list)
+    await asyncio.sleep(LATENCY["vision" if is_vision else "enhance"])
+    text = json.dumps(STUB_ANALYSIS, ensure_ascii=False) if is_vision else "Ocean-themed keychain with shell pendant"
+    return {"content": [{"type": "text", "text": text}]}
+
+
+@stub_app.post("/v1/embeddings")
+async def stub_embeddings(request: Request):
+    await asyncio.sleep(LATENCY["embedding"])
+    return {"data": [{"embedding": [0.1] * 1536}]}
+
+
+@stub_app.post("/v1/images/generations")
+async def stub_generations(request: Request):
+    await asyncio.sleep(LATENCY["seedream"])
+    return {"data": [{"url": f"http://127.0.0.1:{STUB_PORT}/files/generated.png"}]}
+
+
+@stub_app.get("/files/generated.png")
+async def stub_file():
+    return Response(content=SAMPLE_PNG, media_type="image/png")
+
+
+async def run_benchmark(rounds: int):
+    from config import get_settings
+    from agents import design_agent
+
+    settings = get_settings()
+    reference = base64.b64encode(SAMPLE_PNG).decode("utf-8")
+
+    server = uvicorn.Server(uvicorn.Config(stub_app, host="127.0.0.1", port=STUB_PORT, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    # (模式名, 并行执行, 后台分析)
+    modes = [
+        ("sequential", False, False),
+        ("concurrent", True, False),
+        ("deferred", True, True),
+    ]
+    results = {}
+    try:
+        for mode, concurrent, deferred in modes:
+            settings.PIPELINE_CONCURRENT = concurrent
+            totals = []
+            last_timings = {}
+            for _ in range(rounds):
+                response = await design_agent.generate_design(
+                    instruction="设计一个海洋风钥匙扣",
+                    reference_image=reference,
+                    include_similar=True,
+                    defer_analysis=deferred,
+                )
+                if not response.success:
+                    raise RuntimeError(response.message)
+                totals.append(response.timings["total"])
+                last_timings = response.timings
+            results[mode] = (totals, last_timings)
+        # 等待后台分析任务结束再关闭桩网关
+        await asyncio.gather(*list(design_agent._background_tasks), return_exceptions=True)
+    finally:
+        server.should_exit = True
+        await server_task
+
+    print("\n" + "=" * 60)
+    print("📊 设计生成流水线基准（本地桩网关）")
+    print("=" * 60)
+    print(f"模拟延迟: {LATENCY}")
+    for mode, (totals, timings) in results.items():
+        print(f"\n[{mode}] 端到端: 平均 {statistics.mean(totals):.0f} ms, 最小 {min(totals):.0f} ms")
+        for stage, duration in timings.items():
+            if stage != "total":
+                print(f"   {stage:<14} {duration:>8.0f} ms")
+
+    sequential = statistics.mean(results["sequential"][0])
+    print()
+    for mode in ("concurrent", "deferred"):
+        elapsed = statistics.mean(results[mode][0])
+        print(f"⏱  {mode} 相比 sequential 节省: {sequential - elapsed:.0f} ms ({(1 - elapsed / sequential) * 100:.1f}%)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="设计生成流水线基准测试")
+    parser.add_argument("--rounds", type=int, default=3, help="每种模式的运行轮数")
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(args.rounds))
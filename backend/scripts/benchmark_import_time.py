@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+导入耗时基准测试
+用 python -X importtime 在全新的解释器中导入各入口模块，统计累计导入耗时与最慢的模块，
+跟踪启动成本（服务单例延迟构造后，导入 services 不应再加载数据文件或构造服务）
+
+每个模块重复导入 --runs 次取中位数；--save 保存结果，--baseline 与之前保存的结果对比，
+--max-ms 超出时以非零状态退出（可用于 CI）
+
+用法:
+    python scripts/benchmark_import_time.py
+    python scripts/benchmark_import_time.py --save import_time.json
+    python scripts/benchmark_import_time.py --baseline import_time.json --max-ms main=800
+    python scripts/benchmark_import_time.py --warm-up     # 同时统计服务单例的构造耗时
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+BACKEND_DIR = Path(__file__).parent.parent
+
+# 默认统计的入口模块
+DEFAULT_MODULES = [
+    "config",
+    "services",
+    "services.claude_service",
+    "services.gallery_service",
+    "agents",
+    "api.routes",
+    "main",
+    "scripts.test_format_conversion",
+]
+
+WARM_UP_CODE = """
+import json
+from main import design_agent, gallery_service, preset_service
+from utils.lazy_service import warm_up
+print(json.dumps(warm_up(gallery_service, preset_service, design_agent)))
+"""
+
+
+def import_time(module: str) -> Tuple[float, List[Tuple[float, float, str]]]:
+    """
+    在新的解释器中导入模块
+
+    Returns:
+        (累计耗时 ms, [(自身耗时 ms, 累计耗时 ms, 模块名)])
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{result.stderr[-2000:]}")
+
+    rows: List[Tuple[float, float, str]] = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(self_us) / 1000, int(cumulative_us) / 1000, name.strip()))
+    total = next((cumulative for _, cumulative, name in reversed(rows) if name == module), 0.0)
+    return total, rows
+
+
+def warm_up_time() -> Dict[str, float]:
+    """在新的解释器中构造服务单例，返回各自的构造耗时（ms）"""
+    result = subprocess.run(
+        [sys.executable, "-c", WARM_UP_CODE], cwd=BACKEND_DIR, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"预热失败:\n{result.stderr[-2000:]}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return {name: seconds * 1000 for name, seconds in timings.items()}
+
+
+def parse_limits(values: List[str]) -> Dict[str, float]:
+    limits = {}
+    for value in values:
+        module, _, limit = value.partition("=")
+        limits[module] = float(limit)
+    return limits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="统计入口模块的导入耗时（python -X importtime）")
+    parser.add_argument("modules", nargs="*", help=f"要统计的模块（默认: {', '.join(DEFAULT_MODULES)}）")
+    parser.add_argument("--runs", type=int, default=5, help="每个模块的重复次数（取中位数）")
+    parser.add_argument("--top", type=int, default=10, help="显示自身耗时最长的模块数")
+    parser.add_argument("--save", type=Path, help="把结果保存为 JSON")
+    parser.add_argument("--baseline", type=Path, help="与之前保存的 JSON 结果对比")
+    parser.add_argument("--max-ms", nargs="*", default=[], metavar="MODULE=MS", help="耗时上限，超出时退出码为 1")
+    parser.add_argument("--warm-up", action="store_true", help="同时统计服务单例的构造耗时")
+    args = parser.parse_args()
+
+    modules = args.modules or DEFAULT_MODULES
+    baseline = json.loads(args.baseline.read_text(encoding="utf-8"))["modules"] if args.baseline else {}
+    limits = parse_limits(args.max_ms)
+
+    print("\n" + "="*60)
+    print(f"⏱️  导入耗时（{args.runs} 次中位数）")
+    print("="*60)
+
+    results: Dict[str, float] = {}
+    slowest: Dict[str, Tuple[float, str]] = {}
+    for module in modules:
+        totals = []
+        for _ in range(max(1, args.runs)):
+            total, rows = import_time(module)
+            totals.append(total)
+        results[module] = statistics.median(totals)
+        # 最后一次运行中自身耗时最长的模块
+        for self_ms, _, name in rows:
+            if self_ms > slowest.get(name, (0.0, ""))[0]:
+                slowest[name] = (self_ms, module)
+
+        line = f"  {module:<34} {results[module]:8.1f} ms"
+        if module in baseline:
+            delta = results[module] - baseline[module]
+            line += f"   基线 {baseline[module]:8.1f} ms  ({delta:+.1f} ms, {delta / baseline[module] * 100:+.0f}%)"
+        print(line)
+
+    print(f"\n🐢 自身耗时最长的 {args.top} 个模块:")
+    for name, (self_ms, via) in sorted(slowest.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f"  {self_ms:8.1f} ms  {name}（经由 {via}）")
+
+    warm_up_ms: Dict[str, float] = {}
+    if args.warm_up:
+        warm_up_ms = warm_up_time()
+        print("\n🔥 服务单例构造耗时（应用启动时预热）:")
+        for name, ms in warm_up_ms.items():
+            print(f"  {name:<34} {ms:8.1f} ms")
+
+    if args.save:
+        args.save.write_text(
+            json.dumps({"python": sys.version.split()[0], "modules": results, "warm_up": warm_up_ms}, indent=2),
+            encoding="utf-8",
+        )
+        print(f"\n💾 结果已保存: {args.save}")
+
+    exceeded = [(module, results[module], limit) for module, limit in limits.items()
+                if module in results and results[module] > limit]
+    if exceeded:
+        print()
+        for module, ms, limit in exceeded:
+            print(f"❌ {module} 导入耗时 {ms:.1f} ms 超过上限 {limit:.1f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,99 @@
 """
 检查图库中所有图片的分析状态
 识别分析失败或不完整的图片，并提供重新分析选项
+
+重新分析：
+- 多张图片并发分析，并发数默认取 Claude 限流器的并发上限（与服务共享限流与退避）
+- 终端显示进度条（完成数、失败数、速度、剩余时间）
+- 全部完成后通过 gallery_service 一次性加锁写入分析结果（元数据只保存一次），
+  重新分析期间已被其他进程修改过分析结果的图片不覆盖；
+  并为写入的图片批量重新生成向量，使向量指纹与新的分析结果一致
+- 每次运行写出 JSON 报告（检查结果 + 每张图片的重新分析结果）
+
+用法:
+    python scripts/check_gallery_analysis.py                 # 检查，确认后重新分析
+    python scripts/check_gallery_analysis.py --yes           # 不询问，直接重新分析
+    python scripts/check_gallery_analysis.py --check-only    # 只检查
 """
+import argparse
 import json
 import asyncio
-import base64
 import sys
+import time
+from datetime import datetime
 from pathlib import Path
+from typing import Any, Dict, List, Optional
 
 # 添加父目录到路径
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+from config import get_settings
+from models import ImageAnalysis
 from services.claude_service import claude_service
+from services.embedding_service import embedding_service
+from services.search_utils import generate_multimodal_search_description
+from utils.image_payload import ImagePayload, MAX_IMAGE_SIZE
+
+settings = get_settings()
+
+ANALYSIS_PROMPT = "详细分析这个挂饰/配饰设计"
+DEFAULT_REPORT = Path(__file__).parent.parent / "data" / "gallery" / "analysis_report.json"
+
+
+class ProgressBar:
+    """单行终端进度条"""
+
+    def __init__(self, total: int, width: int = 30):
+        self.total = total
+        self.width = width
+        self.done = 0
+        self.failed = 0
+        self.started = time.perf_counter()
+
+    def update(self, ok: bool):
+        self.done += 1
+        if not ok:
+            self.failed += 1
+        self.render()
+
+    def render(self):
+        elapsed = time.perf_counter() - self.started
+        ratio = self.done / self.total if self.total else 1.0
+        filled = int(self.width * ratio)
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = f"{(self.total - self.done) / rate:.0f}s" if rate > 0 else "-"
+        bar = "█" * filled + "░" * (self.width - filled)
+        sys.stdout.write(
+            f"\r  [{bar}] {self.done}/{self.total}  失败 {self.failed}  "
+            f"{rate:.2f} 张/秒  已用 {elapsed:.0f}s  剩余 {eta}   "
+        )
+        sys.stdout.flush()
+        if self.done == self.total:
+            sys.stdout.write("\n")
 
 
-async def check_gallery_analysis():
-    """检查图库分析状态"""
-    # 加载元数据
-    metadata_file = Path(__file__).parent.parent / "data" / "gallery" / "metadata.json"
+def analysis_issue(analysis: Optional[Dict]) -> Optional[str]:
+    """分析结果的问题，完整时返回 None"""
+    if not analysis:
+        return "缺少分析数据"
+
+    # 检查关键字段
+    elements = analysis.get("elements", {})
+    style = analysis.get("style", {})
+    primary = elements.get("primary", [])
+    tags = style.get("tags", [])
+    mood = style.get("mood", "")
 
-    if not metadata_file.exists():
-        print("❌ 元数据文件不存在")
-        return
+    if len(primary) > 0 and len(tags) > 0 and mood != "" and mood != "未知":
+        return None
+    return f"分析不完整（主要元素: {len(primary)}, 风格标签: {len(tags)}, 氛围: {mood or '-'}）"
 
-    with open(metadata_file, 'r', encoding='utf-8') as f:
-        metadata = json.load(f)
 
-    items = metadata.get("items", [])
+async def check_gallery_analysis():
+    """检查图库分析状态"""
+    from services.gallery_service import gallery_service
+
+    items = gallery_service.metadata.get("items", [])
     total = len(items)
 
     print(f"\n📊 图库总计: {total} 张图片")
@@ -37,37 +104,18 @@ async def check_gallery_analysis():
     success_items = []
 
     for idx, item in enumerate(items, 1):
-        item_id = item.get("id", "unknown")
         filename = item.get("filename", "unknown")
         analysis = item.get("analysis", {})
+        issue = analysis_issue(analysis)
 
-        # 检查分析是否存在
-        if not analysis:
-            print(f"❌ [{idx}/{total}] {filename} - 缺少分析数据")
-            failed_items.append(item)
-            continue
-
-        # 检查关键字段
-        elements = analysis.get("elements", {})
-        style = analysis.get("style", {})
-        primary = elements.get("primary", [])
-        tags = style.get("tags", [])
-        mood = style.get("mood", "")
-
-        # 判断是否完整
-        is_complete = (
-            len(primary) > 0 and
-            len(tags) > 0 and
-            mood != "" and
-            mood != "未知"
-        )
-
-        if is_complete:
-            print(f"✅ [{idx}/{total}] {filename} - 分析完整")
+        # 完整的图片不逐条打印
+        if issue is None:
             success_items.append(item)
+        elif not analysis:
+            print(f"❌ [{idx}/{total}] {filename} - {issue}")
+            failed_items.append(item)
         else:
-            print(f"⚠️  [{idx}/{total}] {filename} - 分析不完整")
-            print(f"   主要元素: {len(primary)}, 风格标签: {len(tags)}, 氛围: {mood}")
+            print(f"⚠️  [{idx}/{total}] {filename} - {issue}")
             incomplete_items.append(item)
 
     # 统计
@@ -75,9 +123,10 @@ async def check_gallery_analysis():
     print("📈 统计结果")
     print("="*60)
     print(f"总计: {total} 张")
-    print(f"✅ 完整: {len(success_items)} 张 ({len(success_items)/total*100:.1f}%)")
-    print(f"⚠️  不完整: {len(incomplete_items)} 张 ({len(incomplete_items)/total*100:.1f}%)")
-    print(f"❌ 失败: {len(failed_items)} 张 ({len(failed_items)/total*100:.1f}%)")
+    if total:
+        print(f"✅ 完整: {len(success_items)} 张 ({len(success_items)/total*100:.1f}%)")
+        print(f"⚠️  不完整: {len(incomplete_items)} 张 ({len(incomplete_items)/total*100:.1f}%)")
+        print(f"❌ 失败: {len(failed_items)} 张 ({len(failed_items)/total*100:.1f}%)")
 
     return {
         "total": total,
@@ -87,100 +136,191 @@ async def check_gallery_analysis():
     }
 
 
-async def reanalyze_failed_items(failed_items, incomplete_items):
-    """重新分析失败的图片"""
+async def reanalyze_failed_items(
+    failed_items: List[Dict],
+    incomplete_items: List[Dict],
+    workers: Optional[int] = None,
+    confirm: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    并发重新分析失败 / 不完整的图片，完成后批量写入
+
+    Returns:
+        每张图片的重新分析结果（写入报告）
+    """
+    from services.gallery_service import gallery_service
+
     items_to_fix = failed_items + incomplete_items
 
     if not items_to_fix:
         print("\n✅ 没有需要重新分析的图片")
-        return
+        return []
 
-    print(f"\n🔧 准备重新分析 {len(items_to_fix)} 张图片")
+    workers = workers or claude_service.limiter.max_in_flight
+    print(f"\n🔧 准备重新分析 {len(items_to_fix)} 张图片（并发 {workers}）")
 
-    response = input(f"\n是否继续重新分析？(y/n): ")
-    if response.lower() != 'y':
-        print("❌ 已取消")
-        return
+    if confirm:
+        response = input(f"\n是否继续重新分析？(y/n): ")
+        if response.lower() != 'y':
+            print("❌ 已取消")
+            return []
 
-    # 图片目录
-    images_dir = Path(__file__).parent.parent / "data" / "gallery" / "images"
-    metadata_file = Path(__file__).parent.parent / "data" / "gallery" / "metadata.json"
+    semaphore = asyncio.Semaphore(workers)
+    progress = ProgressBar(len(items_to_fix))
+    analyses: Dict[str, Dict] = {}
+    results: List[Dict[str, Any]] = []
 
-    # 加载元数据
-    with open(metadata_file, 'r', encoding='utf-8') as f:
-        metadata = json.load(f)
-
-    success_count = 0
-    fail_count = 0
-
-    for idx, item in enumerate(items_to_fix, 1):
+    async def reanalyze(item: Dict):
         item_id = item.get("id")
-        filename = item.get("filename")
-        image_path = images_dir / filename
-
-        print(f"\n[{idx}/{len(items_to_fix)}] 正在分析: {filename}")
-
-        if not image_path.exists():
-            print(f"❌ 图片文件不存在: {image_path}")
-            fail_count += 1
-            continue
-
-        try:
-            # 读取图片
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
-
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
-
-            # 分析图片
-            result = await claude_service.analyze_image(
-                image_base64=image_base64,
-                prompt="详细分析这个挂饰/配饰设计"
-            )
-
-            # 更新元数据
-            for meta_item in metadata["items"]:
-                if meta_item["id"] == item_id:
-                    meta_item["analysis"] = result.model_dump()
-                    break
-
-            print(f"✅ 分析成功: {[e.type for e in result.elements.primary]}, {result.style.tags}")
-            success_count += 1
-
-        except Exception as e:
-            print(f"❌ 分析失败: {e}")
-            fail_count += 1
-            continue
-
-    # 保存更新后的元数据
-    if success_count > 0:
-        with open(metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-
-        print(f"\n✅ 元数据已更新")
+        result: Dict[str, Any] = {
+            "id": item_id,
+            "filename": item.get("filename"),
+            "before": analysis_issue(item.get("analysis")),
+        }
+        started = time.perf_counter()
+        async with semaphore:
+            try:
+                image_path = gallery_service.image_path(item_id)
+                if image_path is None:
+                    raise FileNotFoundError(f"图片文件不存在: {item.get('filename')}")
+
+                # 读取与压缩放到线程中，压缩结果缓存在载体上
+                def load() -> ImagePayload:
+                    payload = ImagePayload(data=image_path.read_bytes())
+                    payload.compressed(MAX_IMAGE_SIZE)
+                    return payload
+
+                payload = await asyncio.to_thread(load)
+                analysis = await claude_service.analyze_image(image_base64=payload, prompt=ANALYSIS_PROMPT)
+                analysis_data = analysis.model_dump()
+                analyses[item_id] = analysis_data
+                result.update(status="success", after=analysis_issue(analysis_data))
+            except Exception as e:
+                result.update(status="failed", error=str(e))
+        result["seconds"] = round(time.perf_counter() - started, 2)
+        results.append(result)
+        progress.update(result["status"] == "success")
+
+    progress.render()
+    await asyncio.gather(*[reanalyze(item) for item in items_to_fix])
+
+    # 批量写入分析结果（元数据只保存一次）
+    if analyses:
+        before = {item.get("id"): item.get("analysis") for item in items_to_fix}
+        updated = gallery_service.update_analyses(analyses, expected=before)
+        print(f"\n✅ 元数据已更新（{updated} 张）")
+        written = {}
+        for item_id, analysis_data in analyses.items():
+            reference = gallery_service.get_reference(item_id)
+            if reference is not None and reference.get("analysis") == analysis_data:
+                written[item_id] = analysis_data
+            else:
+                print(f"⚠️  {item_id} 在重新分析期间被修改或删除，未覆盖")
+        for result in results:
+            if result["id"] in analyses and result["id"] not in written:
+                result.update(status="skipped", error="重新分析期间被修改或删除")
+        await refresh_embeddings(written, results)
 
     # 总结
+    success_count = sum(1 for r in results if r["status"] == "success")
     print("\n" + "="*60)
     print("重新分析总结")
     print("="*60)
     print(f"成功: {success_count} 张")
-    print(f"失败: {fail_count} 张")
-
-
-async def main():
+    print(f"  其中仍不完整: {sum(1 for r in results if r['status'] == 'success' and r['after'])} 张")
+    print(f"失败: {sum(1 for r in results if r['status'] == 'failed')} 张")
+    print(f"跳过: {sum(1 for r in results if r['status'] == 'skipped')} 张")
+    for r in results:
+        if r["status"] == "failed":
+            print(f"  ❌ {r['filename']}: {r['error']}")
+    return results
+
+
+async def refresh_embeddings(analyses: Dict[str, Dict], results: List[Dict[str, Any]]):
+    """为重新分析的图片批量生成向量（与 regenerate_embeddings.py 相同的指纹）"""
+    from services.gallery_service import gallery_service
+
+    texts: Dict[str, str] = {}
+    for item_id, analysis_data in analyses.items():
+        texts[item_id] = generate_multimodal_search_description(ImageAnalysis(**analysis_data))
+
+    ids = list(texts)
+    batch_size = max(1, settings.EMBEDDING_BATCH_SIZE)
+    embeddings = {}
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        try:
+            vectors = await embedding_service.generate_embeddings([texts[item_id] for item_id in batch])
+        except Exception as e:
+            # 指纹不写入，之后运行 regenerate_embeddings.py 会重新生成
+            print(f"⚠️  向量生成失败（{len(batch)} 张），稍后运行 regenerate_embeddings.py: {e}")
+            continue
+        for item_id, vector in zip(batch, vectors):
+            embeddings[item_id] = (vector, embedding_service.fingerprint(texts[item_id]))
+
+    if embeddings:
+        gallery_service.save_embeddings(embeddings)
+        print(f"✅ 向量已更新（{len(embeddings)} 张）")
+    for result in results:
+        if result["id"] in analyses:
+            result["embedding_updated"] = result["id"] in embeddings
+
+
+def write_report(path: Path, check: Dict[str, Any], results: List[Dict[str, Any]]):
+    """写出 JSON 报告"""
+    report = {
+        "generated_at": datetime.now().isoformat(),
+        "total": check["total"],
+        "complete": len(check["success"]),
+        "incomplete": [
+            {"id": item.get("id"), "filename": item.get("filename"), "issue": analysis_issue(item.get("analysis"))}
+            for item in check["incomplete"]
+        ],
+        "failed": [{"id": item.get("id"), "filename": item.get("filename")} for item in check["failed"]],
+        "reanalysis": sorted(results, key=lambda r: r["filename"] or ""),
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n📝 报告已写入: {path}")
+
+
+async def main(
+    check_only: bool = False,
+    confirm: bool = True,
+    workers: Optional[int] = None,
+    report_path: Path = DEFAULT_REPORT,
+):
     print("\n" + "="*60)
     print("图库分析状态检查")
     print("="*60)
 
     # 检查分析状态
     result = await check_gallery_analysis()
+    results: List[Dict[str, Any]] = []
 
     if result["failed"] or result["incomplete"]:
-        # 重新分析失败的图片
-        await reanalyze_failed_items(result["failed"], result["incomplete"])
+        if not check_only:
+            # 重新分析失败的图片
+            results = await reanalyze_failed_items(
+                result["failed"], result["incomplete"], workers=workers, confirm=confirm
+            )
     else:
         print("\n🎉 所有图片分析状态正常！")
 
+    write_report(report_path, result, results)
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="检查图库分析状态，并发重新分析失败 / 不完整的图片")
+    parser.add_argument("--check-only", action="store_true", help="只检查，不重新分析")
+    parser.add_argument("--yes", "-y", action="store_true", help="不询问，直接重新分析")
+    parser.add_argument("--workers", type=int, help="重新分析并发数（默认取 Claude 限流器并发上限）")
+    parser.add_argument("--report", type=Path, default=DEFAULT_REPORT, help="JSON 报告路径")
+    args = parser.parse_args()
+    asyncio.run(main(
+        check_only=args.check_only,
+        confirm=not args.yes,
+        workers=args.workers,
+        report_path=args.report,
+    ))
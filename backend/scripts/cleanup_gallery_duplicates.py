@@ -2,83 +2,154 @@
 """
 清理图库重复素材
 基于图片内容哈希识别并删除重复图片
+
+- 每张图片计算 SHA-256（精确重复）和 64 位 dHash / pHash（视觉相似），在进程池中并行计算；
+  感知哈希通过 gallery_service 加锁写回元数据（dhash / phash），之后的运行和入库查重直接复用
+- pHash 建立多索引哈希表，查找汉明距离不超过 --distance 的所有图片对，无需两两比较；
+  入库时 gallery_service 使用同一种索引拒绝重复图片
+- 相互重复的图片合并为一组（并查集），每组保留最早入库的一张；分组是传递的，
+  只删除与保留图片本身距离不超过 --distance 的成员
+- 以 copy 策略入库的副本（copiedFrom）是有意保留的同图不同层级条目，不删除
+- 删除经过 gallery_service.delete_reference，同时释放图片内容（blob_store）的引用
+
+用法:
+    python cleanup_gallery_duplicates.py                 # 分析重复
+    python cleanup_gallery_duplicates.py --distance 4    # 指定相似阈值
+    python cleanup_gallery_duplicates.py --execute       # 删除重复图片
 """
+import argparse
 import hashlib
-import json
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from collections import defaultdict
-from PIL import Image
-
-try:
-    import imagehash
-    HAS_IMAGEHASH = True
-except ImportError:
-    HAS_IMAGEHASH = False
+from typing import Dict, List, Optional, Tuple
 
 # 添加 backend 目录到路径
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+from config import get_settings
+from services.gallery_service import gallery_service
+from utils.perceptual_hash import MultiIndexHash, image_hashes, format_hash, parse_hash
 
-def get_image_hash(image_path: Path) -> str:
-    """计算图片的感知哈希（可识别相似图片）"""
-    if not HAS_IMAGEHASH:
-        return None
+settings = get_settings()
 
-    try:
-        img = Image.open(image_path)
-        # 使用平均哈希，对轻微变化不敏感
-        return str(imagehash.average_hash(img, hash_size=8))
-    except Exception as e:
-        print(f"  ⚠️  无法计算哈希: {image_path.name} - {e}")
-        return None
 
+def hash_image(path: str, with_perceptual: bool = True) -> Tuple[str, Optional[str], Optional[int], Optional[int]]:
+    """
+    计算图片的 SHA-256 与 (dHash, pHash)（在子进程中执行）
 
-def get_file_hash(image_path: Path) -> str:
-    """计算文件MD5哈希（精确匹配）"""
+    Returns:
+        (路径, SHA-256, dHash, pHash)，无法读取或解码的部分为 None
+    """
     try:
-        with open(image_path, 'rb') as f:
-            return hashlib.md5(f.read()).hexdigest()
+        data = Path(path).read_bytes()
+    except OSError as e:
+        print(f"  ⚠️  无法读取文件: {Path(path).name} - {e}")
+        return path, None, None, None
+    sha256 = hashlib.sha256(data).hexdigest()
+    if not with_perceptual:
+        return path, sha256, None, None
+    try:
+        dhash_value, phash_value = image_hashes(data)
     except Exception as e:
-        print(f"  ⚠️  无法读取文件: {image_path.name} - {e}")
-        return None
-
-
-def analyze_duplicates():
-    """分析图库中的重复图片"""
-    gallery_dir = Path(__file__).parent.parent / "data" / "gallery"
-    images_dir = gallery_dir / "images"
-    metadata_file = gallery_dir / "metadata.json"
-
-    if not images_dir.exists():
-        print("❌ 图库目录不存在")
-        return
-
-    # 加载元数据
-    if metadata_file.exists():
-        with open(metadata_file, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-    else:
+        print(f"  ⚠️  无法计算哈希: {Path(path).name} - {e}")
+        return path, sha256, None, None
+    return path, sha256, dhash_value, phash_value
+
+
+def _groups(pairs: List[Tuple[int, int]], count: int) -> List[List[int]]:
+    """并查集：把重复对合并为重复组"""
+    parent = list(range(count))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in pairs:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    groups = defaultdict(list)
+    for i in range(count):
+        groups[find(i)].append(i)
+    return [members for members in groups.values() if len(members) > 1]
+
+
+def analyze_duplicates(distance: Optional[int] = None, workers: Optional[int] = None, rehash: bool = False):
+    """
+    分析图库中的重复图片
+
+    Args:
+        distance: pHash 汉明距离阈值（默认 GALLERY_DUPLICATE_DISTANCE，至少为 0）
+        workers: 计算哈希的进程数
+        rehash: 忽略元数据中已有的感知哈希，全部重新计算
+    """
+    distance = max(0, settings.GALLERY_DUPLICATE_DISTANCE if distance is None else distance)
+    images_dir = gallery_service.images_dir
+
+    # 加载元数据（只读；写回感知哈希经过 gallery_service，与服务进程的写入互不覆盖）
+    if not gallery_service.metadata_file.exists():
         print("⚠️  元数据文件不存在")
-        metadata = {"items": []}
+    metadata = gallery_service.metadata
 
     print("\n" + "="*60)
     print("📊 图库重复分析")
     print("="*60)
 
-    # 获取所有图片
-    image_files = list(images_dir.glob("*.jpg"))
+    # 获取所有图片（按入库顺序排列，重复组保留最早的一张）
+    items_by_file = {item.get("filename"): item for item in metadata["items"]}
+    order = {item.get("filename"): i for i, item in enumerate(metadata["items"])}
+    image_files = sorted(
+        list(images_dir.glob("*.jpg")) + list(images_dir.glob("*.png")),
+        key=lambda path: (order.get(path.name, len(order)), path.name),
+    )
     print(f"\n📁 图库中共有 {len(image_files)} 张图片")
     print(f"📄 元数据中记录 {len(metadata['items'])} 条")
 
+    # 并行计算哈希（元数据中已有感知哈希的图片只计算 SHA-256）
+    started = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    jobs = []
+    for path in image_files:
+        item = items_by_file.get(path.name)
+        known = item is not None and not rehash and parse_hash(item.get("phash")) is not None
+        jobs.append((str(path), not known))
+
+    print(f"\n🧮 计算哈希（{workers} 个进程，{sum(1 for _, p in jobs if p)} 张需要计算感知哈希）...")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        hashed = list(pool.map(hash_image, *zip(*jobs), chunksize=16)) if jobs else []
+
+    sha256s: List[Optional[str]] = []
+    phashes: List[Optional[int]] = []
+    backfill: Dict[str, Tuple[int, int]] = {}
+    for path, (_, sha256, dhash_value, phash_value) in zip(image_files, hashed):
+        item = items_by_file.get(path.name)
+        if phash_value is not None:
+            if item is not None:
+                backfill[item["id"]] = (dhash_value, phash_value)
+        elif item is not None:
+            phash_value = parse_hash(item.get("phash"))
+        sha256s.append(sha256)
+        phashes.append(phash_value)
+    print(f"   耗时 {time.perf_counter() - started:.2f}s")
+
+    if backfill:
+        # 感知哈希写回元数据，供下次运行和入库查重复用
+        updated = gallery_service.update_hashes(backfill)
+        print(f"💾 已写入 {updated} 条感知哈希到元数据")
+
     # 检查精确重复（基于文件哈希）
     print("\n🔍 检查精确重复（相同文件）...")
     file_hashes = defaultdict(list)
-
-    for img_path in image_files:
-        file_hash = get_file_hash(img_path)
-        if file_hash:
-            file_hashes[file_hash].append(img_path)
+    for path, sha256 in zip(image_files, sha256s):
+        if sha256:
+            file_hashes[sha256].append(path)
 
     exact_duplicates = {h: files for h, files in file_hashes.items() if len(files) > 1}
 
@@ -91,33 +162,55 @@ def analyze_duplicates():
     else:
         print("✅ 没有发现精确重复的文件")
 
-    # 检查相似图片（基于感知哈希）
-    print("\n🔍 检查相似图片（视觉相似）...")
-
-    try:
-        image_hashes = {}
-        for img_path in image_files:
-            img_hash = get_image_hash(img_path)
-            if img_hash:
-                if img_hash not in image_hashes:
-                    image_hashes[img_hash] = []
-                image_hashes[img_hash].append(img_path)
-
-        similar_groups = {h: files for h, files in image_hashes.items() if len(files) > 1}
-
-        if similar_groups:
-            print(f"\n⚠️  发现 {len(similar_groups)} 组相似图片:")
-            for hash_val, files in similar_groups.items():
-                print(f"\n  感知哈希: {hash_val}")
-                for f in files:
-                    size_kb = f.stat().st_size / 1024
-                    print(f"    - {f.name} ({size_kb:.1f} KB)")
-        else:
-            print("✅ 没有发现视觉相似的图片")
-
-    except ImportError:
-        print("⚠️  未安装 imagehash 库，跳过相似度检查")
-        print("   可运行: pip install imagehash")
+    # 检查相似图片（pHash 近邻索引范围查询）
+    print(f"\n🔍 检查相似图片（pHash 汉明距离 ≤ {distance}）...")
+    started = time.perf_counter()
+    index: MultiIndexHash = MultiIndexHash(distance)
+    for i, value in enumerate(phashes):
+        if value is not None:
+            index.add(value, i)
+
+    pairs = []
+    for i, value in enumerate(phashes):
+        if value is None:
+            continue
+        for _, j in index.search(value, distance):
+            if j > i:
+                pairs.append((i, j))
+    groups = _groups(pairs, len(image_files))
+    print(f"   {len(pairs)} 对相似图片，耗时 {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    def is_copy(path: Path) -> bool:
+        item = items_by_file.get(path.name)
+        return item is not None and bool(item.get("copiedFrom"))
+
+    similar_groups = {}
+    # 可删除的图片：与保留图片精确重复，或与保留图片本身的距离不超过阈值（不含有意保留的副本）
+    removable: List[Path] = []
+    if groups:
+        print(f"\n⚠️  发现 {len(groups)} 组相似图片:")
+        for members in groups:
+            keeper = phashes[members[0]]
+            files = [image_files[i] for i in members]
+            similar_groups[format_hash(keeper)] = files
+            print(f"\n  感知哈希: {format_hash(keeper)}")
+            for position, i in enumerate(members):
+                size_kb = image_files[i].stat().st_size / 1024
+                distance_to_keeper = (keeper ^ phashes[i]).bit_count()
+                note = ""
+                if position == 0:
+                    note = "，保留"
+                elif is_copy(image_files[i]):
+                    note = "，副本（copiedFrom），保留"
+                elif distance_to_keeper > distance:
+                    note = "，与保留图片距离超过阈值，保留"
+                else:
+                    removable.append(image_files[i])
+                print(f"    - {image_files[i].name} ({size_kb:.1f} KB, 距离 {distance_to_keeper}{note})")
+    else:
+        print("✅ 没有发现视觉相似的图片")
+    for files in exact_duplicates.values():
+        removable.extend(path for path in files[1:] if not is_copy(path) and path not in removable)
 
     # 检查元数据重复
     print("\n🔍 检查元数据重复...")
@@ -151,14 +244,12 @@ def analyze_duplicates():
     else:
         print("✅ 没有发现重复的元数据")
 
-    # 统计建议
+    # 统计建议（精确重复的 pHash 距离为 0，已包含在相似组中）
     print("\n" + "="*60)
     print("💡 清理建议")
     print("="*60)
 
-    total_duplicates = sum(len(files) - 1 for files in exact_duplicates.values())
-    if similar_groups:
-        total_duplicates += sum(len(files) - 1 for files in similar_groups.values())
+    total_duplicates = len(removable)
 
     if total_duplicates > 0:
         print(f"\n可删除约 {total_duplicates} 张重复图片")
@@ -169,22 +260,23 @@ def analyze_duplicates():
     return {
         'total': len(image_files),
         'exact_duplicates': exact_duplicates,
-        'similar_groups': similar_groups if 'similar_groups' in locals() else {},
+        'similar_groups': similar_groups,
+        'removable': removable,
         'duplicate_analyses': duplicate_analyses
     }
 
 
-def cleanup_duplicates(dry_run=True):
+def cleanup_duplicates(dry_run=True, **options):
     """清理重复图片"""
-    result = analyze_duplicates()
+    result = analyze_duplicates(**options)
 
     if not result:
         return
 
-    exact_duplicates = result['exact_duplicates']
-    similar_groups = result['similar_groups']
+    # 每组保留第一个（最早入库的一张），副本和超出阈值的成员已在分析时排除
+    files_to_delete = result['removable']
 
-    if not exact_duplicates and not similar_groups:
+    if not files_to_delete:
         print("\n✅ 无需清理")
         return
 
@@ -192,29 +284,9 @@ def cleanup_duplicates(dry_run=True):
     print("🗑️  开始清理")
     print("="*60)
 
-    gallery_dir = Path(__file__).parent.parent / "data" / "gallery"
-    images_dir = gallery_dir / "images"
-    embeddings_dir = gallery_dir / "embeddings"
-    metadata_file = gallery_dir / "metadata.json"
-
-    # 加载元数据
-    with open(metadata_file, 'r', encoding='utf-8') as f:
-        metadata = json.load(f)
-
-    files_to_delete = []
-    ids_to_remove = set()
-
-    # 收集要删除的文件（每组保留第一个）
-    for files in exact_duplicates.values():
-        files_to_delete.extend(files[1:])  # 保留第一个，删除其余
-
-    for files in similar_groups.values():
-        files_to_delete.extend(files[1:])  # 保留第一个，删除其余
-
-    # 从文件名提取 ID
-    for file_path in files_to_delete:
-        file_id = file_path.stem
-        ids_to_remove.add(file_id)
+    # 删除逐条经过 delete_reference（加锁、重新加载后写回），不会覆盖服务进程同时写入的条目
+    items_by_file = {item.get("filename"): item for item in gallery_service.metadata["items"]}
+    ids_to_remove = {items_by_file[path.name]["id"] for path in files_to_delete if path.name in items_by_file}
 
     if dry_run:
         print(f"\n⚠️  模拟运行模式（不会实际删除）")
@@ -231,45 +303,41 @@ def cleanup_duplicates(dry_run=True):
     else:
         # 实际删除
         deleted_count = 0
+        removed_count = 0
 
         for file_path in files_to_delete:
             try:
-                # 删除图片文件
+                item = items_by_file.get(file_path.name)
+                if item is not None:
+                    # 删除图片、向量和元数据记录，并释放图片内容引用
+                    if gallery_service.delete_reference(item["id"]):
+                        removed_count += 1
+                        print(f"  ✓ 删除参考图: {item['id']}")
+                # 没有元数据记录的图片（或非 .jpg 文件）直接删除文件
                 if file_path.exists():
                     file_path.unlink()
                     print(f"  ✓ 删除图片: {file_path.name}")
 
-                # 删除对应的嵌入向量
-                file_id = file_path.stem
-                embedding_path = embeddings_dir / f"{file_id}.npy"
-                if embedding_path.exists():
-                    embedding_path.unlink()
-                    print(f"  ✓ 删除向量: {embedding_path.name}")
-
                 deleted_count += 1
             except Exception as e:
                 print(f"  ❌ 删除失败: {file_path.name} - {e}")
 
-        # 更新元数据
-        original_count = len(metadata['items'])
-        metadata['items'] = [
-            item for item in metadata['items']
-            if item['id'] not in ids_to_remove
-        ]
-
-        with open(metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-
         print(f"\n✅ 清理完成:")
         print(f"  删除文件: {deleted_count}")
-        print(f"  删除记录: {original_count - len(metadata['items'])}")
-        print(f"  剩余图片: {len(metadata['items'])}")
+        print(f"  删除记录: {removed_count}")
+        print(f"  剩余图片: {len(gallery_service.metadata['items'])}")
 
 
 if __name__ == "__main__":
-    import sys
-
-    if "--execute" in sys.argv:
-        cleanup_duplicates(dry_run=False)
+    parser = argparse.ArgumentParser(description="清理图库重复素材")
+    parser.add_argument("--execute", action="store_true", help="删除重复图片（默认只分析）")
+    parser.add_argument("--distance", type=int, help=f"pHash 汉明距离阈值（默认 {settings.GALLERY_DUPLICATE_DISTANCE}）")
+    parser.add_argument("--workers", type=int, help="计算哈希的进程数（默认 CPU 核数）")
+    parser.add_argument("--rehash", action="store_true", help="重新计算所有感知哈希")
+    args = parser.parse_args()
+    options = {"distance": args.distance, "workers": args.workers, "rehash": args.rehash}
+
+    if args.execute:
+        cleanup_duplicates(dry_run=False, **options)
     else:
-        analyze_duplicates()
+        analyze_duplicates(**options)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+图库快照：导出 / 导入单文件归档，在环境之间迁移或增量同步图库
+
+格式见 services/gallery_snapshot.py。导入会直接修改 data/gallery，
+运行中的服务不会感知到变化，导入后需要重启服务。
+
+用法:
+    # 全量迁移
+    python scripts/gallery_snapshot.py export gallery.snap
+    python scripts/gallery_snapshot.py import gallery.snap
+
+    # 增量同步：目标环境导出状态 → 源环境只打包差异 → 目标环境导入
+    python scripts/gallery_snapshot.py state prod_state.json             # 在目标环境运行
+    python scripts/gallery_snapshot.py export delta.snap --against prod_state.json
+    python scripts/gallery_snapshot.py import delta.snap --prune         # 同时删除源环境已删除的条目
+
+    # 流式导入（不落盘）
+    ssh staging "cd backend && python scripts/gallery_snapshot.py export -" \\
+        | python scripts/gallery_snapshot.py import -
+
+    # 查看快照内容（向量矩阵直接 mmap，不解包）
+    python scripts/gallery_snapshot.py inspect gallery.snap
+"""
+import argparse
+import contextlib
+import json
+import sys
+from pathlib import Path
+
+# 添加 backend 目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.gallery_snapshot import gallery_snapshot
+
+
+def cmd_state(args):
+    state = gallery_snapshot.state()
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    print(f"✅ 图库状态已写入 {args.output}（{len(state['items'])} 个条目，{len(state['blobs'])} 张图片）")
+
+
+def cmd_export(args):
+    against = None
+    if args.against:
+        with open(args.against, "r", encoding="utf-8") as f:
+            against = json.load(f)
+    if args.output == "-":
+        # 快照写入标准输出，日志改写到标准错误
+        stream = sys.stdout.buffer
+        with contextlib.redirect_stdout(sys.stderr):
+            gallery_snapshot.export(stream, against=against)
+    else:
+        gallery_snapshot.export(args.output, against=against)
+
+
+def cmd_import(args):
+    if args.snapshot == "-":
+        stats = gallery_snapshot.import_snapshot(sys.stdin.buffer, prune=args.prune, dry_run=args.dry_run)
+    else:
+        stats = gallery_snapshot.import_snapshot(args.snapshot, prune=args.prune, dry_run=args.dry_run)
+    if args.dry_run:
+        print("\n🔎 dry-run：未写入任何文件")
+    elif stats["changed"] or stats["removed"]:
+        print("\n🔄 图库已更新，请重启服务使其生效")
+
+
+def cmd_inspect(args):
+    ids, matrix = gallery_snapshot.load_embeddings(args.snapshot)
+    print(f"📦 {args.snapshot}")
+    print(f"   向量矩阵: {matrix.shape} {matrix.dtype}（mmap）")
+    if len(ids):
+        norms = (matrix[: min(len(ids), 1000)] ** 2).sum(axis=1) ** 0.5
+        print(f"   前 {len(norms)} 个向量的平均范数: {norms.mean():.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="图库快照导出 / 导入")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    state_parser = subparsers.add_parser("state", help="导出当前图库状态（用于生成增量快照）")
+    state_parser.add_argument("output", help="状态文件路径")
+    state_parser.set_defaults(func=cmd_state)
+
+    export_parser = subparsers.add_parser("export", help="导出快照")
+    export_parser.add_argument("output", help="快照文件路径，- 表示写入标准输出")
+    export_parser.add_argument("--against", help="目标环境的状态文件，只导出差异部分")
+    export_parser.set_defaults(func=cmd_export)
+
+    import_parser = subparsers.add_parser("import", help="导入快照（只写入差异部分）")
+    import_parser.add_argument("snapshot", help="快照文件路径，- 表示从标准输入读取")
+    import_parser.add_argument("--prune", action="store_true", help="删除快照源环境中已不存在的条目")
+    import_parser.add_argument("--dry-run", action="store_true", help="只统计差异，不写入")
+    import_parser.set_defaults(func=cmd_import)
+
+    inspect_parser = subparsers.add_parser("inspect", help="查看快照中的向量矩阵")
+    inspect_parser.add_argument("snapshot", help="快照文件路径")
+    inspect_parser.set_defaults(func=cmd_inspect)
+
+    args = parser.parse_args()
+    args.func(args)
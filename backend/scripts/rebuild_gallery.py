@@ -2,24 +2,189 @@
 """
 重新构建图库系统
 分析所有图片，生成元数据和向量
+
+流水线：读取/压缩 → 分析 → 检索描述 → 嵌入 → 落盘
+- 每个阶段独立的 worker 数，阶段之间用有界队列连接（下游变慢时上游自动等待，内存占用有上限）
+- 分析 / 嵌入阶段的并发数默认取对应模型限流器的并发上限，与服务共享同一套限流与退避
+- 每处理完一张图片追加一行检查点（rebuild_checkpoint.jsonl），中断后重新运行会跳过已完成的图片；
+  全部完成后写入 metadata.json 并删除检查点
+- 只重新生成分析和向量：内容哈希、感知哈希、销售层级等字段沿用原 metadata.json 中的值
+  （原来没有感知哈希的图片在读取阶段补算）
+- 元数据通过图库服务加锁写入；处理失败的图片保留原条目和原向量（图片引用不丢失），并在结果中列出
+- 运行中定期打印各阶段吞吐量
+
+用法：
+    python scripts/rebuild_gallery.py              # 从检查点继续（没有检查点时从头开始）
+    python scripts/rebuild_gallery.py --restart    # 丢弃检查点，从头重建
 """
+import argparse
 import asyncio
-import base64
-import sys
-from pathlib import Path
 import json
+import os
+import sys
+import time
+from dataclasses import dataclass, field
 from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
 # 添加 backend 目录到路径
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from services.claude_service import claude_service
 from services.embedding_service import embedding_service
+from services.gallery_service import gallery_service
 from services.search_utils import generate_multimodal_search_description
+from utils.image_payload import ImagePayload, MAX_IMAGE_SIZE
+from utils.perceptual_hash import format_hash, image_hashes
 import numpy as np
 
+ANALYSIS_PROMPT = "分析这个产品设计的元素、风格和结构"
+
+# 重建时从原元数据沿用的字段（图片引用计数由 image_sha256 对应的图库项持有，不能丢失）
+PRESERVED_FIELDS = ("uploadTime", "salesTier", "image_sha256", "dhash", "phash", "copiedFrom")
+
+# 队列结束标记
+_DONE = object()
+
+
+@dataclass
+class Job:
+    """流水线中的一张图片"""
+    path: Path
+    payload: Optional[ImagePayload] = None
+    analysis: Any = None
+    description: str = ""
+    embedding: Optional[np.ndarray] = None
+    hashes: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class StageStats:
+    """单个阶段的吞吐统计"""
+    name: str
+    workers: int
+    done: int = 0
+    failed: int = 0
+    busy: float = 0.0  # 所有 worker 处理耗时之和（秒）
+
+    def summary(self, elapsed: float) -> str:
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        avg = self.busy / (self.done + self.failed) if self.done + self.failed else 0.0
+        return (f"{self.name:<8} x{self.workers:<3} 完成 {self.done:>6}  失败 {self.failed:>4}  "
+                f"{rate:7.2f} 张/秒  平均 {avg * 1000:7.0f} ms")
+
+
+@dataclass
+class RebuildState:
+    """整个重建任务的进度"""
+    total: int
+    skipped: int
+    started: float = field(default_factory=time.perf_counter)
+    stages: List[StageStats] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def report(self, title: str):
+        elapsed = self.elapsed
+        persisted = self.stages[-1].done if self.stages else 0
+        remaining = self.total - self.skipped - persisted
+        rate = persisted / elapsed if elapsed > 0 else 0.0
+        eta = f"{remaining / rate:.0f}s" if rate > 0 else "-"
+        print(f"\n⏱️  {title}: {elapsed:.1f}s  已落盘 {persisted}/{self.total - self.skipped}"
+              f"（跳过 {self.skipped}）  {rate:.2f} 张/秒  剩余约 {eta}")
+        for stage in self.stages:
+            print(f"    {stage.summary(elapsed)}")
+
+
+class Checkpoint:
+    """追加写入的检查点（每行一个已完成的元数据项）"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = None
+
+    def load(self) -> Dict[str, Dict]:
+        items: Dict[str, Dict] = {}
+        if not self.path.exists():
+            return items
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    # 中断时可能留下写了一半的最后一行
+                    continue
+                items[item["id"]] = item
+        return items
+
+    def append(self, item: Dict):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(item, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        self.path.unlink(missing_ok=True)
+
 
-async def rebuild_gallery():
+async def run_stage(
+    stats: StageStats,
+    state: RebuildState,
+    inbox: asyncio.Queue,
+    outbox: Optional[asyncio.Queue],
+    func: Callable[[Job], Awaitable[None]],
+):
+    """
+    运行一个阶段：stats.workers 个 worker 从 inbox 取任务，成功后放入 outbox
+
+    outbox 有界，下游处理不过来时 put 会等待（背压）；失败的图片记录错误后丢弃，
+    不写入检查点，下次运行时重试
+    """
+    async def worker():
+        while True:
+            job = await inbox.get()
+            if job is _DONE:
+                # 把结束标记放回去，让同阶段的其他 worker 也能退出
+                await inbox.put(_DONE)
+                return
+            start = time.perf_counter()
+            try:
+                await func(job)
+            except Exception as e:
+                stats.failed += 1
+                state.errors.append(f"{job.path.name} [{stats.name}]: {e}")
+                print(f"  ❌ {job.path.name} {stats.name}失败: {e}")
+                continue
+            finally:
+                stats.busy += time.perf_counter() - start
+            stats.done += 1
+            if outbox is not None:
+                await outbox.put(job)
+
+    await asyncio.gather(*[worker() for _ in range(stats.workers)])
+    if outbox is not None:
+        await outbox.put(_DONE)
+
+
+async def rebuild_gallery(
+    restart: bool = False,
+    decode_workers: Optional[int] = None,
+    analyze_workers: Optional[int] = None,
+    embed_workers: Optional[int] = None,
+    queue_size: int = 32,
+    report_interval: float = 10.0,
+):
     """重新构建图库"""
     print("\n" + "="*60)
     print("🔨 重新构建图库系统")
@@ -30,105 +195,167 @@ async def rebuild_gallery():
     images_dir = base_dir / "images"
     embeddings_dir = base_dir / "embeddings"
     metadata_file = base_dir / "metadata.json"
+    checkpoint = Checkpoint(base_dir / "rebuild_checkpoint.jsonl")
+    embeddings_dir.mkdir(parents=True, exist_ok=True)
+
+    if restart:
+        checkpoint.remove()
+    completed = checkpoint.load()
+
+    # 原元数据：重建后沿用其中的哈希、销售层级等字段
+    previous: Dict[str, Dict] = {}
+    if metadata_file.exists():
+        with open(metadata_file, 'r', encoding='utf-8') as f:
+            previous = {item["id"]: item for item in json.load(f).get("items", [])}
 
-    # 清空 embeddings 目录
-    print("\n🗑️  清空向量目录...")
-    for emb_file in embeddings_dir.glob("*.npy"):
-        emb_file.unlink()
+    def preserved(file_id: str) -> Dict[str, Any]:
+        item = previous.get(file_id, {})
+        return {key: item[key] for key in PRESERVED_FIELDS if item.get(key) is not None}
 
     # 获取所有图片文件（支持 jpg 和 png）
-    image_files = list(images_dir.glob("*.jpg")) + list(images_dir.glob("*.png"))
+    image_files = sorted(list(images_dir.glob("*.jpg")) + list(images_dir.glob("*.png")))
     total = len(image_files)
 
+    if completed:
+        print(f"\n♻️  从检查点继续：已完成 {len(completed)} 个")
+    else:
+        # 从头开始时删除没有对应图片的向量；其余向量在重新生成后覆盖，失败的图片保留原向量
+        stems = {path.stem for path in image_files}
+        orphans = [emb_file for emb_file in embeddings_dir.glob("*.npy") if emb_file.stem not in stems]
+        for emb_file in orphans:
+            emb_file.unlink()
+        if orphans:
+            print(f"\n🗑️  删除 {len(orphans)} 个没有对应图片的向量")
+
     print(f"\n📸 找到 {total} 个图片文件")
 
     if total == 0:
         print("❌ 没有图片文件")
         return
 
-    # 初始化元数据
-    metadata = {"items": []}
+    pending = [path for path in image_files if path.stem not in completed]
 
-    # 统计
-    success_count = 0
-    error_count = 0
-
-    # 处理每个图片
-    for idx, img_path in enumerate(image_files, 1):
-        file_id = img_path.stem
-        print(f"\n[{idx}/{total}] 处理: {img_path.name}")
-
-        try:
-            # 读取图片
-            with open(img_path, 'rb') as f:
-                image_data = f.read()
-
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
-            print(f"  📦 大小: {len(image_data) / 1024:.1f} KB")
-
-            # 分析图片
-            print(f"  🔍 分析中...")
-            analysis = await claude_service.analyze_image(
-                image_base64=image_base64,
-                prompt="分析这个产品设计的元素、风格和结构"
-            )
-
-            print(f"  ✅ 分析完成")
-            print(f"     主要元素: {', '.join([e.type for e in analysis.elements.primary[:3]])}")
-            print(f"     风格: {', '.join(analysis.style.tags[:3])}")
-
-            # 生成检索描述
-            search_desc = generate_multimodal_search_description(analysis)
-            print(f"  📝 检索描述: {search_desc[:60]}...")
-
-            # 生成嵌入向量
-            print(f"  🧮 生成向量...")
-            embedding = await embedding_service.generate_embedding(
-                image_base64="",
-                text=search_desc
-            )
-
-            if embedding is not None:
-                # 保存向量
-                embedding_path = embeddings_dir / f"{file_id}.npy"
-                np.save(embedding_path, embedding)
-                print(f"  ✅ 向量已保存")
-            else:
-                print(f"  ⚠️  向量生成失败")
-
-            # 添加到元数据
-            item = {
-                "id": file_id,
-                "filename": img_path.name,
-                "uploadTime": datetime.now().isoformat(),
-                "analysis": analysis.model_dump(),
-                "salesTier": "B"
-            }
-            metadata["items"].append(item)
-
-            success_count += 1
-
-            # 避免请求过快
-            if idx < total:
-                await asyncio.sleep(0.5)
-
-        except Exception as e:
-            print(f"  ❌ 处理失败: {e}")
-            error_count += 1
-            import traceback
-            traceback.print_exc()
-
-    # 保存元数据
+    # ==================== 阶段函数 ====================
+
+    async def decode(job: Job):
+        # 读取与压缩是 CPU / IO 操作，放到线程中；压缩结果缓存在载体上，分析时直接复用
+        def load() -> ImagePayload:
+            payload = ImagePayload(data=job.path.read_bytes())
+            payload.compressed(MAX_IMAGE_SIZE)
+            if "phash" not in preserved(job.path.stem):
+                dhash_value, phash_value = image_hashes(payload.data)
+                job.hashes = {"dhash": format_hash(dhash_value), "phash": format_hash(phash_value)}
+            return payload
+        job.payload = await asyncio.to_thread(load)
+
+    async def analyze(job: Job):
+        job.analysis = await claude_service.analyze_image(image_base64=job.payload, prompt=ANALYSIS_PROMPT)
+        # 分析完成后不再需要图片数据
+        job.payload = None
+
+    async def describe(job: Job):
+        job.description = generate_multimodal_search_description(job.analysis)
+
+    async def embed(job: Job):
+        job.embedding = await embedding_service.generate_embedding(image_base64="", text=job.description)
+
+    async def persist(job: Job):
+        file_id = job.path.stem
+        embedding_sha256 = None
+        if job.embedding is not None:
+            await asyncio.to_thread(np.save, embeddings_dir / f"{file_id}.npy", job.embedding)
+            # 与服务入库时相同的指纹，regenerate_embeddings 据此跳过未变化的项
+            embedding_sha256 = embedding_service.fingerprint(job.description)
+        else:
+            # 原向量与新的分析结果不再对应
+            (embeddings_dir / f"{file_id}.npy").unlink(missing_ok=True)
+            print(f"  ⚠️  {job.path.name} 向量生成失败")
+        item = {
+            "id": file_id,
+            "filename": job.path.name,
+            "uploadTime": datetime.now().isoformat(),
+            "analysis": job.analysis.model_dump(),
+            "salesTier": "B",
+            "embedding_sha256": embedding_sha256,
+            **job.hashes,
+            **preserved(file_id),
+        }
+        checkpoint.append(item)
+        completed[file_id] = item
+
+    # 分析 / 嵌入并发默认取限流器上限：再多的请求只会在限流器里排队，还可能排队超时
+    stages = [
+        ("读取压缩", decode, decode_workers or min(8, os.cpu_count() or 1)),
+        ("分析", analyze, analyze_workers or claude_service.limiter.max_in_flight),
+        ("描述", describe, 1),
+        ("嵌入", embed, embed_workers or embedding_service.limiter.max_in_flight),
+        ("落盘", persist, 1),
+    ]
+    state = RebuildState(total=total, skipped=total - len(pending))
+    state.stages = [StageStats(name=name, workers=workers) for name, _, workers in stages]
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+
+    print(f"\n🚀 待处理 {len(pending)} 个，各阶段并发: "
+          + ", ".join(f"{s.name} x{s.workers}" for s in state.stages))
+
+    async def feed():
+        for path in pending:
+            await queues[0].put(Job(path=path))
+        await queues[0].put(_DONE)
+
+    async def report():
+        while True:
+            await asyncio.sleep(report_interval)
+            state.report("进度")
+
+    reporter = asyncio.create_task(report())
+    try:
+        await asyncio.gather(
+            feed(),
+            *[
+                run_stage(
+                    state.stages[i], state, queues[i],
+                    queues[i + 1] if i + 1 < len(stages) else None, func,
+                )
+                for i, (_, func, _) in enumerate(stages)
+            ],
+        )
+    finally:
+        reporter.cancel()
+        checkpoint.close()
+
+    state.report("重建结束")
+
+    if state.errors:
+        # 保留检查点，修复问题后重新运行只处理失败的图片
+        print(f"\n⚠️  {len(state.errors)} 个图片处理失败，检查点已保留，重新运行脚本可继续：")
+        for error in state.errors[:20]:
+            print(f"    {error}")
+    else:
+        checkpoint.remove()
+
+    def rebuilt(file_id: str) -> Dict[str, Any]:
+        # 已有条目只写入重新生成的字段：沿用的字段以写入时的最新元数据为准
+        # （旧版本写入的检查点没有沿用这些字段，销售层级写死为 B）
+        fields = preserved(file_id)
+        return {key: value for key, value in completed[file_id].items() if key not in fields}
+
+    # 保存元数据（加锁合并：失败的图片不在其中，原条目保持不变）
     print(f"\n💾 保存元数据...")
-    with open(metadata_file, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, ensure_ascii=False, indent=2)
+    success_count = gallery_service.upsert_items(
+        [rebuilt(path.stem) for path in image_files if path.stem in completed]
+    )
+    failed = [path.stem for path in image_files if path.stem not in completed]
+    kept = [file_id for file_id in failed if file_id in previous]
 
     # 统计
     print("\n" + "="*60)
     print("📊 重建完成")
     print("="*60)
     print(f"✅ 成功: {success_count}")
-    print(f"❌ 失败: {error_count}")
+    print(f"❌ 失败: {len(failed)}（其中 {len(kept)} 个保留原条目，{len(failed) - len(kept)} 个未入库）")
+    for file_id in failed[:20]:
+        print(f"    {file_id}{'（保留原条目）' if file_id in previous else ''}")
     print(f"📊 总计: {total}")
     print()
 
@@ -139,4 +366,19 @@ async def rebuild_gallery():
 
 
 if __name__ == "__main__":
-    asyncio.run(rebuild_gallery())
+    parser = argparse.ArgumentParser(description="重新构建图库（并行流水线，可断点续跑）")
+    parser.add_argument("--restart", action="store_true", help="丢弃检查点，从头重建")
+    parser.add_argument("--decode-workers", type=int, help="读取 / 压缩并发数（默认 CPU 核数，最多 8）")
+    parser.add_argument("--analyze-workers", type=int, help="分析并发数（默认取 Claude 限流器并发上限）")
+    parser.add_argument("--embed-workers", type=int, help="嵌入并发数（默认取嵌入限流器并发上限）")
+    parser.add_argument("--queue-size", type=int, default=32, help="阶段之间的队列长度")
+    parser.add_argument("--report-interval", type=float, default=10.0, help="进度打印间隔（秒）")
+    args = parser.parse_args()
+    asyncio.run(rebuild_gallery(
+        restart=args.restart,
+        decode_workers=args.decode_workers,
+        analyze_workers=args.analyze_workers,
+        embed_workers=args.embed_workers,
+        queue_size=args.queue_size,
+        report_interval=args.report_interval,
+    ))
@@ -2,37 +2,56 @@
 """
 重新生成图库中所有图片的嵌入向量
 使用改进的标准化描述方法
+
+增量批量模式：
+- 先为所有项目计算检索描述，与元数据中的向量指纹（embedding_sha256）比对
+- 只有描述（或嵌入模型）变化、缺少指纹或缺少向量文件的项目需要重新生成
+- 按 --batch-size 分批，每批一次请求（input 为文本列表），多批并发数取嵌入限流器的并发上限
+- 所有结果生成后通过 gallery_service 加锁批量写入向量文件与指纹，元数据只保存一次；
+  生成期间分析结果被其他进程修改过的项目不写入，下次运行时重新生成
+
+用法:
+    python regenerate_embeddings.py              # 增量重新生成
+    python regenerate_embeddings.py --dry-run    # 只统计需要重新生成的向量数
+    python regenerate_embeddings.py --force      # 忽略指纹，全部重新生成
 """
+import argparse
 import asyncio
 import json
 import sys
+import time
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 import numpy as np
 
 # 添加 backend 目录到路径
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+from config import get_settings
 from models import ImageAnalysis
 from services.embedding_service import embedding_service
 from services.search_utils import generate_multimodal_search_description
 
+settings = get_settings()
 
-async def regenerate_embeddings():
-    """重新生成所有嵌入向量"""
-    # 路径设置
-    base_dir = Path(__file__).parent.parent / "data" / "gallery"
-    embeddings_dir = base_dir / "embeddings"
-    metadata_file = base_dir / "metadata.json"
 
-    if not metadata_file.exists():
-        print("❌ 元数据文件不存在")
-        return
+async def regenerate_embeddings(
+    dry_run: bool = False,
+    force: bool = False,
+    batch_size: Optional[int] = None,
+):
+    """
+    增量重新生成嵌入向量
 
-    # 加载元数据
-    with open(metadata_file, 'r', encoding='utf-8') as f:
-        metadata = json.load(f)
+    Args:
+        dry_run: 只统计需要重新生成的数量，不发请求、不写文件
+        force: 忽略指纹，全部重新生成
+        batch_size: 每次请求的文本数
+    """
+    from services.gallery_service import gallery_service
 
-    items = metadata.get("items", [])
+    batch_size = max(1, batch_size or settings.EMBEDDING_BATCH_SIZE)
+    items = gallery_service.metadata.get("items", [])
     total = len(items)
 
     if total == 0:
@@ -42,80 +61,92 @@ async def regenerate_embeddings():
     print("\n" + "="*60)
     print(f"📊 图库嵌入向量重新生成")
     print("="*60)
-    print(f"\n总共需要处理 {total} 张图片")
-    print(f"使用改进的标准化描述方法\n")
+    print(f"\n图库共 {total} 张图片")
 
-    # 统计
-    success_count = 0
+    # 1. 计算所有描述并与已存储的指纹比对
     skipped_count = 0
-    error_count = 0
-
-    # 处理每个项目
-    for idx, item in enumerate(items, 1):
+    changed: List[Tuple[str, str, str]] = []  # (ID, 描述, 指纹)
+    analyses: Dict[str, Dict] = {}  # 生成描述时的分析结果，写入时据此跳过期间被修改的项目
+    for item in items:
         ref_id = item["id"]
-        print(f"\n[{idx}/{total}] 处理 {ref_id}...")
-
+        analysis_dict = item.get("analysis")
+        if not analysis_dict:
+            print(f"  ⚠️  {ref_id} 跳过：无分析数据")
+            skipped_count += 1
+            continue
         try:
-            # 从元数据中获取分析结果
-            analysis_dict = item.get("analysis")
-            if not analysis_dict:
-                print(f"  ⚠️  跳过：无分析数据")
-                skipped_count += 1
-                continue
-
-            # 转换为 ImageAnalysis 对象
+            analysis = ImageAnalysis(**analysis_dict)
+        except Exception as e:
+            print(f"  ⚠️  {ref_id} 跳过：分析数据格式错误 - {e}")
+            skipped_count += 1
+            continue
+
+        text_desc = generate_multimodal_search_description(analysis)
+        fingerprint = embedding_service.fingerprint(text_desc)
+        up_to_date = (
+            item.get("embedding_sha256") == fingerprint
+            and gallery_service.embedding_path(ref_id).exists()
+        )
+        if force or not up_to_date:
+            changed.append((ref_id, text_desc, fingerprint))
+            analyses[ref_id] = analysis_dict
+
+    batches = [changed[i:i + batch_size] for i in range(0, len(changed), batch_size)]
+    unchanged_count = total - skipped_count - len(changed)
+    print(f"需要重新生成: {len(changed)}，未变化: {unchanged_count}，跳过: {skipped_count}")
+    print(f"批大小 {batch_size}，共 {len(batches)} 次请求")
+
+    if dry_run:
+        print("\n🔎 dry-run：不发送请求，不写入文件")
+        return
+    if not changed:
+        print("\n✅ 所有向量都是最新的")
+        return
+
+    # 2. 分批请求（并发批数不超过限流器上限，避免在限流器中排队超时）
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(embedding_service.limiter.max_in_flight)
+    results: Dict[str, Tuple[np.ndarray, str]] = {}
+    error_count = 0
+
+    async def run_batch(index: int, batch: List[Tuple[str, str, str]]):
+        nonlocal error_count
+        async with semaphore:
             try:
-                analysis = ImageAnalysis(**analysis_dict)
+                embeddings = await embedding_service.generate_embeddings([text for _, text, _ in batch])
             except Exception as e:
-                print(f"  ⚠️  跳过：分析数据格式错误 - {e}")
-                skipped_count += 1
-                continue
-
-            # 生成标准化描述
-            text_desc = generate_multimodal_search_description(analysis)
-            print(f"  📝 描述: {text_desc[:80]}...")
-
-            # 生成嵌入向量
-            # 注意：这里我们只使用文本，因为图片文件可能不存在或太大
-            embedding = await embedding_service.generate_embedding(
-                image_base64="",  # 不使用图像
-                text=text_desc
-            )
-
-            if embedding is not None:
-                # 保存向量
-                embedding_path = embeddings_dir / f"{ref_id}.npy"
-                np.save(embedding_path, embedding)
-                print(f"  ✅ 向量已生成并保存 ({embedding.shape})")
-                success_count += 1
-            else:
-                print(f"  ❌ 向量生成失败")
-                error_count += 1
+                print(f"  ❌ 第 {index + 1}/{len(batches)} 批失败（{len(batch)} 条）: {e}")
+                error_count += len(batch)
+                return
+        for (ref_id, _, fingerprint), embedding in zip(batch, embeddings):
+            results[ref_id] = (embedding, fingerprint)
+        print(f"  ✅ 第 {index + 1}/{len(batches)} 批完成（{len(batch)} 条）")
 
-        except Exception as e:
-            print(f"  ❌ 处理失败: {e}")
-            error_count += 1
-            import traceback
-            traceback.print_exc()
+    await asyncio.gather(*[run_batch(i, batch) for i, batch in enumerate(batches)])
 
-        # 避免请求过快
-        if idx < total:
-            await asyncio.sleep(0.5)
+    # 3. 批量写入（失败的批次不写指纹，下次运行时重试）
+    success_count = gallery_service.save_embeddings(results, expected=analyses) if results else 0
+    stale_count = len(results) - success_count
+    elapsed = time.perf_counter() - started
 
     # 打印统计
     print("\n" + "="*60)
     print("📊 处理完成")
     print("="*60)
-    print(f"✅ 成功: {success_count}")
+    print(f"✅ 重新生成: {success_count}")
+    print(f"♻️  未变化: {unchanged_count}")
     print(f"⚠️  跳过: {skipped_count}")
     print(f"❌ 失败: {error_count}")
+    if stale_count:
+        print(f"🔄 期间被修改或删除（未写入）: {stale_count}")
     print(f"📊 总计: {total}")
+    print(f"⏱️  耗时: {elapsed:.1f}s（{len(batches)} 次请求）")
     print()
 
     if success_count > 0:
         print(f"🎉 已成功重新生成 {success_count} 个嵌入向量")
         print("   使用新的标准化描述方法，检索准确度将得到提升")
-    else:
+    elif error_count:
         print("⚠️  没有成功生成任何向量，请检查错误信息")
 
 
@@ -224,17 +255,17 @@ async def test_similarity():
 
 
 if __name__ == "__main__":
-    import sys
-
-    if len(sys.argv) > 1:
-        if sys.argv[1] == "--verify":
-            asyncio.run(verify_embeddings())
-        elif sys.argv[1] == "--test":
-            asyncio.run(test_similarity())
-        else:
-            print("用法:")
-            print("  python regenerate_embeddings.py           # 重新生成所有向量")
-            print("  python regenerate_embeddings.py --verify  # 验证向量完整性")
-            print("  python regenerate_embeddings.py --test    # 测试相似度检索")
+    parser = argparse.ArgumentParser(description="增量重新生成图库嵌入向量")
+    parser.add_argument("--dry-run", action="store_true", help="只统计需要重新生成的向量数")
+    parser.add_argument("--force", action="store_true", help="忽略指纹，全部重新生成")
+    parser.add_argument("--batch-size", type=int, help=f"每次请求的文本数（默认 {settings.EMBEDDING_BATCH_SIZE}）")
+    parser.add_argument("--verify", action="store_true", help="验证向量完整性")
+    parser.add_argument("--test", action="store_true", help="测试相似度检索")
+    args = parser.parse_args()
+
+    if args.verify:
+        asyncio.run(verify_embeddings())
+    elif args.test:
+        asyncio.run(test_similarity())
     else:
-        asyncio.run(regenerate_embeddings())
+        asyncio.run(regenerate_embeddings(dry_run=args.dry_run, force=args.force, batch_size=args.batch_size))
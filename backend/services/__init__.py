@@ -1,18 +1,51 @@
-from .claude_service import claude_service, ClaudeService
-from .seedream_service import seedream_service, SeedreamService
-from .embedding_service import embedding_service, EmbeddingService
-from .gallery_service import gallery_service, GalleryService
-from .preset_service import preset_service, PresetService
+"""
+服务模块
 
-__all__ = [
-    "claude_service",
-    "ClaudeService",
-    "seedream_service",
-    "SeedreamService",
-    "embedding_service",
-    "EmbeddingService",
-    "gallery_service",
-    "GalleryService",
-    "preset_service",
-    "PresetService",
-]
+导入本包没有副作用：各服务模块在首次访问对应名称时才导入（from services import gallery_service
+只导入 gallery_service 模块），有构造成本的单例由 LazyService 延迟到首次使用时构造
+"""
+from typing import TYPE_CHECKING
+
+from utils.lazy_service import lazy_exports
+
+# 导出名 → 所在子模块
+lazy_exports(__name__, {
+    "claude_service": "claude_service",
+    "ClaudeService": "claude_service",
+    "seedream_service": "seedream_service",
+    "SeedreamService": "seedream_service",
+    "embedding_service": "embedding_service",
+    "EmbeddingService": "embedding_service",
+    "gallery_service": "gallery_service",
+    "GalleryService": "gallery_service",
+    "preset_service": "preset_service",
+    "PresetService": "preset_service",
+    "event_bus": "event_bus",
+    "EventBus": "event_bus",
+    "blob_store": "blob_store",
+    "BlobStore": "blob_store",
+    "generated_store": "generated_store",
+    "GeneratedImageStore": "generated_store",
+    "image_derivatives": "image_derivatives",
+    "ImageDerivativeService": "image_derivatives",
+    "asset_registry": "asset_registry",
+    "AssetRegistry": "asset_registry",
+    "gallery_ingest": "gallery_ingest",
+    "GalleryIngestQueue": "gallery_ingest",
+    "gallery_snapshot": "gallery_snapshot",
+    "GallerySnapshot": "gallery_snapshot",
+})
+
+if TYPE_CHECKING:
+    from .claude_service import claude_service, ClaudeService
+    from .seedream_service import seedream_service, SeedreamService
+    from .embedding_service import embedding_service, EmbeddingService
+    from .gallery_service import gallery_service, GalleryService
+    from .preset_service import preset_service, PresetService
+    from .event_bus import event_bus, EventBus
+    from .blob_store import blob_store, BlobStore
+    from .generated_store import generated_store, GeneratedImageStore
+    from .image_derivatives import image_derivatives, ImageDerivativeService
+    from .asset_registry import asset_registry, AssetRegistry
+    from .gallery_ingest import gallery_ingest, GalleryIngestQueue
+    from .gallery_snapshot import gallery_snapshot, GallerySnapshot
@@ -0,0 +1,164 @@
+"""
+数据资源注册表
+presets.json、few_shot_examples.json 等 JSON 资源统一在这里加载，修改后无需重启即可生效
+
+设计理念：
+- 每个文件只加载一次，所有使用方共享同一份数据（Asset，不可变快照）
+- 后台任务按间隔检查文件的修改时间和大小，变化时在线程中读取并解析，解析失败保留旧版本
+- 新版本整体替换旧版本（一次引用赋值），随后通知订阅方；
+  订阅方在后台重建各自的派生结构（预设模型、关键词自动机、示例向量等），完成后同样整体替换，
+  请求始终看到完整的旧版本或完整的新版本
+
+核心方法：
+- get(): 获取资源（首次访问时加载）
+- subscribe(): 订阅资源变化
+- check(): 检查并重新加载变化的资源
+- start() / stop(): 启动 / 停止后台检查任务
+"""
+import asyncio
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from config import get_settings
+
+settings = get_settings()
+
+
+@dataclass(frozen=True)
+class Asset:
+    """资源快照"""
+    name: str
+    data: Any
+    mtime: float
+    version: int
+
+
+AssetCallback = Callable[[Asset], Awaitable[None]]
+
+
+class AssetRegistry:
+    """带热重载的 JSON 资源注册表"""
+
+    def __init__(self, base_dir: Optional[Path] = None, interval: Optional[float] = None):
+        """
+        Args:
+            base_dir: 资源目录，默认 data/
+            interval: 检查间隔（秒），0 表示不自动检查
+        """
+        self.base_dir = Path(base_dir or Path(__file__).parent.parent / "data")
+        self.interval = settings.ASSET_RELOAD_INTERVAL if interval is None else interval
+        self._assets: Dict[str, Asset] = {}
+        self._signatures: Dict[str, Tuple[float, int]] = {}
+        self._subscribers: Dict[str, List[AssetCallback]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"reloads": 0, "reload_errors": 0}
+
+    def _signature(self, name: str) -> Optional[Tuple[float, int]]:
+        try:
+            stat = (self.base_dir / name).stat()
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def _read(self, name: str) -> Any:
+        with open(self.base_dir / name, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def get(self, name: str) -> Asset:
+        """
+        获取资源（首次访问时同步加载，文件不存在或解析失败时数据为空字典）
+
+        Args:
+            name: 资源文件名（相对 data/）
+        """
+        asset = self._assets.get(name)
+        if asset is None:
+            signature = self._signature(name)
+            try:
+                data = self._read(name)
+            except (FileNotFoundError, json.JSONDecodeError) as e:
+                print(f"[Asset Registry] Warning: Failed to load {name}: {e}")
+                data = {}
+            asset = Asset(name=name, data=data, mtime=signature[0] if signature else 0.0, version=1)
+            self._assets[name] = asset
+            self._signatures[name] = signature
+        return asset
+
+    def subscribe(self, name: str, callback: AssetCallback):
+        """
+        订阅资源变化（回调在新版本替换后依次执行）
+
+        Args:
+            name: 资源文件名
+            callback: 异步回调，参数为新版本的资源
+        """
+        self._subscribers.setdefault(name, []).append(callback)
+
+    async def check(self) -> List[str]:
+        """
+        检查所有已加载的资源，重新加载发生变化的文件
+
+        Returns:
+            重新加载的资源名
+        """
+        reloaded = []
+        for name in list(self._assets):
+            signature = self._signature(name)
+            if signature is None or signature == self._signatures.get(name):
+                continue
+            try:
+                data = await asyncio.to_thread(self._read, name)
+            except (OSError, json.JSONDecodeError) as e:
+                # 编辑过程中可能读到不完整的文件：保留旧版本，文件再次变化时重试
+                self._signatures[name] = signature
+                self._stats["reload_errors"] += 1
+                print(f"[Asset Registry] {name} 解析失败，继续使用旧版本: {e}")
+                continue
+
+            previous = self._assets[name]
+            asset = Asset(name=name, data=data, mtime=signature[0], version=previous.version + 1)
+            self._assets[name] = asset
+            self._signatures[name] = signature
+            self._stats["reloads"] += 1
+            reloaded.append(name)
+            print(f"[Asset Registry] 已重新加载 {name} (v{asset.version})")
+
+            for callback in self._subscribers.get(name, []):
+                try:
+                    await callback(asset)
+                except Exception as e:
+                    print(f"[Asset Registry] {name} 订阅方更新失败: {e}")
+        return reloaded
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                print(f"[Asset Registry] 检查失败: {e}")
+
+    def start(self):
+        """启动后台检查任务"""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._watch(), name="asset-registry-watch")
+
+    async def stop(self):
+        """停止后台检查任务"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def metrics(self) -> Dict[str, Any]:
+        """资源版本与重载统计"""
+        return {
+            **self._stats,
+            "assets": {name: {"version": a.version, "mtime": a.mtime} for name, a in self._assets.items()},
+        }
+
+
+# 单例实例
+asset_registry = AssetRegistry()
@@ -0,0 +1,193 @@
+"""
+内容寻址的图片存储
+相同内容的图片只在磁盘上保存一份，会话、任务、图库只保存 sha256
+
+设计理念：
+- 文件以内容哈希命名（objects/<前两位>/<sha256>），写入先写临时文件再原子替换
+- 引用计数记录在 SQLite 索引中（多进程安全）：持有方 acquire() 增加引用，release() 减少引用
+- 引用数归零的文件不会立即删除，gc() 在宽限期后清理，避免“刚写入还未被引用”的竞争
+- 图库等需要固定文件名的场景用硬链接指向同一份内容（link()）
+
+核心方法：
+- acquire(): 存入图片并增加引用，返回哈希
+- release(): 减少引用
+- open(): 按哈希读取图片
+- link(): 在指定路径创建指向该内容的硬链接
+- gc(): 清理无引用的文件
+"""
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from utils.image_payload import ImagePayload
+
+
+class BlobStore:
+    """内容寻址存储（sha256 命名 + 引用计数）"""
+
+    def __init__(self, base_dir: Optional[Path] = None):
+        """
+        Args:
+            base_dir: 存储根目录，默认 data/blobs
+        """
+        self.base_dir = Path(base_dir or Path(__file__).parent.parent / "data" / "blobs")
+        self.objects_dir = self.base_dir / "objects"
+        self.index_path = self.base_dir / "index.db"
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.objects_dir.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.index_path), timeout=10.0)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mime_type TEXT NOT NULL,
+                    refcount INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.commit()
+        return self._conn
+
+    def path(self, sha256: str) -> Path:
+        """内容文件路径"""
+        return self.objects_dir / sha256[:2] / sha256
+
+    def put(self, payload: ImagePayload) -> str:
+        """
+        存入图片（不增加引用，内容已存在时不重复写入）
+
+        Returns:
+            内容哈希
+        """
+        sha256 = payload.sha256
+        path = self.path(sha256)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{sha256}.{os.getpid()}.tmp")
+            payload.write_to(tmp)
+            os.replace(tmp, path)
+        db = self._db()
+        with db:
+            db.execute(
+                "INSERT OR IGNORE INTO blobs (sha256, size, mime_type, refcount, updated_at) VALUES (?, ?, ?, 0, ?)",
+                (sha256, payload.size, payload.mime_type, time.time()),
+            )
+        return sha256
+
+    def acquire(self, payload: ImagePayload) -> str:
+        """存入图片并增加一次引用"""
+        sha256 = self.put(payload)
+        self._adjust(sha256, 1)
+        return sha256
+
+    def incref(self, sha256: str):
+        """为已存在的内容增加一次引用"""
+        self._adjust(sha256, 1)
+
+    def release(self, sha256: Optional[str]):
+        """减少一次引用（归零后等待 gc 清理）"""
+        if sha256:
+            self._adjust(sha256, -1)
+
+    def _adjust(self, sha256: str, delta: int):
+        db = self._db()
+        with db:
+            db.execute(
+                "UPDATE blobs SET refcount = MAX(refcount + ?, 0), updated_at = ? WHERE sha256 = ?",
+                (delta, time.time(), sha256),
+            )
+
+    def exists(self, sha256: str) -> bool:
+        return self.path(sha256).exists()
+
+    def open(self, sha256: str) -> Optional[ImagePayload]:
+        """
+        按哈希读取图片
+
+        Returns:
+            图像载体，内容不存在时返回 None
+        """
+        path = self.path(sha256)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        row = self._db().execute("SELECT mime_type FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        payload = ImagePayload(data=data, mime_type=row["mime_type"] if row else None)
+        payload.__dict__["sha256"] = sha256
+        return payload
+
+    def link(self, sha256: str, dest: Path):
+        """
+        在 dest 创建指向内容文件的硬链接（跨设备等无法链接时退化为复制）
+
+        Args:
+            sha256: 内容哈希
+            dest: 目标路径（已存在时覆盖）
+        """
+        source = self.path(sha256)
+        dest = Path(dest)
+        dest.unlink(missing_ok=True)
+        try:
+            os.link(source, dest)
+        except OSError:
+            shutil.copyfile(source, dest)
+
+    def gc(self, grace_seconds: float = 3600.0) -> Tuple[int, int]:
+        """
+        删除引用数为 0 且超过宽限期的内容
+
+        Args:
+            grace_seconds: 引用归零后的保留时间（秒）
+
+        Returns:
+            (删除文件数, 释放字节数)
+        """
+        db = self._db()
+        cutoff = time.time() - grace_seconds
+        rows = db.execute(
+            "SELECT sha256, size FROM blobs WHERE refcount = 0 AND updated_at < ?", (cutoff,)
+        ).fetchall()
+        removed, freed = 0, 0
+        for row in rows:
+            with db:
+                # 再次确认仍无引用（其他进程可能刚刚引用）
+                cursor = db.execute(
+                    "DELETE FROM blobs WHERE sha256 = ? AND refcount = 0", (row["sha256"],)
+                )
+            if cursor.rowcount:
+                self.path(row["sha256"]).unlink(missing_ok=True)
+                removed += 1
+                freed += row["size"]
+        if removed:
+            print(f"[Blob Store] 清理 {removed} 个无引用文件，释放 {freed} bytes")
+        return removed, freed
+
+    def metrics(self) -> Dict[str, Any]:
+        """存储指标"""
+        row = self._db().execute(
+            "SELECT COUNT(*) AS blobs, COALESCE(SUM(size), 0) AS bytes, "
+            "COALESCE(SUM(refcount), 0) AS refs, "
+            "COALESCE(SUM(CASE WHEN refcount = 0 THEN 1 ELSE 0 END), 0) AS unreferenced "
+            "FROM blobs"
+        ).fetchone()
+        return dict(row)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+# 单例实例
+blob_store = BlobStore()
@@ -14,12 +14,11 @@ Claude AI 服务
 """
 import httpx
 import json
-import base64
-import io
-from pathlib import Path
-from typing import List, Optional, Dict, Any
-from PIL import Image
+from typing import List, Optional, Dict, Any, Union
 from config import get_settings
+from utils.image_payload import ImagePayload, MAX_IMAGE_SIZE
+from services.rate_limiter import get_limiter
+from services.asset_registry import asset_registry
 from models import (
     ChatMessage, ImageAnalysis, ElementsGroup,
     StyleInfo, PhysicalSpecs
@@ -27,24 +26,6 @@ from models import (
 
 settings = get_settings()
 
-# 加载模板和模式库
-def load_json_file(filename: str) -> Dict[str, Any]:
-    """加载 JSON 配置文件"""
-    file_path = Path(__file__).parent.parent / "data" / filename
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"[Claude Service] Warning: Failed to load {filename}: {e}")
-        return {}
-
-# 预加载配置
-FEW_SHOT_EXAMPLES = load_json_file("few_shot_examples.json")
-
-# 最大图片大小 (4MB，留一些余量)
-MAX_IMAGE_SIZE = 4 * 1024 * 1024
-
-
 def compress_image_base64(image_base64: str, max_size: int = MAX_IMAGE_SIZE) -> str:
     """
     压缩图片到指定大小以下，并统一转换为 JPEG 格式
@@ -56,91 +37,7 @@ def compress_image_base64(image_base64: str, max_size: int = MAX_IMAGE_SIZE) ->
     Returns:
         压缩后的 JPEG 格式 base64 编码
     """
-    try:
-        # 解码 base64
-        image_data = base64.b64decode(image_base64)
-        print(f"[Image Compress] Original size: {len(image_data)} bytes")
-
-        # 打开图片
-        img = Image.open(io.BytesIO(image_data))
-        print(f"[Image Compress] Original format: {img.format}, mode: {img.mode}")
-
-        # 转换为 RGB（如果是 RGBA 或其他模式）
-        if img.mode in ('RGBA', 'P'):
-            img = img.convert('RGB')
-        elif img.mode not in ('RGB', 'L'):
-            # 其他模式也转换为 RGB
-            img = img.convert('RGB')
-
-        # 如果已经小于限制且是 JPEG，可以快速转换
-        # 否则需要压缩处理
-
-    except Exception as e:
-        print(f"[Image Compress Error] Failed to decode/open image: {e}")
-        # 如果解码或打开失败，尝试返回原始数据
-        # 如果原始数据太大，可能会导致 API 调用失败，但至少不会崩溃
-        return image_base64
-
-    # 统一转换为 JPEG 格式，并根据需要压缩
-    # 首先尝试高质量转换
-    quality = 95
-    max_dimension = 2048
-
-    try:
-        # 第一次尝试：高质量 JPEG 转换
-        buffer = io.BytesIO()
-        img.save(buffer, format='JPEG', quality=quality, optimize=True)
-        compressed_data = buffer.getvalue()
-
-        print(f"[Image Compress] Initial JPEG conversion: {len(compressed_data)} bytes (quality: {quality})")
-
-        # 如果已经满足大小要求，直接返回
-        if len(compressed_data) <= max_size:
-            result = base64.b64encode(compressed_data).decode('utf-8')
-            print(f"[Image Compress] ✓ No compression needed, final size: {len(compressed_data)} bytes")
-            return result
-
-        # 需要进一步压缩
-        print(f"[Image Compress] Image too large ({len(compressed_data)} > {max_size}), compressing...")
-        quality = 85
-
-        while True:
-            # 调整尺寸
-            if max(img.size) > max_dimension:
-                ratio = max_dimension / max(img.size)
-                new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
-                resized_img = img.resize(new_size, Image.Resampling.LANCZOS)
-            else:
-                resized_img = img
-
-            # 压缩为 JPEG
-            buffer = io.BytesIO()
-            resized_img.save(buffer, format='JPEG', quality=quality, optimize=True)
-            compressed_data = buffer.getvalue()
-
-            print(f"[Image Compress] Quality: {quality}, Dimension: {max_dimension}, Size: {len(compressed_data)} bytes")
-
-            if len(compressed_data) <= max_size:
-                result = base64.b64encode(compressed_data).decode('utf-8')
-                print(f"[Image Compress] ✓ Compression successful, final size: {len(compressed_data)} bytes")
-                return result
-
-            # 降低质量或尺寸
-            if quality > 30:
-                quality -= 15
-            elif max_dimension > 512:
-                max_dimension = int(max_dimension * 0.7)
-                quality = 85
-            else:
-                # 已经是最小了，强制返回
-                result = base64.b64encode(compressed_data).decode('utf-8')
-                print(f"[Image Compress] ⚠ Minimum reached, size: {len(compressed_data)} bytes")
-                return result
-
-    except Exception as e:
-        print(f"[Image Compress Error] Failed during compression: {e}")
-        # 压缩失败，返回原始数据
-        return image_base64
+    return ImagePayload.from_base64(image_base64).compressed(max_size).base64
 
 
 class ClaudeService:
@@ -150,7 +47,12 @@ class ClaudeService:
         self.base_url = settings.OPENAI_API_BASE
         self.api_key = settings.OPENAI_API_KEY
         self.model = settings.CLAUDE_MODEL
-        self.few_shot_examples = FEW_SHOT_EXAMPLES.get("examples", [])
+        self.limiter = get_limiter(self.model)
+
+    @property
+    def few_shot_examples(self) -> List[Dict[str, Any]]:
+        """few-shot 示例（由资源注册表加载，文件修改后自动更新）"""
+        return asset_registry.get("few_shot_examples.json").data.get("examples", [])
 
     def _get_headers(self) -> dict:
         """获取请求头"""
@@ -198,11 +100,11 @@ class ClaudeService:
             payload["system"] = system_prompt
 
         async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
+            response = await self.limiter.call(lambda: client.post(
                 f"{self.base_url.replace('/v1', '')}/v1/messages",
                 headers=self._get_headers(),
                 json=payload,
-            )
+            ))
             if response.status_code != 200:
                 print(f"[Claude Chat Error] Status: {response.status_code}")
                 print(f"[Claude Chat Error] Response: {response.text}")
@@ -217,23 +119,25 @@ class ClaudeService:
 
     async def analyze_image(
         self,
-        image_base64: str,
+        image_base64: Union[str, ImagePayload],
         prompt: str = "分析这个挂饰设计的元素、风格和结构",
     ) -> ImageAnalysis:
         """
         使用Claude Vision分析图像 - 使用 Anthropic 官方格式
 
         Args:
-            image_base64: 图像base64数据
+            image_base64: 图像base64数据或图像载体
             prompt: 分析提示词
 
         Returns:
             分析结果
         """
         try:
-            # 压缩图片以确保不超过大小限制
-            print(f"[Claude Vision] Starting image analysis, original size: {len(image_base64)} chars")
-            compressed_image = compress_image_base64(image_base64)
+            # 压缩图片以确保不超过大小限制（压缩结果缓存在载体上）
+            payload = ImagePayload.coerce(image_base64)
+            print(f"[Claude Vision] Starting image analysis, original size: {payload.size} bytes")
+            compressed = payload.compressed(MAX_IMAGE_SIZE)
+            compressed_image = compressed.base64
             print(f"[Claude Vision] Image compressed, size: {len(compressed_image)} chars")
         except Exception as e:
             print(f"[Claude Vision Error] Image compression failed: {e}")
@@ -251,7 +155,7 @@ class ClaudeService:
                             "type": "image",
                             "source": {
                                 "type": "base64",
-                                "media_type": "image/jpeg",
+                                "media_type": compressed.mime_type,
                                 "data": compressed_image
                             }
                         },
@@ -298,11 +202,11 @@ class ClaudeService:
         }
 
         async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
+            response = await self.limiter.call(lambda: client.post(
                 f"{self.base_url.replace('/v1', '')}/v1/messages",
                 headers=self._get_headers(),
                 json=payload,
-            )
+            ))
             if response.status_code != 200:
                 print(f"[Claude Vision Error] Status: {response.status_code}")
                 print(f"[Claude Vision Error] Response: {response.text}")
@@ -1,11 +1,17 @@
 """
 图像嵌入服务 - 使用网关向量嵌入 API
 支持多模态输入（图像 + 文本）
+
+批量场景（如重新生成图库向量）使用 generate_embeddings()：一次请求提交多条文本（input 为列表），
+fingerprint() 标识"模型 + 描述文本"，描述未变化的向量无需重新生成
 """
+import hashlib
 import httpx
 import numpy as np
-from typing import Optional
+from typing import List, Optional, Union
 from config import get_settings
+from services.rate_limiter import get_limiter
+from utils.image_payload import ImagePayload
 
 settings = get_settings()
 
@@ -21,6 +27,7 @@ class EmbeddingService:
         # 注意: 如果 API 提供了支持图像的模型，可以修改 use_image_embedding 为 True
         # 并设置 self.model 为支持多模态的模型名称（如 "clip-vit-base" 等）
         self.max_image_size = 400 * 1024  # 最大图片大小（base64字符）
+        self.limiter = get_limiter(self.model)
 
     def _get_headers(self) -> dict:
         """获取请求头"""
@@ -31,14 +38,14 @@ class EmbeddingService:
 
     async def generate_embedding(
         self,
-        image_base64: str,
+        image_base64: Union[str, ImagePayload],
         text: Optional[str] = None
     ) -> Optional[np.ndarray]:
         """
         生成多模态嵌入向量（支持图像+文本）
 
         Args:
-            image_base64: 图像base64数据
+            image_base64: 图像base64数据或图像载体（当前模型仅使用文本）
             text: 可选的文本描述
 
         Returns:
@@ -59,11 +66,11 @@ class EmbeddingService:
 
         async with httpx.AsyncClient(timeout=60.0) as client:
             try:
-                response = await client.post(
+                response = await self.limiter.call(lambda: client.post(
                     f"{self.base_url}/embeddings",
                     headers=self._get_headers(),
                     json=payload,
-                )
+                ))
 
                 if response.status_code != 200:
                     print(f"[Embedding Error] Status: {response.status_code}")
@@ -97,6 +104,58 @@ class EmbeddingService:
                 print(f"[Embedding Error] {e}")
                 raise
 
+    def fingerprint(self, text: str) -> str:
+        """
+        向量指纹（模型 + 描述文本的哈希），指纹相同的向量无需重新生成
+
+        Args:
+            text: 用于生成向量的文本描述
+        """
+        return hashlib.sha256(f"{self.model}\n{text}".encode("utf-8")).hexdigest()
+
+    async def generate_embeddings(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        批量生成文本嵌入向量（一次请求，input 为文本列表）
+
+        Args:
+            texts: 文本描述列表
+
+        Returns:
+            与 texts 一一对应的归一化向量
+        """
+        if not texts:
+            return []
+
+        payload = {
+            "model": self.model,
+            "input": texts
+        }
+
+        print(f"[Embedding] 批量文本嵌入: {len(texts)} 条")
+
+        async with httpx.AsyncClient(timeout=120.0) as client:
+            response = await self.limiter.call(lambda: client.post(
+                f"{self.base_url}/embeddings",
+                headers=self._get_headers(),
+                json=payload,
+            ))
+
+            if response.status_code != 200:
+                print(f"[Embedding Error] Status: {response.status_code}")
+                print(f"[Embedding Error] Response: {response.text}")
+                response.raise_for_status()
+
+            data = response.json().get("data") or []
+            if len(data) != len(texts):
+                raise ValueError(f"Expected {len(texts)} embeddings, got {len(data)}")
+
+        # 按 index 对齐（OpenAI 兼容接口不保证返回顺序）
+        data = sorted(data, key=lambda entry: entry.get("index", 0))
+        matrix = np.array([entry.get("embedding", []) for entry in data], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms > 0, norms, 1.0)
+        return list(matrix)
+
     @staticmethod
     def compute_similarity(emb1: np.ndarray, emb2: np.ndarray) -> float:
         """
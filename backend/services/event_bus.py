@@ -0,0 +1,99 @@
+"""
+进程内事件总线
+为 SSE 推送提供按频道的发布/订阅
+
+事件只分发给同一进程内的订阅者；多 worker 部署时订阅方需要回查共享存储
+（任务状态、会话版本）来补上其他 worker 发布的事件
+
+核心方法：
+- publish(): 向频道发布事件（无订阅者时直接丢弃）
+- subscribe(): 订阅频道，返回异步迭代器
+- sse_format(): 把事件格式化为 SSE 文本帧
+"""
+import asyncio
+import json
+from typing import Any, AsyncIterator, Dict, Optional, Set
+
+
+class EventBus:
+    """按频道分发事件的发布/订阅总线"""
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def publish(self, channel: str, event: Dict[str, Any]):
+        """
+        发布事件
+
+        Args:
+            channel: 频道名（如 session:<id>、job:<id>）
+            event: 事件内容（需可 JSON 序列化）
+        """
+        for queue in list(self._subscribers.get(channel, ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # 慢订阅者丢弃最旧的事件，保证发布方不被阻塞
+                try:
+                    queue.get_nowait()
+                    queue.put_nowait(event)
+                except (asyncio.QueueEmpty, asyncio.QueueFull):
+                    pass
+
+    async def subscribe(
+        self,
+        channel: str,
+        heartbeat: Optional[float] = 15.0,
+    ) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """
+        订阅频道
+
+        Args:
+            channel: 频道名
+            heartbeat: 心跳间隔（秒），超时无事件时产出 None 供调用方发送保活帧
+
+        Yields:
+            事件字典，或心跳时的 None
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(channel, set()).add(queue)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                yield event
+        finally:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    self._subscribers.pop(channel, None)
+
+    def subscriber_count(self, channel: str) -> int:
+        """频道当前订阅者数量"""
+        return len(self._subscribers.get(channel, ()))
+
+
+def sse_format(event: Optional[Dict[str, Any]]) -> str:
+    """
+    格式化为 SSE 帧
+
+    Args:
+        event: 事件字典，None 表示心跳
+
+    Returns:
+        SSE 文本帧
+    """
+    if event is None:
+        return ": keep-alive\n\n"
+    name = event.get("event", "message")
+    data = json.dumps(event, ensure_ascii=False, default=str)
+    return f"event: {name}\ndata: {data}\n\n"
+
+
+# 单例实例
+event_bus = EventBus()
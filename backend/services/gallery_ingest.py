@@ -0,0 +1,381 @@
+"""
+图库后台入库队列
+上传接口只负责保存图片并返回 pending，分析、向量生成和写入图库在后台完成
+
+设计理念：
+- 上传时图片存入内容寻址存储（blob_store）并写入一条队列记录，接口立即返回
+- 每张图片依次经过 pending → analyzed → embedded → indexed，每完成一个阶段就把结果写入 SQLite；
+  重启后未完成的图片从上次完成的阶段继续，已完成的分析不会重复请求
+- 有界的 worker 池并行处理（GALLERY_INGEST_WORKERS），分析 / 向量请求仍经过各模型的共享限流器
+- 多个进程共享同一个 SQLite 文件：处理前以条件更新认领记录，处理期间每隔 JOB_HEARTBEAT_INTERVAL 刷新 updated_at；
+  每隔 JOB_SCAN_INTERVAL 扫描一次数据库，接管超过 JOB_STALE_SECONDS 未更新的认领（所属进程已退出），
+  认领被接管的进程停止本地处理；
+  写入图库时在文件锁内重新加载 metadata.json 再追加（index_reference），多个进程同时入库不会互相覆盖
+- 同一内容的图片在队列中只处理一次（重复提交返回已有记录）
+
+核心方法：
+- submit(): 提交图片
+- get() / get_batch(): 查询单张 / 批量上传的处理状态
+- start() / stop(): 启动与停止 worker 池（由应用生命周期调用）
+"""
+import asyncio
+import json
+import sqlite3
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from config import get_settings
+from models import ImageAnalysis
+from services.blob_store import blob_store
+from services.claude_service import claude_service
+from services.embedding_service import embedding_service
+from services.gallery_service import gallery_service
+from services.search_utils import generate_multimodal_search_description
+from utils.image_payload import ImagePayload
+
+settings = get_settings()
+
+# 处理中的状态（按阶段顺序）与终态
+ACTIVE_STATUSES = ("pending", "analyzed", "embedded")
+TERMINAL_STATUSES = ("indexed", "failed")
+
+
+class GalleryIngestQueue:
+    """图库后台入库队列"""
+
+    def __init__(self, db_path: Optional[Path] = None, workers: Optional[int] = None):
+        """
+        Args:
+            db_path: SQLite 文件路径
+            workers: worker 数量（最大并行处理的图片数）
+        """
+        self.db_path = Path(
+            db_path or settings.GALLERY_INGEST_DB_PATH
+            or Path(__file__).parent.parent / "data" / "gallery" / "ingest.db"
+        )
+        self.worker_count = workers or settings.GALLERY_INGEST_WORKERS
+        # 当前进程的认领标识
+        self._owner = uuid.uuid4().hex
+        self._conn: Optional[sqlite3.Connection] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._scanner: Optional[asyncio.Task] = None
+        # 本进程已入队 / 处理中的记录，以及认领被其他进程接管的记录
+        self._queued: set = set()
+        self._running: set = set()
+        self._taken_over: set = set()
+
+    # ==================== 持久化 ====================
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.db_path), timeout=10.0)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ingest_items (
+                    id TEXT PRIMARY KEY,
+                    batch_id TEXT,
+                    filename TEXT,
+                    status TEXT NOT NULL,
+                    image_sha256 TEXT NOT NULL,
+                    sales_tier TEXT NOT NULL,
+                    analysis TEXT,
+                    embedding_sha256 TEXT,
+                    error TEXT,
+                    claimed_by TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_status ON ingest_items(status, created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_batch ON ingest_items(batch_id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_sha ON ingest_items(image_sha256)")
+            self._conn.commit()
+        return self._conn
+
+    def _update(self, item_id: str, **fields):
+        fields["updated_at"] = datetime.now().isoformat()
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        self._db().execute(f"UPDATE ingest_items SET {columns} WHERE id = ?", (*fields.values(), item_id))
+        self._db().commit()
+
+    def _claim(self, item_id: str) -> Optional[sqlite3.Row]:
+        """认领处理中的记录（多进程下只有一个进程能认领成功）"""
+        now = datetime.now()
+        stale_before = (now - timedelta(seconds=settings.JOB_STALE_SECONDS)).isoformat()
+        cursor = self._db().execute(
+            "UPDATE ingest_items SET claimed_by = ?, updated_at = ? "
+            f"WHERE id = ? AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))}) "
+            "AND (claimed_by IS NULL OR claimed_by = ? OR updated_at < ?)",
+            (self._owner, now.isoformat(), item_id, *ACTIVE_STATUSES, self._owner, stale_before),
+        )
+        self._db().commit()
+        if cursor.rowcount != 1:
+            return None
+        return self._db().execute("SELECT * FROM ingest_items WHERE id = ?", (item_id,)).fetchone()
+
+    def _row_to_item(self, row: sqlite3.Row) -> Dict[str, Any]:
+        item = {
+            "id": row["id"],
+            "batch_id": row["batch_id"],
+            "filename": row["filename"],
+            "status": row["status"],
+            "sales_tier": row["sales_tier"],
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+        if row["status"] == "indexed":
+            item["reference"] = gallery_service.get_reference(row["id"])
+        return item
+
+    # ==================== 执行 ====================
+
+    def _queue_instance(self) -> asyncio.Queue:
+        """延迟创建队列，确保绑定到运行中的事件循环"""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    def _enqueue(self, item_id: str):
+        self._queued.add(item_id)
+        self._queue_instance().put_nowait(item_id)
+
+    async def _worker(self, index: int):
+        queue = self._queue_instance()
+        while True:
+            item_id = await queue.get()
+            self._queued.discard(item_id)
+            row = self._claim(item_id)
+            if row is None:
+                continue
+            task = asyncio.create_task(self._process(row))
+            self._running.add(item_id)
+            heartbeat = asyncio.create_task(self._heartbeat(item_id, task))
+            try:
+                await task
+            except asyncio.CancelledError:
+                if item_id not in self._taken_over:
+                    # worker 自身被停止（应用关闭）：由 stop() 释放认领
+                    task.cancel()
+                    raise
+                print(f"[Gallery Ingest] {item_id} 已被其他进程接管，停止本地处理")
+            except Exception as e:
+                if gallery_service.get_reference(item_id) is not None:
+                    # 已写入图库（之后的步骤才出错）：向量和图片引用已归图库项所有，只补记状态
+                    print(f"[Gallery Ingest] {item_id} 已入库，但之后的处理出错: {e}")
+                    self._update(item_id, status="indexed", claimed_by=None)
+                    continue
+                print(f"[Gallery Ingest] {item_id} 处理失败（{row['status']} 之后）: {e}")
+                self._update(item_id, status="failed", error=str(e), claimed_by=None)
+                gallery_service.embedding_path(item_id).unlink(missing_ok=True)
+                blob_store.release(row["image_sha256"])
+            finally:
+                heartbeat.cancel()
+                self._running.discard(item_id)
+                self._taken_over.discard(item_id)
+
+    async def _heartbeat(self, item_id: str, task: asyncio.Task):
+        """处理期间定期刷新 updated_at；认领已被其他进程接管时停止本地处理"""
+        while not task.done():
+            await asyncio.sleep(settings.JOB_HEARTBEAT_INTERVAL)
+            try:
+                cursor = self._db().execute(
+                    "UPDATE ingest_items SET updated_at = ? WHERE id = ? AND claimed_by = ?",
+                    (datetime.now().isoformat(), item_id, self._owner),
+                )
+                self._db().commit()
+            except Exception as e:
+                print(f"[Gallery Ingest] {item_id} 心跳失败: {e}")
+                continue
+            if cursor.rowcount != 1 and not task.done():
+                self._taken_over.add(item_id)
+                task.cancel()
+                return
+
+    async def _process(self, row: sqlite3.Row):
+        """从记录当前的阶段继续处理"""
+        item_id = row["id"]
+        status = row["status"]
+        analysis_data = json.loads(row["analysis"]) if row["analysis"] else None
+        embedding_sha256 = row["embedding_sha256"]
+
+        if status == "pending":
+            payload = blob_store.open(row["image_sha256"])
+            if payload is None:
+                raise FileNotFoundError(f"图片内容不存在: {row['image_sha256']}")
+            analysis = await claude_service.analyze_image(payload)
+            analysis_data = analysis.model_dump()
+            status = "analyzed"
+            self._update(item_id, status=status, analysis=json.dumps(analysis_data, ensure_ascii=False))
+
+        if status == "analyzed":
+            description = generate_multimodal_search_description(ImageAnalysis(**analysis_data))
+            embedding = await embedding_service.generate_embedding(image_base64="", text=description)
+            if embedding is not None:
+                await asyncio.to_thread(np.save, gallery_service.embedding_path(item_id), embedding)
+                embedding_sha256 = embedding_service.fingerprint(description)
+            status = "embedded"
+            self._update(item_id, status=status, embedding_sha256=embedding_sha256)
+
+        if status == "embedded":
+            await gallery_service.index_reference(
+                item_id, row["image_sha256"], analysis_data, row["sales_tier"], embedding_sha256
+            )
+            self._update(item_id, status="indexed", claimed_by=None)
+            print(f"[Gallery Ingest] {item_id} 入库完成")
+
+    # ==================== 公共接口 ====================
+
+    def _scan(self) -> int:
+        """
+        扫描数据库：把本进程尚未调度的、未被认领或认领已过期的图片加入队列
+
+        Returns:
+            新加入队列的图片数
+        """
+        stale_before = (datetime.now() - timedelta(seconds=settings.JOB_STALE_SECONDS)).isoformat()
+        rows = self._db().execute(
+            f"SELECT id FROM ingest_items WHERE status IN ({', '.join('?' * len(ACTIVE_STATUSES))}) "
+            "AND (claimed_by IS NULL OR updated_at < ?) ORDER BY created_at",
+            (*ACTIVE_STATUSES, stale_before),
+        ).fetchall()
+        count = 0
+        for row in rows:
+            if row["id"] in self._queued or row["id"] in self._running:
+                continue
+            # 是否能处理由 worker 认领时的条件更新决定
+            self._enqueue(row["id"])
+            count += 1
+        return count
+
+    async def _scan_loop(self):
+        while True:
+            await asyncio.sleep(settings.JOB_SCAN_INTERVAL)
+            try:
+                count = self._scan()
+                if count:
+                    print(f"[Gallery Ingest] 扫描到 {count} 张待处理的图片")
+            except Exception as e:
+                print(f"[Gallery Ingest] 扫描队列失败: {e}")
+
+    async def start(self):
+        """启动 worker 池，并恢复重启前未完成的图片"""
+        if self._workers:
+            return
+        count = self._scan()
+        if count:
+            print(f"[Gallery Ingest] 恢复 {count} 张未完成的图片")
+
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"gallery-ingest-{i}")
+            for i in range(self.worker_count)
+        ]
+        self._scanner = asyncio.create_task(self._scan_loop(), name="gallery-ingest-scanner")
+        print(f"[Gallery Ingest] 启动 {self.worker_count} 个 worker")
+
+    async def stop(self):
+        """停止 worker 池（处理中的图片释放认领，下次启动时从已完成的阶段继续）"""
+        interrupted = list(self._running)
+        tasks = self._workers + ([self._scanner] if self._scanner else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._scanner = None
+        for item_id in interrupted:
+            self._update(item_id, claimed_by=None)
+        self._queue = None
+        self._queued.clear()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def submit(
+        self,
+        image: ImagePayload,
+        sales_tier: str = "B",
+        filename: Optional[str] = None,
+        batch_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        提交图片（保存图片并入队，立即返回）
+
+        Args:
+            image: 图像载体
+            sales_tier: 销售层级 (A/B/C)
+            filename: 原始文件名
+            batch_id: 批量上传ID
+
+        Returns:
+            队列记录（status 为 pending；同一内容已在队列中时返回已有记录）
+        """
+        image_sha256 = image.sha256
+        existing = self._db().execute(
+            f"SELECT * FROM ingest_items WHERE image_sha256 = ? "
+            f"AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))}) LIMIT 1",
+            (image_sha256, *ACTIVE_STATUSES),
+        ).fetchone()
+        if existing is not None:
+            return self._row_to_item(existing)
+
+        item_id = str(uuid.uuid4())
+        now = datetime.now().isoformat()
+        blob_store.acquire(image)
+        self._db().execute(
+            "INSERT INTO ingest_items (id, batch_id, filename, status, image_sha256, sales_tier, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'pending', ?, ?, ?, ?)",
+            (item_id, batch_id, filename, image_sha256, sales_tier, now, now),
+        )
+        self._db().commit()
+        self._enqueue(item_id)
+        print(f"[Gallery Ingest] 图片入队 {item_id} ({filename or '-'}, 排队={self._queue_instance().qsize()})")
+        return self.get(item_id)
+
+    def get(self, item_id: str) -> Optional[Dict[str, Any]]:
+        """查询单张图片的处理状态"""
+        row = self._db().execute("SELECT * FROM ingest_items WHERE id = ?", (item_id,)).fetchone()
+        return self._row_to_item(row) if row else None
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """查询批量上传的处理状态（各状态计数 + 每张图片的状态）"""
+        rows = self._db().execute(
+            "SELECT * FROM ingest_items WHERE batch_id = ? ORDER BY created_at", (batch_id,)
+        ).fetchall()
+        if not rows:
+            return None
+        counts: Dict[str, int] = {}
+        for row in rows:
+            counts[row["status"]] = counts.get(row["status"], 0) + 1
+        return {
+            "batch_id": batch_id,
+            "total": len(rows),
+            "done": sum(counts.get(status, 0) for status in TERMINAL_STATUSES) == len(rows),
+            "counts": counts,
+            "items": [self._row_to_item(row) for row in rows],
+        }
+
+    def metrics(self) -> Dict[str, Any]:
+        """队列指标"""
+        counts = {
+            row["status"]: row["count"]
+            for row in self._db().execute("SELECT status, COUNT(*) AS count FROM ingest_items GROUP BY status")
+        }
+        return {
+            "workers": len(self._workers),
+            "running": len(self._running),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "statuses": counts,
+        }
+
+
+# 单例实例
+gallery_ingest = GalleryIngestQueue()
@@ -1,25 +1,77 @@
 """
 参考图库管理服务
 集成向量检索功能
+
+图片本体存放在内容寻址存储（blob_store）中，images/ 目录下的文件是指向同一内容的硬链接，
+元数据记录 image_sha256；相同图片重复入库时磁盘上只保存一份
+
+元数据同时记录图片的 dHash / pHash（64 位感知哈希），pHash 建立多索引哈希表。
+入库时先查重（内容哈希精确匹配 → 感知哈希近似匹配），重复图片在分析和生成向量之前按策略处理：
+- reject: 拒绝（DuplicateReferenceError）
+- alias: 直接返回已有的参考图
+- copy: 复用已有的分析结果和向量，以新的销售层级另存一条
+
+向量存放在 embeddings/<id>.npy，元数据记录 embedding_sha256（生成向量时的模型 + 描述文本指纹），
+批量重新生成时只处理指纹变化或缺少向量的项
+
+metadata.json 可能被多个进程（多个 worker、后台入库、维护脚本）同时修改：
+- 所有写入都经过 _editing_metadata：在文件锁内重新加载磁盘上的最新内容，修改后写临时文件再原子替换，
+  不会覆盖其他进程刚写入的条目，读取方也不会看到写了一半的 JSON
+- 读取前比较文件标识（inode + 修改时间 + 大小），其他进程写入过时重新加载
 """
+import asyncio
+import contextlib
 import json
+import os
+import shutil
 import uuid
-import base64
+from collections import OrderedDict
 import numpy as np
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple, Union
 from pathlib import Path
 from datetime import datetime
 from models import ImageAnalysis
 from services.embedding_service import embedding_service
 from services.search_utils import generate_multimodal_search_description
+from services.blob_store import blob_store
+from utils.image_payload import ImagePayload
+from utils.perceptual_hash import MultiIndexHash, image_hashes, format_hash, parse_hash
+from utils.lazy_service import LazyService
+from config import get_settings
+
+try:
+    import fcntl
+except ImportError:  # Windows 下不做跨进程文件锁
+    fcntl = None
+
+settings = get_settings()
+
+# 感知哈希缓存条数（同一次上传的查重与入库只计算一次）
+_HASH_CACHE_SIZE = 256
+
+# 重复图片的处理策略
+DUPLICATE_POLICIES = ("reject", "alias", "copy")
+
+
+class DuplicateReferenceError(Exception):
+    """入库图片与图库中已有的参考图重复"""
+
+    def __init__(self, item: Dict, distance: int):
+        super().__init__(f"与图库中的参考图 {item['id']} 重复（感知哈希距离 {distance}）")
+        self.item = item
+        self.distance = distance
 
 
 class GalleryService:
     """图库管理服务类"""
 
-    def __init__(self):
+    def __init__(self, base_dir: Optional[Path] = None):
+        """
+        Args:
+            base_dir: 图库根目录，默认 data/gallery
+        """
         # 支持从不同目录运行
-        self.base_dir = Path(__file__).parent.parent / "data" / "gallery"
+        self.base_dir = Path(base_dir or Path(__file__).parent.parent / "data" / "gallery")
         self.images_dir = self.base_dir / "images"
         self.embeddings_dir = self.base_dir / "embeddings"
         self.metadata_file = self.base_dir / "metadata.json"
@@ -28,9 +80,15 @@ class GalleryService:
         self.images_dir.mkdir(parents=True, exist_ok=True)
         self.embeddings_dir.mkdir(parents=True, exist_ok=True)
 
-        # 加载元数据
+        # 加载元数据（记录加载时的文件标识，用于发现其他进程的写入）
+        self._metadata_stamp = self._file_stamp()
         self.metadata = self._load_metadata()
 
+        # pHash 近邻索引（首次查重时构建）与感知哈希缓存（按图片内容 SHA-256）
+        self._hash_index: Optional[MultiIndexHash] = None
+        self._hash_index_lock: Optional[asyncio.Lock] = None
+        self._hash_cache: "OrderedDict[str, Tuple[int, int]]" = OrderedDict()
+
     def _load_metadata(self) -> Dict:
         """加载元数据索引"""
         if self.metadata_file.exists():
@@ -39,13 +97,305 @@ class GalleryService:
         return {"items": []}
 
     def _save_metadata(self):
-        """保存元数据索引"""
-        with open(self.metadata_file, 'w', encoding='utf-8') as f:
+        """保存元数据索引（先写临时文件再原子替换）"""
+        tmp = self.metadata_file.with_suffix(self.metadata_file.suffix + ".tmp")
+        with open(tmp, 'w', encoding='utf-8') as f:
             json.dump(self.metadata, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.metadata_file)
+        self._metadata_stamp = self._file_stamp()
+
+    def _file_stamp(self) -> Optional[Tuple[int, int, int]]:
+        """metadata.json 的文件标识（原子替换后 inode 改变），文件不存在返回 None"""
+        try:
+            stat = self.metadata_file.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _find_item(self, ref_id: str) -> Optional[Dict]:
+        return next((item for item in self.metadata["items"] if item["id"] == ref_id), None)
+
+    @contextlib.contextmanager
+    def _metadata_lock(self):
+        """跨进程的元数据写锁（锁内不能 await，同一进程的其他协程也会在锁上阻塞）"""
+        with open(self.base_dir / "metadata.json.lock", "a") as handle:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            yield
+
+    def _reload_metadata(self):
+        """其他进程写入过 metadata.json 时重新加载，替换内存中的副本"""
+        stamp = self._file_stamp()
+        if stamp == self._metadata_stamp:
+            return
+        self._metadata_stamp = stamp
+        self.metadata = self._load_metadata()
+        # 条目可能有变化，pHash 索引下次查重时重建
+        self._hash_index = None
+
+    @contextlib.contextmanager
+    def _editing_metadata(self):
+        """
+        修改元数据：加锁 → 重新加载磁盘上的最新内容 → 修改 → 原子写回
+
+        with 块内不能 await；块内出错时不写回，并在下次访问时从磁盘重新加载
+        """
+        with self._metadata_lock():
+            self._reload_metadata()
+            try:
+                yield self.metadata
+            except BaseException:
+                self._metadata_stamp = None
+                raise
+            self._save_metadata()
+
+    # ==================== 感知哈希查重 ====================
+
+    async def image_hashes(self, image: Union[str, ImagePayload]) -> Tuple[int, int]:
+        """
+        计算图片的 (dHash, pHash)（在线程中解码，结果按内容哈希缓存）
+
+        Args:
+            image: 图像base64数据或图像载体
+        """
+        payload = ImagePayload.coerce(image)
+        key = payload.sha256
+        hashes = self._hash_cache.get(key)
+        if hashes is None:
+            hashes = await asyncio.to_thread(image_hashes, payload.data)
+            self._hash_cache[key] = hashes
+            while len(self._hash_cache) > _HASH_CACHE_SIZE:
+                self._hash_cache.popitem(last=False)
+        else:
+            self._hash_cache.move_to_end(key)
+        return hashes
+
+    def _build_hash_index(self, max_distance: int) -> MultiIndexHash:
+        """用元数据中的 pHash 构建近邻索引（缺少哈希的旧数据从图片文件补算并写回）"""
+        index: MultiIndexHash = MultiIndexHash(max_distance)
+        backfill: Dict[str, Tuple[int, int]] = {}
+        for item in self.metadata["items"]:
+            value = parse_hash(item.get("phash"))
+            if value is None:
+                path = self.images_dir / item.get("filename", "")
+                if not path.is_file():
+                    continue
+                try:
+                    backfill[item["id"]] = image_hashes(path)
+                except Exception as e:
+                    print(f"[Gallery] Failed to hash {item['id']}: {e}")
+                    continue
+                value = backfill[item["id"]][1]
+            index.add(value, item["id"])
+        if backfill:
+            self.update_hashes(backfill)
+            print(f"[Gallery] Backfilled perceptual hashes for {len(backfill)} references")
+        return index
+
+    def update_hashes(self, hashes: Dict[str, Tuple[int, int]]) -> int:
+        """
+        批量写入感知哈希（元数据只保存一次）
+
+        Args:
+            hashes: 参考图ID → (dHash, pHash)
+
+        Returns:
+            更新的参考图数
+        """
+        updated = 0
+        with self._editing_metadata() as metadata:
+            for item in metadata["items"]:
+                if item["id"] in hashes:
+                    dhash_value, phash_value = hashes[item["id"]]
+                    item["dhash"] = format_hash(dhash_value)
+                    item["phash"] = format_hash(phash_value)
+                    updated += 1
+        return updated
+
+    async def _get_hash_index(self, max_distance: int) -> MultiIndexHash:
+        """获取近邻索引（不存在或支持的查询距离不够时重新构建）"""
+        def usable() -> bool:
+            return self._hash_index is not None and self._hash_index.max_distance >= max_distance
+
+        if not usable():
+            if self._hash_index_lock is None:
+                self._hash_index_lock = asyncio.Lock()
+            async with self._hash_index_lock:
+                if not usable():
+                    self._hash_index = await asyncio.to_thread(self._build_hash_index, max_distance)
+        return self._hash_index
+
+    async def find_duplicate(
+        self,
+        image: Union[str, ImagePayload],
+        max_distance: Optional[int] = None,
+    ) -> Optional[Tuple[Dict, int]]:
+        """
+        在图库中查找与图片重复的参考图
+
+        Args:
+            image: 图像base64数据或图像载体
+            max_distance: pHash 最大汉明距离，默认 GALLERY_DUPLICATE_DISTANCE
+
+        Returns:
+            (最相近的参考图项, 距离)，没有重复时返回 None
+        """
+        max_distance = settings.GALLERY_DUPLICATE_DISTANCE if max_distance is None else max_distance
+        if max_distance < 0:
+            return None
+
+        # 1. 内容哈希精确匹配（上传时已增量计算，无需解码图片）
+        self._reload_metadata()
+        payload = ImagePayload.coerce(image)
+        image_sha256 = payload.sha256
+        for item in self.metadata["items"]:
+            if item.get("image_sha256") == image_sha256:
+                return item, 0
+
+        # 2. 感知哈希近似匹配
+        _, phash_value = await self.image_hashes(image)
+        index = await self._get_hash_index(max_distance)
+        for distance, ref_id in index.search(phash_value, max_distance):
+            for item in self.metadata["items"]:
+                if item["id"] == ref_id:
+                    return item, distance
+        return None
+
+    async def handle_duplicate(
+        self,
+        image: Union[str, ImagePayload],
+        duplicate: Dict,
+        distance: int,
+        sales_tier: str = "B",
+        policy: Optional[str] = None,
+    ) -> Dict:
+        """
+        按策略处理重复图片（不调用分析和向量接口）
+
+        Args:
+            image: 上传的图像base64数据或图像载体
+            duplicate: 图库中重复的参考图项
+            distance: 感知哈希距离（内容完全相同时为 0）
+            sales_tier: 销售层级 (A/B/C)
+            policy: reject / alias / copy，默认 GALLERY_DUPLICATE_POLICY
+
+        Returns:
+            alias 返回已有的参考图项，copy 返回新建的参考图项
+
+        Raises:
+            DuplicateReferenceError: 策略为 reject
+        """
+        policy = policy or settings.GALLERY_DUPLICATE_POLICY
+        if policy == "alias":
+            print(f"[Gallery] Duplicate of {duplicate['id']} (distance={distance}), aliased")
+            return duplicate
+        if policy == "copy":
+            return await self._copy_reference(image, duplicate, sales_tier)
+        raise DuplicateReferenceError(duplicate, distance)
+
+    async def _copy_reference(self, image: Union[str, ImagePayload], source: Dict, sales_tier: str) -> Dict:
+        """以上传的图片新建参考图，分析结果、向量和指纹复制自已有的参考图"""
+        ref_id = str(uuid.uuid4())
+        payload = ImagePayload.coerce(image)
+        image_path = self.images_dir / f"{ref_id}.jpg"
+        embedding_path = self.embedding_path(ref_id)
+        image_sha256 = None
+        dhash_value, phash_value = await self.image_hashes(payload)
+
+        try:
+            image_sha256 = blob_store.acquire(payload)
+            blob_store.link(image_sha256, image_path)
+            source_embedding = self.embedding_path(source["id"])
+            if source_embedding.exists():
+                shutil.copyfile(source_embedding, embedding_path)
+
+            item = {
+                "id": ref_id,
+                "filename": f"{ref_id}.jpg",
+                "image_sha256": image_sha256,
+                "uploadTime": datetime.now().isoformat(),
+                "analysis": source.get("analysis"),
+                "salesTier": sales_tier,
+                "embedding_sha256": source.get("embedding_sha256") if source_embedding.exists() else None,
+                "dhash": format_hash(dhash_value),
+                "phash": format_hash(phash_value),
+                "copiedFrom": source["id"],
+            }
+            with self._editing_metadata() as metadata:
+                metadata["items"].append(item)
+            if self._hash_index is not None:
+                self._hash_index.add(phash_value, ref_id)
+
+            print(f"[Gallery] Copied reference {source['id']} -> {ref_id} (tier {sales_tier})")
+            return item
+        except Exception as e:
+            print(f"[Gallery Error] Failed to copy reference: {e}")
+            image_path.unlink(missing_ok=True)
+            embedding_path.unlink(missing_ok=True)
+            blob_store.release(image_sha256)
+            raise
+
+    async def index_reference(
+        self,
+        ref_id: str,
+        image_sha256: str,
+        analysis: Dict,
+        sales_tier: str = "B",
+        embedding_sha256: Optional[str] = None,
+    ) -> Dict:
+        """
+        把后台入库队列处理完成的图片写入图库（向量文件已由调用方写入 embeddings/）
+
+        图片内容已在 blob_store 中并持有一次引用，该引用转交给图库项（删除时释放）。
+        同一 ref_id 重复调用（如写入后进程退出、重新执行）直接返回已有项
+
+        Args:
+            ref_id: 参考图ID
+            image_sha256: 图片内容哈希
+            analysis: 图像分析结果（dict）
+            sales_tier: 销售层级 (A/B/C)
+            embedding_sha256: 向量指纹
+
+        Returns:
+            参考图项
+        """
+        self._reload_metadata()
+        existing = self._find_item(ref_id)
+        if existing is not None:
+            return existing
+
+        payload = blob_store.open(image_sha256)
+        if payload is None:
+            raise FileNotFoundError(f"图片内容不存在: {image_sha256}")
+        dhash_value, phash_value = await self.image_hashes(payload)
+
+        with self._editing_metadata() as metadata:
+            # 其他入库进程可能已写入同一条目
+            existing = self._find_item(ref_id)
+            if existing is not None:
+                return existing
+            blob_store.link(image_sha256, self.images_dir / f"{ref_id}.jpg")
+            item = {
+                "id": ref_id,
+                "filename": f"{ref_id}.jpg",
+                "image_sha256": image_sha256,
+                "uploadTime": datetime.now().isoformat(),
+                "analysis": analysis,
+                "salesTier": sales_tier,
+                "embedding_sha256": embedding_sha256,
+                "dhash": format_hash(dhash_value),
+                "phash": format_hash(phash_value),
+            }
+            metadata["items"].append(item)
+        if self._hash_index is not None:
+            self._hash_index.add(phash_value, ref_id)
+
+        print(f"[Gallery] Indexed reference {ref_id}")
+        return item
 
     async def add_reference(
         self,
-        image_base64: str,
+        image_base64: Union[str, ImagePayload],
         analysis: ImageAnalysis,
         sales_tier: str = "B"
     ) -> Dict:
@@ -53,21 +403,32 @@ class GalleryService:
         添加参考图到图库
 
         Args:
-            image_base64: 图像base64数据
+            image_base64: 图像base64数据或图像载体
             analysis: 图像分析结果
             sales_tier: 销售层级 (A/B/C)
 
         Returns:
             参考图项
+
+        Raises:
+            DuplicateReferenceError: 图库中已有几乎相同的图片
         """
         ref_id = str(uuid.uuid4())
+        payload = ImagePayload.coerce(image_base64)
+        image_path = self.images_dir / f"{ref_id}.jpg"
+        embedding_path = None
+        image_sha256 = None
+
+        # 0. 查重（哈希已在调用方查重时计算过则直接命中缓存）
+        duplicate = await self.find_duplicate(payload)
+        if duplicate:
+            raise DuplicateReferenceError(*duplicate)
+        dhash_value, phash_value = await self.image_hashes(payload)
 
         try:
-            # 1. 保存图像文件
-            image_path = self.images_dir / f"{ref_id}.jpg"
-            image_data = base64.b64decode(image_base64)
-            with open(image_path, 'wb') as f:
-                f.write(image_data)
+            # 1. 存入内容寻址存储，并在图库目录创建硬链接（上传临时文件流式复制，不整体读入内存）
+            image_sha256 = blob_store.acquire(payload)
+            blob_store.link(image_sha256, image_path)
 
             # 2. 生成并保存嵌入向量（基于结构化文本描述）
             print(f"[Gallery] Generating embedding for {ref_id}...")
@@ -75,13 +436,15 @@ class GalleryService:
             text_desc = generate_multimodal_search_description(analysis)
             print(f"[Gallery] Search description: {text_desc}")
             embedding = await embedding_service.generate_embedding(
-                image_base64=image_base64,
+                image_base64=payload,
                 text=text_desc
             )
 
+            embedding_sha256 = None
             if embedding is not None:
                 embedding_path = self.embeddings_dir / f"{ref_id}.npy"
                 np.save(embedding_path, embedding)
+                embedding_sha256 = embedding_service.fingerprint(text_desc)
                 print(f"[Gallery] Embedding saved to {embedding_path}")
             else:
                 print(f"[Gallery] Warning: Embedding generation failed, skipping...")
@@ -90,13 +453,19 @@ class GalleryService:
             item = {
                 "id": ref_id,
                 "filename": f"{ref_id}.jpg",
+                "image_sha256": image_sha256,
                 "uploadTime": datetime.now().isoformat(),
                 "analysis": analysis.model_dump(),
-                "salesTier": sales_tier
+                "salesTier": sales_tier,
+                "embedding_sha256": embedding_sha256,
+                "dhash": format_hash(dhash_value),
+                "phash": format_hash(phash_value),
             }
 
-            self.metadata["items"].append(item)
-            self._save_metadata()
+            with self._editing_metadata() as metadata:
+                metadata["items"].append(item)
+            if self._hash_index is not None:
+                self._hash_index.add(phash_value, ref_id)
 
             print(f"[Gallery] Added reference {ref_id}")
             return item
@@ -106,6 +475,7 @@ class GalleryService:
             # 清理已创建的文件
             if image_path.exists():
                 image_path.unlink()
+            blob_store.release(image_sha256)
             if embedding_path and embedding_path.exists():
                 embedding_path.unlink()
             raise
@@ -127,6 +497,7 @@ class GalleryService:
         Returns:
             参考图列表
         """
+        self._reload_metadata()
         items = self.metadata["items"]
 
         # 风格过滤
@@ -161,6 +532,7 @@ class GalleryService:
         Returns:
             参考图项，不存在返回None
         """
+        self._reload_metadata()
         for item in self.metadata["items"]:
             if item["id"] == ref_id:
                 item_copy = item.copy()
@@ -168,6 +540,173 @@ class GalleryService:
                 return item_copy
         return None
 
+    def image_path(self, image_id: str) -> Optional[Path]:
+        """
+        参考图ID（或文件名）→ 图片文件路径
+
+        Args:
+            image_id: 参考图ID，兼容直接传文件名
+
+        Returns:
+            图片路径，不存在返回None
+        """
+        self._reload_metadata()
+        for item in self.metadata["items"]:
+            if item["id"] == image_id:
+                image_id = item["filename"]
+                break
+        path = self.images_dir / image_id
+        # 只允许访问图库目录下的文件
+        if path.parent != self.images_dir or not path.is_file():
+            return None
+        return path
+
+    def embedding_path(self, ref_id: str) -> Path:
+        """参考图向量文件路径"""
+        return self.embeddings_dir / f"{ref_id}.npy"
+
+    def save_embeddings(
+        self,
+        embeddings: Dict[str, Tuple[np.ndarray, str]],
+        expected: Optional[Dict[str, Dict]] = None,
+    ) -> int:
+        """
+        批量写入向量及其指纹（在元数据锁内写入，元数据只保存一次）
+
+        Args:
+            embeddings: 参考图ID → (向量, 指纹)
+            expected: 参考图ID → 调用方生成描述时的分析结果；写入时分析结果已变化的条目跳过
+                （向量与新的分析结果不对应）
+
+        Returns:
+            写入的向量数（已删除或被跳过的参考图不写入）
+        """
+        written = 0
+        with self._editing_metadata() as metadata:
+            for item in metadata["items"]:
+                if item["id"] not in embeddings:
+                    continue
+                if expected is not None and item.get("analysis") != expected.get(item["id"]):
+                    continue
+                embedding, fingerprint = embeddings[item["id"]]
+                np.save(self.embedding_path(item["id"]), embedding)
+                item["embedding_sha256"] = fingerprint
+                written += 1
+        return written
+
+    def update_analyses(self, analyses: Dict[str, Dict], expected: Optional[Dict[str, Dict]] = None) -> int:
+        """
+        批量替换分析结果（元数据只保存一次）
+
+        分析结果变化后检索描述随之变化，原有向量的指纹不再匹配，
+        需要调用方重新生成向量（save_embeddings）或运行 regenerate_embeddings.py
+
+        Args:
+            analyses: 参考图ID → 分析结果
+            expected: 参考图ID → 调用方读取时的分析结果；写入时已被其他进程修改的条目跳过
+
+        Returns:
+            更新的参考图数
+        """
+        updated = 0
+        with self._editing_metadata() as metadata:
+            for item in metadata["items"]:
+                analysis = analyses.get(item["id"])
+                if analysis is None:
+                    continue
+                if expected is None or item.get("analysis") == expected.get(item["id"]):
+                    item["analysis"] = analysis
+                    item["analyzedAt"] = datetime.now().isoformat()
+                    updated += 1
+        return updated
+
+    def upsert_items(self, items: List[Dict]) -> int:
+        """
+        批量写入维护脚本重新生成的条目（元数据只保存一次）
+
+        同 ID 的已有条目只更新传入的字段，其余字段保持写入时的最新值；新条目追加在末尾。
+        不处理图片文件和内容引用
+
+        Args:
+            items: 条目（至少含 id）
+
+        Returns:
+            写入的条目数
+        """
+        with self._editing_metadata() as metadata:
+            positions = {item["id"]: index for index, item in enumerate(metadata["items"])}
+            for item in items:
+                index = positions.get(item["id"])
+                if index is None:
+                    positions[item["id"]] = len(metadata["items"])
+                    metadata["items"].append(item)
+                else:
+                    metadata["items"][index].update(item)
+        return len(items)
+
+    def merge_references(
+        self,
+        items: List[Dict],
+        embeddings: Dict[str, np.ndarray],
+        remove_ids: Optional[List[str]] = None,
+    ) -> int:
+        """
+        合并从其他环境导入的参考图（元数据只保存一次）
+
+        图片内容需已存入 blob_store；同 ID 的条目整体替换，新条目追加在末尾。
+        没有随条目提供向量时删除本地旧向量（旧向量与新的分析结果不再对应）
+
+        Args:
+            items: 新增或变化的参考图项（含 image_sha256）
+            embeddings: 参考图ID → 向量
+            remove_ids: 需要删除的参考图ID
+
+        Returns:
+            合并的条目数
+        """
+        with self._editing_metadata() as metadata:
+            positions = {item["id"]: index for index, item in enumerate(metadata["items"])}
+            for item in items:
+                ref_id = item["id"]
+                item["filename"] = Path(item.get("filename") or f"{ref_id}.jpg").name
+                index = positions.get(ref_id)
+                current = metadata["items"][index] if index is not None else None
+
+                # 每个图库项持有一次图片内容引用
+                if current is None or current.get("image_sha256") != item["image_sha256"]:
+                    blob_store.incref(item["image_sha256"])
+                    if current is not None:
+                        blob_store.release(current.get("image_sha256"))
+                if current is not None and current["filename"] != item["filename"]:
+                    (self.images_dir / current["filename"]).unlink(missing_ok=True)
+                blob_store.link(item["image_sha256"], self.images_dir / item["filename"])
+
+                embedding = embeddings.get(ref_id)
+                if embedding is not None:
+                    np.save(self.embedding_path(ref_id), embedding)
+                else:
+                    self.embedding_path(ref_id).unlink(missing_ok=True)
+
+                if index is None:
+                    positions[ref_id] = len(metadata["items"])
+                    metadata["items"].append(item)
+                else:
+                    metadata["items"][index] = item
+
+            remove = set(remove_ids or [])
+            for item in metadata["items"]:
+                if item["id"] in remove:
+                    (self.images_dir / item["filename"]).unlink(missing_ok=True)
+                    self.embedding_path(item["id"]).unlink(missing_ok=True)
+                    blob_store.release(item.get("image_sha256"))
+            if remove:
+                metadata["items"] = [item for item in metadata["items"] if item["id"] not in remove]
+
+        # 哈希索引下次查重时重新构建
+        self._hash_index = None
+        print(f"[Gallery] Merged {len(items)} references, removed {len(remove)}")
+        return len(items)
+
     def delete_reference(self, ref_id: str) -> bool:
         """
         删除参考图
@@ -188,15 +727,16 @@ class GalleryService:
         if embedding_path.exists():
             embedding_path.unlink()
 
-        # 从元数据中删除
-        original_count = len(self.metadata["items"])
-        self.metadata["items"] = [
-            item for item in self.metadata["items"]
-            if item["id"] != ref_id
-        ]
-        self._save_metadata()
+        with self._editing_metadata() as metadata:
+            item = self._find_item(ref_id)
+            if item is not None:
+                # 释放图片内容引用，并从元数据中删除
+                blob_store.release(item.get("image_sha256"))
+                metadata["items"] = [other for other in metadata["items"] if other["id"] != ref_id]
+        # 索引不支持删除，下次查重时重新构建
+        self._hash_index = None
 
-        deleted = len(self.metadata["items"]) < original_count
+        deleted = item is not None
         if deleted:
             print(f"[Gallery] Deleted reference {ref_id}")
         return deleted
@@ -218,6 +758,7 @@ class GalleryService:
         Returns:
             相似图片列表（按相似度降序）
         """
+        self._reload_metadata()
         similarities = []
 
         for item in self.metadata["items"]:
@@ -249,5 +790,5 @@ class GalleryService:
         return similarities[:top_k]
 
 
-# 单例实例
-gallery_service = GalleryService()
+# 单例实例（首次使用时构造：创建目录并解析 metadata.json）
+gallery_service: GalleryService = LazyService(GalleryService)
@@ -0,0 +1,394 @@
+"""
+图库快照（单文件归档）
+在环境之间（如 staging → production）迁移图库：元数据、图片和向量打包成一个文件，支持增量同步
+
+归档格式（不压缩的 tar，成员按以下顺序写入，导入时可顺序流式读取）：
+- manifest.json: 格式版本、条目数、向量矩阵的 dtype / 形状、增量信息
+- columns.json: 列式元数据（字段名 → 按条目顺序的值列表），embedding_row 列为向量矩阵中的行号（无向量为 -1）
+- embeddings.f32: 未压缩的 float32 向量矩阵（行优先，小端）。tar 成员数据按 512 字节对齐，
+  可以直接从归档文件 mmap，不需要解包（load_embeddings()）
+- blobs/<sha256>: 图片内容，按内容哈希只保存一份
+
+设计理念：
+- 导出时先读取目标环境的状态文件（state()：条目摘要 + 已有的图片哈希），
+  只打包新增 / 变化的条目和目标环境缺少的图片，并记录目标环境中多余的条目（prune 时删除）
+- 导入时逐个成员流式读取（支持从管道读取），跳过内容未变化的条目和本地已有的图片，
+  最后由 gallery_service 一次性合并元数据；因此即使导入全量快照也只写入差异部分
+- 向量按条目写回 embeddings/<id>.npy，元数据中的 embedding_sha256 随条目一起迁移，
+  增量重新生成向量时仍能识别
+
+核心方法：
+- state(): 当前图库状态（提供给另一环境导出增量）
+- export(): 导出快照
+- import_snapshot(): 导入快照
+- load_embeddings(): 从归档 mmap 向量矩阵
+"""
+import hashlib
+import io
+import json
+import tarfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from services.blob_store import blob_store
+from services.gallery_service import gallery_service
+from utils.image_payload import ImagePayload
+
+SNAPSHOT_FORMAT = "gallery-snapshot"
+SNAPSHOT_VERSION = 1
+
+MANIFEST_MEMBER = "manifest.json"
+COLUMNS_MEMBER = "columns.json"
+EMBEDDINGS_MEMBER = "embeddings.f32"
+BLOB_PREFIX = "blobs/"
+
+EMBEDDING_DTYPE = "<f4"
+
+# 元数据中不迁移的字段（由服务动态生成）
+_TRANSIENT_FIELDS = {"imageUrl"}
+
+
+class SnapshotFormatError(Exception):
+    """快照文件格式不正确"""
+
+
+def item_digest(item: Dict[str, Any]) -> str:
+    """条目摘要（规范化 JSON 的 SHA-256），用于判断两个环境中的条目是否一致"""
+    canonical = {key: value for key, value in item.items() if key not in _TRANSIENT_FIELDS and value is not None}
+    return hashlib.sha256(
+        json.dumps(canonical, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def _to_columns(items: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    """条目列表 → 列式元数据（缺失字段为 None）"""
+    fields: List[str] = []
+    for item in items:
+        for key in item:
+            if key not in _TRANSIENT_FIELDS and key not in fields:
+                fields.append(key)
+    return {field: [item.get(field) for item in items] for field in fields}
+
+
+def _from_columns(columns: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    """列式元数据 → 条目列表（None 值不写入条目）"""
+    count = len(columns.get("id", []))
+    items: List[Dict[str, Any]] = [{} for _ in range(count)]
+    for field, values in columns.items():
+        if len(values) != count:
+            raise SnapshotFormatError(f"列 {field} 的长度 {len(values)} 与条目数 {count} 不一致")
+        for item, value in zip(items, values):
+            if value is not None:
+                item[field] = value
+    return items
+
+
+def _json_member(name: str, data: Any) -> Tuple[tarfile.TarInfo, io.BytesIO]:
+    raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    info = tarfile.TarInfo(name)
+    info.size = len(raw)
+    info.mtime = int(time.time())
+    return info, io.BytesIO(raw)
+
+
+def _read_json_member(archive: tarfile.TarFile, members: Iterator[tarfile.TarInfo], expected: str) -> Any:
+    """按顺序读取下一个 JSON 成员（流式读取时成员只能依次访问）"""
+    member = next(members, None)
+    if member is None or member.name != expected:
+        raise SnapshotFormatError(f"快照成员顺序不正确：期望 {expected}，实际 {member.name if member else '文件结束'}")
+    return json.loads(archive.extractfile(member).read().decode("utf-8"))
+
+
+class GallerySnapshot:
+    """图库快照导出 / 导入"""
+
+    def _local_image(self, item: Dict[str, Any]) -> Optional[Path]:
+        """条目的图片文件（优先内容寻址存储，兼容未迁移到 blob_store 的旧条目）"""
+        sha256 = item.get("image_sha256")
+        if sha256 and blob_store.exists(sha256):
+            return blob_store.path(sha256)
+        return gallery_service.image_path(item["id"])
+
+    def _portable_item(self, source: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[Path]]:
+        """
+        条目在快照中的形式：去掉动态字段，旧条目补上内容哈希（导入后存入内容寻址存储）
+
+        state()、export() 和导入时的比对都以这一形式计算摘要，旧条目不会因缺少哈希被视为变化
+
+        Returns:
+            (条目, 图片文件路径)，图片不存在时路径为 None
+        """
+        item = {key: value for key, value in source.items() if key not in _TRANSIENT_FIELDS}
+        image_path = self._local_image(item)
+        if image_path is not None and not item.get("image_sha256"):
+            item["image_sha256"] = hashlib.sha256(image_path.read_bytes()).hexdigest()
+        return item, image_path
+
+    def state(self) -> Dict[str, Any]:
+        """
+        当前图库状态（条目摘要 + 已有的图片哈希），另一环境据此导出增量快照
+
+        Returns:
+            {"items": {ID: 摘要}, "blobs": [图片哈希]}
+        """
+        items = [self._portable_item(item)[0] for item in gallery_service.metadata.get("items", [])]
+        return {
+            "format": f"{SNAPSHOT_FORMAT}-state",
+            "version": SNAPSHOT_VERSION,
+            "created_at": datetime.now().isoformat(),
+            "items": {item["id"]: item_digest(item) for item in items},
+            "blobs": sorted({item["image_sha256"] for item in items if item.get("image_sha256")}),
+        }
+
+    def export(
+        self,
+        destination: Union[str, Path, BinaryIO],
+        against: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        导出快照
+
+        Args:
+            destination: 输出文件路径，或可顺序写入的二进制流（如 sys.stdout.buffer）
+            against: 目标环境的状态（state() 的结果）；提供时只导出目标环境缺少或不同的部分
+
+        Returns:
+            manifest
+        """
+        started = time.perf_counter()
+        items: List[Dict[str, Any]] = []
+        images: Dict[str, Path] = {}
+        missing_images = 0
+
+        for source in gallery_service.metadata.get("items", []):
+            item, image_path = self._portable_item(source)
+            if image_path is None:
+                missing_images += 1
+                print(f"[Gallery Snapshot] 跳过 {item['id']}：图片文件不存在")
+                continue
+            items.append(item)
+            images.setdefault(item["image_sha256"], image_path)
+
+        removed: List[str] = []
+        target_blobs: Set[str] = set()
+        if against is not None:
+            target_items = against.get("items", {})
+            local_ids = {item["id"] for item in items}
+            removed = [ref_id for ref_id in target_items if ref_id not in local_ids]
+            items = [item for item in items if target_items.get(item["id"]) != item_digest(item)]
+            target_blobs = set(against.get("blobs", []))
+        blobs = sorted({item["image_sha256"] for item in items} - target_blobs)
+
+        # 向量矩阵：维度以第一个向量为准，维度不一致（换过嵌入模型）的条目不导出向量
+        rows: List[np.ndarray] = []
+        embedding_rows: List[int] = []
+        dim: Optional[int] = None
+        for item in items:
+            row = -1
+            embedding_path = gallery_service.embedding_path(item["id"])
+            if embedding_path.exists():
+                vector = np.load(embedding_path).astype(EMBEDDING_DTYPE).ravel()
+                if dim is None:
+                    dim = vector.shape[0]
+                if vector.shape[0] == dim:
+                    row = len(rows)
+                    rows.append(vector)
+                else:
+                    print(f"[Gallery Snapshot] 跳过 {item['id']} 的向量：维度 {vector.shape[0]} ≠ {dim}")
+            embedding_rows.append(row)
+        matrix = np.ascontiguousarray(np.vstack(rows) if rows else np.zeros((0, dim or 0)), dtype=EMBEDDING_DTYPE)
+
+        columns = _to_columns(items)
+        columns["embedding_row"] = embedding_rows
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "created_at": datetime.now().isoformat(),
+            "delta": against is not None,
+            "count": len(items),
+            "removed": removed,
+            "blobs": len(blobs),
+            "embeddings": {
+                "member": EMBEDDINGS_MEMBER,
+                "dtype": EMBEDDING_DTYPE,
+                "shape": list(matrix.shape),
+            },
+        }
+
+        def write(archive: tarfile.TarFile):
+            archive.addfile(*_json_member(MANIFEST_MEMBER, manifest))
+            archive.addfile(*_json_member(COLUMNS_MEMBER, columns))
+
+            info = tarfile.TarInfo(EMBEDDINGS_MEMBER)
+            info.size = matrix.nbytes
+            info.mtime = int(time.time())
+            archive.addfile(info, io.BytesIO(matrix.tobytes()))
+
+            for sha256 in blobs:
+                image_path = images[sha256]
+                info = tarfile.TarInfo(BLOB_PREFIX + sha256)
+                info.size = image_path.stat().st_size
+                info.mtime = int(time.time())
+                with open(image_path, "rb") as f:
+                    archive.addfile(info, f)
+
+        if isinstance(destination, (str, Path)):
+            # 先写临时文件再替换，中断时不会留下不完整的快照
+            path = Path(destination)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(path.name + ".tmp")
+            with tarfile.open(tmp, "w", format=tarfile.PAX_FORMAT) as archive:
+                write(archive)
+            tmp.replace(path)
+            target = f"{path}，{path.stat().st_size / 1024 / 1024:.1f}MB"
+        else:
+            with tarfile.open(fileobj=destination, mode="w|", format=tarfile.PAX_FORMAT) as archive:
+                write(archive)
+            target = "输出流"
+
+        print(
+            f"[Gallery Snapshot] 导出 {len(items)} 个条目、{matrix.shape[0]} 个向量、{len(blobs)} 张图片"
+            f"{f'（增量，目标环境多余 {len(removed)} 个）' if against is not None else ''}"
+            f"{f'，{missing_images} 个条目缺少图片' if missing_images else ''}"
+            f" → {target} ({time.perf_counter() - started:.1f}s)"
+        )
+        return manifest
+
+    def import_snapshot(
+        self,
+        source: Union[str, Path, BinaryIO],
+        prune: bool = False,
+        dry_run: bool = False,
+    ) -> Dict[str, int]:
+        """
+        流式导入快照（只写入与本地不同的条目、向量和本地缺少的图片）
+
+        Args:
+            source: 快照文件路径，或可顺序读取的二进制流（如 sys.stdin.buffer）
+            prune: 删除快照中记录为多余的条目（增量快照），或快照中不存在的本地条目（全量快照）
+            dry_run: 只统计差异，不写入
+
+        Returns:
+            统计：changed / unchanged / removed / blobs_written / blobs_skipped
+        """
+        started = time.perf_counter()
+        if isinstance(source, (str, Path)):
+            archive = tarfile.open(source, "r|")
+        else:
+            archive = tarfile.open(fileobj=source, mode="r|")
+
+        local = {item["id"]: item for item in gallery_service.metadata.get("items", [])}
+        stats = {"changed": 0, "unchanged": 0, "removed": 0, "blobs_written": 0, "blobs_skipped": 0}
+
+        with archive:
+            members = iter(archive)
+            manifest = _read_json_member(archive, members, MANIFEST_MEMBER)
+            if manifest.get("format") != SNAPSHOT_FORMAT or manifest.get("version") != SNAPSHOT_VERSION:
+                raise SnapshotFormatError(f"不支持的快照格式: {manifest.get('format')} v{manifest.get('version')}")
+            columns = _read_json_member(archive, members, COLUMNS_MEMBER)
+            embedding_rows = columns.pop("embedding_row", [])
+            items = _from_columns(columns)
+
+            # 只保留内容不同的条目
+            changed: Dict[str, Tuple[Dict[str, Any], int]] = {}
+            for item, row in zip(items, embedding_rows):
+                current = local.get(item["id"])
+                if current is not None and item_digest(self._portable_item(current)[0]) == item_digest(item):
+                    stats["unchanged"] += 1
+                    continue
+                changed[item["id"]] = (item, row)
+            stats["changed"] = len(changed)
+            needed_rows = {row: ref_id for ref_id, (_, row) in changed.items() if row >= 0}
+
+            # 向量矩阵按行流式读取，只保留变化条目的行
+            member = next(members, None)
+            if member is None or member.name != EMBEDDINGS_MEMBER:
+                raise SnapshotFormatError(f"快照缺少 {EMBEDDINGS_MEMBER}")
+            shape = manifest["embeddings"]["shape"]
+            dtype = np.dtype(manifest["embeddings"]["dtype"])
+            row_bytes = shape[1] * dtype.itemsize if len(shape) == 2 else 0
+            embeddings: Dict[str, np.ndarray] = {}
+            if row_bytes and needed_rows:
+                reader = archive.extractfile(member)
+                for row in range(shape[0]):
+                    raw = reader.read(row_bytes)
+                    if len(raw) != row_bytes:
+                        raise SnapshotFormatError("向量矩阵不完整")
+                    if row in needed_rows:
+                        embeddings[needed_rows[row]] = np.frombuffer(raw, dtype=dtype).astype(np.float32)
+
+            # 图片：只写入变化条目需要、且本地没有的内容
+            needed_blobs = {item["image_sha256"] for item, _ in changed.values() if item.get("image_sha256")}
+            for member in members:
+                if not member.name.startswith(BLOB_PREFIX):
+                    continue
+                sha256 = member.name[len(BLOB_PREFIX):]
+                if sha256 not in needed_blobs or blob_store.exists(sha256):
+                    stats["blobs_skipped"] += 1
+                    continue
+                if not dry_run:
+                    payload = ImagePayload(data=archive.extractfile(member).read())
+                    if payload.sha256 != sha256:
+                        raise SnapshotFormatError(f"图片内容与哈希不一致: {sha256}")
+                    blob_store.put(payload)
+                stats["blobs_written"] += 1
+
+        missing = sorted(sha for sha in needed_blobs if not blob_store.exists(sha))
+        if missing and not dry_run:
+            raise SnapshotFormatError(f"快照缺少 {len(missing)} 张图片（例如 {missing[0]}），本地也不存在")
+
+        remove_ids: List[str] = []
+        if prune:
+            if manifest.get("delta"):
+                remove_ids = [ref_id for ref_id in manifest.get("removed", []) if ref_id in local]
+            else:
+                snapshot_ids = {item["id"] for item in items}
+                remove_ids = [ref_id for ref_id in local if ref_id not in snapshot_ids]
+        stats["removed"] = len(remove_ids)
+
+        if not dry_run and (changed or remove_ids):
+            gallery_service.merge_references(
+                [item for item, _ in changed.values()], embeddings, remove_ids
+            )
+
+        print(
+            f"[Gallery Snapshot] {'预览' if dry_run else '导入'}完成：变化 {stats['changed']}，"
+            f"未变化 {stats['unchanged']}，删除 {stats['removed']}，"
+            f"写入图片 {stats['blobs_written']}，跳过图片 {stats['blobs_skipped']}"
+            f" ({time.perf_counter() - started:.1f}s)"
+        )
+        return stats
+
+    def load_embeddings(self, path: Union[str, Path]) -> Tuple[List[str], np.ndarray]:
+        """
+        从快照中 mmap 向量矩阵（不解包、不复制）
+
+        Args:
+            path: 快照文件路径
+
+        Returns:
+            (行对应的参考图ID, 只读的 np.memmap 矩阵)
+        """
+        with tarfile.open(path, "r:") as archive:
+            manifest = json.loads(archive.extractfile(MANIFEST_MEMBER).read().decode("utf-8"))
+            columns = json.loads(archive.extractfile(COLUMNS_MEMBER).read().decode("utf-8"))
+            member = archive.getmember(EMBEDDINGS_MEMBER)
+            offset = member.offset_data
+
+        shape = tuple(manifest["embeddings"]["shape"])
+        ids: List[Optional[str]] = [None] * shape[0]
+        for ref_id, row in zip(columns["id"], columns["embedding_row"]):
+            if row >= 0:
+                ids[row] = ref_id
+        if shape[0] == 0:
+            return [], np.zeros(shape, dtype=manifest["embeddings"]["dtype"])
+        matrix = np.memmap(path, dtype=manifest["embeddings"]["dtype"], mode="r", offset=offset, shape=shape)
+        return ids, matrix
+
+
+# 单例实例
+gallery_snapshot = GallerySnapshot()
@@ -0,0 +1,241 @@
+"""
+生成图片本地存储
+网关返回的 Seedream 图片 URL 是临时地址，下载一次后由本服务提供
+
+设计理念：
+- 生成完成后立即流式下载（边下载边写临时文件、边计算哈希），文件以内容哈希命名，重复内容只存一份
+- 同一 URL 的并发下载合并为一次（single-flight），远程 URL → 本地 URL 的映射在进程内缓存
+- 下载完成后在线程中生成多种尺寸的 WebP 缩略图（thumbs/<哈希>_<宽度>.webp）
+- 原图与缩略图通过静态目录挂载在 /generated 下，前端、生成图分析、图像编辑都读取本地副本，
+  上游 URL 过期后图片依然可用
+- 下载失败时保留原始 URL，不影响生成结果返回
+
+核心方法：
+- localize(): 下载远程图片，返回本地 URL
+- localize_result(): 把生成结果中的所有 URL 替换为本地 URL
+- open(): 读取图片（本地 URL 直接读文件，远程 URL 先下载）
+- thumbnails(): 本地图片的缩略图 URL
+"""
+import asyncio
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+from PIL import Image
+
+from config import get_settings
+from models import GenerationResult
+from utils.image_payload import ImagePayload, PayloadTooLargeError
+
+settings = get_settings()
+
+# 远程 URL → 本地 URL 映射的缓存条数
+_URL_CACHE_SIZE = 4096
+# 下载分块大小
+_CHUNK_SIZE = 256 * 1024
+
+
+class GeneratedImageStore:
+    """生成图片本地存储（内容哈希命名 + WebP 缩略图）"""
+
+    URL_PREFIX = "/generated"
+
+    def __init__(self, base_dir: Optional[Path] = None, thumbnail_sizes: Optional[List[int]] = None):
+        """
+        Args:
+            base_dir: 存储目录，默认 data/generated
+            thumbnail_sizes: 缩略图宽度列表（像素）
+        """
+        self.base_dir = Path(base_dir or Path(__file__).parent.parent / "data" / "generated")
+        self.thumbs_dir = self.base_dir / "thumbs"
+        self.thumbnail_sizes = sorted(thumbnail_sizes or settings.GENERATED_THUMBNAIL_SIZES, reverse=True)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._local_urls: "OrderedDict[str, str]" = OrderedDict()
+        self._stats = {"downloads": 0, "download_bytes": 0, "download_failures": 0, "deduplicated": 0, "local_reads": 0}
+
+    def ensure_dirs(self):
+        self.thumbs_dir.mkdir(parents=True, exist_ok=True)
+
+    # ==================== URL 与路径 ====================
+
+    def is_local(self, url: Optional[str]) -> bool:
+        """是否为本服务提供的图片 URL"""
+        return bool(url) and url.startswith(self.URL_PREFIX + "/")
+
+    def path_for(self, url: str) -> Optional[Path]:
+        """本地 URL → 文件路径（不存在或路径不合法时返回 None）"""
+        if not self.is_local(url):
+            return None
+        relative = url[len(self.URL_PREFIX) + 1:].split("?", 1)[0]
+        if not relative or ".." in relative.split("/"):
+            return None
+        path = self.base_dir / relative
+        return path if path.is_file() else None
+
+    def _url_for(self, path: Path) -> str:
+        return f"{self.URL_PREFIX}/{path.relative_to(self.base_dir).as_posix()}"
+
+    def _thumbnail_path(self, sha256: str, width: int) -> Path:
+        return self.thumbs_dir / f"{sha256}_{width}.webp"
+
+    def thumbnails(self, url: Optional[str]) -> Dict[str, str]:
+        """
+        本地图片的缩略图 URL
+
+        Returns:
+            宽度（字符串） → 缩略图 URL，非本地图片返回空字典
+        """
+        path = self.path_for(url) if url else None
+        if path is None:
+            return {}
+        sha256 = path.stem
+        return {
+            str(width): self._url_for(self._thumbnail_path(sha256, width))
+            for width in sorted(self.thumbnail_sizes)
+            if self._thumbnail_path(sha256, width).exists()
+        }
+
+    # ==================== 下载 ====================
+
+    async def localize(self, url: Optional[str]) -> Optional[str]:
+        """
+        下载远程图片并返回本地 URL（已是本地 URL 或下载失败时原样返回）
+
+        Args:
+            url: 图片 URL
+        """
+        if not url or self.is_local(url) or not url.startswith("http"):
+            return url
+        if url in self._local_urls:
+            self._local_urls.move_to_end(url)
+            return self._local_urls[url]
+
+        future = self._inflight.get(url)
+        if future is None:
+            future = asyncio.ensure_future(self._download(url))
+            self._inflight[url] = future
+            future.add_done_callback(lambda _: self._inflight.pop(url, None))
+        try:
+            local_url = await asyncio.shield(future)
+        except Exception as e:
+            self._stats["download_failures"] += 1
+            print(f"[Generated Store] 下载失败，保留原始 URL: {e}")
+            return url
+
+        self._local_urls[url] = local_url
+        if len(self._local_urls) > _URL_CACHE_SIZE:
+            self._local_urls.popitem(last=False)
+        return local_url
+
+    async def _download(self, url: str) -> str:
+        """流式下载到临时文件，按内容哈希落盘并生成缩略图"""
+        self.ensure_dirs()
+        hasher = hashlib.sha256()
+        size = 0
+        header = b""
+        fd, tmp_name = tempfile.mkstemp(dir=self.base_dir, suffix=".part")
+        tmp = Path(tmp_name)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async with httpx.AsyncClient(timeout=60.0) as client:
+                    async with client.stream("GET", url) as response:
+                        response.raise_for_status()
+                        async for chunk in response.aiter_bytes(_CHUNK_SIZE):
+                            size += len(chunk)
+                            if size > settings.GENERATED_MAX_BYTES:
+                                raise PayloadTooLargeError(settings.GENERATED_MAX_BYTES)
+                            if len(header) < 16:
+                                header += chunk[:16]
+                            hasher.update(chunk)
+                            f.write(chunk)
+
+            sha256 = hasher.hexdigest()
+            # 扩展名按文件头识别（只需开头几个字节）
+            extension = ImagePayload(data=header).extension
+            path = self.base_dir / f"{sha256}{extension}"
+            if path.exists():
+                self._stats["deduplicated"] += 1
+            else:
+                os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+        self._stats["downloads"] += 1
+        self._stats["download_bytes"] += size
+        try:
+            await asyncio.to_thread(self._make_thumbnails, path, sha256)
+        except Exception as e:
+            print(f"[Generated Store] 缩略图生成失败 {path.name}: {e}")
+        print(f"[Generated Store] 已保存 {path.name} ({size} bytes)")
+        return self._url_for(path)
+
+    def _make_thumbnails(self, path: Path, sha256: str):
+        """生成各尺寸 WebP 缩略图（从大到小依次缩放，只解码一次）"""
+        pending = [w for w in self.thumbnail_sizes if not self._thumbnail_path(sha256, w).exists()]
+        if not pending:
+            return
+        with Image.open(path) as source:
+            image = source.convert("RGBA" if source.mode in ("RGBA", "LA", "P") else "RGB")
+        for width in pending:
+            if image.width > width:
+                image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+            target = self._thumbnail_path(sha256, width)
+            tmp = target.with_suffix(".webp.part")
+            image.save(tmp, format="WEBP", quality=80, method=4)
+            os.replace(tmp, target)
+
+    async def localize_result(self, result: GenerationResult) -> GenerationResult:
+        """
+        把生成结果中的图片 URL 替换为本地 URL（原地修改）
+
+        metadata 中补充 remote_urls（原始 URL）和 thumbnails（各图片的缩略图 URL）
+        """
+        urls = result.metadata.get("all_urls") or ([result.image_url] if result.image_url else [])
+        if not urls:
+            return result
+        local_urls = await asyncio.gather(*[self.localize(url) for url in urls])
+        url_map = dict(zip(urls, local_urls))
+        result.metadata["remote_urls"] = urls
+        result.metadata["all_urls"] = list(local_urls)
+        result.metadata["thumbnails"] = {url: self.thumbnails(url) for url in local_urls if self.is_local(url)}
+        result.image_url = url_map.get(result.image_url, result.image_url)
+        return result
+
+    # ==================== 读取 ====================
+
+    async def open(self, url: str) -> ImagePayload:
+        """
+        读取图片（优先使用本地副本）
+
+        Args:
+            url: 本地 URL 或远程 URL
+
+        Returns:
+            图像载体
+        """
+        url = await self.localize(url)
+        path = self.path_for(url)
+        if path is not None:
+            self._stats["local_reads"] += 1
+            data = await asyncio.to_thread(path.read_bytes)
+            return ImagePayload(data=data)
+
+        if self.is_local(url):
+            raise FileNotFoundError(f"本地图片不存在: {url}")
+        # 下载失败时直接读取远程内容
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            response = await client.get(url)
+            response.raise_for_status()
+            return ImagePayload(data=response.content)
+
+    def metrics(self) -> Dict[str, int]:
+        """存储指标"""
+        return {**self._stats, "cached_urls": len(self._local_urls), "inflight": len(self._inflight)}
+
+
+# 单例实例
+generated_store = GeneratedImageStore()
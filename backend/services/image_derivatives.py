@@ -0,0 +1,236 @@
+"""
+图片衍生图服务
+按需生成指定宽度 / 格式的缩略图（如图库网格只需要 200px 左右的 WebP），结果缓存在磁盘
+
+设计理念：
+- 缩放与编码是 CPU 密集操作，放到进程池中执行，不阻塞事件循环、不受 GIL 限制
+- 请求宽度向上取整到固定档位（GALLERY_DERIVATIVE_WIDTHS），避免任意宽度导致缓存膨胀
+- 缓存键 = 源文件标识（路径 + 大小 + 修改时间）+ 宽度 + 格式 + 编码版本，源文件变化后自然失效；
+  缓存键同时作为强 ETag（同一键对应的内容字节完全一致）
+- 同一衍生图的并发请求合并为一次生成（single-flight）
+- 磁盘缓存按 LRU 控制总大小：命中时更新文件修改时间，重启后按修改时间恢复 LRU 顺序
+
+核心方法：
+- get(): 获取（必要时生成）衍生图
+- metrics(): 缓存指标
+"""
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+from PIL import Image, ImageOps
+
+from config import get_settings
+
+settings = get_settings()
+
+# 编码参数变化时递增，使旧的缓存键失效
+_ENCODER_VERSION = 1
+
+FORMATS = {
+    "webp": ("WEBP", "image/webp", ".webp"),
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+    "png": ("PNG", "image/png", ".png"),
+}
+FORMAT_ALIASES = {"jpg": "jpeg"}
+
+
+def _render(source: str, dest: str, width: Optional[int], fmt: str, quality: int) -> int:
+    """
+    生成衍生图（在子进程中执行）
+
+    Returns:
+        写入的字节数
+    """
+    pil_format = FORMATS[fmt][0]
+    with Image.open(source) as img:
+        if width and img.width > width:
+            # JPEG 在解码时按 2 的幂缩小，大图解码只占用缩小后的内存
+            img.draft("RGB", (width, max(1, img.height * width // img.width)))
+        img = ImageOps.exif_transpose(img)
+        if width and img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA", "L", "LA"):
+            img = img.convert("RGBA")
+
+        tmp = f"{dest}.{os.getpid()}.part"
+        options = {"quality": quality}
+        if pil_format == "WEBP":
+            options["method"] = 4
+        elif pil_format == "JPEG":
+            options.update(optimize=True, progressive=True)
+        elif pil_format == "PNG":
+            options = {"optimize": True}
+        img.save(tmp, format=pil_format, **options)
+    os.replace(tmp, dest)
+    return os.path.getsize(dest)
+
+
+@dataclass
+class Derivative:
+    """衍生图文件"""
+    path: Path
+    etag: str
+    media_type: str
+    size: int
+
+
+class ImageDerivativeService:
+    """按需生成并缓存图片衍生图"""
+
+    def __init__(
+        self,
+        cache_dir: Optional[Path] = None,
+        max_bytes: Optional[int] = None,
+        workers: Optional[int] = None,
+    ):
+        """
+        Args:
+            cache_dir: 衍生图缓存目录，默认 data/derivatives
+            max_bytes: 缓存总大小上限
+            workers: 进程池大小
+        """
+        self.cache_dir = Path(cache_dir or Path(__file__).parent.parent / "data" / "derivatives")
+        self.max_bytes = max_bytes or settings.DERIVATIVE_CACHE_MAX_BYTES
+        self.workers = workers or settings.DERIVATIVE_WORKERS
+        self.widths = sorted(settings.GALLERY_DERIVATIVE_WIDTHS)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._index: Optional["OrderedDict[str, int]"] = None  # 文件名 → 字节数（LRU 顺序）
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "errors": 0}
+
+    # ==================== 参数规范化 ====================
+
+    def normalize_width(self, width: Optional[int]) -> Optional[int]:
+        """宽度向上取整到档位（超过最大档位时取最大档位）"""
+        if not width:
+            return None
+        for candidate in self.widths:
+            if candidate >= width:
+                return candidate
+        return self.widths[-1]
+
+    @staticmethod
+    def normalize_format(fmt: Optional[str], source: Path) -> str:
+        fmt = FORMAT_ALIASES.get((fmt or "").lower(), (fmt or "").lower())
+        if fmt in FORMATS:
+            return fmt
+        # 未指定格式时保持源文件格式（非 PNG 一律按 JPEG）
+        return "png" if source.suffix.lower() == ".png" else "jpeg"
+
+    # ==================== 磁盘缓存 ====================
+
+    def _load_index(self) -> "OrderedDict[str, int]":
+        if self._index is None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            entries = []
+            for path in self.cache_dir.iterdir():
+                if path.suffix == ".part":
+                    path.unlink(missing_ok=True)
+                    continue
+                stat = path.stat()
+                entries.append((stat.st_mtime, path.name, stat.st_size))
+            self._index = OrderedDict((name, size) for _, name, size in sorted(entries))
+            self._bytes = sum(self._index.values())
+        return self._index
+
+    def _touch(self, name: str):
+        index = self._load_index()
+        index.move_to_end(name)
+        try:
+            os.utime(self.cache_dir / name)
+        except FileNotFoundError:
+            pass
+
+    def _add(self, name: str, size: int):
+        index = self._load_index()
+        self._bytes += size - index.get(name, 0)
+        index[name] = size
+        index.move_to_end(name)
+        while self._bytes > self.max_bytes and len(index) > 1:
+            old_name, old_size = index.popitem(last=False)
+            (self.cache_dir / old_name).unlink(missing_ok=True)
+            self._bytes -= old_size
+            self._stats["evictions"] += 1
+
+    # ==================== 生成 ====================
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def get(self, source: Path, width: Optional[int] = None, fmt: Optional[str] = None) -> Derivative:
+        """
+        获取衍生图
+
+        Args:
+            source: 源图片路径
+            width: 目标宽度（向上取整到档位，不放大）
+            fmt: 输出格式 webp / jpeg / png
+
+        Returns:
+            衍生图文件（含强 ETag）
+        """
+        width = self.normalize_width(width)
+        fmt = self.normalize_format(fmt, source)
+        _, media_type, extension = FORMATS[fmt]
+        stat = source.stat()
+        key = hashlib.sha256(
+            f"{source.resolve()}|{stat.st_size}|{stat.st_mtime_ns}|{width}|{fmt}|{_ENCODER_VERSION}".encode("utf-8")
+        ).hexdigest()[:32]
+        name = f"{key}{extension}"
+        path = self.cache_dir / name
+        index = self._load_index()
+
+        if name in index and path.exists():
+            self._stats["hits"] += 1
+            self._touch(name)
+            return Derivative(path=path, etag=f'"{key}"', media_type=media_type, size=index[name])
+
+        future = self._inflight.get(name)
+        if future is None:
+            self._stats["misses"] += 1
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self._pool(), _render, str(source), str(path), width, fmt, settings.DERIVATIVE_QUALITY
+            )
+            self._inflight[name] = future
+            future.add_done_callback(lambda _: self._inflight.pop(name, None))
+        try:
+            size = await asyncio.shield(future)
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        if name not in index:
+            self._add(name, size)
+        return Derivative(path=path, etag=f'"{key}"', media_type=media_type, size=size)
+
+    def shutdown(self):
+        """关闭进程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def metrics(self) -> Dict[str, int]:
+        """缓存指标"""
+        index = self._load_index()
+        return {
+            **self._stats,
+            "entries": len(index),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "inflight": len(self._inflight),
+        }
+
+
+# 单例实例
+image_derivatives = ImageDerivativeService()
@@ -1,11 +1,20 @@
 """
 预设管理服务
 提供产品类型和风格预设的管理、匹配和检测功能
+
+预设只在 presets.json 变化时变化，列表 / 组合预设的响应体在加载时序列化一次
+（CachedBody，带 ETag 和 Last-Modified），接口直接返回字节
+
+presets.json 由资源注册表加载并监视：文件修改后在后台线程重建预设模型、关键词自动机和响应体，
+完成后整体替换 PresetState，请求不会看到新旧混合的状态
 """
-import json
-import re
-from pathlib import Path
-from typing import Optional, List, Dict, Any
+import asyncio
+from dataclasses import dataclass
+from typing import Optional, List, Dict, Any, Tuple
+from utils.http_cache import CachedBody
+from utils.keyword_matcher import KeywordAutomaton
+from utils.lazy_service import LazyService
+from services.asset_registry import asset_registry, Asset
 from models import (
     ImageAnalysis,
     ProductTypePreset,
@@ -13,37 +22,88 @@ from models import (
     DesignPreset,
     ColorPalette,
     PresetListResponse,
+    PresetDetection,
 )
 
 
-def load_json_file(filename: str) -> Dict[str, Any]:
-    """加载 JSON 配置文件"""
-    file_path = Path(__file__).parent.parent / "data" / filename
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"[Preset Service] Warning: Failed to load {filename}: {e}")
-        return {}
+PRESETS_FILE = "presets.json"
 
 
-# 预加载预设配置
-PRESETS = load_json_file("presets.json")
+@dataclass
+class PresetState:
+    """由 presets.json 派生的全部结构（整体替换）"""
+    presets: Dict[str, Any]
+    product_types: Dict[str, ProductTypePreset]
+    styles: Dict[str, StylePreset]
+    detection_rules: Dict[str, Any]
+    product_type_matcher: KeywordAutomaton
+    style_matcher: KeywordAutomaton
+    hardware_matcher: KeywordAutomaton
+    product_type_order: List[str]
+    style_order: List[str]
+    last_modified: float
+    responses: Dict[Any, CachedBody]
 
 
 class PresetService:
     """预设管理服务类"""
 
     def __init__(self):
-        self.presets = PRESETS
-        self.product_types = self._load_product_types()
-        self.styles = self._load_styles()
-        self.detection_rules = self.presets.get("detection_rules", {})
+        self._state = self._build_state(asset_registry.get(PRESETS_FILE))
+        asset_registry.subscribe(PRESETS_FILE, self._reload)
+
+    async def _reload(self, asset: Asset):
+        """presets.json 变化后在后台线程重建，完成后整体替换"""
+        state = await asyncio.to_thread(self._build_state, asset)
+        self._state = state
+        print(f"[Preset Service] 预设已更新 (v{asset.version}): "
+              f"{len(state.product_types)} product types, {len(state.styles)} styles")
+
+    # ==================== 当前状态 ====================
+
+    @property
+    def presets(self) -> Dict[str, Any]:
+        return self._state.presets
+
+    @property
+    def product_types(self) -> Dict[str, ProductTypePreset]:
+        return self._state.product_types
+
+    @property
+    def styles(self) -> Dict[str, StylePreset]:
+        return self._state.styles
+
+    @property
+    def detection_rules(self) -> Dict[str, Any]:
+        return self._state.detection_rules
+
+    @property
+    def responses(self) -> Dict[Any, CachedBody]:
+        return self._state.responses
+
+    # ==================== 构建 ====================
+
+    def _build_state(self, asset: Asset) -> PresetState:
+        """从 presets.json 构建预设模型、检测自动机和预序列化响应"""
+        presets = asset.data if isinstance(asset.data, dict) else {}
+        detection_rules = presets.get("detection_rules", {})
+        state = PresetState(
+            presets=presets,
+            product_types=self._load_product_types(presets),
+            styles=self._load_styles(presets),
+            detection_rules=detection_rules,
+            **self._compile_detection(detection_rules),
+            last_modified=asset.mtime,
+            responses={},
+        )
+        state.responses = self._build_responses(state)
+        return state
 
-    def _load_product_types(self) -> Dict[str, ProductTypePreset]:
+    @staticmethod
+    def _load_product_types(presets: Dict[str, Any]) -> Dict[str, ProductTypePreset]:
         """加载产品类型预设"""
         product_types = {}
-        raw_types = self.presets.get("product_types", {})
+        raw_types = presets.get("product_types", {})
 
         for key, data in raw_types.items():
             try:
@@ -63,10 +123,11 @@ class PresetService:
 
         return product_types
 
-    def _load_styles(self) -> Dict[str, StylePreset]:
+    @staticmethod
+    def _load_styles(presets: Dict[str, Any]) -> Dict[str, StylePreset]:
         """加载风格预设"""
         styles = {}
-        raw_styles = self.presets.get("style_presets", {})
+        raw_styles = presets.get("style_presets", {})
 
         for key, data in raw_styles.items():
             try:
@@ -93,6 +154,46 @@ class PresetService:
 
         return styles
 
+    @staticmethod
+    def _build_responses(state: PresetState) -> Dict[Any, CachedBody]:
+        """预先序列化列表接口和全部组合预设的响应体"""
+        last_modified = state.last_modified
+        product_types = list(state.product_types.values())
+        styles = list(state.styles.values())
+        responses: Dict[Any, CachedBody] = {
+            "presets": CachedBody.from_data(
+                PresetListResponse(product_types=product_types, styles=styles), last_modified
+            ),
+            "product_types": CachedBody.from_data({"success": True, "product_types": product_types}, last_modified),
+            "styles": CachedBody.from_data({"success": True, "styles": styles}, last_modified),
+        }
+        for type_id, product_type in state.product_types.items():
+            for style_id, style in state.styles.items():
+                responses[(type_id, style_id)] = CachedBody.from_data(
+                    DesignPreset(product_type=product_type, style=style), last_modified
+                )
+        return responses
+
+    def cached_preset(self, product_type: str, style: str) -> CachedBody:
+        """
+        组合预设的预序列化响应（未知的类型 / 风格与 get_preset 一样回退到默认值）
+
+        Args:
+            product_type: 产品类型ID
+            style: 风格ID
+        """
+        state = self._state
+        key: Tuple[str, str] = (product_type, style)
+        cached = state.responses.get(key)
+        if cached is None:
+            preset = self.get_preset(product_type, style)
+            resolved = (preset.product_type.id, preset.style.id)
+            cached = state.responses.get(resolved)
+            if cached is None:
+                cached = CachedBody.from_data(preset, state.last_modified)
+                state.responses[resolved] = cached
+        return cached
+
     def get_product_type(self, type_id: str) -> Optional[ProductTypePreset]:
         """获取产品类型预设"""
         return self.product_types.get(type_id)
@@ -156,6 +257,93 @@ class PresetService:
             style=style_preset,
         )
 
+    @staticmethod
+    def _compile_detection(detection_rules: Dict[str, Any]) -> Dict[str, Any]:
+        """把检测规则中的关键词编译为 Aho–Corasick 自动机（中英文关键词一次扫描）"""
+        def entries(keywords_map: Dict[str, Any]) -> List[Tuple[str, str, float]]:
+            compiled = []
+            for label, keywords in keywords_map.items():
+                for keyword in keywords:
+                    # 关键词可写为字符串，或 {"keyword": ..., "weight": ...} 指定权重
+                    if isinstance(keyword, dict):
+                        compiled.append((keyword.get("keyword", ""), label, float(keyword.get("weight", 1.0))))
+                    else:
+                        compiled.append((keyword, label, 1.0))
+            return compiled
+
+        product_keywords = detection_rules.get("product_type_keywords", {})
+        style_keywords = detection_rules.get("style_keywords", {})
+        hardware_map = detection_rules.get("hardware_to_product", {})
+
+        return {
+            "product_type_matcher": KeywordAutomaton(entries(product_keywords)),
+            "style_matcher": KeywordAutomaton(entries(style_keywords)),
+            # 五金件类型是图像分析给出的描述（如 "split keyring"），与原逻辑一样按子串匹配
+            "hardware_matcher": KeywordAutomaton(
+                ((keyword, product_type, 1.0) for keyword, product_type in hardware_map.items()),
+                whole_words=False,
+            ),
+            # 得分相同时按规则中的先后顺序
+            "product_type_order": list(product_keywords) + [
+                p for p in hardware_map.values() if p not in product_keywords
+            ],
+            "style_order": list(style_keywords),
+        }
+
+    @staticmethod
+    def _best(scores: Dict[str, float], order: List[str], default: str) -> Tuple[str, float]:
+        """得分最高的标签及其置信度（占总得分的比例），没有命中时返回默认值和 0"""
+        total = sum(scores.values())
+        if total <= 0:
+            return default, 0.0
+        ranked = sorted(scores, key=lambda label: (-scores[label], order.index(label) if label in order else len(order)))
+        best = ranked[0]
+        return best, round(scores[best] / total, 3)
+
+    def detect(
+        self,
+        text: str = "",
+        analysis: Optional[ImageAnalysis] = None
+    ) -> PresetDetection:
+        """
+        检测产品类型和风格（一次扫描，按加权命中数打分）
+
+        - 产品类型：用户文本中的关键词优先；用户没有提到任何产品关键词时才按图像分析中的五金件判断
+        - 风格：用户文本 + 图像分析的风格标签
+
+        Args:
+            text: 用户输入文本
+            analysis: 图像分析结果
+
+        Returns:
+            PresetDetection: 最佳产品类型 / 风格及其置信度
+        """
+        state = self._state
+        product_scores = state.product_type_matcher.score(text)
+        if not product_scores and analysis and analysis.elements and analysis.elements.hardware:
+            hardware_text = " | ".join(hw.type for hw in analysis.elements.hardware)
+            product_scores = state.hardware_matcher.score(hardware_text)
+
+        style_text = text
+        if analysis and analysis.style and analysis.style.tags:
+            style_text += " | " + " | ".join(analysis.style.tags)
+        style_scores = state.style_matcher.score(style_text)
+
+        defaults = state.presets.get("default_preset", {})
+        product_type, product_confidence = self._best(
+            product_scores, state.product_type_order, defaults.get("product_type", "keychain")
+        )
+        style, style_confidence = self._best(style_scores, state.style_order, defaults.get("style", "ocean_kawaii"))
+
+        return PresetDetection(
+            product_type=product_type,
+            product_type_confidence=product_confidence,
+            style=style,
+            style_confidence=style_confidence,
+            product_type_scores=product_scores,
+            style_scores=style_scores,
+        )
+
     def detect_product_type(
         self,
         text: str = "",
@@ -169,32 +357,12 @@ class PresetService:
             analysis: 图像分析结果
 
         Returns:
-            产品类型ID
+            产品类型ID（没有命中时为默认产品类型）
         """
-        text_lower = text.lower()
-
-        # 1. 从关键词检测
-        keywords_map = self.detection_rules.get("product_type_keywords", {})
-        for product_type, keywords in keywords_map.items():
-            for keyword in keywords:
-                if keyword.lower() in text_lower:
-                    print(f"[Preset Service] Detected product type from keyword: {product_type}")
-                    return product_type
-
-        # 2. 从五金件检测
-        if analysis and analysis.elements and analysis.elements.hardware:
-            hardware_map = self.detection_rules.get("hardware_to_product", {})
-            for hw in analysis.elements.hardware:
-                hw_type = hw.type.lower()
-                for hw_keyword, product_type in hardware_map.items():
-                    if hw_keyword.lower() in hw_type:
-                        print(f"[Preset Service] Detected product type from hardware: {product_type}")
-                        return product_type
-
-        # 3. 默认
-        default = self.presets.get("default_preset", {}).get("product_type", "keychain")
-        print(f"[Preset Service] Using default product type: {default}")
-        return default
+        detection = self.detect(text, analysis)
+        print(f"[Preset Service] Detected product type: {detection.product_type} "
+              f"(confidence={detection.product_type_confidence})")
+        return detection.product_type
 
     def detect_style(
         self,
@@ -209,25 +377,11 @@ class PresetService:
             analysis: 图像分析结果
 
         Returns:
-            风格ID
+            风格ID（没有命中时为默认风格）
         """
-        # 组合文本
-        combined_text = text.lower()
-        if analysis and analysis.style and analysis.style.tags:
-            combined_text += " " + " ".join([t.lower() for t in analysis.style.tags])
-
-        # 从关键词检测
-        keywords_map = self.detection_rules.get("style_keywords", {})
-        for style_id, keywords in keywords_map.items():
-            for keyword in keywords:
-                if keyword.lower() in combined_text:
-                    print(f"[Preset Service] Detected style from keyword: {style_id}")
-                    return style_id
-
-        # 默认
-        default = self.presets.get("default_preset", {}).get("style", "ocean_kawaii")
-        print(f"[Preset Service] Using default style: {default}")
-        return default
+        detection = self.detect(text, analysis)
+        print(f"[Preset Service] Detected style: {detection.style} (confidence={detection.style_confidence})")
+        return detection.style
 
     def auto_detect_preset(
         self,
@@ -244,12 +398,13 @@ class PresetService:
         Returns:
             DesignPreset: 自动检测的预设
         """
-        product_type = self.detect_product_type(text, analysis)
-        style = self.detect_style(text, analysis)
+        detection = self.detect(text, analysis)
 
-        print(f"[Preset Service] Auto-detected preset: product_type={product_type}, style={style}")
+        print(f"[Preset Service] Auto-detected preset: "
+              f"product_type={detection.product_type} ({detection.product_type_confidence}), "
+              f"style={detection.style} ({detection.style_confidence})")
 
-        return self.get_preset(product_type, style)
+        return self.get_preset(detection.product_type, detection.style)
 
     def list_presets(self) -> PresetListResponse:
         """
@@ -272,5 +427,5 @@ class PresetService:
         return list(self.styles.values())
 
 
-# 单例实例
-preset_service = PresetService()
+# 单例实例（首次使用时构造：加载预设并编译识别规则）
+preset_service: PresetService = LazyService(PresetService)
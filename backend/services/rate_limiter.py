@@ -0,0 +1,317 @@
+"""
+上游限流服务
+为 Claude / 嵌入 / Seedream 等上游模型提供共享的自适应限流
+
+设计理念：
+- 每个上游模型一个限流器，所有调用方共享同一份配额
+- 令牌桶控制请求速率，AIMD 动态调整并发上限
+- 收到 429/5xx 时遵循 Retry-After，否则使用带抖动的指数退避
+- 排队等待有超时，超时后抛出 UpstreamBusyError，由路由层转换为 503
+
+核心方法：
+- get_limiter(): 获取（或创建）指定模型的限流器
+- AdaptiveLimiter.call(): 在限流保护下发送请求并自动重试
+- limiter_metrics(): 导出所有限流器的队列深度、等待时间等指标
+"""
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from config import get_settings
+
+settings = get_settings()
+
+# 视为“上游繁忙”的状态码，会触发退避重试
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+
+class UpstreamBusyError(Exception):
+    """上游繁忙：排队超时或重试次数耗尽"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    解析 Retry-After 头
+
+    Args:
+        value: 头部值（秒数或 HTTP 日期）
+
+    Returns:
+        需要等待的秒数，无法解析时返回 None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    """单个上游模型的自适应限流器（令牌桶 + AIMD 并发控制）"""
+
+    def __init__(
+        self,
+        name: str,
+        max_in_flight: int = 4,
+        rate_per_sec: float = 0.0,
+        burst: int = 1,
+        queue_timeout: float = 30.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20.0,
+    ):
+        """
+        Args:
+            name: 限流器名称（通常为模型名）
+            max_in_flight: 最大并发请求数（AIMD 上限）
+            rate_per_sec: 令牌桶速率，0 表示不限速
+            burst: 令牌桶容量
+            queue_timeout: 排队等待超时（秒）
+            max_retries: 遇到 429/5xx 的最大重试次数
+            backoff_base: 指数退避基数（秒）
+            backoff_max: 单次退避上限（秒）
+        """
+        self.name = name
+        self.max_in_flight = max(1, max_in_flight)
+        self.rate_per_sec = rate_per_sec
+        self.burst = max(1, burst)
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # AIMD 当前并发上限（浮点数，加性增/乘性减）
+        self._limit = float(self.max_in_flight)
+        self._in_flight = 0
+        self._waiting = 0
+        self._cond: Optional[asyncio.Condition] = None
+
+        # 令牌桶
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+
+        # Retry-After 冷却：在此时间点之前不发出新请求
+        self._blocked_until = 0.0
+
+        # 指标
+        self._stats = {
+            "requests": 0,
+            "throttled": 0,
+            "retries": 0,
+            "rejected": 0,
+            "acquired": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+
+    def _condition(self) -> asyncio.Condition:
+        """延迟创建 Condition，确保绑定到运行中的事件循环"""
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    @property
+    def current_limit(self) -> int:
+        """当前生效的并发上限"""
+        return max(1, int(self._limit))
+
+    async def _take_token(self, deadline: float):
+        """从令牌桶取一个令牌，不足时等待"""
+        if self.rate_per_sec <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(
+                float(self.burst),
+                self._tokens + (now - self._last_refill) * self.rate_per_sec,
+            )
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            delay = (1 - self._tokens) / self.rate_per_sec
+            if now + delay > deadline:
+                raise asyncio.TimeoutError()
+            await asyncio.sleep(delay)
+
+    async def acquire(self):
+        """
+        获取一个并发槽位（排队等待，超时抛出 UpstreamBusyError）
+        """
+        cond = self._condition()
+        start = time.monotonic()
+        deadline = start + self.queue_timeout
+        self._waiting += 1
+        try:
+            async with cond:
+                while self._in_flight >= self.current_limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    await asyncio.wait_for(cond.wait(), timeout=remaining)
+                self._in_flight += 1
+
+            try:
+                # 遵循全局 Retry-After 冷却
+                cooldown = self._blocked_until - time.monotonic()
+                if cooldown > 0:
+                    if time.monotonic() + cooldown > deadline:
+                        raise asyncio.TimeoutError()
+                    await asyncio.sleep(cooldown)
+                await self._take_token(deadline)
+            except BaseException:
+                await self._release_slot()
+                raise
+
+        except asyncio.TimeoutError:
+            self._stats["rejected"] += 1
+            print(f"[Rate Limiter] {self.name}: 排队超时 ({self.queue_timeout}s)")
+            raise UpstreamBusyError(
+                f"上游服务繁忙，请稍后重试 ({self.name})",
+                retry_after=max(1.0, self._blocked_until - time.monotonic()),
+            )
+        finally:
+            self._waiting -= 1
+
+        waited = time.monotonic() - start
+        self._stats["acquired"] += 1
+        self._stats["wait_time_total"] += waited
+        self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+
+    async def _release_slot(self):
+        cond = self._condition()
+        async with cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            cond.notify_all()
+
+    def _on_success(self):
+        """加性增：每次成功把并发上限提高 1/limit"""
+        if self._limit < self.max_in_flight:
+            self._limit = min(float(self.max_in_flight), self._limit + 1.0 / self._limit)
+
+    def _on_throttle(self, retry_after: Optional[float]):
+        """乘性减：并发上限减半，并设置冷却时间"""
+        self._stats["throttled"] += 1
+        self._limit = max(1.0, self._limit / 2)
+        if retry_after:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        print(f"[Rate Limiter] {self.name}: 上游限流，并发上限降至 {self.current_limit}")
+
+    def _backoff_delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        """计算退避时间：优先 Retry-After，否则带全抖动的指数退避"""
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(self.backoff_base / 2, ceiling)
+
+    async def call(
+        self,
+        send: Callable[[], Awaitable[httpx.Response]],
+    ) -> httpx.Response:
+        """
+        在限流保护下发送请求
+
+        Args:
+            send: 发送请求的协程工厂（每次重试会重新调用）
+
+        Returns:
+            上游响应（非重试状态码）
+
+        Raises:
+            UpstreamBusyError: 排队超时或重试次数耗尽
+        """
+        attempt = 0
+        while True:
+            await self.acquire()
+            self._stats["requests"] += 1
+            try:
+                response = await send()
+            finally:
+                await self._release_slot()
+
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                self._on_success()
+                return response
+
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            self._on_throttle(retry_after)
+
+            if attempt >= self.max_retries:
+                print(f"[Rate Limiter] {self.name}: 重试 {attempt} 次后仍失败 ({response.status_code})")
+                raise UpstreamBusyError(
+                    f"上游服务繁忙，请稍后重试 ({self.name}: {response.status_code})",
+                    retry_after=retry_after,
+                )
+
+            delay = self._backoff_delay(attempt, retry_after)
+            attempt += 1
+            self._stats["retries"] += 1
+            print(f"[Rate Limiter] {self.name}: {response.status_code}，{delay:.1f}s 后第 {attempt} 次重试")
+            await asyncio.sleep(delay)
+
+    def metrics(self) -> dict:
+        """导出限流器指标"""
+        acquired = self._stats["acquired"]
+        return {
+            "name": self.name,
+            "in_flight": self._in_flight,
+            "queue_depth": self._waiting,
+            "current_limit": self.current_limit,
+            "max_in_flight": self.max_in_flight,
+            "rate_per_sec": self.rate_per_sec,
+            "cooldown_remaining": round(max(0.0, self._blocked_until - time.monotonic()), 2),
+            "requests": self._stats["requests"],
+            "throttled": self._stats["throttled"],
+            "retries": self._stats["retries"],
+            "rejected": self._stats["rejected"],
+            "wait_time_avg": round(self._stats["wait_time_total"] / acquired, 4) if acquired > 0 else 0.0,
+            "wait_time_max": round(self._stats["wait_time_max"], 4),
+        }
+
+
+# 限流器注册表（按模型名共享）
+_limiters: Dict[str, AdaptiveLimiter] = {}
+
+
+def get_limiter(name: str) -> AdaptiveLimiter:
+    """
+    获取指定上游模型的限流器（不存在时按配置创建）
+
+    Args:
+        name: 模型名（UPSTREAM_MODEL_MAX_IN_FLIGHT 可按模型覆盖并发上限）
+
+    Returns:
+        共享的限流器实例
+    """
+    if name not in _limiters:
+        _limiters[name] = AdaptiveLimiter(
+            name=name,
+            max_in_flight=settings.UPSTREAM_MODEL_MAX_IN_FLIGHT.get(name, settings.UPSTREAM_MAX_IN_FLIGHT),
+            rate_per_sec=settings.UPSTREAM_RATE_PER_SEC,
+            burst=settings.UPSTREAM_BURST,
+            queue_timeout=settings.UPSTREAM_QUEUE_TIMEOUT,
+            max_retries=settings.UPSTREAM_MAX_RETRIES,
+            backoff_base=settings.UPSTREAM_BACKOFF_BASE,
+            backoff_max=settings.UPSTREAM_BACKOFF_MAX,
+        )
+    return _limiters[name]
+
+
+def limiter_metrics() -> Dict[str, dict]:
+    """导出所有限流器指标"""
+    return {name: limiter.metrics() for name, limiter in _limiters.items()}
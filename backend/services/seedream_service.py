@@ -2,10 +2,15 @@
 即梦 (Seedream) 绘图服务
 豆包即梦4模型 - 支持文生图和图生图
 """
+import asyncio
 import httpx
 import base64
-from typing import List, Optional
+import random
+from typing import List, Optional, Union
 from config import get_settings
+from services.rate_limiter import get_limiter
+from services.generated_store import generated_store
+from utils.image_payload import ImagePayload
 from models import GenerationResult
 
 settings = get_settings()
@@ -18,6 +23,7 @@ class SeedreamService:
         self.base_url = settings.OPENAI_API_BASE
         self.api_key = settings.OPENAI_API_KEY
         self.model = getattr(settings, 'SEEDREAM_MODEL', 'doubao-seedream-4-5-251128')
+        self.limiter = get_limiter(self.model)
 
     def _get_headers(self) -> dict:
         """获取请求头"""
@@ -29,7 +35,7 @@ class SeedreamService:
     async def generate(
         self,
         prompt: str,
-        reference_images: Optional[List[str]] = None,
+        reference_images: Optional[List[Union[str, ImagePayload]]] = None,
         style_reference: Optional[str] = None,
         structure_reference: Optional[str] = None,
         size: str = "2K",
@@ -37,13 +43,14 @@ class SeedreamService:
         stream: bool = False,
         watermark: bool = False,
         sequential_image_generation: str = "auto",
+        seed: Optional[int] = None,
     ) -> GenerationResult:
         """
         生成图像（文生图或多图参考生成）
 
         Args:
             prompt: 图像生成提示词
-            reference_images: 参考图列表 (base64或URL)，不带就是文生图
+            reference_images: 参考图列表 (base64、URL或图像载体)，不带就是文生图
             style_reference: 风格参考图 (用于风格锚定)
             structure_reference: 结构参考图 (用于形态约束)
             size: 图像尺寸 (2K/1K/4K)
@@ -51,6 +58,7 @@ class SeedreamService:
             stream: 是否流式返回
             watermark: 是否添加水印
             sequential_image_generation: 顺序图片生成模式 (auto)
+            seed: 随机种子（用于生成不同方案，可选）
 
         Returns:
             生成结果，包含图像URL
@@ -77,6 +85,8 @@ class SeedreamService:
             "stream": stream,
             "watermark": watermark,
         }
+        if seed is not None:
+            payload["seed"] = seed
 
         # 组装所有参考图（最多8张）
         all_images = []
@@ -95,9 +105,17 @@ class SeedreamService:
 
         # 格式化并添加到请求
         if all_images:
+            # 本地存储的生成图（/generated/...）上游无法访问，读取本地副本后以 data URI 发送
+            all_images = [
+                await generated_store.open(img) if isinstance(img, str) and generated_store.is_local(img) else img
+                for img in all_images
+            ]
             formatted_images = []
             for img in all_images[:8]:  # 最多8张
-                if img.startswith("http"):
+                if isinstance(img, ImagePayload):
+                    # 图像载体：复用缓存的 data URI（MIME 按文件头识别）
+                    formatted_images.append(img.data_uri)
+                elif img.startswith("http"):
                     # URL 直接使用
                     formatted_images.append(img)
                 elif img.startswith("data:"):
@@ -128,11 +146,11 @@ class SeedreamService:
 
         async with httpx.AsyncClient(timeout=180.0) as client:
             try:
-                response = await client.post(
+                response = await self.limiter.call(lambda: client.post(
                     f"{self.base_url}/images/generations",
                     headers=self._get_headers(),
                     json=payload,
-                )
+                ))
 
                 if response.status_code != 200:
                     print(f"[Seedream Error] Status: {response.status_code}")
@@ -153,7 +171,7 @@ class SeedreamService:
                 # 返回第一张图的URL（如果需要多张可以扩展）
                 image_url = image_urls[0] if image_urls else ""
 
-                return GenerationResult(
+                generation = GenerationResult(
                     image_url=image_url,
                     prompt_used=prompt,
                     metadata={
@@ -165,6 +183,8 @@ class SeedreamService:
                         "usage": data.get("usage", {}),
                     },
                 )
+                # 临时 URL 下载到本地存储，后续读取都使用本地副本
+                return await generated_store.localize_result(generation)
 
             except httpx.ReadTimeout:
                 print("[Seedream Error] 请求超时")
@@ -191,7 +211,7 @@ class SeedreamService:
 
         Args:
             prompt: 编辑提示词
-            image: 原图 (base64或文件路径)
+            image: 原图 (base64、data URI、远程URL或本地生成图URL)
             mask: 遮罩图 (base64或文件路径，可选)
             size: 输出尺寸
             n: 生成数量
@@ -215,11 +235,10 @@ class SeedreamService:
             _, img_data = image.split(",", 1)
             img_bytes = base64.b64decode(img_data)
             files["image"] = ("image.png", img_bytes, "image/png")
-        elif image.startswith("http"):
-            # URL 需要先下载
-            async with httpx.AsyncClient() as client:
-                resp = await client.get(image)
-                files["image"] = ("image.png", resp.content, "image/png")
+        elif image.startswith("http") or generated_store.is_local(image):
+            # URL：优先读取本地存储的副本（远程 URL 只下载一次）
+            source = await generated_store.open(image)
+            files["image"] = (f"image{source.extension}", source.data, source.mime_type)
         else:
             # 纯 base64
             img_bytes = base64.b64decode(image)
@@ -244,12 +263,12 @@ class SeedreamService:
 
         async with httpx.AsyncClient(timeout=180.0) as client:
             try:
-                response = await client.post(
+                response = await self.limiter.call(lambda: client.post(
                     f"{self.base_url}/images/edits",
                     headers=headers,
                     data=data,
                     files=files,
-                )
+                ))
 
                 if response.status_code != 200:
                     print(f"[Seedream Edit Error] Status: {response.status_code}")
@@ -269,7 +288,7 @@ class SeedreamService:
 
                 image_url = image_urls[0] if image_urls else ""
 
-                return GenerationResult(
+                generation = GenerationResult(
                     image_url=image_url,
                     prompt_used=prompt,
                     metadata={
@@ -281,6 +300,8 @@ class SeedreamService:
                         "usage": result.get("usage", {}),
                     },
                 )
+                # 临时 URL 下载到本地存储，后续读取都使用本地副本
+                return await generated_store.localize_result(generation)
 
             except httpx.ReadTimeout:
                 print("[Seedream Edit Error] 请求超时")
@@ -292,30 +313,66 @@ class SeedreamService:
     async def generate_batch(
         self,
         prompt: str,
-        reference_images: Optional[List[str]] = None,
+        reference_images: Optional[List[Union[str, ImagePayload]]] = None,
         size: str = "2K",
         n: int = 3,
+        strategy: str = "batch",
+        seed: Optional[int] = None,
     ) -> List[str]:
         """
-        批量生成图像
+        批量生成图像（多方案）
+
+        batch 策略先单次请求 n 张，上游返回不足 n 张时再按不同 seed 并行补齐；
+        seeds 策略直接按不同 seed 并行请求 n 次。并发请求统一经过上游限流器。
 
         Args:
             prompt: 提示词
             reference_images: 参考图列表
             size: 尺寸
             n: 生成数量
+            strategy: batch / seeds
+            seed: 起始随机种子（不传则随机）
 
         Returns:
-            图像URL列表
+            图像URL列表（最多 n 个）
         """
-        result = await self.generate(
-            prompt=prompt,
-            reference_images=reference_images,
-            size=size,
-            n=n,
-        )
-
-        return result.metadata.get("all_urls", [result.image_url])
+        image_urls: List[str] = []
+        if strategy == "batch":
+            result = await self.generate(
+                prompt=prompt,
+                reference_images=reference_images,
+                size=size,
+                n=n,
+            )
+            image_urls = result.metadata.get("all_urls") or ([result.image_url] if result.image_url else [])
+            image_urls = image_urls[:n]
+
+        missing = n - len(image_urls)
+        if missing > 0:
+            if seed is None:
+                seed = random.randint(0, 2**31 - 1 - missing)
+            print(f"[Seedream] 并行请求 {missing} 个方案 (seed={seed}..{seed + missing - 1})")
+            results = await asyncio.gather(
+                *[
+                    self.generate(
+                        prompt=prompt,
+                        reference_images=reference_images,
+                        size=size,
+                        seed=seed + i,
+                    )
+                    for i in range(missing)
+                ],
+                return_exceptions=True,
+            )
+            for item in results:
+                if isinstance(item, BaseException):
+                    print(f"[Seedream] 方案生成失败: {item}")
+                elif item.image_url:
+                    image_urls.append(item.image_url)
+
+        if not image_urls:
+            raise Exception("图像生成失败：未返回任何图片")
+        return image_urls
 
 
 # 单例实例
@@ -0,0 +1,38 @@
+"""
+测试公共配置
+- backend 目录加入导入路径，测试代码与服务代码一样使用 services / agents / utils 等顶层包
+- 会话默认使用纯内存后端，测试不写入 data/ 目录
+"""
+import io
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+os.environ.setdefault("SESSION_BACKEND", "memory")
+
+from services.blob_store import blob_store  # noqa: E402
+
+
+@pytest.fixture
+def isolated_blob_store(tmp_path, monkeypatch):
+    """把内容寻址存储（单例）指向临时目录"""
+    base_dir = tmp_path / "blobs"
+    monkeypatch.setattr(blob_store, "base_dir", base_dir)
+    monkeypatch.setattr(blob_store, "objects_dir", base_dir / "objects")
+    monkeypatch.setattr(blob_store, "index_path", base_dir / "index.db")
+    monkeypatch.setattr(blob_store, "_conn", None)
+    yield blob_store
+    if blob_store._conn is not None:
+        blob_store._conn.close()
+        blob_store._conn = None
+
+
+def make_image(color=(120, 180, 220), size=(64, 64), fmt="JPEG") -> bytes:
+    """生成纯色测试图片"""
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format=fmt)
+    return buffer.getvalue()
@@ -0,0 +1,66 @@
+"""GalleryIngestQueue：多个进程共享队列时的定期扫描、心跳与过期认领接管"""
+import asyncio
+
+import pytest
+
+from config import get_settings
+from services.gallery_ingest import GalleryIngestQueue
+from tests.conftest import make_image
+from utils.image_payload import ImagePayload
+
+
+@pytest.fixture
+def queues(tmp_path, isolated_blob_store, monkeypatch):
+    """两个进程的入库队列，共享同一个 SQLite 文件；处理过程只记录由哪个进程完成"""
+    settings = get_settings()
+    monkeypatch.setattr(settings, "JOB_HEARTBEAT_INTERVAL", 0.05)
+    monkeypatch.setattr(settings, "JOB_SCAN_INTERVAL", 0.05)
+    monkeypatch.setattr(settings, "JOB_STALE_SECONDS", 0.3)
+    processed = []
+
+    def make(name: str, duration: float) -> GalleryIngestQueue:
+        queue = GalleryIngestQueue(db_path=tmp_path / "ingest.db", workers=1)
+
+        async def process(row):
+            await asyncio.sleep(duration)
+            queue._update(row["id"], status="indexed", claimed_by=None)
+            processed.append((row["id"], name))
+
+        queue._process = process
+        return queue
+
+    return make, processed
+
+
+def test_running_queue_picks_up_items_submitted_elsewhere(queues):
+    make, processed = queues
+
+    async def scenario():
+        worker, submitter = make("worker", 0.0), make("submitter", 0.0)
+        await worker.start()
+        # submitter 没有启动 worker：记录只能由另一个进程的定期扫描接手
+        item = submitter.submit(ImagePayload(data=make_image()))
+        await asyncio.sleep(0.3)
+        await worker.stop()
+        return item["id"]
+
+    item_id = asyncio.run(scenario())
+    assert processed == [(item_id, "worker")]
+
+
+def test_heartbeat_keeps_claim_while_processing(queues):
+    make, processed = queues
+
+    async def scenario():
+        slow, other = make("slow", 0.8), make("other", 0.0)
+        item = slow.submit(ImagePayload(data=make_image()))
+        await slow.start()
+        await other.start()
+        # 处理时间超过 JOB_STALE_SECONDS，心跳让认领保持有效，不会被另一个进程接管
+        await asyncio.sleep(1.0)
+        await slow.stop()
+        await other.stop()
+        return item["id"]
+
+    item_id = asyncio.run(scenario())
+    assert processed == [(item_id, "slow")]
@@ -0,0 +1,64 @@
+"""GalleryService：多个进程（实例）共用同一图库时的元数据写入与重新加载"""
+import numpy as np
+
+from services.gallery_service import GalleryService
+
+
+def shared_galleries(tmp_path):
+    first = GalleryService(tmp_path)
+    first.metadata["items"] = [
+        {"id": "a", "filename": "a.jpg", "analysis": {"v": 0}},
+        {"id": "b", "filename": "b.jpg", "analysis": {"v": 0}},
+    ]
+    first._save_metadata()
+    return first, GalleryService(tmp_path)
+
+
+def test_writes_merge_with_changes_from_other_instances(tmp_path):
+    first, second = shared_galleries(tmp_path)
+
+    assert first.update_analyses({"a": {"v": 1}}) == 1
+    # second 的内存副本已过期：写入前重新加载，不会覆盖 first 的分析结果
+    second.save_embeddings({"b": (np.ones(4, dtype=np.float32), "fp-b")})
+    assert first.delete_reference("a")
+
+    items = {item["id"]: item for item in GalleryService(tmp_path).metadata["items"]}
+    assert list(items) == ["b"]
+    assert items["b"]["embedding_sha256"] == "fp-b"
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_readers_reload_after_other_instance_writes(tmp_path):
+    first, second = shared_galleries(tmp_path)
+    assert second.get_reference("a")["analysis"] == {"v": 0}
+
+    first.update_analyses({"a": {"v": 2}})
+
+    assert second.get_reference("a")["analysis"] == {"v": 2}
+    assert [item["id"] for item in second.list_references()] == ["a", "b"]
+
+
+def test_update_analyses_skips_items_changed_since_read(tmp_path):
+    first, second = shared_galleries(tmp_path)
+    before = {item["id"]: item["analysis"] for item in second.metadata["items"]}
+
+    first.update_analyses({"a": {"v": 1}})
+    updated = second.update_analyses({"a": {"v": 9}, "b": {"v": 9}}, expected=before)
+
+    assert updated == 1
+    assert second.get_reference("a")["analysis"] == {"v": 1}
+    assert second.get_reference("b")["analysis"] == {"v": 9}
+
+
+def test_save_embeddings_skips_items_reanalyzed_or_deleted_meanwhile(tmp_path):
+    first, second = shared_galleries(tmp_path)
+    before = {item["id"]: item["analysis"] for item in second.metadata["items"]}
+
+    first.update_analyses({"a": {"v": 1}})
+    vectors = {ref_id: (np.ones(4, dtype=np.float32), f"fp-{ref_id}") for ref_id in ("a", "b", "gone")}
+
+    assert second.save_embeddings(vectors, expected=before) == 1
+    assert "embedding_sha256" not in second.get_reference("a")
+    assert not second.embedding_path("a").exists()
+    assert second.get_reference("b")["embedding_sha256"] == "fp-b"
+    assert not second.embedding_path("gone").exists()
@@ -0,0 +1,135 @@
+"""图库快照：导出 → 导入往返、增量同步与旧条目（缺少内容哈希）的比对"""
+import importlib
+import io
+import json
+import tarfile
+
+import numpy as np
+import pytest
+
+from services.gallery_service import GalleryService
+from services.gallery_snapshot import GallerySnapshot, SnapshotFormatError
+from tests.conftest import make_image
+from utils.image_payload import ImagePayload
+
+# services 包把同名单例导出为包属性，模块本身从 sys.modules 中取
+snapshot_module = importlib.import_module("services.gallery_snapshot")
+
+
+@pytest.fixture
+def galleries(tmp_path, isolated_blob_store, monkeypatch):
+    """源图库（一个已迁移到 blob_store 的条目 + 一个旧条目）与空的目标图库"""
+    source = GalleryService(tmp_path / "source")
+    target = GalleryService(tmp_path / "target")
+
+    sha256 = isolated_blob_store.acquire(ImagePayload(data=make_image((200, 40, 40))))
+    isolated_blob_store.link(sha256, source.images_dir / "new.jpg")
+    (source.images_dir / "legacy.jpg").write_bytes(make_image((40, 200, 40)))
+    source.metadata["items"] = [
+        {"id": "new", "filename": "new.jpg", "image_sha256": sha256, "salesTier": "A",
+         "analysis": {"style": {"tags": ["海洋风"]}}, "embedding_sha256": "fp-new"},
+        {"id": "legacy", "filename": "legacy.jpg", "salesTier": "B", "analysis": {"style": {"tags": []}}},
+    ]
+    source._save_metadata()
+    np.save(source.embedding_path("new"), np.arange(8, dtype=np.float32))
+    np.save(source.embedding_path("legacy"), np.ones(8, dtype=np.float32))
+
+    def use(gallery: GalleryService):
+        monkeypatch.setattr(snapshot_module, "gallery_service", gallery)
+
+    return source, target, use
+
+
+def export(against=None) -> bytes:
+    buffer = io.BytesIO()
+    GallerySnapshot().export(buffer, against=against)
+    return buffer.getvalue()
+
+
+def test_export_import_roundtrip(galleries, isolated_blob_store):
+    source, target, use = galleries
+    use(source)
+    archive = export()
+
+    use(target)
+    stats = GallerySnapshot().import_snapshot(io.BytesIO(archive))
+
+    assert stats["changed"] == 2
+    # 两个图库共用同一个 blob_store：已迁移条目的图片已存在，只写入旧条目的图片
+    assert stats["blobs_written"] == 1 and stats["blobs_skipped"] == 1
+    assert [item["id"] for item in target.metadata["items"]] == ["new", "legacy"]
+    imported = {item["id"]: item for item in target.metadata["items"]}
+    assert imported["new"]["salesTier"] == "A"
+    assert imported["new"]["embedding_sha256"] == "fp-new"
+    assert imported["legacy"]["image_sha256"]  # 旧条目导出时补上内容哈希
+    for ref_id in ("new", "legacy"):
+        assert (target.images_dir / f"{ref_id}.jpg").read_bytes() == (source.images_dir / f"{ref_id}.jpg").read_bytes()
+        np.testing.assert_array_equal(np.load(target.embedding_path(ref_id)), np.load(source.embedding_path(ref_id)))
+        assert isolated_blob_store.exists(imported[ref_id]["image_sha256"])
+
+    # 再次导入：没有任何变化
+    again = GallerySnapshot().import_snapshot(io.BytesIO(archive))
+    assert again["changed"] == 0 and again["unchanged"] == 2
+
+
+def test_state_of_same_gallery_yields_empty_delta(galleries):
+    source, _, use = galleries
+    use(source)
+    snapshot = GallerySnapshot()
+
+    state = snapshot.state()
+    assert len(state["blobs"]) == 2  # 旧条目的内容哈希同样计入
+    delta = export(against=state)
+    stats = snapshot.import_snapshot(io.BytesIO(delta), dry_run=True)
+    assert stats["changed"] == 0 and stats["blobs_written"] == 0
+
+    full = export()
+    stats = snapshot.import_snapshot(io.BytesIO(full), dry_run=True)
+    assert stats["changed"] == 0 and stats["unchanged"] == 2
+
+
+def test_delta_sync_exports_only_changes_and_prunes(galleries):
+    source, target, use = galleries
+    use(source)
+    archive = export()
+    use(target)
+    GallerySnapshot().import_snapshot(io.BytesIO(archive))
+    state = GallerySnapshot().state()
+
+    use(source)
+    source.metadata["items"][0]["salesTier"] = "C"
+    source.metadata["items"] = source.metadata["items"][:1]
+    delta = export(against=state)
+
+    use(target)
+    stats = GallerySnapshot().import_snapshot(io.BytesIO(delta), prune=True)
+    assert stats == {"changed": 1, "unchanged": 0, "removed": 1, "blobs_written": 0, "blobs_skipped": 0}
+    assert [(item["id"], item["salesTier"]) for item in target.metadata["items"]] == [("new", "C")]
+    assert not (target.images_dir / "legacy.jpg").exists()
+
+
+def test_embeddings_can_be_memory_mapped(galleries, tmp_path):
+    source, _, use = galleries
+    use(source)
+    path = tmp_path / "gallery.snap"
+    GallerySnapshot().export(path)
+
+    ids, matrix = GallerySnapshot().load_embeddings(path)
+    assert isinstance(matrix, np.memmap)
+    rows = dict(zip(ids, matrix))
+    np.testing.assert_array_equal(rows["new"], np.arange(8, dtype=np.float32))
+
+
+def test_rejects_foreign_archive(tmp_path):
+    with pytest.raises(SnapshotFormatError):
+        GallerySnapshot().import_snapshot(io.BytesIO(export_foreign()))
+
+
+def export_foreign() -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as archive:
+        data = json.dumps({"format": "something-else", "version": 1}).encode()
+        info = tarfile.TarInfo("manifest.json")
+        info.size = len(data)
+        archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
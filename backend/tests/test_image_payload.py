@@ -0,0 +1,112 @@
+"""ImagePayload：流式读取落盘、大小限制、压缩与编码视图"""
+import asyncio
+import base64
+import hashlib
+import io
+import random
+
+import pytest
+from PIL import Image
+
+from tests.conftest import make_image
+from utils.image_payload import ImagePayload, PayloadTooLargeError
+
+
+def stream(data: bytes):
+    """模拟 UploadFile.read 的异步读取函数"""
+    buffer = io.BytesIO(data)
+
+    async def read(size: int) -> bytes:
+        return buffer.read(size)
+
+    return read
+
+
+def noise_png(size=(600, 600)) -> bytes:
+    """难以压缩的随机噪声 PNG"""
+    image = Image.frombytes("RGB", size, random.Random(0).randbytes(size[0] * size[1] * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_from_stream_spools_large_uploads_to_disk():
+    data = make_image(size=(512, 512), fmt="PNG") + b"\0" * 50_000
+    payload = asyncio.run(ImagePayload.from_stream(stream(data), max_bytes=1_000_000, spool_bytes=10_000, chunk_size=4096))
+
+    assert payload._file._rolled  # 超过 spool_bytes 后转存到磁盘临时文件
+    assert payload.size == len(data)
+    assert payload.sha256 == hashlib.sha256(data).hexdigest()
+    assert payload.mime_type == "image/png"
+    assert payload.data == data
+    payload.close()
+
+
+def test_from_stream_keeps_small_uploads_in_memory():
+    data = make_image()
+    payload = asyncio.run(ImagePayload.from_stream(stream(data), max_bytes=1_000_000, spool_bytes=1_000_000))
+
+    assert not payload._file._rolled
+    assert payload.mime_type == "image/jpeg"
+
+
+def test_from_stream_rejects_oversized_upload():
+    data = b"\xff" * 20_000
+    with pytest.raises(PayloadTooLargeError) as excinfo:
+        asyncio.run(ImagePayload.from_stream(stream(data), max_bytes=10_000, chunk_size=4096))
+
+    assert excinfo.value.max_bytes == 10_000
+
+
+def test_write_to_streams_spooled_file(tmp_path):
+    data = make_image(size=(256, 256), fmt="PNG")
+    payload = asyncio.run(ImagePayload.from_stream(stream(data), max_bytes=1_000_000, spool_bytes=100))
+
+    payload.write_to(tmp_path / "out.png")
+    assert (tmp_path / "out.png").read_bytes() == data
+    assert "data" not in payload.__dict__  # 写文件不把内容整体读入内存
+
+
+def test_materialized_payload_stops_reading_spooled_file():
+    data = make_image(size=(256, 256), fmt="PNG")
+    payload = asyncio.run(ImagePayload.from_stream(stream(data), max_bytes=1_000_000, spool_bytes=100))
+    assert payload.data == data
+
+    payload._file.close()  # 读入内存后各视图都不再 seek 共享的临时文件
+    assert payload.mime_type == "image/png"
+    assert payload.data_uri.startswith("data:image/png;base64,")
+    assert payload.compressed().mime_type == "image/jpeg"
+
+
+def test_compressed_converts_to_jpeg_under_limit_and_caches():
+    payload = ImagePayload(data=noise_png())
+    assert payload.size > 200_000
+
+    compressed = payload.compressed(200_000)
+
+    assert compressed.mime_type == "image/jpeg"
+    assert compressed.size <= 200_000
+    assert payload.compressed(200_000) is compressed
+
+
+def test_compressed_reuses_small_rgb_jpeg():
+    payload = ImagePayload(data=make_image())
+
+    assert payload.compressed() is payload
+
+
+def test_compressed_returns_self_for_undecodable_data():
+    payload = ImagePayload(data=b"not an image")
+
+    assert payload.compressed() is payload
+
+
+def test_base64_and_data_uri_views():
+    data = make_image()
+    payload = ImagePayload.from_base64("data:image/jpeg;base64," + base64.b64encode(data).decode())
+
+    assert payload.data == data
+    assert payload.mime_type == "image/jpeg"
+    assert payload.data_uri.startswith("data:image/jpeg;base64,")
+    assert ImagePayload.coerce(payload) is payload
+    assert ImagePayload.coerce(data).sha256 == payload.sha256
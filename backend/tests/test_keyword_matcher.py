@@ -0,0 +1,65 @@
+"""KeywordAutomaton：中英文关键词匹配、完整单词规则与加权得分"""
+from utils.keyword_matcher import KeywordAutomaton
+
+
+def keywords(hits):
+    return sorted(hit.keyword for hit in hits)
+
+
+def test_english_keywords_match_whole_words_only():
+    automaton = KeywordAutomaton([("car", "vehicle", 1.0)])
+
+    assert keywords(automaton.find("a red car")) == ["car"]
+    assert keywords(automaton.find("two cars")) == ["car"]  # 允许复数后缀
+    assert automaton.find("silver carabiner") == []
+    assert automaton.find("scar") == []
+
+
+def test_matching_is_case_insensitive():
+    automaton = KeywordAutomaton([("Ocean", "marine", 1.0)])
+
+    assert keywords(automaton.find("OCEAN breeze")) == ["ocean"]
+
+
+def test_chinese_keywords_match_as_substrings():
+    automaton = KeywordAutomaton([("贝壳", "marine", 1.0), ("海洋", "marine", 1.0)])
+
+    assert keywords(automaton.find("海洋风贝壳钥匙扣")) == ["海洋", "贝壳"]
+
+
+def test_overlapping_keywords_are_all_found():
+    automaton = KeywordAutomaton([
+        ("he", "a", 1.0), ("she", "b", 1.0), ("his", "c", 1.0), ("hers", "d", 1.0),
+        ("花", "e", 1.0), ("花瓣", "f", 1.0), ("樱花瓣", "g", 1.0),
+    ])
+
+    # 英文要求完整单词：ushers 中的 she / he / hers 都不算命中
+    assert automaton.find("ushers") == []
+    assert keywords(automaton.find("she and hers")) == ["hers", "she"]
+    assert keywords(automaton.find("樱花瓣")) == ["樱花瓣", "花", "花瓣"]
+
+
+def test_hits_report_end_offsets():
+    automaton = KeywordAutomaton([("星星", "star", 1.0)])
+
+    assert [hit.end for hit in automaton.find("星星和星星")] == [2, 5]
+
+
+def test_score_sums_weights_per_label():
+    automaton = KeywordAutomaton([
+        ("shell", "marine", 2.0),
+        ("贝壳", "marine", 1.5),
+        ("shell", "beach", 0.5),
+        ("", "ignored", 9.0),
+    ])
+
+    assert automaton.size == 3
+    assert automaton.score("shell 贝壳") == {"marine": 3.5, "beach": 0.5}
+    assert automaton.score("shell", factor=2.0) == {"marine": 4.0, "beach": 1.0}
+    assert automaton.score("nothing here") == {}
+
+
+def test_substring_mode_matches_inside_english_words():
+    automaton = KeywordAutomaton([("ring", "keychain", 1.0)], whole_words=False)
+
+    assert keywords(automaton.find("split keyring")) == ["ring"]
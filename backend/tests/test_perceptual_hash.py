@@ -0,0 +1,67 @@
+"""MultiIndexHash：范围查询结果与暴力比较一致"""
+import random
+
+from utils.perceptual_hash import MultiIndexHash, format_hash, hamming, parse_hash
+
+
+def flip_bits(value: int, count: int, rng: random.Random) -> int:
+    for bit in rng.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+def test_search_matches_brute_force():
+    rng = random.Random(42)
+    max_distance = 8
+    values = []
+    for _ in range(40):
+        base = rng.getrandbits(64)
+        values.append(base)
+        # 每个基准哈希附近放几个不同距离的邻居
+        values.extend(flip_bits(base, rng.randint(1, 14), rng) for _ in range(5))
+
+    index = MultiIndexHash(max_distance)
+    for key, value in enumerate(values):
+        index.add(value, key)
+    assert len(index) == len(values)
+
+    for query in values[::7]:
+        for distance in (0, 3, max_distance):
+            expected = sorted(
+                (hamming(query, value), key) for key, value in enumerate(values)
+                if hamming(query, value) <= distance
+            )
+            assert sorted(index.search(query, distance)) == expected
+
+
+def test_results_sorted_by_distance_and_capped_by_build_distance():
+    index = MultiIndexHash(4)
+    index.add(0, "zero")
+    index.add(0b1, "one")
+    index.add(0b111, "three")
+    index.add(0b11111, "five")
+
+    results = index.search(0, 10)  # 超过构建时的距离时按构建距离查询
+    assert results == [(0, "zero"), (1, "one"), (3, "three")]
+
+
+def test_identical_hashes_keep_all_keys():
+    index = MultiIndexHash(2)
+    index.add(123, "a")
+    index.add(123, "b")
+
+    assert sorted(key for _, key in index.search(123)) == ["a", "b"]
+
+
+def test_zero_distance_index_is_exact_lookup():
+    index = MultiIndexHash(0)
+    index.add(0xFFFF, "a")
+    index.add(0xFFFE, "b")
+
+    assert index.search(0xFFFF) == [(0, "a")]
+
+
+def test_format_and_parse_roundtrip():
+    value = random.Random(1).getrandbits(64)
+    assert parse_hash(format_hash(value)) == value
+    assert parse_hash(None) is None
@@ -0,0 +1,121 @@
+"""StagePipeline：依赖调度、可选 / 必需阶段失败与取消"""
+import asyncio
+import time
+
+import pytest
+
+from agents.pipeline import StagePipeline
+
+
+def test_independent_stages_run_concurrently():
+    async def slow(_):
+        await asyncio.sleep(0.1)
+        return "done"
+
+    async def combine(results):
+        return results["a"] + results["b"]
+
+    pipeline = StagePipeline().add("a", slow).add("b", slow).add("c", combine, deps=["a", "b"])
+    started = time.perf_counter()
+    results = asyncio.run(pipeline.run())
+
+    assert results["c"] == "donedone"
+    assert time.perf_counter() - started < 0.18
+    assert set(pipeline.durations()) == {"a", "b", "c", "total"}
+
+
+def test_sequential_mode_runs_in_declaration_order():
+    order = []
+
+    def stage(name):
+        async def run(_):
+            order.append(name)
+        return run
+
+    pipeline = StagePipeline(concurrent=False)
+    for name in ("first", "second", "third"):
+        pipeline.add(name, stage(name))
+    asyncio.run(pipeline.run())
+
+    assert order == ["first", "second", "third"]
+
+
+def test_optional_failure_is_recorded_and_dependents_continue():
+    events = []
+
+    async def broken(_):
+        raise RuntimeError("boom")
+
+    async def after(results):
+        return results["broken"]
+
+    pipeline = StagePipeline(listener=lambda name, status: events.append((name, status)))
+    pipeline.add("broken", broken, optional=True).add("after", after, deps=["broken"])
+    results = asyncio.run(pipeline.run())
+
+    assert results == {"broken": None, "after": None}
+    assert pipeline.errors == {"broken": "boom"}
+    assert ("broken", "failed") in events
+    assert ("after", "completed") in events
+
+
+def test_required_failure_cancels_running_stages():
+    cancelled = []
+
+    async def long_running(_):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append("long")
+            raise
+
+    async def broken(_):
+        await asyncio.sleep(0.01)
+        raise ValueError("required stage failed")
+
+    async def dependent(_):
+        cancelled.append("dependent ran")
+
+    pipeline = StagePipeline()
+    pipeline.add("long", long_running).add("broken", broken).add("dependent", dependent, deps=["broken"])
+
+    started = time.perf_counter()
+    with pytest.raises(ValueError):
+        asyncio.run(pipeline.run())
+
+    assert cancelled == ["long"]
+    assert time.perf_counter() - started < 1
+    assert "total" in pipeline.timings
+
+
+def test_cancelling_run_cancels_all_stages():
+    cancelled = []
+
+    async def long_running(_):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def scenario():
+        pipeline = StagePipeline().add("a", long_running).add("b", long_running)
+        task = asyncio.create_task(pipeline.run())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert cancelled == [True, True]
+
+
+def test_listener_errors_do_not_break_pipeline():
+    def listener(name, status):
+        raise RuntimeError("listener bug")
+
+    async def stage(_):
+        return 1
+
+    pipeline = StagePipeline(listener=listener).add("a", stage)
+    assert asyncio.run(pipeline.run()) == {"a": 1}
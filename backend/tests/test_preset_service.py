@@ -0,0 +1,71 @@
+"""PresetService.detect：用户关键词优先于五金件，五金件按子串匹配"""
+from models import ImageAnalysis
+from services.asset_registry import Asset
+from services.preset_service import PresetService
+
+
+RULES = {
+    "product_type_keywords": {
+        "keychain": ["钥匙扣", "keychain"],
+        "bag_charm": ["包挂", "bag"],
+        "car_charm": ["车挂", "car"],
+    },
+    "hardware_to_product": {
+        "keyring": "keychain",
+        "lobster clasp": "keychain",
+        "carabiner": "bag_charm",
+    },
+    "style_keywords": {"ocean_kawaii": ["ocean"]},
+}
+
+
+def make_service() -> PresetService:
+    service = PresetService.__new__(PresetService)
+    service._state = service._build_state(
+        Asset(name="presets.json", data={"detection_rules": RULES}, mtime=0.0, version=1)
+    )
+    return service
+
+
+def analysis_with(*hardware: str) -> ImageAnalysis:
+    return ImageAnalysis.model_validate({
+        "elements": {"hardware": [{"type": hw} for hw in hardware]},
+        "style": {"tags": []},
+        "physicalSpecs": {"lengthCm": 10, "weightG": 5},
+    })
+
+
+def test_user_keyword_wins_over_any_number_of_hardware_hits():
+    service = make_service()
+    analysis = analysis_with("split keyring", "lobster clasp", "keyring chain")
+
+    detection = service.detect("a bag charm", analysis)
+
+    assert detection.product_type == "bag_charm"
+    assert detection.product_type_scores == {"bag_charm": 1.0}
+
+
+def test_hardware_decides_when_text_has_no_product_keyword():
+    service = make_service()
+
+    detection = service.detect("something cute", analysis_with("silver carabiner", "keyrings"))
+
+    assert detection.product_type == "keychain"  # 得分相同时按规则顺序
+    assert detection.product_type_scores == {"bag_charm": 1.0, "keychain": 1.0}
+
+
+def test_hardware_keywords_match_inside_compound_words():
+    service = make_service()
+
+    detection = service.detect("", analysis_with("split-ring minikeyring"))
+
+    assert detection.product_type == "keychain"
+
+
+def test_user_text_keeps_whole_word_matching():
+    service = make_service()
+
+    # "car" 不命中 "carabiner"，落到五金件判断
+    detection = service.detect("with a carabiner", analysis_with("keyring"))
+
+    assert detection.product_type == "keychain"
@@ -0,0 +1,130 @@
+"""AdaptiveLimiter：重试、Retry-After 冷却、排队超时与 AIMD 并发调整"""
+import asyncio
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+from services.rate_limiter import AdaptiveLimiter, UpstreamBusyError, parse_retry_after
+
+
+def responses(*status_codes, retry_after=None):
+    """按顺序返回给定状态码的 send() 工厂，并记录调用次数"""
+    calls = []
+
+    async def send():
+        status = status_codes[min(len(calls), len(status_codes) - 1)]
+        calls.append(status)
+        headers = {"Retry-After": retry_after} if retry_after is not None and status != 200 else {}
+        return httpx.Response(status, headers=headers)
+
+    return send, calls
+
+
+def test_retries_throttled_response_then_succeeds():
+    limiter = AdaptiveLimiter("test", max_retries=3, backoff_base=0.001, backoff_max=0.01)
+    send, calls = responses(429, 503, 200)
+
+    response = asyncio.run(limiter.call(send))
+
+    assert response.status_code == 200
+    assert calls == [429, 503, 200]
+    metrics = limiter.metrics()
+    assert metrics["retries"] == 2
+    assert metrics["throttled"] == 2
+    assert metrics["requests"] == 3
+
+
+def test_non_retryable_status_is_returned_without_retry():
+    limiter = AdaptiveLimiter("test", max_retries=3)
+    send, calls = responses(400)
+
+    assert asyncio.run(limiter.call(send)).status_code == 400
+    assert calls == [400]
+
+
+def test_exhausted_retries_raise_busy_with_retry_after():
+    limiter = AdaptiveLimiter("test", max_retries=1, backoff_max=0.01)
+    send, calls = responses(429, retry_after="7")
+
+    with pytest.raises(UpstreamBusyError) as excinfo:
+        asyncio.run(limiter.call(send))
+
+    assert len(calls) == 2
+    assert excinfo.value.retry_after == 7.0
+
+
+def test_retry_after_cools_down_following_requests():
+    limiter = AdaptiveLimiter("test", max_retries=0)
+
+    async def scenario():
+        send, _ = responses(429, retry_after="0.2")
+        with pytest.raises(UpstreamBusyError):
+            await limiter.call(send)
+        started = time.monotonic()
+        await limiter.acquire()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.15
+
+
+def test_queue_timeout_raises_busy():
+    limiter = AdaptiveLimiter("test", max_in_flight=1, queue_timeout=0.05)
+
+    async def scenario():
+        await limiter.acquire()
+        with pytest.raises(UpstreamBusyError):
+            await limiter.acquire()
+
+    asyncio.run(scenario())
+    assert limiter.metrics()["rejected"] == 1
+
+
+def test_aimd_halves_on_throttle_and_grows_additively():
+    limiter = AdaptiveLimiter("test", max_in_flight=8)
+
+    limiter._on_throttle(None)
+    assert limiter.current_limit == 4
+    limiter._on_throttle(None)
+    limiter._on_throttle(None)
+    limiter._on_throttle(None)
+    assert limiter.current_limit == 1  # 下限为 1
+
+    # 加性增：每次成功增加 1/limit，需要多次成功才能回到上限
+    successes = 0
+    while limiter.current_limit < 8:
+        limiter._on_success()
+        successes += 1
+    assert successes > 7
+    limiter._on_success()
+    assert limiter.current_limit == 8  # 不超过 max_in_flight
+
+
+def test_concurrency_never_exceeds_current_limit():
+    limiter = AdaptiveLimiter("test", max_in_flight=3)
+    in_flight = []
+    peak = []
+
+    async def send():
+        in_flight.append(1)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.pop()
+        return httpx.Response(200)
+
+    async def scenario():
+        await asyncio.gather(*[limiter.call(send) for _ in range(12)])
+
+    asyncio.run(scenario())
+    assert max(peak) == 3
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("5") == 5.0
+    assert parse_retry_after("-3") == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    http_date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 <= parse_retry_after(http_date) <= 30
@@ -0,0 +1,180 @@
+"""SessionStore：空闲过期、LRU 内存预算淘汰与多 worker 写入冲突的三方合并"""
+import time
+
+import asyncio
+
+import pytest
+
+from agents.session_backend import SQLiteSessionBackend
+from agents.session_store import SessionStore, settings
+from models import ChatMessage
+
+
+def fill(store: SessionStore, session_id: str, size: int):
+    session = store.get_or_create(session_id)
+    store.append_history(session, [ChatMessage(role="user", content="x" * size)])
+    return session
+
+
+def version(version_id: str, created_at: str, **fields):
+    return {"version_id": version_id, "created_at": created_at, **fields}
+
+
+def test_sweep_removes_idle_sessions():
+    store = SessionStore(ttl_seconds=0.05, backend=None)
+    store.get_or_create("old")
+    time.sleep(0.1)
+    store.get_or_create("fresh")
+
+    assert store.sweep() == 1
+    assert "old" not in store
+    assert "fresh" in store
+    assert store.metrics()["expired"] == 1
+
+
+def test_access_refreshes_idle_timer():
+    store = SessionStore(ttl_seconds=0.1, backend=None)
+    store.get_or_create("a")
+    time.sleep(0.06)
+    store.get("a")
+    time.sleep(0.06)
+
+    assert store.sweep() == 0
+    assert "a" in store
+
+
+def test_budget_evicts_least_recently_used():
+    store = SessionStore(max_bytes=2500, backend=None)
+    fill(store, "a", 1000)
+    fill(store, "b", 1000)
+    store.get("a")  # a 变为最近访问
+    fill(store, "c", 1000)
+
+    assert list(store) == ["a", "c"]
+    assert store.metrics()["evicted"] == 1
+    assert store.metrics()["bytes_held"] <= 2500
+
+
+def test_budget_keeps_the_session_being_saved():
+    store = SessionStore(max_bytes=500, backend=None)
+    fill(store, "a", 100)
+    fill(store, "big", 2000)
+
+    # 超出预算时淘汰其他会话，正在写入的会话即使单独超出预算也保留
+    assert list(store) == ["big"]
+
+
+def test_save_of_evicted_session_is_ignored_in_memory_mode():
+    store = SessionStore(max_bytes=1500, backend=None)
+    stale = fill(store, "a", 1000)
+    fill(store, "b", 1000)
+    assert "a" not in store
+
+    stale["analysis"] = None
+    store.save(stale)
+    assert "a" not in store
+
+
+@pytest.fixture
+def shared_backend_stores(tmp_path, isolated_blob_store, monkeypatch):
+    """两个 worker 进程的会话存储，共享同一个 SQLite 文件（每次访问都比对修订号）"""
+    monkeypatch.setattr(settings, "SESSION_REVISION_CHECK_INTERVAL", 0.0)
+    db_path = tmp_path / "sessions.db"
+    first = SessionStore(backend=SQLiteSessionBackend(db_path))
+    second = SessionStore(backend=SQLiteSessionBackend(db_path))
+    yield first, second
+    first.backend.close()
+    second.backend.close()
+
+
+def test_conflicting_saves_merge_generated_versions(shared_backend_stores):
+    first, second = shared_backend_stores
+    session_a = first.get_or_create("s1")
+    session_b = second.get("s1")
+    assert session_b is not None
+
+    session_a["generated_versions"].append(version("v1", "2024-01-01T00:00:01"))
+    first.save(session_a)
+    session_b["generated_versions"].append(version("v2", "2024-01-01T00:00:02"))
+    second.save(session_b)
+
+    assert second.metrics()["conflicts"] == 1
+    assert [v["version_id"] for v in session_b["generated_versions"]] == ["v1", "v2"]
+    # 另一个 worker 访问时重新加载到合并后的结果
+    reloaded = first.get("s1")
+    assert [v["version_id"] for v in reloaded["generated_versions"]] == ["v1", "v2"]
+    assert first.metrics()["reloaded"] == 1
+
+
+def test_merge_keeps_local_edits_and_takes_untouched_fields(shared_backend_stores):
+    first, second = shared_backend_stores
+    session_a = first.get_or_create("s1")
+    session_a["generated_versions"].append(version("v1", "2024-01-01T00:00:01", status="pending"))
+    first.save(session_a)
+    session_b = second.get("s1")
+
+    # A 更新了摘要，B 修改了同一个版本：B 的版本修改保留，A 的摘要被合并进来
+    session_a["summary"] = {"text": "摘要", "covered": 4}
+    first.save(session_a)
+    session_b["generated_versions"][0]["status"] = "done"
+    second.save(session_b)
+
+    assert session_b["summary"] == {"text": "摘要", "covered": 4}
+    assert session_b["generated_versions"][0]["status"] == "done"
+    assert first.get("s1")["generated_versions"][0]["status"] == "done"
+
+
+def test_buffered_history_is_flushed_and_visible_to_other_worker(shared_backend_stores):
+    first, second = shared_backend_stores
+    session = first.get_or_create("s1")
+    first.append_history(session, [ChatMessage(role="user", content="你好")])
+    assert first.metrics()["pending_history"] == 1
+
+    first.flush()
+    assert first.metrics()["pending_history"] == 0
+    assert [m.content for m in second.get("s1")["history"]] == ["你好"]
+
+
+def test_revision_is_checked_at_most_once_per_interval(shared_backend_stores, monkeypatch):
+    first, second = shared_backend_stores
+    monkeypatch.setattr(settings, "SESSION_REVISION_CHECK_INTERVAL", 60.0)
+    session = first.get_or_create("s1")
+    cached = second.get("s1")
+    session["summary"] = {"text": "摘要", "covered": 2}
+    first.save(session)
+
+    calls = []
+    revision = second.backend.revision
+    monkeypatch.setattr(second.backend, "revision", lambda session_id: calls.append(session_id) or revision(session_id))
+    # 间隔内直接使用缓存，不查询后端
+    assert second.get("s1") is cached and cached["summary"] is None
+    assert calls == []
+
+    monkeypatch.setattr(settings, "SESSION_REVISION_CHECK_INTERVAL", 0.0)
+    assert second.get("s1")["summary"] == {"text": "摘要", "covered": 2}
+    assert calls == ["s1"]
+
+
+def test_background_flusher_writes_history_in_a_thread(shared_backend_stores, monkeypatch):
+    first, second = shared_backend_stores
+    monkeypatch.setattr(settings, "SESSION_FLUSH_BATCH", 2)
+    first.flush_interval = 60.0
+
+    async def scenario():
+        first.start()
+        session = first.get_or_create("s1")
+        # 达到批量阈值时唤醒后台任务，而不是在事件循环中同步写入
+        first.append_history(session, [
+            ChatMessage(role="user", content="一"),
+            ChatMessage(role="assistant", content="二"),
+        ])
+        assert first.metrics()["pending_history"] == 2
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+            if first.metrics()["pending_history"] == 0:
+                break
+        assert first.metrics()["pending_history"] == 0
+        await first.stop()
+
+    asyncio.run(scenario())
+    assert [m.content for m in second.get("s1")["history"]] == ["一", "二"]
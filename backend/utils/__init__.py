@@ -1 +1,4 @@
 # Utils module
+from .image_payload import ImagePayload, MAX_IMAGE_SIZE
+
+__all__ = ["ImagePayload", "MAX_IMAGE_SIZE"]
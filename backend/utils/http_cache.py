@@ -0,0 +1,128 @@
+"""
+HTTP 缓存工具
+预先序列化的响应体 + ETag / Last-Modified 条件请求
+
+设计理念：
+- 只在数据变化时变化的响应（如预设列表）在加载时序列化一次，请求时直接返回字节
+- ETag 取响应体的哈希（强校验），Last-Modified 取数据源文件的修改时间
+- If-None-Match 优先于 If-Modified-Since（RFC 9110），命中时返回不带响应体的 304
+- 内容寻址的静态文件（文件名即内容哈希）标记为 immutable，浏览器无需再验证
+
+核心方法：
+- CachedBody.from_data(): 序列化并计算校验信息
+- cached_response(): 按条件请求返回 200 / 304
+- is_not_modified(): 判断条件请求是否命中
+"""
+import hashlib
+import json
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+from pydantic import BaseModel
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+
+def _to_jsonable(data: Any) -> Any:
+    if isinstance(data, BaseModel):
+        return data.model_dump(mode="json")
+    if isinstance(data, dict):
+        return {key: _to_jsonable(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [_to_jsonable(item) for item in data]
+    return data
+
+
+@dataclass(frozen=True)
+class CachedBody:
+    """预先序列化的响应体"""
+    body: bytes
+    etag: str
+    last_modified: float
+    media_type: str = "application/json"
+
+    @classmethod
+    def from_data(cls, data: Any, last_modified: float) -> "CachedBody":
+        """
+        序列化数据（支持 pydantic 模型及其组成的 dict / list）
+
+        Args:
+            data: 响应数据
+            last_modified: 数据源的修改时间（Unix 时间戳）
+        """
+        body = json.dumps(_to_jsonable(data), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        return cls(body=body, etag=etag, last_modified=last_modified)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # 比较时忽略弱校验前缀（If-None-Match 使用弱比较）
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag.removeprefix("W/") in candidates
+
+
+def is_not_modified(request: Request, etag: Optional[str], last_modified: Optional[float]) -> bool:
+    """
+    条件请求是否命中（资源未修改）
+
+    Args:
+        request: 请求
+        etag: 当前 ETag
+        last_modified: 当前修改时间（Unix 时间戳）
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return bool(etag) and _etag_matches(if_none_match, etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP 日期精度为秒
+        return int(last_modified) <= since
+    return False
+
+
+def cache_headers(
+    etag: Optional[str] = None,
+    last_modified: Optional[float] = None,
+    cache_control: str = "no-cache",
+) -> Dict[str, str]:
+    """组装缓存相关响应头"""
+    headers = {"Cache-Control": cache_control}
+    if etag:
+        headers["ETag"] = etag
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    return headers
+
+
+def cached_response(request: Request, cached: CachedBody, cache_control: str = "no-cache") -> Response:
+    """
+    返回预先序列化的响应（条件请求命中时返回 304）
+
+    Args:
+        request: 请求
+        cached: 预先序列化的响应体
+        cache_control: Cache-Control 响应头
+    """
+    headers = cache_headers(cached.etag, cached.last_modified, cache_control)
+    if is_not_modified(request, cached.etag, cached.last_modified):
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached.body, media_type=cached.media_type, headers=headers)
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """内容寻址的静态文件目录（文件名包含内容哈希，内容永不变化）"""
+
+    async def get_response(self, path: str, scope) -> Response:
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 206, 304):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
@@ -0,0 +1,370 @@
+"""
+图像数据载体
+在一次请求内统一传递图像，避免 bytes ↔ base64 的重复转换
+
+设计理念：
+- 原始字节为唯一数据源，base64 / data URI / 哈希 / PIL 视图均惰性计算且只计算一次
+- 由 base64 构造时保留原字符串，不会再编码一遍
+- 压缩结果（发送给 Claude Vision 的 JPEG）同样缓存在载体上
+- 上传文件可流式写入临时文件（from_stream），边写边算哈希，并以 draft 模式解码，
+  单次上传的内存占用与文件大小无关
+"""
+import base64
+import binascii
+import hashlib
+import io
+import shutil
+import tempfile
+from functools import cached_property
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, IO, Optional, Tuple, Union
+
+from PIL import Image
+
+# 最大图片大小 (4MB，留一些余量)
+MAX_IMAGE_SIZE = 4 * 1024 * 1024
+
+# 文件头魔数 → MIME 类型
+_MAGIC_MIME = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+
+_MIME_EXTENSION = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/bmp": ".bmp",
+}
+
+
+class PayloadTooLargeError(ValueError):
+    """上传内容超过大小限制"""
+
+    def __init__(self, max_bytes: int):
+        super().__init__(f"文件过大，最大允许 {max_bytes // (1024 * 1024)}MB")
+        self.max_bytes = max_bytes
+
+
+def sniff_mime_type(header: bytes) -> str:
+    """
+    根据文件头判断图片 MIME 类型
+
+    Args:
+        header: 文件开头的若干字节（至少 12 字节）
+
+    Returns:
+        MIME 类型，无法识别时返回 image/png（与旧的 data URI 默认值一致）
+    """
+    for magic, mime in _MAGIC_MIME:
+        if header.startswith(magic):
+            return mime
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+class ImagePayload:
+    """图像载体：持有原始字节，按需生成各种编码视图"""
+
+    def __init__(
+        self,
+        data: Optional[bytes] = None,
+        base64_str: Optional[str] = None,
+        mime_type: Optional[str] = None,
+    ):
+        """
+        Args:
+            data: 原始图像字节
+            base64_str: 纯 base64 字符串（与 data 二选一）
+            mime_type: 已知的 MIME 类型（不传则按文件头识别）
+        """
+        if data is None and base64_str is None:
+            raise ValueError("ImagePayload 需要 data 或 base64_str")
+        # 直接写入 cached_property 的缓存槽，已知的视图不再重新计算
+        if data is not None:
+            self.__dict__["data"] = data
+        if base64_str is not None:
+            self.__dict__["base64"] = base64_str
+        if mime_type:
+            self.__dict__["mime_type"] = mime_type
+        self._compressed: Dict[int, "ImagePayload"] = {}
+        # 文件存储模式（from_stream）下的临时文件与字节数
+        self._file: Optional[IO[bytes]] = None
+        self._file_size = 0
+
+    @classmethod
+    def _from_file(cls, file: IO[bytes], size: int, sha256: str) -> "ImagePayload":
+        payload = cls.__new__(cls)
+        payload._compressed = {}
+        payload._file = file
+        payload._file_size = size
+        payload.__dict__["sha256"] = sha256
+        return payload
+
+    @classmethod
+    async def from_stream(
+        cls,
+        read: Callable[[int], Awaitable[bytes]],
+        max_bytes: int,
+        spool_bytes: int = 1024 * 1024,
+        chunk_size: int = 256 * 1024,
+    ) -> "ImagePayload":
+        """
+        从异步流分块读取，写入溢出式临时文件并增量计算哈希
+
+        Args:
+            read: 异步读取函数（如 UploadFile.read）
+            max_bytes: 最大允许字节数，超出时抛出 PayloadTooLargeError
+            spool_bytes: 超过该大小后临时文件转存到磁盘
+            chunk_size: 每次读取的字节数
+
+        Returns:
+            以临时文件为存储的图像载体
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            while True:
+                chunk = await read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise PayloadTooLargeError(max_bytes)
+                hasher.update(chunk)
+                spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return cls._from_file(spool, size, hasher.hexdigest())
+
+    def _rewind(self) -> IO[bytes]:
+        self._file.seek(0)
+        return self._file
+
+    def _source(self) -> IO[bytes]:
+        """可供 PIL 读取的文件对象（不把临时文件整体读入内存）"""
+        if self._file is not None and "data" not in self.__dict__:
+            return self._rewind()
+        return io.BytesIO(self.data)
+
+    def close(self):
+        """释放临时文件（文件存储模式）"""
+        if self._file is not None:
+            self._file.close()
+
+    @classmethod
+    def from_base64(cls, value: str) -> "ImagePayload":
+        """
+        从 base64 或 data URI 构造
+
+        Args:
+            value: 纯 base64 字符串或 data:image/...;base64,... 形式
+        """
+        mime_type = None
+        if value.startswith("data:"):
+            header, value = value.split(",", 1)
+            mime_type = header[5:].split(";", 1)[0] or None
+        return cls(base64_str=value, mime_type=mime_type)
+
+    @classmethod
+    def coerce(cls, value: Union[str, bytes, "ImagePayload"]) -> "ImagePayload":
+        """把 base64 字符串 / 字节 / 载体统一转换为载体"""
+        if isinstance(value, ImagePayload):
+            return value
+        if isinstance(value, (bytes, bytearray)):
+            return cls(data=bytes(value))
+        return cls.from_base64(value)
+
+    @cached_property
+    def data(self) -> bytes:
+        """原始图像字节（文件存储模式下会整体读入内存，尽量使用 write_to / open_image）"""
+        if self._file is not None:
+            return self._rewind().read()
+        return base64.b64decode(self.base64)
+
+    @cached_property
+    def base64(self) -> str:
+        """纯 base64 编码"""
+        return base64.b64encode(self.data).decode("utf-8")
+
+    @cached_property
+    def mime_type(self) -> str:
+        """MIME 类型（按文件头识别）"""
+        if "data" in self.__dict__:
+            return sniff_mime_type(self.data[:16])
+        if self._file is not None:
+            return sniff_mime_type(self._rewind().read(16))
+        # 只解码 base64 开头的 24 个字符（18 字节），不触发整体解码
+        try:
+            header = base64.b64decode(self.base64[:24])
+        except (binascii.Error, ValueError):
+            header = b""
+        return sniff_mime_type(header)
+
+    @cached_property
+    def data_uri(self) -> str:
+        """data URI（用于 Seedream 等接受 URI 的接口）"""
+        return f"data:{self.mime_type};base64,{self.base64}"
+
+    @cached_property
+    def sha256(self) -> str:
+        """内容哈希（十六进制）"""
+        return hashlib.sha256(self.data).hexdigest()
+
+    @cached_property
+    def image(self) -> Image.Image:
+        """解码后的 PIL 图像"""
+        return self.open_image()
+
+    def open_image(self, draft_size: Optional[Tuple[int, int]] = None) -> Image.Image:
+        """
+        解码图像
+
+        Args:
+            draft_size: 目标尺寸；对 JPEG 使用 draft 模式在解码时按 2 的幂缩小，
+                        大图解码只占用缩小后的内存
+
+        Returns:
+            已加载的 PIL 图像
+        """
+        img = Image.open(self._source())
+        if draft_size:
+            img.draft("RGB", draft_size)
+        img.load()
+        return img
+
+    def write_to(self, path: Union[str, Path]):
+        """把原始字节写入文件（文件存储模式下流式复制）"""
+        with open(path, "wb") as f:
+            if self._file is not None and "data" not in self.__dict__:
+                shutil.copyfileobj(self._rewind(), f)
+            else:
+                f.write(self.data)
+
+    @property
+    def extension(self) -> str:
+        """与 MIME 类型对应的文件扩展名"""
+        return _MIME_EXTENSION.get(self.mime_type, ".png")
+
+    @property
+    def size(self) -> int:
+        """原始字节数"""
+        if self._file is not None:
+            return self._file_size
+        return len(self.data)
+
+    def compressed(self, max_size: int = MAX_IMAGE_SIZE) -> "ImagePayload":
+        """
+        压缩到指定大小以下并统一为 JPEG（结果按 max_size 缓存）
+
+        Args:
+            max_size: 最大字节数
+
+        Returns:
+            JPEG 格式的图像载体（失败时返回自身）
+        """
+        if max_size not in self._compressed:
+            self._compressed[max_size] = _compress_to_jpeg(self, max_size)
+        return self._compressed[max_size]
+
+
+def _compress_to_jpeg(payload: ImagePayload, max_size: int) -> ImagePayload:
+    """
+    压缩图片到指定大小以下，并统一转换为 JPEG 格式
+
+    Args:
+        payload: 原始图像
+        max_size: 最大字节数
+
+    Returns:
+        压缩后的 JPEG 图像载体
+    """
+    try:
+        print(f"[Image Compress] Original size: {payload.size} bytes")
+
+        # 已经是 RGB/灰度 JPEG 且大小满足要求，直接复用原始字节
+        if payload.mime_type == "image/jpeg" and payload.size <= max_size:
+            with Image.open(payload._source()) as probe:
+                if probe.mode in ("RGB", "L"):
+                    print(f"[Image Compress] ✓ Already JPEG, no conversion needed")
+                    return payload
+
+        # 以 draft 模式解码：JPEG 大图直接按 2 的幂缩小到不低于 2048px
+        img = payload.open_image(draft_size=(2048, 2048))
+        print(f"[Image Compress] Original format: {img.format}, mode: {img.mode}")
+
+        # 转换为 RGB（如果是 RGBA 或其他模式）
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+    except Exception as e:
+        print(f"[Image Compress Error] Failed to decode/open image: {e}")
+        # 如果解码或打开失败，返回原始数据
+        # 如果原始数据太大，可能会导致 API 调用失败，但至少不会崩溃
+        return payload
+
+    # 统一转换为 JPEG 格式，并根据需要压缩
+    # 首先尝试高质量转换
+    quality = 95
+    max_dimension = 2048
+
+    try:
+        # 第一次尝试：高质量 JPEG 转换
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=quality, optimize=True)
+        compressed_data = buffer.getvalue()
+
+        print(f"[Image Compress] Initial JPEG conversion: {len(compressed_data)} bytes (quality: {quality})")
+
+        # 如果已经满足大小要求，直接返回
+        if len(compressed_data) <= max_size:
+            print(f"[Image Compress] ✓ No compression needed, final size: {len(compressed_data)} bytes")
+            return ImagePayload(data=compressed_data, mime_type="image/jpeg")
+
+        # 需要进一步压缩
+        print(f"[Image Compress] Image too large ({len(compressed_data)} > {max_size}), compressing...")
+        quality = 85
+
+        while True:
+            # 调整尺寸
+            if max(img.size) > max_dimension:
+                ratio = max_dimension / max(img.size)
+                new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
+                resized_img = img.resize(new_size, Image.Resampling.LANCZOS)
+            else:
+                resized_img = img
+
+            # 压缩为 JPEG
+            buffer = io.BytesIO()
+            resized_img.save(buffer, format='JPEG', quality=quality, optimize=True)
+            compressed_data = buffer.getvalue()
+
+            print(f"[Image Compress] Quality: {quality}, Dimension: {max_dimension}, Size: {len(compressed_data)} bytes")
+
+            if len(compressed_data) <= max_size:
+                print(f"[Image Compress] ✓ Compression successful, final size: {len(compressed_data)} bytes")
+                return ImagePayload(data=compressed_data, mime_type="image/jpeg")
+
+            # 降低质量或尺寸
+            if quality > 30:
+                quality -= 15
+            elif max_dimension > 512:
+                max_dimension = int(max_dimension * 0.7)
+                quality = 85
+            else:
+                # 已经是最小了，强制返回
+                print(f"[Image Compress] ⚠ Minimum reached, size: {len(compressed_data)} bytes")
+                return ImagePayload(data=compressed_data, mime_type="image/jpeg")
+
+    except Exception as e:
+        print(f"[Image Compress Error] Failed during compression: {e}")
+        # 压缩失败，返回原始数据
+        return payload
@@ -0,0 +1,125 @@
+"""
+多关键词匹配（Aho–Corasick 自动机）
+一次扫描文本即可找出所有关键词的出现位置，耗时与关键词数量无关
+
+设计理念：
+- 加载预设时把所有关键词（中英文）编译成一个自动机，匹配时只扫描一遍文本
+- 匹配不区分大小写；纯英文 / 数字关键词默认要求完整单词（避免 "car" 命中 "carabiner"，允许复数后缀），
+  中文关键词按子串匹配；whole_words=False 时英文关键词也按子串匹配（如 "ring" 命中 "keyring"）
+- 每个关键词可映射到多个标签，并带权重；score() 汇总各标签的加权命中数
+
+核心方法：
+- KeywordAutomaton(): 编译关键词
+- find(): 返回所有命中（关键词、标签、权重）
+- score(): 返回各标签的加权得分
+"""
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+
+@dataclass(frozen=True)
+class KeywordHit:
+    """一次关键词命中"""
+    keyword: str
+    label: str
+    weight: float
+    end: int  # 命中结束位置（不含）
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isascii() and ch.isalnum()
+
+
+class KeywordAutomaton:
+    """Aho–Corasick 关键词自动机"""
+
+    def __init__(self, entries: Iterable[Tuple[str, str, float]], whole_words: bool = True):
+        """
+        Args:
+            entries: (关键词, 标签, 权重) 列表
+            whole_words: 英文关键词是否要求完整单词（False 时与中文一样按子串匹配）
+        """
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[str, str, float, bool]]] = [[]]
+        self.size = 0
+
+        for keyword, label, weight in entries:
+            keyword = keyword.strip().lower()
+            if not keyword:
+                continue
+            node = 0
+            for ch in keyword:
+                next_node = self._goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][ch] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                node = next_node
+            whole_word = whole_words and all(_is_word_char(ch) or ch in " -" for ch in keyword)
+            self._output[node].append((keyword, label, weight, whole_word))
+            self.size += 1
+
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                # 合并后缀节点的输出，匹配时无需沿失败链回溯
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    @staticmethod
+    def _is_whole_word(text: str, start: int, end: int) -> bool:
+        """命中是否为完整单词（允许英文复数后缀 s / es）"""
+        if start > 0 and _is_word_char(text[start - 1]):
+            return False
+        for suffix in ("", "s", "es"):
+            if text.startswith(suffix, end):
+                tail = end + len(suffix)
+                if tail >= len(text) or not _is_word_char(text[tail]):
+                    return True
+        return False
+
+    def find(self, text: str) -> List[KeywordHit]:
+        """
+        扫描文本，返回所有关键词命中
+
+        Args:
+            text: 待匹配文本
+        """
+        text = text.lower()
+        hits: List[KeywordHit] = []
+        node = 0
+        for index, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for keyword, label, weight, whole_word in self._output[node]:
+                end = index + 1
+                if whole_word and not self._is_whole_word(text, end - len(keyword), end):
+                    continue
+                hits.append(KeywordHit(keyword=keyword, label=label, weight=weight, end=end))
+        return hits
+
+    def score(self, text: str, factor: float = 1.0) -> Dict[str, float]:
+        """
+        各标签的加权得分
+
+        Args:
+            text: 待匹配文本
+            factor: 得分乘数（区分不同来源的文本，如用户输入 / 图像分析）
+        """
+        scores: Dict[str, float] = {}
+        for hit in self.find(text):
+            scores[hit.label] = scores.get(hit.label, 0.0) + hit.weight * factor
+        return scores
@@ -0,0 +1,124 @@
+"""
+延迟构造的服务单例
+模块级单例在导入时就会构造（读文件、建目录、编译预设），脚本和测试只用到其中一小部分却要全部付出启动成本
+
+设计理念：
+- LazyService 是单例的代理：导入时只记录构造函数，首次访问属性时才构造真正的实例，
+  之后所有属性读写都转发给该实例，使用方的写法（from services import gallery_service）不变
+- 构造过程加锁，多个线程同时首次访问时只构造一次
+- 应用启动时由生命周期显式预热（warm_up()），第一个请求不承担构造成本
+- 包的 __init__ 用 lazy_exports() 按需导入子模块：导入包本身不会导入任何服务模块
+
+核心方法：
+- LazyService(): 包装构造函数
+- warm_up(): 构造一组服务，返回各自的构造耗时
+- lazy_exports(): 包的导出名在首次访问时才导入对应子模块
+"""
+import importlib
+import sys
+import threading
+import time
+import types
+from typing import Any, Callable, Dict, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class LazyService(Generic[T]):
+    """首次访问时构造的单例代理"""
+
+    def __init__(self, factory: Callable[[], T], name: Optional[str] = None):
+        """
+        Args:
+            factory: 构造函数（通常是服务类本身）
+            name: 名称（日志与指标），默认取构造函数名
+        """
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_name", name or getattr(factory, "__name__", "service"))
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+        object.__setattr__(self, "_init_seconds", None)
+
+    def get(self) -> T:
+        """获取实例（不存在时构造）"""
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                instance = self._instance
+                if instance is None:
+                    started = time.perf_counter()
+                    instance = self._factory()
+                    object.__setattr__(self, "_init_seconds", time.perf_counter() - started)
+                    object.__setattr__(self, "_instance", instance)
+        return instance
+
+    @property
+    def initialized(self) -> bool:
+        """是否已构造"""
+        return self._instance is not None
+
+    def __getattr__(self, name: str) -> Any:
+        # 只有代理自身没有的属性才会走到这里
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        setattr(self.get(), name, value)
+
+    def __delattr__(self, name: str):
+        delattr(self.get(), name)
+
+    def __repr__(self) -> str:
+        state = repr(self._instance) if self._instance is not None else "未构造"
+        return f"<LazyService {self._name}: {state}>"
+
+
+def warm_up(*services: LazyService) -> Dict[str, float]:
+    """
+    构造一组服务（已构造的直接跳过）
+
+    Returns:
+        服务名 → 构造耗时（秒，已构造的记录首次构造耗时）
+    """
+    timings: Dict[str, float] = {}
+    for service in services:
+        service.get()
+        timings[service._name] = service._init_seconds or 0.0
+    return timings
+
+
+class _LazyExportsModule(types.ModuleType):
+    """按需导入子模块的包"""
+
+    def __setattr__(self, name: str, value: Any):
+        # 子模块导入后，导入系统会把子模块对象绑定为包的同名属性（如 services.gallery_service），
+        # 与导出的单例同名时会把单例遮住；这里跳过这类绑定，包属性始终是导出的对象
+        if isinstance(value, types.ModuleType) and name in self.__dict__.get("_lazy_exports", ()):
+            return
+        super().__setattr__(name, value)
+
+
+def lazy_exports(package: str, exports: Dict[str, str]):
+    """
+    让包的导出名在首次访问时才导入对应子模块（在包的 __init__ 中调用）
+
+    Args:
+        package: 包名（__name__）
+        exports: 导出名 → 子模块名
+    """
+    module = sys.modules[package]
+
+    def __getattr__(name: str) -> Any:
+        submodule = exports.get(name)
+        if submodule is None:
+            raise AttributeError(f"module {package!r} has no attribute {name!r}")
+        value = getattr(importlib.import_module(f".{submodule}", package), name)
+        # 缓存到包命名空间，之后的访问不再经过 __getattr__
+        module.__dict__[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(module.__dict__) | set(exports))
+
+    module.__dict__.update(_lazy_exports=exports, __getattr__=__getattr__, __dir__=__dir__)
+    module.__dict__["__all__"] = list(exports)
+    module.__class__ = _LazyExportsModule
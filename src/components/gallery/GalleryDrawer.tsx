@@ -27,6 +27,7 @@ export function GalleryDrawer({ isOpen, onClose, onSelect }: GalleryDrawerProps)
         const transformedProducts: ReferenceProduct[] = response.items.map(item => ({
           id: item.id,
           imageUrl: `/gallery/images/${item.filename}`,
+          thumbnailUrl: api.galleryImageUrl(item.id, { width: 320, format: 'webp' }),
           elements: [
             ...item.analysis.elements.primary.map(e => e.type),
             ...item.analysis.elements.secondary.map(e => e.type),
@@ -154,7 +155,7 @@ export function GalleryDrawer({ isOpen, onClose, onSelect }: GalleryDrawerProps)
                   className="group relative aspect-square rounded-xl overflow-hidden"
                 >
                   <img
-                    src={product.imageUrl}
+                    src={product.thumbnailUrl || product.imageUrl}
                     alt={product.style}
                     className="w-full h-full object-cover group-hover:scale-105 transition-transform duration-300"
                   />
@@ -11,6 +11,7 @@ function transformGalleryItem(item: any): ReferenceProduct {
   return {
     id: item.id,
     imageUrl: `/gallery/images/${item.filename}`,
+    thumbnailUrl: api.galleryImageUrl(item.id, { width: 320, format: 'webp' }),
     elements: [...primaryElements, ...secondaryElements],
     style: styleTags[0] || '未分类',
     salesTier: item.salesTier || 'B'
@@ -138,7 +139,7 @@ export function Gallery({ onSelect }: GalleryProps) {
               {/* 图片 */}
               <div className="aspect-square bg-gray-100">
                 <img
-                  src={product.imageUrl}
+                  src={product.thumbnailUrl || product.imageUrl}
                   alt={product.style}
                   className="w-full h-full object-cover"
                   loading="lazy"
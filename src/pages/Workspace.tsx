@@ -687,6 +687,19 @@ export function Workspace({ onNavigate, historyItem }: WorkspaceProps = {}) {
             v.id === newVersionId ? { ...v, analysis: result.analysis } : v
           ));
           console.log('[Generate] 使用后端返回的分析结果');
+        } else if (result.analysis_status === 'pending' && result.session_id && result.version_id) {
+          // 两阶段响应：图片已返回，分析结果在后台完成后再补充
+          console.log('[Generate] 生成图片分析进行中，等待后台结果');
+          api.waitForVersionAnalysis(result.session_id, result.version_id)
+            .then(version => {
+              if (!version?.analysis) return;
+              const analysis = version.analysis;
+              setImageAnalysis(analysis);
+              setVersions(prev => prev.map(v =>
+                v.id === newVersionId ? { ...v, analysis } : v
+              ));
+            })
+            .catch(e => console.error('[Generate] 获取后台分析结果失败:', e));
         } else {
           console.log('[Generate] 后端未返回分析结果');
         }
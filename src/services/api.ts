@@ -89,6 +89,7 @@ export interface GenerationResult {
 export interface DesignResponse {
   success: boolean;
   image_url?: string;
+  thumbnails?: Record<string, string>;  // WebP 缩略图（宽度 → URL）
   analysis?: ImageAnalysis;  // 使用新格式
   prompt_used?: string;
   message: string;
@@ -98,6 +99,40 @@ export interface DesignResponse {
     total: number;
     currency: string;
   };
+  session_id?: string;
+  timings?: Record<string, number>;
+  version_id?: string;
+  analysis_status?: AnalysisStatus;
+  variants?: DesignVariant[];
+}
+
+export type VariantStrategy = 'batch' | 'seeds';
+
+export interface DesignVariant {
+  version_id: string;
+  image_url: string;
+  thumbnails?: Record<string, string>;
+  rank?: number;
+  score?: number;
+  analysis?: ImageAnalysis;
+  cost_estimate?: DesignResponse['cost_estimate'];
+  analysis_status?: AnalysisStatus;
+}
+
+// 生成图片的分析状态（后台分析时先返回 pending）
+export type AnalysisStatus = 'pending' | 'completed' | 'failed' | 'skipped';
+
+// 会话版本记录
+export interface SessionVersion {
+  version_id?: string;
+  instruction: string;
+  prompt: string;
+  image_url: string;
+  thumbnails?: Record<string, string>;
+  created_at?: string;
+  analysis_status?: AnalysisStatus;
+  analysis?: ImageAnalysis | null;
+  cost_estimate?: DesignResponse['cost_estimate'] | null;
 }
 
 // 图库参考图
@@ -177,6 +212,8 @@ export async function generateDesign(params: {
   aspect_ratio?: AspectRatio;
   image_size?: ImageSize;
   style_hint?: StyleHint;
+  variants?: number;
+  variant_strategy?: VariantStrategy;
 }): Promise<DesignResponse> {
   return request('/generate', {
     method: 'POST',
@@ -187,6 +224,8 @@ export async function generateDesign(params: {
       aspect_ratio: params.aspect_ratio || '1:1',
       image_size: params.image_size || '2K',
       style_hint: params.style_hint,
+      variants: params.variants,
+      variant_strategy: params.variant_strategy,
     }),
   });
 }
@@ -252,15 +291,33 @@ export async function chat(params: {
  */
 export async function getSessionVersions(sessionId: string): Promise<{
   session_id: string;
-  versions: Array<{
-    instruction: string;
-    prompt: string;
-    image_url: string;
-  }>;
+  versions: SessionVersion[];
 }> {
   return request(`/session/${sessionId}/versions`);
 }
 
+/**
+ * 等待生成图片的后台分析完成
+ * 轮询会话版本历史，直到指定版本的分析状态不再是 pending
+ */
+export async function waitForVersionAnalysis(
+  sessionId: string,
+  versionId: string,
+  options: { intervalMs?: number; timeoutMs?: number } = {}
+): Promise<SessionVersion | null> {
+  const intervalMs = options.intervalMs ?? 2000;
+  const deadline = Date.now() + (options.timeoutMs ?? 60000);
+
+  while (Date.now() < deadline) {
+    const { versions } = await getSessionVersions(sessionId);
+    const version = versions.find(v => v.version_id === versionId);
+    if (!version) return null;
+    if (version.analysis_status !== 'pending') return version;
+    await new Promise(resolve => setTimeout(resolve, intervalMs));
+  }
+  return null;
+}
+
 /**
  * 将文件转换为base64
  */
@@ -303,13 +360,32 @@ export async function urlToBase64(url: string): Promise<string> {
   }
 }
 
+export type IngestStatus = 'pending' | 'analyzed' | 'embedded' | 'indexed' | 'failed';
+
+export interface IngestItem {
+  id: string;
+  batch_id: string | null;
+  filename: string | null;
+  status: IngestStatus;
+  sales_tier: string;
+  error: string | null;
+  created_at: string;
+  updated_at: string;
+  reference?: GalleryReference | null;
+}
+
 /**
- * 上传参考图到图库
+ * 上传参考图到图库（后台入库，通过 getIngestStatus 查询进度）
  */
 export async function uploadReference(params: {
   file: File;
   salesTier?: 'A' | 'B' | 'C';
-}): Promise<{ success: boolean; reference: GalleryReference }> {
+}): Promise<{
+  success: boolean;
+  status: IngestStatus;
+  ingest?: IngestItem;
+  reference?: GalleryReference;
+}> {
   const formData = new FormData();
   formData.append('image', params.file);
   if (params.salesTier) {
@@ -329,6 +405,19 @@ export async function uploadReference(params: {
   return response.json();
 }
 
+/**
+ * 查询参考图入库进度
+ */
+export async function getIngestStatus(ingestId: string): Promise<IngestItem> {
+  const response = await fetch(`${API_BASE_URL}/gallery/ingest/${ingestId}`);
+
+  if (!response.ok) {
+    throw new Error('查询入库进度失败');
+  }
+
+  return response.json();
+}
+
 /**
  * 列出图库参考图
  */
@@ -353,6 +442,20 @@ export async function getReference(refId: string): Promise<GalleryReference> {
   return request(`/gallery/references/${refId}`);
 }
 
+/**
+ * 图库图片 URL（指定宽度时返回按需生成的缩略图）
+ */
+export function galleryImageUrl(
+  imageId: string,
+  options?: { width?: number; format?: 'webp' | 'jpeg' | 'png' }
+): string {
+  const query = new URLSearchParams();
+  if (options?.width) query.set('w', String(options.width));
+  if (options?.format) query.set('fmt', options.format);
+  const suffix = query.toString() ? `?${query}` : '';
+  return `${API_BASE_URL}/gallery/images/${encodeURIComponent(imageId)}${suffix}`;
+}
+
 /**
  * 删除参考图
  */
@@ -469,7 +572,7 @@ export async function fetchExplorationSeeds(_intent: string): Promise<SeedItem[]
   // 将图库参考图转换为 SeedItem 格式
   return result.items.map((item, index) => ({
     id: item.id,
-    imageUrl: `/api/v1/gallery/images/${item.filename}`,
+    imageUrl: galleryImageUrl(item.id, { width: 320, format: 'webp' }),
     style: item.analysis?.style?.tags?.[0] || 'unknown',
     styleName: getStyleName(item.analysis?.style?.tags?.[0]),
     salesTier: item.salesTier,
@@ -559,12 +662,15 @@ export const api = {
   generateImage,
   chat,
   getSessionVersions,
+  waitForVersionAnalysis,
   fileToBase64,
   urlToBase64,
   // 图库管理
   uploadReference,
+  getIngestStatus,
   listReferences,
   getReference,
+  galleryImageUrl,
   deleteReference,
   findSimilar,
   // 预设系统
@@ -100,6 +100,7 @@ export interface CompatibilityCheck {
 export interface ReferenceProduct {
   id: string;
   imageUrl: string;
+  thumbnailUrl?: string;  // 网格展示用的缩略图（WebP）
   elements: string[];
   style: string;
   salesTier: 'A' | 'B' | 'C' | 'D';
@@ -16,6 +16,11 @@ export default defineConfig({
         target: 'http://localhost:8010',
         changeOrigin: true,
       },
+      // 生成图片（本地存储副本及缩略图）
+      '/generated': {
+        target: 'http://localhost:8010',
+        changeOrigin: true,
+      },
     },
   },
 });